@@ -1,6 +1,8 @@
 import streamlit as st
 import pandas as pd
-from backend import DeliveryProcessor, TruckRentalProcessor, TruckTransferManager, SEUIL_POIDS, SEUIL_VOLUME 
+import functools
+import time
+from backend import DeliveryProcessor, EXECUTEUR_TRAITEMENTS, TruckRentalProcessor, HorizonPlanner, TruckTransferManager, VoyageValidator, VoyageSpatialIndex, PlanExporter, ArtifactManager, version_donnees, generer_feuilles_route_zip, FleetScheduler, AttributionSolver, estimer_duree_voyages, filtrer_voyages, preparer_vues_analyse, HISTORIQUE_PLANNING, PlanStore, memoire_dataframes, FenetresHoraires, PERSISTANCE_SESSIONS, DUREE_SHIFT_MIN, SEUIL_POIDS, SEUIL_VOLUME, COLONNES_OBJETS_MANUELS
 import plotly.express as px
 
 
@@ -13,9 +15,8 @@ def show_df(df, **kwargs):
     kwargs sont transmis à st.dataframe.
     """
     if isinstance(df, pd.DataFrame):
-        df_to_display = df.copy()
-        df_to_display = df_to_display.round(3)
-        st.dataframe(df_to_display, **kwargs)
+        # round() retourne un nouveau DataFrame : pas de copie préalable
+        st.dataframe(df.round(3), **kwargs)
     else:
         st.dataframe(df, **kwargs)
 
@@ -77,6 +78,17 @@ CHAUFFEURS_DETAILS = {
     '18339': 'REKIK Ahmed', '07250': 'BARKIA Mustapha', '13321': 'BADRI Moez','99999': 'Chauffeur Camion'
 }
 
+# =====================================================
+# 📥 Exports Excel (générés en arrière-plan par ArtifactManager)
+# =====================================================
+def excel_une_feuille(df, sheet_name):
+    """Classeur Excel (bytes) d'une seule feuille, sans index."""
+    from io import BytesIO
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
 # Configuration page
 st.set_page_config(page_title="Planning Livraisons", layout="wide")
 
@@ -171,6 +183,367 @@ if 'data_processed' not in st.session_state:
     st.session_state.message = ""
     st.session_state.df_voyages = None
     st.session_state.df_livraisons = None
+    st.session_state.df_clients_gps = None
+    st.session_state.fenetres_horaires = None
+    st.session_state.df_tournees = None
+    st.session_state.dates_bl = None
+    st.session_state.vues_analyse = None
+    st.session_state.horizon_planner = None
+    st.session_state.validateur = None
+    st.session_state.plan_store = PlanStore()
+
+# Exports téléchargeables générés en arrière-plan, mis en cache par version des données
+if 'artefacts' not in st.session_state:
+    st.session_state.artefacts = ArtifactManager()
+
+# =====================================================
+# Sections interactives en fragments (reruns limités à la section)
+# =====================================================
+
+def section_fragment(fonction):
+    """
+    Rend une section dans un st.fragment : une interaction avec ses widgets ne ré-exécute
+    que cette section. La durée de sa dernière exécution est conservée dans
+    st.session_state.durees_sections (lue par mesure_reruns.py).
+    """
+    @st.fragment
+    @functools.wraps(fonction)
+    def section():
+        debut = time.perf_counter()
+        try:
+            fonction()
+        finally:
+            st.session_state.setdefault("durees_sections", {})[fonction.__name__] = time.perf_counter() - debut
+        # Un rerun limité au fragment ne passe pas par la fin du script : point de reprise ici
+        sauvegarder_session()
+    return section
+
+def entree_section(nom, construire, *donnees):
+    """
+    Entrée calculée d'une section, conservée en session et reconstruite seulement
+    quand ses données (DataFrames ou paramètres) changent.
+    """
+    entrees = st.session_state.setdefault("entrees_sections", {})
+    version = version_donnees(*donnees)
+    if nom not in entrees or entrees[nom][0] != version:
+        entrees[nom] = (version, construire(*donnees))
+    return entrees[nom][1]
+
+def signaler_plan_modifie():
+    """Une section a modifié le planning : les sections suivantes doivent être recalculées."""
+    st.session_state.plan_modifie = True
+
+def enregistrer_plan(df_voyages, operation, contexte=None, vehicules_modifies=None):
+    """
+    Nouvelle version du plan dans le magasin (delta des lignes modifiées) ;
+    la session garde une vue en lecture seule du plan courant.
+    Le registre des objets manuels est joint à chaque version pour être restauré avec elle.
+    `vehicules_modifies` : clés (Zone, Véhicule N°) touchées, transmises à la validation incrémentale.
+    """
+    magasin = st.session_state.setdefault("plan_store", PlanStore())
+    signaler_vehicules_modifies(vehicules_modifies)
+    transfer_manager = st.session_state.get("transfer_manager")
+    if transfer_manager is not None:
+        contexte = {**(contexte or {}), "objets_manuels": transfer_manager.objets_manuels.copy()}
+    magasin.enregistrer(df_voyages, operation, contexte)
+    st.session_state.df_voyages = magasin.vue()
+    sauvegarder_session()
+    return st.session_state.df_voyages
+
+def signaler_vehicules_modifies(vehicules):
+    """
+    Cumule les véhicules modifiés depuis la dernière validation ; None (inconnus) force
+    la détection par empreinte de ligne à la prochaine validation.
+    """
+    modifies = st.session_state.get("vehicules_modifies")
+    st.session_state.vehicules_modifies = (
+        None if modifies is None or vehicules is None
+        else modifies | {(str(zone), str(vehicule)) for zone, vehicule in vehicules}
+    )
+
+def restaurer_plan(version):
+    """
+    Restaure une version du plan (annuler / rétablir / aller à une version) et la propage
+    aux gestionnaires de transfert, de validation et aux décisions de location de cette version.
+    """
+    magasin = st.session_state.plan_store
+    debut = time.perf_counter()
+    if not magasin.aller_a(version):
+        return
+    signaler_vehicules_modifies(None)
+    st.session_state.df_voyages = magasin.vue()
+    if "transfer_manager" in st.session_state:
+        st.session_state.transfer_manager.df_voyages = magasin.vue()
+    if st.session_state.get("validateur") is not None:
+        st.session_state.validateur.mettre_a_jour(magasin.vue())
+    if "transfer_manager" in st.session_state:
+        contexte_objets = magasin.contexte(cle="objets_manuels")
+        st.session_state.transfer_manager.objets_manuels = (
+            contexte_objets["objets_manuels"].copy() if contexte_objets is not None
+            else pd.DataFrame(columns=COLONNES_OBJETS_MANUELS)
+        )
+    etat_location = magasin.contexte(cle="df_base")
+    if etat_location is not None and st.session_state.rental_processor:
+        st.session_state.rental_processor.restaurer_etat(etat_location)
+        st.session_state.base_location = st.session_state.rental_processor.df_base
+        update_propositions_view()
+    operation = magasin.journal[version - 1]["operation"]
+    st.session_state.message = (f"♻️ Plan restauré à la version {version} ({operation}) "
+                                f"en {(time.perf_counter() - debut) * 1000:.0f} ms.")
+
+def annuler_modification_plan():
+    restaurer_plan(st.session_state.plan_store.version - 1)
+
+def retablir_modification_plan():
+    restaurer_plan(st.session_state.plan_store.version + 1)
+
+def aller_a_version_plan():
+    restaurer_plan(st.session_state.version_plan_cible)
+
+# Tables de la session sauvegardées sur disque (Parquet) pour une reprise après un redémarrage
+TABLES_SESSION = ["df_grouped", "df_city", "df_grouped_zone", "df_zone", "df_optimized_estafettes",
+                  "df_livraisons_original", "df_livraisons", "df_clients_gps", "df_tournees", "dates_bl",
+                  "df_voyages_valides"]
+
+def sauvegarder_session():
+    """
+    Point de reprise de la session en cours : seules les tables modifiées et les nouvelles
+    versions du plan sont écrites, le reste de l'état (validations, attributions) en JSON.
+    """
+    id_session = st.session_state.get("id_session")
+    if id_session is None:
+        return
+    tables = {nom: st.session_state.get(nom) for nom in TABLES_SESSION}
+    transfer_manager = st.session_state.get("transfer_manager")
+    tables["objets_manuels"] = transfer_manager.objets_manuels if transfer_manager is not None else None
+    fenetres_horaires = st.session_state.get("fenetres_horaires")
+    if fenetres_horaires is not None and "fenetres_horaires" not in st.session_state.get("tables_fixes", {}):
+        # Table des fenêtres construite une seule fois (l'objet ne change pas pendant la session)
+        st.session_state.setdefault("tables_fixes", {})["fenetres_horaires"] = fenetres_horaires.vers_table()
+    tables["fenetres_horaires"] = st.session_state.get("tables_fixes", {}).get("fenetres_horaires")
+    etat = {
+        "validations": {str(idx): statut for idx, statut in st.session_state.get("validations", {}).items()},
+        "attributions": {str(idx): choix for idx, choix in st.session_state.get("attributions", {}).items()},
+        "selected_client": st.session_state.get("selected_client"),
+    }
+    ok, msg, _ = PERSISTANCE_SESSIONS.sauvegarder(id_session, tables, st.session_state.get("plan_store"), etat,
+                                                  st.session_state.get("libelle_session"))
+    if not ok:
+        st.session_state.message = msg
+
+def reprendre_session(id_session):
+    """Recharge une session enregistrée : tables, historique du plan, location, transferts et choix saisis."""
+    debut = time.perf_counter()
+    ok, msg, donnees = PERSISTANCE_SESSIONS.charger(id_session)
+    if not ok:
+        st.session_state.message = msg
+        return
+    tables = donnees["tables"]
+    for nom in TABLES_SESSION:
+        st.session_state[nom] = tables.get(nom)
+    if st.session_state.df_voyages_valides is None:
+        del st.session_state.df_voyages_valides  # les sections 8 et suivantes testent sa présence
+    table_fenetres = tables.get("fenetres_horaires")
+    st.session_state.fenetres_horaires = (FenetresHoraires(table_fenetres, tables.get("df_clients_gps"))
+                                          if table_fenetres is not None else None)
+    st.session_state.tables_fixes = {"fenetres_horaires": table_fenetres}
+    st.session_state.vues_analyse = None  # recalculées par la section 2
+    st.session_state.plan_store = donnees["magasin"] or PlanStore()
+    magasin = st.session_state.plan_store
+    st.session_state.df_voyages = magasin.vue() if magasin.journal else None
+
+    # Décisions de location de la version courante du plan
+    st.session_state.rental_processor = TruckRentalProcessor(
+        st.session_state.df_optimized_estafettes, st.session_state.df_livraisons_original,
+        st.session_state.fenetres_horaires
+    )
+    etat_location = magasin.contexte(cle="df_base")
+    if etat_location is not None:
+        st.session_state.rental_processor.restaurer_etat(etat_location)
+    st.session_state.base_location = st.session_state.rental_processor.df_base
+
+    # Gestionnaires de validation et de transfert sur le plan repris
+    st.session_state.pop("transfer_manager", None)
+    st.session_state.pop("vehicules_modifies", None)
+    st.session_state.validateur = None
+    if st.session_state.df_voyages is not None:
+        st.session_state.validateur = VoyageValidator(st.session_state.df_voyages)
+        st.session_state.transfer_manager = TruckTransferManager(
+            st.session_state.df_voyages, st.session_state.df_livraisons, validateur=st.session_state.validateur
+        )
+        if tables.get("objets_manuels") is not None:
+            st.session_state.transfer_manager.objets_manuels = tables["objets_manuels"]
+
+    etat = donnees["etat"]
+    st.session_state.validations = {int(idx): statut for idx, statut in etat.get("validations", {}).items()}
+    st.session_state.attributions = {int(idx): choix for idx, choix in etat.get("attributions", {}).items()}
+    st.session_state.selected_client = etat.get("selected_client")
+    st.session_state.data_processed = True
+    st.session_state.id_session = id_session
+    st.session_state.libelle_session = donnees["libelle"]
+    update_propositions_view()
+    st.session_state.message = f"{msg} en {(time.perf_counter() - debut) * 1000:.0f} ms."
+
+def reprendre_session_choisie():
+    reprendre_session(st.session_state.session_a_reprendre)
+
+# =====================================================
+# Traitements longs en arrière-plan (la session reste réactive pendant le calcul)
+# =====================================================
+INTERVALLE_SUIVI_JOB_S = 0.5
+
+def lancer_job(cle, libelle, fonction, *args, **kwargs):
+    """Soumet un traitement long au pool partagé ; son avancement est suivi par suivre_job(cle, ...)."""
+    st.session_state.pop(f"issue_{cle}", None)
+    st.session_state[cle] = EXECUTEUR_TRAITEMENTS.soumettre(libelle, fonction, *args, **kwargs)
+
+@st.fragment(run_every=INTERVALLE_SUIVI_JOB_S)
+def avancement_job(cle, appliquer):
+    """
+    Rafraîchi toutes les INTERVALLE_SUIVI_JOB_S secondes tant que le job tourne ; à la fin, le résultat
+    est transmis à appliquer() (état de session) et toute l'application est relancée.
+    """
+    job = st.session_state.get(cle)
+    if job is None:
+        return
+    if not job.termine:
+        col_progression, col_annuler = st.columns([5, 1])
+        with col_progression:
+            st.progress(job.avancement, text=f"⏳ {job.libelle} : {job.etape} ({job.duree:.0f} s)")
+        with col_annuler:
+            st.button("⏹️ Annuler", key=f"annuler_{cle}", on_click=job.annuler,
+                      disabled=job.annulation_demandee, use_container_width=True)
+        return
+
+    del st.session_state[cle]
+    if job.statut == "terminé":
+        try:
+            appliquer(job.resultat)
+            print(f"✅ {job.libelle} : terminé en {job.duree:.1f} s")
+        except Exception as e:
+            st.session_state[f"issue_{cle}"] = f"❌ Erreur lors du traitement : {str(e)}"
+    elif job.statut == "annulé":
+        st.session_state[f"issue_{cle}"] = f"⚠️ {job.libelle} : annulé après {job.duree:.1f} s."
+    else:
+        st.session_state[f"issue_{cle}"] = f"❌ Erreur lors du traitement : {job.erreur}"
+    st.rerun(scope="app")
+
+def suivre_job(cle, appliquer):
+    """Avancement du job de la session (fragment rafraîchi seulement pendant le calcul) ou issue du dernier job."""
+    if st.session_state.get(cle) is not None:
+        avancement_job(cle, appliquer)
+    elif st.session_state.get(f"issue_{cle}"):
+        issue = st.session_state[f"issue_{cle}"]
+        (st.warning if issue.startswith("⚠️") else st.error)(issue)
+
+def executer_traitement(fichiers, libelle_session, progression=None):
+    """Traitement complet exécuté dans un worker : (processeur, 6 DataFrames, libellé de la session)."""
+    processor = DeliveryProcessor()
+    resultats = processor.traiter_avec_cache(*fichiers, progression=progression)
+    return processor, resultats, libelle_session
+
+def appliquer_traitement(resultat):
+    """Résultats du traitement complet poussés dans l'état de session (nouveau plan, nouvelle session persistée)."""
+    processor, resultats, libelle_session = resultat
+    df_grouped, df_city, df_grouped_zone, df_zone, df_optimized_estafettes, df_livraisons_original = resultats
+
+    # Stockage des résultats dans l'état de session
+    st.session_state.df_optimized_estafettes = df_optimized_estafettes
+    st.session_state.df_grouped = df_grouped
+    st.session_state.df_city = df_city
+    st.session_state.df_grouped_zone = df_grouped_zone
+    st.session_state.df_zone = df_zone 
+    st.session_state.df_livraisons_original = df_livraisons_original
+    st.session_state.df_livraisons = df_grouped_zone  # Pour la section transfert
+    st.session_state.df_clients_gps = processor.df_clients_gps  # Pour les suggestions de transfert
+    st.session_state.fenetres_horaires = processor.fenetres_horaires
+    st.session_state.df_tournees = processor.df_tournees
+    st.session_state.dates_bl = processor.dates_bl
+    st.session_state.vues_analyse = processor.vues_analyse  # Tableaux et graphiques de la section 2
+    st.session_state.plan_store = PlanStore()  # Nouvel historique de versions du plan
+    # Nouvelle session persistée (reprise possible après un redémarrage)
+    st.session_state.id_session = PERSISTANCE_SESSIONS.nouvel_identifiant()
+    st.session_state.libelle_session = libelle_session
+    st.session_state.tables_fixes = {}
+
+    # Initialisation avec les données originales
+    st.session_state.rental_processor = TruckRentalProcessor(
+        df_optimized_estafettes, df_livraisons_original, processor.fenetres_horaires
+    )
+    update_propositions_view()
+
+    st.session_state.data_processed = True
+    #st.session_state.message = "Traitement terminé avec succès ! Les résultats s'affichent ci-dessous."
+    if processor.depuis_cache:
+        st.session_state.message = "♻️ Fichiers déjà traités : résultats repris du cache."
+    # Fenêtres horaires à l'heure illisible : clients traités sans fenêtre
+    if processor.fenetres_horaires is not None and processor.fenetres_horaires.lignes_ignorees:
+        lignes = processor.fenetres_horaires.lignes_ignorees
+        st.session_state.message = (f"⚠️ {len(lignes)} fenêtre(s) horaire(s) ignorée(s), heure illisible "
+                                    f"(client sans fenêtre) : {'; '.join(lignes[:10])}"
+                                    + (" ..." if len(lignes) > 10 else ""))
+
+def appliquer_horizon(resultat):
+    st.session_state.horizon_resultat = resultat
+
+def relancer_si_plan_modifie():
+    """Relance toute l'application si une action de la section a modifié le planning."""
+    if st.session_state.pop("plan_modifie", False):
+        st.rerun(scope="app")
+
+TAILLES_PAGE = [10, 25, 50, 100]
+
+def vue_paginee(df, cle, taille_defaut=25):
+    """
+    Filtres (zones, véhicule) et pagination d'une liste de voyages : seule la page courante
+    est rendue, le coût d'affichage est borné par la taille de page.
+    """
+    col_zone, col_vehicule, col_taille, col_page = st.columns([2, 2, 1, 1])
+    with col_zone:
+        zones_disponibles = sorted(df["Zone"].dropna().unique().tolist()) if "Zone" in df.columns else []
+        zones = st.multiselect("🌍 Zones", zones_disponibles, key=f"{cle}_zones")
+    with col_vehicule:
+        recherche = st.text_input("🔎 Véhicule", key=f"{cle}_recherche",
+                                  placeholder="N° de voyage ou véhicule attribué")
+    with col_taille:
+        taille_page = st.selectbox("Par page", TAILLES_PAGE, index=TAILLES_PAGE.index(taille_defaut),
+                                   key=f"{cle}_taille")
+
+    return page_courante(filtrer_voyages(df, zones, recherche), cle, taille_page, col_page, "Voyages")
+
+def page_courante(df, cle, taille_page, conteneur_page, libelle):
+    """Page demandée dans conteneur_page (bornée au nombre de pages) et légende de la position."""
+    nb_pages = max(1, -(-len(df) // taille_page))
+    cle_page = f"{cle}_page"
+    if st.session_state.get(cle_page, 1) > nb_pages:
+        st.session_state[cle_page] = nb_pages
+    with conteneur_page:
+        page = st.number_input("Page", min_value=1, max_value=nb_pages, step=1, key=cle_page)
+
+    debut = (page - 1) * taille_page
+    df_page = df.iloc[debut:debut + taille_page]
+    st.caption(f"{libelle} {debut + 1 if len(df_page) else 0}–{debut + len(df_page)} sur {len(df)} "
+               f"(page {page}/{nb_pages})")
+    return df_page
+
+def tableau_html_pagine(df, cle, libelle, taille_defaut=25):
+    """
+    Tableau HTML (classe custom-table) dont seule la page courante est convertie et envoyée
+    au navigateur ; les petits tableaux sont affichés en entier, sans pagination.
+    """
+    if len(df) > TAILLES_PAGE[0]:
+        col_taille, col_page, _ = st.columns([1, 1, 4])
+        with col_taille:
+            taille_page = st.selectbox("Par page", TAILLES_PAGE, index=TAILLES_PAGE.index(taille_defaut),
+                                       key=f"{cle}_taille")
+        df = page_courante(df, cle, taille_page, col_page, libelle)
+
+    html_table = df.to_html(escape=False, index=False, classes="custom-table", border=0)
+    st.markdown(f"""
+    <div class="table-container">
+        {html_table}
+    </div>
+    """, unsafe_allow_html=True)
 
 # =====================================================
 # Fonctions de Callback pour la Location
@@ -204,6 +577,8 @@ def handle_location_action(accepter):
             )
             st.session_state.message = msg
             update_propositions_view()
+            # La section 4 et les suivantes dépendent des locations décidées
+            signaler_plan_modifie()
         except Exception as e:
             st.session_state.message = f"❌ Erreur lors du traitement : {str(e)}"
     elif not st.session_state.selected_client:
@@ -231,36 +606,43 @@ with col_file_3:
     wcliegps_file = st.file_uploader("Fichier Clients/Zones", type=["xlsx"])
 with col_button:
     st.markdown("<br>", unsafe_allow_html=True)
-    if st.button("Exécuter le traitement complet", type="primary"):
+    fenetres_file = st.file_uploader("Fenêtres horaires clients (optionnel)", type=["xlsx"],
+                                     help="Colonnes : Client, Heure début, Heure fin, Temps de service (min)")
+    if st.button("Exécuter le traitement complet", type="primary",
+                 disabled=st.session_state.get("job_traitement") is not None):
         if liv_file and ydlogist_file and wcliegps_file:
-            processor = DeliveryProcessor()
-            try:
-                with st.spinner("Traitement des données en cours..."):
-                    # Récupération des 6 valeurs
-                    df_grouped, df_city, df_grouped_zone, df_zone, df_optimized_estafettes, df_livraisons_original = processor.process_delivery_data(liv_file, ydlogist_file, wcliegps_file)
-                
-                # Stockage des résultats dans l'état de session
-                st.session_state.df_optimized_estafettes = df_optimized_estafettes
-                st.session_state.df_grouped = df_grouped
-                st.session_state.df_city = df_city
-                st.session_state.df_grouped_zone = df_grouped_zone
-                st.session_state.df_zone = df_zone 
-                st.session_state.df_livraisons_original = df_livraisons_original
-                st.session_state.df_livraisons = df_grouped_zone  # Pour la section transfert
-                
-                # Initialisation avec les données originales
-                st.session_state.rental_processor = TruckRentalProcessor(df_optimized_estafettes, df_livraisons_original)
-                update_propositions_view()
-                
-                st.session_state.data_processed = True
-                #st.session_state.message = "Traitement terminé avec succès ! Les résultats s'affichent ci-dessous."
-                st.rerun()
-
-            except Exception as e:
-                st.error(f"❌ Erreur lors du traitement : {str(e)}")
-                st.session_state.data_processed = False
+            from io import BytesIO
+            # Copie du contenu des fichiers : le worker les lit pendant que la session continue
+            fichiers = tuple(BytesIO(f.getvalue()) if f is not None else None
+                             for f in (liv_file, ydlogist_file, wcliegps_file, fenetres_file))
+            lancer_job("job_traitement", "Traitement complet", executer_traitement, fichiers,
+                       f"{liv_file.name} — {time.strftime('%d/%m/%Y %H:%M')}")
         else:
             st.warning("Veuillez uploader tous les fichiers nécessaires.")
+
+# Avancement du traitement complet (étapes du pipeline), résultats appliqués à la fin
+suivre_job("job_traitement", appliquer_traitement)
+
+# Sessions enregistrées : listées seulement quand le panneau est ouvert
+panneau_sessions = st.expander("🗂️ Reprendre une session enregistrée", key="panneau_sessions",
+                               on_change="rerun")
+if panneau_sessions.open:
+    with panneau_sessions:
+        df_sessions = PERSISTANCE_SESSIONS.sessions_recentes()
+        if df_sessions.empty:
+            st.info("Aucune session enregistrée pour le moment.")
+        else:
+            show_df(df_sessions, use_container_width=True, hide_index=True)
+            libelles = dict(zip(df_sessions["Session"], df_sessions["Libellé"]))
+            col_session, col_reprendre = st.columns([4, 1])
+            with col_session:
+                st.selectbox("Session", list(libelles), format_func=lambda s: f"{libelles[s]} ({s})",
+                             key="session_a_reprendre")
+            with col_reprendre:
+                st.markdown("<br>", unsafe_allow_html=True)
+                st.button("▶️ Reprendre", on_click=reprendre_session_choisie, use_container_width=True,
+                          disabled=st.session_state.session_a_reprendre == st.session_state.get("id_session"),
+                          key="reprendre_session")
 st.markdown("---")
 
 # =====================================================
@@ -275,6 +657,8 @@ if st.session_state.data_processed:
         st.error(st.session_state.message)
     elif st.session_state.message.startswith("⚠️"):
         st.warning(st.session_state.message)
+    elif st.session_state.message.startswith("♻️"):
+        st.info(st.session_state.message)
     #else:
         #st.info(st.session_state.message or "Prêt à traiter les propositions de location.")
     
@@ -286,14 +670,6 @@ if st.session_state.data_processed:
 # =====================================================
 st.header("2. 🔍 Analyse de Livraison Détaillée")
 
-tab_grouped, tab_city, tab_zone_group, tab_zone_summary, tab_charts = st.tabs([
-    "Livraisons Client/Ville", 
-    "Besoin Estafette par Ville", 
-    "Livraisons Client/Zone", 
-    "Besoin Estafette par Zone",
-    "Graphiques"
-])
-
 # --- CSS PERSONNALISÉ POUR LES ONGLETS ---
 st.markdown("""
 <style>
@@ -308,601 +684,302 @@ st.markdown("""
         background-color: #F0F2F6;
         border-radius: 8px 8px 0px 0px;
         gap: 8px;
-        padding: 10px 16px;
-        font-weight: 600;
-    }
-    
-    .stTabs [data-baseweb="tab"]:hover {
-        background-color: #E6F3FF;
-        color: #0369A1;
-    }
-    
-    /* ONGLET ACTIF - BLEU ROYAL */
-    .stTabs [aria-selected="true"] {
-        background-color: #0369A1 !important;
-        color: white !important;
-    }
-    
-    /* TEXTE DES ONGLETS */
-    .stTabs [data-baseweb="tab"] p {
-        font-size: 16px;
-        font-weight: 600;
-        margin: 0;
-    }
-    
-    /* COULEUR DU TEXTE POUR ONGLET ACTIF */
-    .stTabs [aria-selected="true"] p {
-        color: white !important;
-    }
-</style>
-""", unsafe_allow_html=True)
-
-
-# --- Onglet Livraisons Client/Ville ---
-with tab_grouped:
-    st.subheader("Livraisons par Client & Ville")
-    
-    # Créer une copie du DataFrame et FILTRER TRIPOLI
-    df_liv = st.session_state.df_grouped.drop(columns=["Zone"], errors='ignore').copy()
-    df_liv = df_liv[df_liv["Ville"] != "TRIPOLI"]  # ← FILTRE TRIPOLI ICI
-    
-    # CSS pour un tableau organisé et professionnel
-    st.markdown("""
-    <style>
-    /* Style général du tableau */
-    .custom-table {
-        width: 100%;
-        border-collapse: collapse;
-        font-family: Arial, sans-serif;
-        font-size: 14px;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-        border-radius: 8px;
-        overflow: hidden;
-    }
-    
-    /* En-têtes du tableau - BLEU ROYAL SANS DÉGRADÉ */
-    .custom-table th {
-        background-color: #0369A1;
-        color: white;
-        padding: 12px 8px;
-        text-align: center;
-        border: 2px solid #4682B4;
-        font-weight: normal;  /* CHANGÉ : bold → normal */
-        font-size: 13px;
-        vertical-align: middle;
-    }
-    
-    /* Cellules du tableau - TOUTES EN BLANC */
-    .custom-table td {
-        padding: 10px 8px;
-        text-align: center;
-        border: 1px solid #B0C4DE;
-        background-color: white;
-        color: #000000;
-        vertical-align: middle;
-        font-weight: normal;  /* AJOUT : poids normal */
-    }
-    
-    /* Bordures visibles pour toutes les cellules */
-    .custom-table th, 
-    .custom-table td {
-        border: 1px solid #B0C4DE !important;
-    }
-    
-    /* Bordures épaisses pour l'extérieur du tableau */
-    .custom-table {
-        border: 2px solid #4682B4 !important;
-    }
-    
-    /* Style spécifique pour la colonne Article - CENTRÉ */
-    .custom-table td:nth-child(5) {
-        text-align: center;
-        max-width: 200px;
-        word-wrap: break-word;
-        white-space: normal;
-        vertical-align: middle;
-    }
-    
-    /* Style pour les cellules de poids et volume - NOIR SANS GRAS */
-    .custom-table td:nth-child(6),
-    .custom-table td:nth-child(7) {
-        font-weight: normal;  /* CHANGÉ : 600 → normal */
-        color: #000000 !important;
-        vertical-align: middle;
-    }
-    
-    /* Conteneur du tableau avec défilement horizontal */
-    .table-container {
-        overflow-x: auto;
-        margin: 1rem 0;
-        border-radius: 8px;
-        border: 2px solid #4682B4;
-    }
-    
-    /* Supprimer l'alternance des couleurs - TOUTES LES LIGNES BLANCHES */
-    .custom-table tr:nth-child(even) td {
-        background-color: white !important;
-    }
-    
-    /* Survol des lignes - léger effet */
-    .custom-table tr:hover td {
-        background-color: #F0F8FF !important;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # Vérifier si le DataFrame n'est pas vide après filtrage
-    if df_liv.empty:
-        st.info("ℹ️ Aucune livraison à afficher (TRIPOLI exclue)")
-    else:
-        # Préparer les données pour l'affichage HTML
-        if "Article" in df_liv.columns:
-            # Transformer les articles avec retours à la ligne HTML - SANS "•"
-            df_liv["Article"] = df_liv["Article"].astype(str).apply(
-                lambda x: "<br>".join(a.strip() for a in x.split(",") if a.strip())
-            )
-        
-        # Formater les nombres - 3 chiffres après la virgule
-        if "Poids total" in df_liv.columns:
-            df_liv["Poids total"] = df_liv["Poids total"].map(lambda x: f"{x:.3f} kg" if pd.notna(x) else "")
-        if "Volume total" in df_liv.columns:
-            df_liv["Volume total"] = df_liv["Volume total"].map(lambda x: f"{x:.3f} m³" if pd.notna(x) else "")
-        
-        # Afficher le tableau avec le style CSS
-        html_table = df_liv.to_html(
-            escape=False, 
-            index=False, 
-            classes="custom-table",
-            border=0
-        )
-        
-        st.markdown(f"""
-        <div class="table-container">
-            {html_table}
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # Métriques résumées - CORRECTION : Utiliser les données filtrées
-    st.markdown("---")
-    col1, col2, col3, col4 = st.columns(4)
-    
-    with col1:
-        total_livraisons = len(df_liv)
-        st.metric("📦 Total Livraisons", total_livraisons)
-    
-    with col2:
-        total_clients = df_liv["Client"].nunique()
-        st.metric("👥 Clients Uniques", total_clients)
-    
-    with col3:
-        # CORRECTION : Calculer le poids total à partir des données filtrées (données originales)
-        df_liv_original = st.session_state.df_grouped[st.session_state.df_grouped["Ville"] != "TRIPOLI"]
-        total_poids = df_liv_original["Poids total"].sum()
-        st.metric("⚖️ Poids Total", f"{total_poids:.3f} kg")
-    
-    with col4:
-        # CORRECTION : Calculer le volume total à partir des données filtrées (données originales)
-        total_volume = df_liv_original["Volume total"].sum()
-        st.metric("📏 Volume Total", f"{total_volume:.3f} m³")
-    
-    # AJOUT DE L'IMPORT MANQUANT POUR BytesIO
-    from io import BytesIO
-    
-    # Bouton de téléchargement (garder les données originales pour l'export)
-    excel_buffer_grouped = BytesIO()
-    with pd.ExcelWriter(excel_buffer_grouped, engine='openpyxl') as writer:
-        st.session_state.df_grouped.drop(columns=["Zone"], errors='ignore').to_excel(writer, index=False, sheet_name="Livraisons Client Ville")
-    excel_buffer_grouped.seek(0)
-    
-    st.download_button(
-        label="💾 Télécharger Livraisons Client/Ville",
-        data=excel_buffer_grouped,
-        file_name="Livraisons_Client_Ville.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-    
-    # Stockage pour la section 5
-    if "df_livraisons" not in st.session_state:
-        st.session_state.df_livraisons = df_liv.copy()
-
-# --- Onglet Besoin Estafette par Ville ---
-with tab_city:
-    st.subheader("Besoin Estafette par Ville")
-    
-    # Créer une copie du DataFrame et FILTRER TRIPOLI
-    df_city_display = st.session_state.df_city.copy()
-    df_city_display = df_city_display[df_city_display["Ville"] != "TRIPOLI"]  # ← FILTRE TRIPOLI ICI
-    
-    # Formater les nombres - 3 chiffres après la virgule
-    if "Poids total" in df_city_display.columns:
-        df_city_display["Poids total"] = df_city_display["Poids total"].map(lambda x: f"{x:.3f} kg" if pd.notna(x) else "")
-    if "Volume total" in df_city_display.columns:
-        df_city_display["Volume total"] = df_city_display["Volume total"].map(lambda x: f"{x:.3f} m³" if pd.notna(x) else "")
-    if "Besoin estafette réel" in df_city_display.columns:
-        df_city_display["Besoin estafette réel"] = df_city_display["Besoin estafette réel"].map(lambda x: f"{x:.1f}" if pd.notna(x) else "")
-    
-    # Vérifier si le DataFrame n'est pas vide après filtrage
-    if df_city_display.empty:
-        st.info("ℹ️ Aucune ville à afficher (TRIPOLI exclue)")
-    else:
-        # Afficher le tableau avec le style CSS
-        html_table_city = df_city_display.to_html(
-            escape=False, 
-            index=False, 
-            classes="custom-table",
-            border=0
-        )
-        
-        st.markdown(f"""
-        <div class="table-container">
-            {html_table_city}
-        </div>
-        """, unsafe_allow_html=True)
-    
-    # Métriques résumées - CORRECTION : Utiliser les données filtrées
-    st.markdown("---")
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        total_villes = len(df_city_display)
-        st.metric("🏙️ Total Villes", total_villes)
-    
-    with col2:
-        # CORRECTION : Utiliser les données filtrées pour les calculs
-        df_city_original_filtered = st.session_state.df_city[st.session_state.df_city["Ville"] != "TRIPOLI"]
-        total_bls = df_city_original_filtered["Nombre de BLs"].sum() if "Nombre de BLs" in df_city_original_filtered.columns else 0
-        st.metric("📦 Total BLs", int(total_bls))
-    
-    with col3:
-        # CORRECTION : Utiliser les données filtrées pour les calculs
-        total_estafettes = df_city_original_filtered["Besoin estafette réel"].sum() if "Besoin estafette réel" in df_city_original_filtered.columns else 0
-        st.metric("🚐 Besoin Estafettes", f"{total_estafettes:.1f}")
-
-    # Bouton de téléchargement (garder les données originales pour l'export)
-    excel_buffer_city = BytesIO()
-    with pd.ExcelWriter(excel_buffer_city, engine='openpyxl') as writer:
-        st.session_state.df_city.to_excel(writer, index=False, sheet_name="Besoin Estafette Ville")
-    excel_buffer_city.seek(0)
-    
-    st.download_button(
-        label="💾 Télécharger Besoin par Ville",
-        data=excel_buffer_city,
-        file_name="Besoin_Estafette_Ville.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-
-# --- Onglet Livraisons Client & Ville + Zone ---
-with tab_zone_group:
-    st.subheader("Livraisons par Client & Ville + Zone")
-
-    # Créer une copie du DataFrame
-    df_liv_zone = st.session_state.df_grouped_zone.copy()
-    
-    # CSS pour un tableau organisé et professionnel
-    st.markdown("""
-    <style>
-    /* Style général du tableau */
-    .custom-table {
-        width: 100%;
-        border-collapse: collapse;
-        font-family: Arial, sans-serif;
-        font-size: 14px;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-        border-radius: 8px;
-        overflow: hidden;
-    }
-    
-    /* En-têtes du tableau - BLEU ROYAL SANS DÉGRADÉ */
-    .custom-table th {
-        background-color: #0369A1;
-        color: white;
-        padding: 12px 8px;
-        text-align: center;
-        border: 2px solid #4682B4;
-        font-weight: normal;
-        font-size: 13px;
-        vertical-align: middle;
-    }
-    
-    /* Cellules du tableau - TOUTES EN BLANC */
-    .custom-table td {
-        padding: 10px 8px;
-        text-align: center;
-        border: 1px solid #B0C4DE;
-        background-color: white;
-        color: #000000;
-        vertical-align: middle;
-        font-weight: normal;
-    }
-    
-    /* Bordures visibles pour toutes les cellules */
-    .custom-table th, 
-    .custom-table td {
-        border: 1px solid #B0C4DE !important;
-    }
-    
-    /* Bordures épaisses pour l'extérieur du tableau */
-    .custom-table {
-        border: 2px solid #4682B4 !important;
-    }
-    
-    /* Style spécifique pour la colonne Article - CENTRÉ */
-    .custom-table td:nth-child(5) {
-        text-align: center;
-        max-width: 200px;
-        word-wrap: break-word;
-        white-space: normal;
-        vertical-align: middle;
-    }
-    
-    /* Style pour les cellules de poids et volume - NOIR SANS GRAS */
-    .custom-table td:nth-child(6),
-    .custom-table td:nth-child(7) {
-        font-weight: normal;
-        color: #000000 !important;
-        vertical-align: middle;
-    }
-    
-    /* Conteneur du tableau avec défilement horizontal */
-    .table-container {
-        overflow-x: auto;
-        margin: 1rem 0;
-        border-radius: 8px;
-        border: 2px solid #4682B4;
-    }
-    
-    /* Supprimer l'alternance des couleurs - TOUTES LES LIGNES BLANCHES */
-    .custom-table tr:nth-child(even) td {
-        background-color: white !important;
-    }
-    
-    /* Survol des lignes - léger effet */
-    .custom-table tr:hover td {
-        background-color: #F0F8FF !important;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # Préparer les données pour l'affichage HTML
-    if "Article" in df_liv_zone.columns:
-        # Transformer les articles avec retours à la ligne HTML - SANS "•"
-        df_liv_zone["Article"] = df_liv_zone["Article"].astype(str).apply(
-            lambda x: "<br>".join(a.strip() for a in x.split(",") if a.strip())
-        )
-    
-    # Formater les nombres - 3 chiffres après la virgule
-    if "Poids total" in df_liv_zone.columns:
-        df_liv_zone["Poids total"] = df_liv_zone["Poids total"].map(lambda x: f"{x:.3f} kg" if pd.notna(x) else "")
-    if "Volume total" in df_liv_zone.columns:
-        df_liv_zone["Volume total"] = df_liv_zone["Volume total"].map(lambda x: f"{x:.3f} m³" if pd.notna(x) else "")
-    
-    # Afficher le tableau avec le style CSS
-    html_table_zone_group = df_liv_zone.to_html(
-        escape=False, 
-        index=False, 
-        classes="custom-table",
-        border=0
-    )
-    
-    st.markdown(f"""
-    <div class="table-container">
-        {html_table_zone_group}
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # Métriques résumées
-    st.markdown("---")
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        total_livraisons_zone = len(df_liv_zone)
-        st.metric("📦 Total Livraisons", total_livraisons_zone)
-    
-    with col2:
-        zones_count = df_liv_zone["Zone"].nunique()
-        st.metric("🌍 Zones", zones_count)
-    
-    with col3:
-        villes_count = df_liv_zone["Ville"].nunique()
-        st.metric("🏙️ Villes", villes_count)
-    
-    # Bouton de téléchargement
-    excel_buffer_zone_group = BytesIO()
-    with pd.ExcelWriter(excel_buffer_zone_group, engine='openpyxl') as writer:
-        st.session_state.df_grouped_zone.to_excel(writer, index=False, sheet_name="Livraisons Client Ville Zone")
-    excel_buffer_zone_group.seek(0)
-    
-    st.download_button(
-        label="💾 Télécharger Livraisons Client/Ville/Zone",
-        data=excel_buffer_zone_group,
-        file_name="Livraisons_Client_Ville_Zone.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-
-# --- Onglet Besoin Estafette par Zone ---
-with tab_zone_summary:
-    st.subheader("Besoin Estafette par Zone")
-    
-    # Créer une copie du DataFrame et renommer la colonne
-    df_zone_display = st.session_state.df_zone.copy()
-    
-    # RENOMMER LA COLONNE "Nombre livraisons" en "Nombre de BLs"
-    df_zone_display = df_zone_display.rename(columns={"Nombre livraisons": "Nombre de BLs"})
-    
-    # CSS pour un tableau organisé et professionnel
-    st.markdown("""
-    <style>
-    /* Style général du tableau */
-    .custom-table {
-        width: 100%;
-        border-collapse: collapse;
-        font-family: Arial, sans-serif;
-        font-size: 14px;
-        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-        border-radius: 8px;
-        overflow: hidden;
-    }
-    
-    /* En-têtes du tableau - BLEU ROYAL SANS DÉGRADÉ */
-    .custom-table th {
-        background-color: #0369A1;
-        color: white;
-        padding: 12px 8px;
-        text-align: center;
-        border: 2px solid #4682B4;
-        font-weight: normal;  /* CHANGÉ : bold → normal */
-        font-size: 13px;
-        vertical-align: middle;
-    }
-    
-    /* Cellules du tableau - TOUTES EN BLANC */
-    .custom-table td {
-        padding: 10px 8px;
-        text-align: center;
-        border: 1px solid #B0C4DE;
-        background-color: white;
-        color: #000000;
-        vertical-align: middle;
-        font-weight: normal;  /* AJOUT : poids normal */
-    }
-    
-    /* Bordures visibles pour toutes les cellules */
-    .custom-table th, 
-    .custom-table td {
-        border: 1px solid #B0C4DE !important;
-    }
-    
-    /* Bordures épaisses pour l'extérieur du tableau */
-    .custom-table {
-        border: 2px solid #4682B4 !important;
-    }
-    
-    /* Style pour les cellules numériques - SANS GRAS */
-    .custom-table td:nth-child(2),
-    .custom-table td:nth-child(3),
-    .custom-table td:nth-child(4),
-    .custom-table td:nth-child(5) {
-        font-weight: normal;  /* CHANGÉ : 600 → normal */
-        color: #000000 !important;
-        vertical-align: middle;
-    }
-    
-    /* Conteneur du tableau avec défilement horizontal */
-    .table-container {
-        overflow-x: auto;
-        margin: 1rem 0;
-        border-radius: 8px;
-        border: 2px solid #4682B4;
-    }
-    
-    /* Supprimer l'alternance des couleurs - TOUTES LES LIGNES BLANCHES */
-    .custom-table tr:nth-child(even) td {
-        background-color: white !important;
-    }
-    
-    /* Survol des lignes - léger effet */
-    .custom-table tr:hover td {
-        background-color: #F0F8FF !important;
-    }
-    </style>
-    """, unsafe_allow_html=True)
-    
-    # Formater les nombres - 3 chiffres après la virgule
-    if "Poids total" in df_zone_display.columns:
-        df_zone_display["Poids total"] = df_zone_display["Poids total"].map(lambda x: f"{x:.3f} kg" if pd.notna(x) else "")
-    if "Volume total" in df_zone_display.columns:
-        df_zone_display["Volume total"] = df_zone_display["Volume total"].map(lambda x: f"{x:.3f} m³" if pd.notna(x) else "")
-    if "Besoin estafette réel" in df_zone_display.columns:
-        df_zone_display["Besoin estafette réel"] = df_zone_display["Besoin estafette réel"].map(lambda x: f"{x:.1f}" if pd.notna(x) else "")
-    # MAINTENANT ON UTILISE "Nombre de BLs" AU LIEU DE "Nombre livraisons"
-    if "Nombre de BLs" in df_zone_display.columns:
-        df_zone_display["Nombre de BLs"] = df_zone_display["Nombre de BLs"].map(lambda x: f"{int(x)}" if pd.notna(x) else "")
-    
-    # Afficher le tableau avec le style CSS
-    html_table_zone = df_zone_display.to_html(
-        escape=False, 
-        index=False, 
-        classes="custom-table",
-        border=0
-    )
-    
-    st.markdown(f"""
-    <div class="table-container">
-        {html_table_zone}
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # Métriques résumées - CORRECTION : Utiliser les données originales pour les calculs
-    st.markdown("---")
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        total_zones = len(df_zone_display)
-        st.metric("🌍 Total Zones", total_zones)
-    
-    with col2:
-        # Utiliser les données originales pour les calculs (avec l'ancien nom de colonne)
-        if "Nombre livraisons" in st.session_state.df_zone.columns:
-            total_bls_zone = st.session_state.df_zone["Nombre livraisons"].sum()
-        else:
-            total_bls_zone = 0
-        st.metric("📦 Total BLs", int(total_bls_zone))
-    
-    with col3:
-        # Utiliser les données originales pour les calculs
-        total_estafettes_zone = st.session_state.df_zone["Besoin estafette réel"].sum() if "Besoin estafette réel" in st.session_state.df_zone.columns else 0
-        st.metric("🚐 Besoin Estafettes", f"{total_estafettes_zone:.1f}")
-    
-    # Bouton de téléchargement
-    excel_buffer_zone = BytesIO()
-    with pd.ExcelWriter(excel_buffer_zone, engine='openpyxl') as writer:
-        # Pour l'export Excel, on utilise les données originales
-        st.session_state.df_zone.to_excel(writer, index=False, sheet_name="Besoin Estafette Zone")
-    excel_buffer_zone.seek(0)
+        padding: 10px 16px;
+        font-weight: 600;
+    }
     
-    st.download_button(
-        label="💾 Télécharger Besoin par Zone",
-        data=excel_buffer_zone,
-        file_name="Besoin_Estafette_Zone.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
-
-# --- Onglet Graphiques ---
-with tab_charts:
-    st.subheader("Statistiques par Ville")
+    .stTabs [data-baseweb="tab"]:hover {
+        background-color: #E6F3FF;
+        color: #0369A1;
+    }
     
-    # FILTRER LES DONNÉES POUR EXCLURE TRIPOLI
-    df_filtered = st.session_state.df_city[st.session_state.df_city["Ville"] != "TRIPOLI"]
+    /* ONGLET ACTIF - BLEU ROYAL */
+    .stTabs [aria-selected="true"] {
+        background-color: #0369A1 !important;
+        color: white !important;
+    }
     
-    # Configuration commune pour tous les graphiques
-    chart_config = {
-        'color_discrete_sequence': ['#0369A1'],  # BLEU ROYAL
-        'template': 'plotly_white',
+    /* TEXTE DES ONGLETS */
+    .stTabs [data-baseweb="tab"] p {
+        font-size: 16px;
+        font-weight: 600;
+        margin: 0;
     }
     
-    col1, col2 = st.columns(2)
-    with col1:
-        fig1 = px.bar(df_filtered, x="Ville", y="Poids total", **chart_config)
-        fig1.update_layout(title_text="Poids total livré par ville", title_x=0.5)
-        st.plotly_chart(fig1, use_container_width=True)
-        
-    with col2:
-        fig2 = px.bar(df_filtered, x="Ville", y="Volume total", **chart_config)
-        fig2.update_layout(title_text="Volume total livré par ville (m³)", title_x=0.5)
-        st.plotly_chart(fig2, use_container_width=True)
+    /* COULEUR DU TEXTE POUR ONGLET ACTIF */
+    .stTabs [aria-selected="true"] p {
+        color: white !important;
+    }
+</style>
+""", unsafe_allow_html=True)
 
-    col3, col4 = st.columns(2)
-    with col3:
-        # DIAGRAMME CORRIGÉ : Nombre de BL par ville
-        df_chart = df_filtered.rename(columns={"Nombre livraisons": "Nombre de BLs"})
-        fig3 = px.bar(df_chart, x="Ville", y="Nombre de BLs", **chart_config)
-        fig3.update_layout(title_text="Nombre de BL par ville", title_x=0.5)
-        st.plotly_chart(fig3, use_container_width=True)
-        
-    with col4:
-        fig4 = px.bar(df_filtered, x="Ville", y="Besoin estafette réel", **chart_config)
-        fig4.update_layout(title_text="Besoin en Estafettes par ville", title_x=0.5)
-        st.plotly_chart(fig4, use_container_width=True)
+# CSS pour un tableau organisé et professionnel (commun aux tableaux des onglets)
+st.markdown("""
+<style>
+/* Style général du tableau */
+.custom-table {
+    width: 100%;
+    border-collapse: collapse;
+    font-family: Arial, sans-serif;
+    font-size: 14px;
+    box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+    border-radius: 8px;
+    overflow: hidden;
+}
+
+/* En-têtes du tableau - BLEU ROYAL SANS DÉGRADÉ */
+.custom-table th {
+    background-color: #0369A1;
+    color: white;
+    padding: 12px 8px;
+    text-align: center;
+    border: 2px solid #4682B4;
+    font-weight: normal;
+    font-size: 13px;
+    vertical-align: middle;
+}
+
+/* Cellules du tableau - TOUTES EN BLANC */
+.custom-table td {
+    padding: 10px 8px;
+    text-align: center;
+    border: 1px solid #B0C4DE;
+    background-color: white;
+    color: #000000;
+    vertical-align: middle;
+    font-weight: normal;
+}
+
+/* Bordures visibles pour toutes les cellules */
+.custom-table th, 
+.custom-table td {
+    border: 1px solid #B0C4DE !important;
+}
+
+/* Bordures épaisses pour l'extérieur du tableau */
+.custom-table {
+    border: 2px solid #4682B4 !important;
+}
+
+/* Style spécifique pour la colonne Article - CENTRÉ */
+.custom-table td:nth-child(5) {
+    text-align: center;
+    max-width: 200px;
+    word-wrap: break-word;
+    white-space: normal;
+    vertical-align: middle;
+}
+
+/* Style pour les cellules numériques, de poids et volume - NOIR SANS GRAS */
+.custom-table td:nth-child(2),
+.custom-table td:nth-child(3),
+.custom-table td:nth-child(4),
+.custom-table td:nth-child(6),
+.custom-table td:nth-child(7) {
+    font-weight: normal;
+    color: #000000 !important;
+    vertical-align: middle;
+}
+
+/* Conteneur du tableau avec défilement horizontal */
+.table-container {
+    overflow-x: auto;
+    margin: 1rem 0;
+    border-radius: 8px;
+    border: 2px solid #4682B4;
+}
+
+/* Supprimer l'alternance des couleurs - TOUTES LES LIGNES BLANCHES */
+.custom-table tr:nth-child(even) td {
+    background-color: white !important;
+}
+
+/* Survol des lignes - léger effet */
+.custom-table tr:hover td {
+    background-color: #F0F8FF !important;
+}
+</style>
+""", unsafe_allow_html=True)
+
+@section_fragment
+def section_analyse():
+    # Tableaux formatés, indicateurs et données des graphiques : calculés avec le traitement
+    vues = st.session_state.get("vues_analyse")
+    if vues is None:
+        vues = entree_section(
+            "vues_analyse", preparer_vues_analyse,
+            st.session_state.df_grouped, st.session_state.df_city,
+            st.session_state.df_grouped_zone, st.session_state.df_zone
+        )
+
+    # Seul l'onglet ouvert est exécuté ; changer d'onglet ne relance que cette section
+    tab_grouped, tab_city, tab_zone_group, tab_zone_summary, tab_charts = st.tabs([
+        "Livraisons Client/Ville", 
+        "Besoin Estafette par Ville", 
+        "Livraisons Client/Zone", 
+        "Besoin Estafette par Zone",
+        "Graphiques"
+    ], key="onglets_analyse", on_change="rerun")
+
+    # --- Onglet Livraisons Client/Ville ---
+    if tab_grouped.open:
+        with tab_grouped:
+            st.subheader("Livraisons par Client & Ville")
+            vue = vues["livraisons_ville"]
+
+            # Vérifier si le DataFrame n'est pas vide après filtrage (TRIPOLI exclue)
+            if vue["tableau"].empty:
+                st.info("ℹ️ Aucune livraison à afficher (TRIPOLI exclue)")
+            else:
+                tableau_html_pagine(vue["tableau"], "analyse_livraisons_ville", "Livraisons")
+
+            # Métriques résumées (calculées sur les données non formatées)
+            st.markdown("---")
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("📦 Total Livraisons", vue["indicateurs"]["livraisons"])
+            with col2:
+                st.metric("👥 Clients Uniques", vue["indicateurs"]["clients"])
+            with col3:
+                st.metric("⚖️ Poids Total", f"{vue['indicateurs']['poids']:.3f} kg")
+            with col4:
+                st.metric("📏 Volume Total", f"{vue['indicateurs']['volume']:.3f} m³")
+
+            # Bouton de téléchargement (garder les données originales pour l'export), classeur généré en arrière-plan
+            st.download_button(
+                label="💾 Télécharger Livraisons Client/Ville",
+                data=st.session_state.artefacts.preparer(
+                    "livraisons_client_ville", excel_une_feuille,
+                    st.session_state.df_grouped.drop(columns=["Zone"], errors='ignore'), "Livraisons Client Ville"
+                ),
+                file_name="Livraisons_Client_Ville.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore"
+            )
+
+    # --- Onglet Besoin Estafette par Ville ---
+    if tab_city.open:
+        with tab_city:
+            st.subheader("Besoin Estafette par Ville")
+            vue = vues["besoin_ville"]
+
+            if vue["tableau"].empty:
+                st.info("ℹ️ Aucune ville à afficher (TRIPOLI exclue)")
+            else:
+                tableau_html_pagine(vue["tableau"], "analyse_besoin_ville", "Villes")
+
+            st.markdown("---")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("🏙️ Total Villes", vue["indicateurs"]["villes"])
+            with col2:
+                st.metric("📦 Total BLs", int(vue["indicateurs"]["bls"]))
+            with col3:
+                st.metric("🚐 Besoin Estafettes", f"{vue['indicateurs']['estafettes']:.1f}")
+
+            # Bouton de téléchargement (garder les données originales pour l'export), classeur généré en arrière-plan
+            st.download_button(
+                label="💾 Télécharger Besoin par Ville",
+                data=st.session_state.artefacts.preparer(
+                    "besoin_estafette_ville", excel_une_feuille, st.session_state.df_city, "Besoin Estafette Ville"
+                ),
+                file_name="Besoin_Estafette_Ville.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore"
+            )
+
+    # --- Onglet Livraisons Client & Ville + Zone ---
+    if tab_zone_group.open:
+        with tab_zone_group:
+            st.subheader("Livraisons par Client & Ville + Zone")
+            vue = vues["livraisons_zone"]
+
+            tableau_html_pagine(vue["tableau"], "analyse_livraisons_zone", "Livraisons")
+
+            st.markdown("---")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("📦 Total Livraisons", vue["indicateurs"]["livraisons"])
+            with col2:
+                st.metric("🌍 Zones", vue["indicateurs"]["zones"])
+            with col3:
+                st.metric("🏙️ Villes", vue["indicateurs"]["villes"])
+
+            # Bouton de téléchargement (classeur généré en arrière-plan)
+            st.download_button(
+                label="💾 Télécharger Livraisons Client/Ville/Zone",
+                data=st.session_state.artefacts.preparer(
+                    "livraisons_client_ville_zone", excel_une_feuille,
+                    st.session_state.df_grouped_zone, "Livraisons Client Ville Zone"
+                ),
+                file_name="Livraisons_Client_Ville_Zone.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore"
+            )
+
+    # --- Onglet Besoin Estafette par Zone ---
+    if tab_zone_summary.open:
+        with tab_zone_summary:
+            st.subheader("Besoin Estafette par Zone")
+            vue = vues["besoin_zone"]
+
+            tableau_html_pagine(vue["tableau"], "analyse_besoin_zone", "Zones")
+
+            st.markdown("---")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("🌍 Total Zones", vue["indicateurs"]["zones"])
+            with col2:
+                st.metric("📦 Total BLs", int(vue["indicateurs"]["bls"]))
+            with col3:
+                st.metric("🚐 Besoin Estafettes", f"{vue['indicateurs']['estafettes']:.1f}")
+
+            # Pour l'export Excel, on utilise les données originales (classeur généré en arrière-plan)
+            st.download_button(
+                label="💾 Télécharger Besoin par Zone",
+                data=st.session_state.artefacts.preparer(
+                    "besoin_estafette_zone", excel_une_feuille, st.session_state.df_zone, "Besoin Estafette Zone"
+                ),
+                file_name="Besoin_Estafette_Zone.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                on_click="ignore"
+            )
+
+    # --- Onglet Graphiques ---
+    if tab_charts.open:
+        with tab_charts:
+            st.subheader("Statistiques par Ville")
+            df_graphiques = vues["graphiques"]  # TRIPOLI exclue
+
+            # Configuration commune pour tous les graphiques
+            chart_config = {
+                'color_discrete_sequence': ['#0369A1'],  # BLEU ROYAL
+                'template': 'plotly_white',
+            }
+
+            col1, col2 = st.columns(2)
+            with col1:
+                fig1 = px.bar(df_graphiques, x="Ville", y="Poids total", **chart_config)
+                fig1.update_layout(title_text="Poids total livré par ville", title_x=0.5)
+                st.plotly_chart(fig1, use_container_width=True)
+
+            with col2:
+                fig2 = px.bar(df_graphiques, x="Ville", y="Volume total", **chart_config)
+                fig2.update_layout(title_text="Volume total livré par ville (m³)", title_x=0.5)
+                st.plotly_chart(fig2, use_container_width=True)
+
+            col3, col4 = st.columns(2)
+            with col3:
+                fig3 = px.bar(df_graphiques, x="Ville", y="Nombre de BLs", **chart_config)
+                fig3.update_layout(title_text="Nombre de BL par ville", title_x=0.5)
+                st.plotly_chart(fig3, use_container_width=True)
+
+            with col4:
+                fig4 = px.bar(df_graphiques, x="Ville", y="Besoin estafette réel", **chart_config)
+                fig4.update_layout(title_text="Besoin en Estafettes par ville", title_x=0.5)
+                st.plotly_chart(fig4, use_container_width=True)
+
+section_analyse()
 
 st.markdown("---")
 # =====================================================
@@ -997,246 +1074,251 @@ st.markdown("""
     }
 </style>
 """, unsafe_allow_html=True)
-if st.session_state.propositions is not None and not st.session_state.propositions.empty:
-    col_prop, col_details = st.columns([2, 3])
-    
-    with col_prop:
-        st.markdown("### Propositions ouvertes")
+@section_fragment
+def section_location():
+    relancer_si_plan_modifie()
+    if st.session_state.propositions is not None and not st.session_state.propositions.empty:
+        col_prop, col_details = st.columns([2, 3])
+    
+        with col_prop:
+            st.markdown("### Propositions ouvertes")
         
-        # CORRECTION : Vérifier si la colonne 'Client' existe
-        if 'Client' in st.session_state.propositions.columns:
-            # FORMATAGE DU TABLEAU DES PROPOSITIONS AVEC STYLE CSS
-            propositions_display = st.session_state.propositions.copy()
+            # CORRECTION : Vérifier si la colonne 'Client' existe
+            if 'Client' in st.session_state.propositions.columns:
+                # FORMATAGE DU TABLEAU DES PROPOSITIONS AVEC STYLE CSS
+                propositions_display = st.session_state.propositions.copy()
+            
+                # Formater les nombres
+                if "Poids total (kg)" in propositions_display.columns:
+                    propositions_display["Poids total (kg)"] = propositions_display["Poids total (kg)"].map(
+                        lambda x: f"{float(x):.3f}" if pd.notna(x) else ""
+                    )
+                if "Volume total (m³)" in propositions_display.columns:
+                    propositions_display["Volume total (m³)"] = propositions_display["Volume total (m³)"].map(
+                        lambda x: f"{float(x):.3f}" if pd.notna(x) else ""
+                    )
             
-            # Formater les nombres
-            if "Poids total (kg)" in propositions_display.columns:
-                propositions_display["Poids total (kg)"] = propositions_display["Poids total (kg)"].map(
-                    lambda x: f"{float(x):.3f}" if pd.notna(x) else ""
-                )
-            if "Volume total (m³)" in propositions_display.columns:
-                propositions_display["Volume total (m³)"] = propositions_display["Volume total (m³)"].map(
-                    lambda x: f"{float(x):.3f}" if pd.notna(x) else ""
+                # Afficher le tableau avec le style CSS
+                html_table_propositions = propositions_display.to_html(
+                    escape=False, 
+                    index=False, 
+                    classes="custom-table-rental",
+                    border=0
                 )
             
-            # Afficher le tableau avec le style CSS
-            html_table_propositions = propositions_display.to_html(
-                escape=False, 
-                index=False, 
-                classes="custom-table-rental",
-                border=0
-            )
-            
-            st.markdown(f"""
-            <div class="table-container-rental">
-                {html_table_propositions}
-            </div>
-            """, unsafe_allow_html=True)
+                st.markdown(f"""
+                <div class="table-container-rental">
+                    {html_table_propositions}
+                </div>
+                """, unsafe_allow_html=True)
             
-           # MÉTRIQUES RÉSUMÉES
-            st.markdown("---")
-            col_metric1, col_metric2, col_metric3 = st.columns(3)
-
-            with col_metric1:
-                total_propositions = len(st.session_state.propositions)
-                st.metric("📋 Propositions ouvertes", total_propositions)
-
-            with col_metric2:
-                # Calculer le nombre de clients dépassant le seuil de POIDS
-                clients_poids = len(st.session_state.propositions[
-                    st.session_state.propositions["Poids total (kg)"] >= SEUIL_POIDS
-                ]) if "Poids total (kg)" in st.session_state.propositions.columns else 0
-                st.metric("⚖️ Dépassement poids", clients_poids)
-
-            with col_metric3:
-                # CORRECTION : Calculer le nombre de clients dépassant le seuil de VOLUME
-                clients_volume = len(st.session_state.propositions[
-                    st.session_state.propositions["Volume total (m³)"] >= SEUIL_VOLUME
-                ]) if "Volume total (m³)" in st.session_state.propositions.columns else 0
-                st.metric("📦 Dépassement volume", clients_volume)
+               # MÉTRIQUES RÉSUMÉES
+                st.markdown("---")
+                col_metric1, col_metric2, col_metric3 = st.columns(3)
+
+                with col_metric1:
+                    total_propositions = len(st.session_state.propositions)
+                    st.metric("📋 Propositions ouvertes", total_propositions)
+
+                with col_metric2:
+                    # Calculer le nombre de clients dépassant le seuil de POIDS
+                    clients_poids = len(st.session_state.propositions[
+                        st.session_state.propositions["Poids total (kg)"] >= SEUIL_POIDS
+                    ]) if "Poids total (kg)" in st.session_state.propositions.columns else 0
+                    st.metric("⚖️ Dépassement poids", clients_poids)
+
+                with col_metric3:
+                    # CORRECTION : Calculer le nombre de clients dépassant le seuil de VOLUME
+                    clients_volume = len(st.session_state.propositions[
+                        st.session_state.propositions["Volume total (m³)"] >= SEUIL_VOLUME
+                    ]) if "Volume total (m³)" in st.session_state.propositions.columns else 0
+                    st.metric("📦 Dépassement volume", clients_volume)
 
         
-            # Sélection du client
-            client_options = st.session_state.propositions['Client'].astype(str).tolist()
-            client_options_with_empty = [""] + client_options
+                # Sélection du client
+                client_options = st.session_state.propositions['Client'].astype(str).tolist()
+                client_options_with_empty = [""] + client_options
             
-            # Index de sélection par défaut
-            default_index = 0
-            if st.session_state.selected_client in client_options:
-                 default_index = client_options_with_empty.index(st.session_state.selected_client)
-            elif len(client_options) > 0:
-                 default_index = 1
-
-            st.session_state.selected_client = st.selectbox(
-                "Client à traiter :", 
-                options=client_options_with_empty, 
-                index=default_index,
-                key='client_select' 
-            )
-        else:
-            st.warning("⚠️ Format de données incorrect dans les propositions.")
-            st.session_state.selected_client = None
+                # Index de sélection par défaut
+                default_index = 0
+                if st.session_state.selected_client in client_options:
+                     default_index = client_options_with_empty.index(st.session_state.selected_client)
+                elif len(client_options) > 0:
+                     default_index = 1
+
+                st.session_state.selected_client = st.selectbox(
+                    "Client à traiter :", 
+                    options=client_options_with_empty, 
+                    index=default_index,
+                    key='client_select' 
+                )
+            else:
+                st.warning("⚠️ Format de données incorrect dans les propositions.")
+                st.session_state.selected_client = None
 
-        col_btn_acc, col_btn_ref = st.columns(2)
-        is_client_selected = st.session_state.selected_client != "" and st.session_state.selected_client is not None
+            col_btn_acc, col_btn_ref = st.columns(2)
+            is_client_selected = st.session_state.selected_client != "" and st.session_state.selected_client is not None
         
-        with col_btn_acc:
-            st.button(
-                "✅ Accepter la location", 
-                on_click=accept_location_callback, 
-                disabled=not is_client_selected,
-                use_container_width=True
-            )
-        with col_btn_ref:
-            st.button(
-                "❌ Refuser la proposition", 
-                on_click=refuse_location_callback, 
-                disabled=not is_client_selected,
-                use_container_width=True
-            )
-
-    with col_details:
-        st.markdown("### Détails de la commande client")
-        if is_client_selected:
-            try:
-                resume, details_df = st.session_state.rental_processor.get_details_client(
-                    st.session_state.selected_client
+            with col_btn_acc:
+                st.button(
+                    "✅ Accepter la location", 
+                    on_click=accept_location_callback, 
+                    disabled=not is_client_selected,
+                    use_container_width=True
+                )
+            with col_btn_ref:
+                st.button(
+                    "❌ Refuser la proposition", 
+                    on_click=refuse_location_callback, 
+                    disabled=not is_client_selected,
+                    use_container_width=True
                 )
+
+        with col_details:
+            st.markdown("### Détails de la commande client")
+            if is_client_selected:
+                try:
+                    resume, details_df = st.session_state.rental_processor.get_details_client(
+                        st.session_state.selected_client
+                    )
                 
-                # Afficher le résumé
-                st.markdown(f"**{resume}**")
+                    # Afficher le résumé
+                    st.markdown(f"**{resume}**")
                 
-                # FORMATAGE DU TABLEAU DES DÉTAILS AVEC STYLE CSS
-                if not details_df.empty:
-                    details_display = details_df.copy()
+                    # FORMATAGE DU TABLEAU DES DÉTAILS AVEC STYLE CSS
+                    if not details_df.empty:
+                        details_display = details_df.copy()
                     
-                    # CORRECTION : Formatage simple et sécurisé des colonnes
-                    def format_numeric_column(series, decimals, unit=""):
-                        """Formate une colonne numérique avec le nombre de décimales et unité spécifiés"""
-                        formatted_series = series.copy()
-                        for i, value in enumerate(series):
-                            if pd.notna(value) and value != "":
-                                try:
-                                    # Essayer de convertir en float
-                                    if isinstance(value, str):
-                                        # Nettoyer la valeur si c'est une string
-                                        clean_value = value.replace(' kg', '').replace(' m³', '').replace('%', '').strip()
-                                        num_value = float(clean_value)
-                                    else:
-                                        num_value = float(value)
+                        # CORRECTION : Formatage simple et sécurisé des colonnes
+                        def format_numeric_column(series, decimals, unit=""):
+                            """Formate une colonne numérique avec le nombre de décimales et unité spécifiés"""
+                            formatted_series = series.copy()
+                            for i, value in enumerate(series):
+                                if pd.notna(value) and value != "":
+                                    try:
+                                        # Essayer de convertir en float
+                                        if isinstance(value, str):
+                                            # Nettoyer la valeur si c'est une string
+                                            clean_value = value.replace(' kg', '').replace(' m³', '').replace('%', '').strip()
+                                            num_value = float(clean_value)
+                                        else:
+                                            num_value = float(value)
                                     
-                                    # Formater selon le nombre de décimales
-                                    if decimals == 3:
-                                        formatted_value = f"{num_value:.3f}"
-                                    elif decimals == 2:
-                                        formatted_value = f"{num_value:.2f}"
-                                    elif decimals == 1:
-                                        formatted_value = f"{num_value:.1f}"
-                                    else:
-                                        formatted_value = f"{num_value:.0f}"
+                                        # Formater selon le nombre de décimales
+                                        if decimals == 3:
+                                            formatted_value = f"{num_value:.3f}"
+                                        elif decimals == 2:
+                                            formatted_value = f"{num_value:.2f}"
+                                        elif decimals == 1:
+                                            formatted_value = f"{num_value:.1f}"
+                                        else:
+                                            formatted_value = f"{num_value:.0f}"
                                     
-                                    formatted_series.iloc[i] = f"{formatted_value}{unit}"
-                                except (ValueError, TypeError):
-                                    # Si conversion échoue, garder la valeur originale
-                                    formatted_series.iloc[i] = str(value)
-                            else:
-                                formatted_series.iloc[i] = ""
-                        return formatted_series
+                                        formatted_series.iloc[i] = f"{formatted_value}{unit}"
+                                    except (ValueError, TypeError):
+                                        # Si conversion échoue, garder la valeur originale
+                                        formatted_series.iloc[i] = str(value)
+                                else:
+                                    formatted_series.iloc[i] = ""
+                            return formatted_series
                     
-                    # Formater les colonnes numériques
-                    if "Poids total" in details_display.columns:
-                        details_display["Poids total"] = format_numeric_column(details_display["Poids total"], 3, " kg")
+                        # Formater les colonnes numériques
+                        if "Poids total" in details_display.columns:
+                            details_display["Poids total"] = format_numeric_column(details_display["Poids total"], 3, " kg")
                     
-                    if "Volume total" in details_display.columns:
-                        details_display["Volume total"] = format_numeric_column(details_display["Volume total"], 3, " m³")
+                        if "Volume total" in details_display.columns:
+                            details_display["Volume total"] = format_numeric_column(details_display["Volume total"], 3, " m³")
                     
-                    if "Taux d'occupation (%)" in details_display.columns:
-                        details_display["Taux d'occupation (%)"] = format_numeric_column(details_display["Taux d'occupation (%)"], 2, "%")
+                        if "Taux d'occupation (%)" in details_display.columns:
+                            details_display["Taux d'occupation (%)"] = format_numeric_column(details_display["Taux d'occupation (%)"], 2, "%")
                     
-                    # Gestion spéciale pour "BL inclus" - format multiligne
-                    if "BL inclus" in details_display.columns:
-                        details_display["BL inclus"] = details_display["BL inclus"].astype(str).apply(
-                            lambda x: "<br>".join(bl.strip() for bl in x.split(";")) if ";" in x else x
-                        )
+                        # Gestion spéciale pour "BL inclus" - format multiligne
+                        if "BL inclus" in details_display.columns:
+                            details_display["BL inclus"] = details_display["BL inclus"].astype(str).apply(
+                                lambda x: "<br>".join(bl.strip() for bl in x.split(";")) if ";" in x else x
+                            )
                     
-                    # Afficher le tableau avec le style CSS
-                    html_table_details = details_display.to_html(
-                        escape=False, 
-                        index=False, 
-                        classes="custom-table-rental",
-                        border=0
-                    )
+                        # Afficher le tableau avec le style CSS
+                        html_table_details = details_display.to_html(
+                            escape=False, 
+                            index=False, 
+                            classes="custom-table-rental",
+                            border=0
+                        )
                     
-                    st.markdown(f"""
-                    <div class="table-container-rental">
-                        {html_table_details}
-                    </div>
-                    """, unsafe_allow_html=True)
+                        st.markdown(f"""
+                        <div class="table-container-rental">
+                            {html_table_details}
+                        </div>
+                        """, unsafe_allow_html=True)
                     
-                    # MÉTRIQUES POUR LES DÉTAILS - CORRECTION : Calculs sur données brutes
-                    st.markdown("---")
-                    col_det1, col_det2, col_det3 = st.columns(3)
+                        # MÉTRIQUES POUR LES DÉTAILS - CORRECTION : Calculs sur données brutes
+                        st.markdown("---")
+                        col_det1, col_det2, col_det3 = st.columns(3)
                     
-                    with col_det1:
-                        total_camions = len(details_display)
-                        st.metric("🚚 Nombre de camions", total_camions)
+                        with col_det1:
+                            total_camions = len(details_display)
+                            st.metric("🚚 Nombre de camions", total_camions)
                     
-                    with col_det2:
-                        # Calculer le poids total à partir des données brutes
-                        try:
-                            if "Poids total" in details_df.columns:
-                                poids_total = 0
-                                for value in details_df["Poids total"]:
-                                    if pd.notna(value):
-                                        try:
-                                            # Nettoyer la valeur si elle contient des unités
-                                            if isinstance(value, str):
-                                                clean_value = value.replace(' kg', '').replace('m³', '').strip()
-                                            else:
-                                                clean_value = str(value)
-                                            poids_total += float(clean_value)
-                                        except (ValueError, TypeError):
-                                            continue
-                                st.metric("📦 Poids total", f"{poids_total:.1f} kg")
-                            else:
-                                st.metric("📦 Poids total", "N/A")
-                        except Exception as e:
-                            st.metric("📦 Poids total", "Erreur")
+                        with col_det2:
+                            # Calculer le poids total à partir des données brutes
+                            try:
+                                if "Poids total" in details_df.columns:
+                                    poids_total = 0
+                                    for value in details_df["Poids total"]:
+                                        if pd.notna(value):
+                                            try:
+                                                # Nettoyer la valeur si elle contient des unités
+                                                if isinstance(value, str):
+                                                    clean_value = value.replace(' kg', '').replace('m³', '').strip()
+                                                else:
+                                                    clean_value = str(value)
+                                                poids_total += float(clean_value)
+                                            except (ValueError, TypeError):
+                                                continue
+                                    st.metric("📦 Poids total", f"{poids_total:.1f} kg")
+                                else:
+                                    st.metric("📦 Poids total", "N/A")
+                            except Exception as e:
+                                st.metric("📦 Poids total", "Erreur")
                     
-                    with col_det3:
-                        # Calculer le volume total à partir des données brutes
-                        try:
-                            if "Volume total" in details_df.columns:
-                                volume_total = 0
-                                for value in details_df["Volume total"]:
-                                    if pd.notna(value):
-                                        try:
-                                            # Nettoyer la valeur si elle contient des unités
-                                            if isinstance(value, str):
-                                                clean_value = value.replace(' kg', '').replace('m³', '').strip()
-                                            else:
-                                                clean_value = str(value)
-                                            volume_total += float(clean_value)
-                                        except (ValueError, TypeError):
-                                            continue
-                                st.metric("📏 Volume total", f"{volume_total:.3f} m³")
-                            else:
-                                st.metric("📏 Volume total", "N/A")
-                        except Exception as e:
-                            st.metric("📏 Volume total", "Erreur")
+                        with col_det3:
+                            # Calculer le volume total à partir des données brutes
+                            try:
+                                if "Volume total" in details_df.columns:
+                                    volume_total = 0
+                                    for value in details_df["Volume total"]:
+                                        if pd.notna(value):
+                                            try:
+                                                # Nettoyer la valeur si elle contient des unités
+                                                if isinstance(value, str):
+                                                    clean_value = value.replace(' kg', '').replace('m³', '').strip()
+                                                else:
+                                                    clean_value = str(value)
+                                                volume_total += float(clean_value)
+                                            except (ValueError, TypeError):
+                                                continue
+                                    st.metric("📏 Volume total", f"{volume_total:.3f} m³")
+                                else:
+                                    st.metric("📏 Volume total", "N/A")
+                            except Exception as e:
+                                st.metric("📏 Volume total", "Erreur")
                         
-            except Exception as e:
-                st.error(f"❌ Erreur lors de la récupération des détails : {str(e)}")
-                # Debug information
-                st.write("Détails de l'erreur :")
-                if 'details_df' in locals():
-                    st.write("Colonnes disponibles :", details_df.columns.tolist())
-                    if not details_df.empty:
-                        st.write("Aperçu des données :")
-                        st.dataframe(details_df.head())
-        else:
-            st.info("Sélectionnez un client pour afficher les détails de la commande/estafettes.")
-else:
-    st.success("✅ Aucune proposition de location de camion en attente de décision.")
+                except Exception as e:
+                    st.error(f"❌ Erreur lors de la récupération des détails : {str(e)}")
+                    # Debug information
+                    st.write("Détails de l'erreur :")
+                    if 'details_df' in locals():
+                        st.write("Colonnes disponibles :", details_df.columns.tolist())
+                        if not details_df.empty:
+                            st.write("Aperçu des données :")
+                            st.dataframe(details_df.head())
+            else:
+                st.info("Sélectionnez un client pour afficher les détails de la commande/estafettes.")
+    else:
+        st.success("✅ Aucune proposition de location de camion en attente de décision.")
+
+section_location()
 
 st.markdown("---")
 
@@ -1408,92 +1490,160 @@ try:
     with col4:
         estafettes = total_voyages - camions_loues
         st.metric("📦 Estafettes", estafettes)
+
+    # Détail horaire des tournées quand un référentiel de fenêtres a été fourni
+    df_tournees = st.session_state.get("df_tournees")
+    if df_tournees is not None and not df_tournees.empty:
+        with st.expander("🕒 Tournées horaires (fenêtres clients, plan initial)"):
+            nb_retards = int((df_tournees["Retard (min)"] > 0).sum())
+            if nb_retards:
+                st.warning(f"⚠️ {nb_retards} arrêt(s) hors fenêtre : client inatteignable à temps depuis le dépôt.")
+            show_df(df_tournees, use_container_width=True, hide_index=True)
+    
+    # Export Excel avec retours à la ligne \n, généré en arrière-plan (seulement si df_clean change)
+    def to_excel_voyages_optimises(df_clean):
+        df_export = df_clean.copy()
+    
+        # CORRECTION : S'assurer que l'export est aussi trié par zone
+        if "Zone" in df_export.columns:
+            df_export["Zone_Num"] = df_export["Zone"].str.extract('(\d+)').astype(float)
+            df_export = df_export.sort_values("Zone_Num").drop("Zone_Num", axis=1)
+    
+        # Transformer les colonnes avec retours à la ligne \n pour Excel
+        if "Client(s) inclus" in df_export.columns:
+            df_export["Client(s) inclus"] = df_export["Client(s) inclus"].astype(str).apply(
+                lambda x: "\n".join(client.strip() for client in x.split(",")) if x != "nan" else ""
+            )
     
-    # Préparer l'export Excel avec retours à la ligne \n
-    df_export = df_clean.copy()
-    
-    # CORRECTION : S'assurer que l'export est aussi trié par zone
-    if "Zone" in df_export.columns:
-        df_export["Zone_Num"] = df_export["Zone"].str.extract('(\d+)').astype(float)
-        df_export = df_export.sort_values("Zone_Num").drop("Zone_Num", axis=1)
-    
-    # Transformer les colonnes avec retours à la ligne \n pour Excel
-    if "Client(s) inclus" in df_export.columns:
-        df_export["Client(s) inclus"] = df_export["Client(s) inclus"].astype(str).apply(
-            lambda x: "\n".join(client.strip() for client in x.split(",")) if x != "nan" else ""
-        )
-    
-    if "Représentant(s) inclus" in df_export.columns:
-        df_export["Représentant(s) inclus"] = df_export["Représentant(s) inclus"].astype(str).apply(
-            lambda x: "\n".join(rep.strip() for rep in x.split(",")) if x != "nan" else ""
-        )
+        if "Représentant(s) inclus" in df_export.columns:
+            df_export["Représentant(s) inclus"] = df_export["Représentant(s) inclus"].astype(str).apply(
+                lambda x: "\n".join(rep.strip() for rep in x.split(",")) if x != "nan" else ""
+            )
     
-    if "BL inclus" in df_export.columns:
-        df_export["BL inclus"] = df_export["BL inclus"].astype(str).apply(
-            lambda x: "\n".join(bl.strip() for bl in x.split(";")) if x != "nan" else ""
-        )
+        if "BL inclus" in df_export.columns:
+            df_export["BL inclus"] = df_export["BL inclus"].astype(str).apply(
+                lambda x: "\n".join(bl.strip() for bl in x.split(";")) if x != "nan" else ""
+            )
     
-    # Formater les colonnes numériques pour l'export
-    if "Poids total chargé" in df_export.columns:
-        df_export["Poids total chargé"] = df_export["Poids total chargé"].round(3)
-    if "Volume total chargé" in df_export.columns:
-        df_export["Volume total chargé"] = df_export["Volume total chargé"].round(3)
+        # Formater les colonnes numériques pour l'export
+        if "Poids total chargé" in df_export.columns:
+            df_export["Poids total chargé"] = df_export["Poids total chargé"].round(3)
+        if "Volume total chargé" in df_export.columns:
+            df_export["Volume total chargé"] = df_export["Volume total chargé"].round(3)
     
-    # Bouton de téléchargement avec formatage Excel
-    from io import BytesIO
-    import openpyxl
-    from openpyxl.styles import Alignment
+        # Classeur avec formatage Excel
+        from io import BytesIO
+        import openpyxl
+        from openpyxl.styles import Alignment
     
-    excel_buffer = BytesIO()
+        excel_buffer = BytesIO()
     
-    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-        df_export.to_excel(writer, index=False, sheet_name="Voyages Optimisés")
+        with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+            df_export.to_excel(writer, index=False, sheet_name="Voyages Optimisés")
         
-        # Récupérer le workbook et worksheet pour appliquer le formatage
-        workbook = writer.book
-        worksheet = writer.sheets["Voyages Optimisés"]
+            # Récupérer le workbook et worksheet pour appliquer le formatage
+            workbook = writer.book
+            worksheet = writer.sheets["Voyages Optimisés"]
         
-        # Appliquer le style wrap_text aux colonnes avec retours à la ligne
-        wrap_columns = []
-        if "Client(s) inclus" in df_export.columns:
-            wrap_columns.append("Client(s) inclus")
-        if "Représentant(s) inclus" in df_export.columns:
-            wrap_columns.append("Représentant(s) inclus")
-        if "BL inclus" in df_export.columns:
-            wrap_columns.append("BL inclus")
+            # Appliquer le style wrap_text aux colonnes avec retours à la ligne
+            wrap_columns = []
+            if "Client(s) inclus" in df_export.columns:
+                wrap_columns.append("Client(s) inclus")
+            if "Représentant(s) inclus" in df_export.columns:
+                wrap_columns.append("Représentant(s) inclus")
+            if "BL inclus" in df_export.columns:
+                wrap_columns.append("BL inclus")
         
-        # Appliquer le format wrap_text à toutes les cellules des colonnes concernées
-        for col_idx, col_name in enumerate(df_export.columns):
-            if col_name in wrap_columns:
-                col_letter = openpyxl.utils.get_column_letter(col_idx + 1)
-                for row in range(2, len(df_export) + 2):  # Commence à la ligne 2 (après l'en-tête)
-                    cell = worksheet[f"{col_letter}{row}"]
-                    cell.alignment = Alignment(wrap_text=True, vertical='top')
+            # Appliquer le format wrap_text à toutes les cellules des colonnes concernées
+            for col_idx, col_name in enumerate(df_export.columns):
+                if col_name in wrap_columns:
+                    col_letter = openpyxl.utils.get_column_letter(col_idx + 1)
+                    for row in range(2, len(df_export) + 2):  # Commence à la ligne 2 (après l'en-tête)
+                        cell = worksheet[f"{col_letter}{row}"]
+                        cell.alignment = Alignment(wrap_text=True, vertical='top')
         
-        # Ajuster la largeur des colonnes pour une meilleure visibilité
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = openpyxl.utils.get_column_letter(column[0].column)
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)  # Largeur max de 50
-            worksheet.column_dimensions[column_letter].width = adjusted_width
-    
-    excel_buffer.seek(0)
+            # Ajuster la largeur des colonnes pour une meilleure visibilité
+            for column in worksheet.columns:
+                max_length = 0
+                column_letter = openpyxl.utils.get_column_letter(column[0].column)
+                for cell in column:
+                    try:
+                        if len(str(cell.value)) > max_length:
+                            max_length = len(str(cell.value))
+                    except:
+                        pass
+                adjusted_width = min(max_length + 2, 50)  # Largeur max de 50
+                worksheet.column_dimensions[column_letter].width = adjusted_width
+    
+        excel_buffer.seek(0)
+        return excel_buffer.getvalue()
     
     st.download_button(
         label="💾 Télécharger Voyages Estafette Optimisés",
-        data=excel_buffer,
+        data=st.session_state.artefacts.preparer("voyages_estafette_optimises", to_excel_voyages_optimises, df_clean),
         file_name="Voyages_Estafette_Optimises.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
     
-    # Mise à jour pour les sections suivantes
-    st.session_state.df_voyages = df_clean
+    # Mise à jour pour les sections suivantes : nouvelle version du plan seulement quand les
+    # décisions de location ont changé (les transferts et objets enregistrés depuis sont conservés)
+    rental_processor = st.session_state.rental_processor
+    if rental_processor and st.session_state.get("base_location") is not rental_processor.df_base:
+        st.session_state.base_location = rental_processor.df_base
+        premiere_version = st.session_state.get("plan_store") is None or not st.session_state.plan_store.journal
+        enregistrer_plan(df_clean, "Plan initial" if premiere_version else "Décisions de location",
+                         contexte=rental_processor.etat())
+    elif st.session_state.get("plan_store") is None or not st.session_state.plan_store.journal:
+        enregistrer_plan(df_clean, "Plan initial")
+
+    # Historique des modifications : annuler / rétablir / aller à une version (quelques deltas rejoués)
+    magasin = st.session_state.plan_store
+    col_annuler, col_retablir, col_version, col_aller = st.columns([1, 1, 3, 1])
+    with col_annuler:
+        st.button("↩️ Annuler", on_click=annuler_modification_plan, disabled=magasin.version <= 1,
+                  use_container_width=True, key="annuler_plan")
+    with col_retablir:
+        st.button("↪️ Rétablir", on_click=retablir_modification_plan,
+                  disabled=magasin.version >= magasin.derniere_version, use_container_width=True, key="retablir_plan")
+    with col_version:
+        operations = {delta["version"]: delta["operation"] for delta in magasin.journal}
+        st.selectbox("Version du plan", list(operations), index=max(magasin.version - 1, 0),
+                     format_func=lambda v: f"v{v} — {operations[v]}", key="version_plan_cible",
+                     label_visibility="collapsed")
+    with col_aller:
+        st.button("⏩ Aller à", on_click=aller_a_version_plan, disabled=not operations,
+                  use_container_width=True, key="aller_version_plan")
+
+    # Mémoire du plan : calculée seulement quand le panneau est ouvert
+    panneau_memoire = st.expander("🧠 Mémoire du plan (versions et vues partagées)", key="panneau_memoire_plan",
+                                  on_change="rerun")
+    if panneau_memoire.open:
+        with panneau_memoire:
+            memoire = st.session_state.plan_store.memoire()
+            col_version, col_deltas, col_plan, col_journal = st.columns(4)
+            col_version.metric("🔖 Version du plan", memoire["version"])
+            col_deltas.metric("🧾 Deltas enregistrés", memoire["deltas"], f"{memoire['instantanes']} instantané(s)",
+                              delta_color="off")
+            col_plan.metric("📦 Plan courant", f"{memoire['plan_mo']:.3f} Mo")
+            col_journal.metric("🗂️ Journal des deltas", f"{memoire['journal_mo']:.3f} Mo")
+            show_df(st.session_state.plan_store.historique(), use_container_width=True, hide_index=True)
+
+            rental_processor = st.session_state.get("rental_processor")
+            transfer_manager = st.session_state.get("transfer_manager")
+            validateur = st.session_state.get("validateur")
+            df_memoire = memoire_dataframes({
+                "Plan courant (magasin)": st.session_state.plan_store.vue(),
+                "Voyages de la session": st.session_state.df_voyages,
+                "Voyages validés": st.session_state.get("df_voyages_valides"),
+                "Location (df_base)": rental_processor.df_base if rental_processor else None,
+                "Transferts (df_voyages)": transfer_manager.df_voyages if transfer_manager else None,
+                "Validateur (df_voyages)": validateur.df_voyages if validateur else None,
+                "Livraisons": st.session_state.get("df_livraisons"),
+                "Livraisons originales": st.session_state.get("df_livraisons_original"),
+            })
+            show_df(df_memoire, use_container_width=True, hide_index=True)
+            st.caption(f"Mémoire occupée : {df_memoire['Mémoire propre (Mo)'].sum():.3f} Mo "
+                       f"(copies complètes : {df_memoire['Copie complète (Mo)'].sum():.3f} Mo)")
 
 except KeyError as e:
     st.error(f"❌ Erreur de colonne manquante : {e}")
@@ -1502,6 +1652,7 @@ except KeyError as e:
     # Tentative de récupération
     if st.session_state.rental_processor:
         st.session_state.df_voyages = st.session_state.rental_processor.df_base.copy()
+        signaler_vehicules_modifies(None)
         st.rerun()
         
 except Exception as e:
@@ -1511,292 +1662,399 @@ except Exception as e:
     if st.session_state.rental_processor:
         st.write("Colonnes du df_base:", list(st.session_state.rental_processor.df_base.columns))
 # =====================================================
+# 🗓️ PLANIFICATION MULTI-JOURS (HORIZON GLISSANT)
+# =====================================================
+dates_bl = st.session_state.get("dates_bl")
+if st.session_state.data_processed and dates_bl is not None and dates_bl.notna().any():
+    with st.expander("🗓️ Planification multi-jours (horizon glissant sur la date de livraison)"):
+        col_h1, col_h2, col_h3, col_h4 = st.columns(4)
+        with col_h1:
+            nb_jours = st.number_input("Jours de l'horizon", min_value=1, max_value=31, value=5, key="horizon_nb_jours")
+        with col_h2:
+            date_debut = st.date_input("Premier jour", value=(dates_bl.max() - pd.Timedelta(days=nb_jours - 1)).date(),
+                                       key="horizon_date_debut")
+        with col_h3:
+            flexibilite = st.number_input("Avance max. d'un BL (jours)", min_value=0, max_value=7, value=1,
+                                          key="horizon_flexibilite")
+        with col_h4:
+            voyages_max = st.number_input("Voyages max. par jour (0 = illimité)", min_value=0, value=0,
+                                          key="horizon_voyages_max")
+
+        # Lissage : seuls les BLs des clients qui acceptent une livraison anticipée peuvent être avancés
+        df_bls_horizon = st.session_state.df_grouped_zone
+        clients_flexibles = st.multiselect(
+            "Clients acceptant une livraison anticipée (BLs avançables lors du lissage)",
+            sorted(df_bls_horizon["Client de l'estafette"].dropna().astype(str).unique()),
+            key="horizon_clients_flexibles"
+        )
+
+        # Le planificateur est conservé en session : cache par jour et reliquat d'un run à l'autre
+        if st.session_state.get("horizon_planner") is None:
+            st.session_state.horizon_planner = HorizonPlanner(st.session_state.get("fenetres_horaires"))
+        planner = st.session_state.horizon_planner
+        horizon_en_cours = st.session_state.get("job_horizon") is not None
+        if not horizon_en_cours:  # paramètres figés pendant la planification en arrière-plan
+            planner.nb_jours = int(nb_jours)
+            planner.flexibilite_jours = int(flexibilite)
+            planner.voyages_max_jour = int(voyages_max) or None
+
+        if st.button("📆 Planifier l'horizon", key="btn_planifier_horizon", disabled=horizon_en_cours):
+            df_bls_horizon = df_bls_horizon.assign(**{
+                HorizonPlanner.COLONNE_FLEXIBLE: df_bls_horizon["Client de l'estafette"].astype(str).isin(clients_flexibles)
+            })
+            lancer_job("job_horizon", "Planification de l'horizon", planner.planifier,
+                       df_bls_horizon, dates_bl, date_debut)
+        suivre_job("job_horizon", appliquer_horizon)
+
+        if st.session_state.get("horizon_resultat") is not None:
+            df_plan_horizon, df_reliquat, df_resume_horizon = st.session_state.horizon_resultat
+            show_df(df_resume_horizon.assign(**{"Date livraison": df_resume_horizon["Date livraison"].dt.strftime("%d/%m/%Y")}),
+                    use_container_width=True, hide_index=True)
+            st.caption(f"{planner.bls_avances} BL(s) avancé(s) vers des voyages sous-remplis · "
+                       f"{int(df_resume_horizon['Recalculé'].sum())} jour(s) recalculé(s), les autres viennent du cache.")
+            if not df_reliquat.empty:
+                st.warning(f"⚠️ {len(df_reliquat)} BL(s) non planifié(s) (au-delà de l'horizon ou du plafond de voyages) : "
+                           "ils seront repris au prochain run.")
+
+            if not df_plan_horizon.empty:
+                jours_planifies = sorted(df_plan_horizon["Date livraison"].unique())
+                jour_choisi = st.selectbox("Jour à afficher", jours_planifies,
+                                           format_func=lambda d: pd.Timestamp(d).strftime("%d/%m/%Y"),
+                                           key="horizon_jour_choisi")
+                df_jour = df_plan_horizon[df_plan_horizon["Date livraison"] == jour_choisi]
+                show_df(df_jour.drop(columns=["Date livraison"]), use_container_width=True, hide_index=True)
+
+                if st.button("📌 Utiliser ce jour comme plan courant", key="btn_horizon_plan_courant"):
+                    st.session_state.rental_processor = TruckRentalProcessor(
+                        df_jour.drop(columns=["Date livraison"]).reset_index(drop=True),
+                        st.session_state.df_livraisons_original,
+                        st.session_state.get("fenetres_horaires")
+                    )
+                    update_propositions_view()
+                    st.rerun()
+
+# =====================================================
 # 5️⃣ TRANSFERT DES BLs ENTRE ESTAFETTES / CAMIONS - VERSION AMÉLIORÉE
 # =====================================================
 st.markdown("## 🔁 Transfert de BLs entre Estafettes / Camions")
 
 MAX_POIDS = 1550  # kg
 MAX_VOLUME = 4.608  # m³
+NB_SUGGESTIONS_CIBLES = 5  # voisins recherchés dans l'index spatial (détour estimé)
+
+def clients_des_bls(df_livraisons):
+    """Client de chaque BL (première ligne du BL dans les livraisons)."""
+    premieres = df_livraisons.drop_duplicates(subset="No livraison")
+    return dict(zip(premieres["No livraison"], premieres["Client de l'estafette"]))
+
+@section_fragment
+def section_transfert():
+    if "df_voyages" not in st.session_state:
+        st.warning("⚠️ Vous devez d'abord exécuter la section 4 (Voyages par Estafette Optimisé).")
+    elif "df_livraisons" not in st.session_state:
+        st.warning("⚠️ Le DataFrame des livraisons détaillées n'est pas disponible.")
+    else:
+        # Vues en lecture seule (copy-on-write) : le transfert produit un nouveau plan
+        df_voyages = st.session_state.df_voyages
+        df_livraisons = st.session_state.df_livraisons
+
+        colonnes_requises = ["Zone", "Véhicule N°", "Poids total chargé", "Volume total chargé", "BL inclus"]
+
+        if not all(col in df_voyages.columns for col in colonnes_requises):
+            st.error(f"❌ Le DataFrame ne contient pas toutes les colonnes nécessaires : {', '.join(colonnes_requises)}")
+        else:
+            zones_disponibles = sorted(df_voyages["Zone"].dropna().unique().tolist())
+            zone_selectionnee = st.selectbox("🌍 Sélectionner une zone", zones_disponibles)
+
+            if zone_selectionnee:
+                df_zone = df_voyages[df_voyages["Zone"] == zone_selectionnee]
+                vehicules = sorted(df_zone["Véhicule N°"].dropna().unique().tolist())
+
+                col1, col2 = st.columns(2)
+                with col1:
+                    source = st.selectbox("🚐 Estafette / Camion source", vehicules)
+
+                # --- Classement des cibles par l'index spatial (détour ajouté + capacité restante) ---
+                suggestions_cibles = None
+                options_cibles = [v for v in vehicules if v != source]
+                if source and st.session_state.get("df_clients_gps") is not None:
+                    try:
+                        bls_source = str(df_zone[df_zone["Véhicule N°"] == source]["BL inclus"].iloc[0]).split(";")
+                        # Les BLs déjà cochés (valeur du multiselect au rerun précédent) priment sur tout le véhicule
+                        bls_coches = [opt.split(" - ")[0] for opt in st.session_state.get("bls_transfert_select", [])]
+                        bls_coches = [bl for bl in bls_coches if bl in bls_source]
+                        # Index reconstruit seulement quand les voyages, livraisons ou positions changent
+                        index_spatial = entree_section(
+                            "index_spatial", VoyageSpatialIndex, df_voyages, df_livraisons, st.session_state.df_clients_gps
+                        )
+                        suggestions_cibles = index_spatial.suggerer_cibles(
+                            source, bls_coches or bls_source, zone=zone_selectionnee, k=NB_SUGGESTIONS_CIBLES
+                        )
+                        options_cibles = suggestions_cibles["Véhicule N°"].tolist()
+                    except Exception as e:
+                        st.warning(f"⚠️ Suggestions de cibles indisponibles : {str(e)}")
+                with col2:
+                    cible = st.selectbox("🎯 Estafette / Camion cible (classées par pertinence)", options_cibles)
+
+                if source and cible:
+                    df_source = df_zone[df_zone["Véhicule N°"] == source]
+                    if df_source.empty or df_source["BL inclus"].isna().all():
+                        st.warning("⚠️ Aucun BL trouvé pour ce véhicule source.")
+                    else:
+                        st.subheader(f"📦 BLs actuellement assignés à {source}")
+
+                        # --- NOUVEAU : Créer un mapping BL → Client ---
+                        clients_par_bl = entree_section("clients_par_bl", clients_des_bls, df_livraisons)
+                        bls_simples = df_source["BL inclus"].iloc[0].split(";")
+                        bls_avec_clients = [f"{bl} - {clients_par_bl.get(bl, 'Client non trouvé')}" for bl in bls_simples]
+                    
+                        # Affichage formaté avec clients
+                        df_source_display = df_source[["Véhicule N°", "Poids total chargé", "Volume total chargé"]].copy()
+                        df_source_display["BL inclus (avec clients)"] = "<br>".join(bls_avec_clients)
+                    
+                        df_source_display["Poids total chargé"] = df_source_display["Poids total chargé"].map(lambda x: f"{x:.3f} kg")
+                        df_source_display["Volume total chargé"] = df_source_display["Volume total chargé"].map(lambda x: f"{x:.3f} m³")
+                    
+                        # CSS AMÉLIORÉ pour un tableau plus visible et bien centré
+                        st.markdown("""
+                        <style>
+                        .centered-table {
+                            margin-left: auto;
+                            margin-right: auto;
+                            display: table;
+                            width: 100%;
+                        }
+                        .centered-table table {
+                            margin: 0 auto;
+                            border-collapse: collapse;
+                            width: 100%;
+                            font-family: Arial, sans-serif;
+                            box-shadow: 0 2px 8px rgba(0,0,0,0.1);
+                        }
+                        .centered-table th {
+                            background-color: #0369A1;
+                            color: white;
+                            padding: 12px 8px;
+                            text-align: center;
+                            border: 2px solid #555;
+                            font-weight: bold;
+                            font-size: 14px;
+                            vertical-align: middle;  /* ← CENTRAGE VERTICAL AJOUTÉ */
+                        }
+                        .centered-table td {
+                            padding: 10px 8px;
+                            text-align: center;
+                            border: 2px solid #555;
+                            background-color: #f9f9f9;
+                            color: #333;
+                            vertical-align: middle;  /* ← CENTRAGE VERTICAL AJOUTÉ */
+                        }
+                        .centered-table tr:nth-child(even) td {
+                            background-color: #f0f0f0;
+                        }
+                        .centered-table tr:hover td {
+                            background-color: #e6f3ff;
+                        }
+                        </style>
+                        """, unsafe_allow_html=True)
+                        # CSS SPÉCIFIQUE POUR LE MULTISELECT - VERSION GRIS
+                        st.markdown("""
+                        <style>
+                        /* ===== STYLES POUR LE MULTISELECT DES BLs ===== */
+
+                        /* APPROCHE 1 : Style général pour tous les multiselect */
+                        .stMultiSelect > div > div {
+                            background-color: #F8FAFC !important;  /* GRIS TRÈS CLAIR */
+                            border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
+                            border-radius: 8px !important;
+                        }
+
+                        /* APPROCHE 2 : Style pour le conteneur du multiselect */
+                        div[data-baseweb="select"] > div {
+                            background-color: #F8FAFC !important;  /* GRIS TRÈS CLAIR */
+                            border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
+                            border-radius: 8px !important;
+                        }
+
+                        /* APPROCHE 3 : Style spécifique pour l'input */
+                        div[data-baseweb="select"] > div:first-child {
+                            background-color: #F8FAFC !important;  /* GRIS TRÈS CLAIR */
+                            border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
+                            border-radius: 8px !important;
+                        }
+
+                        /* Style pour les tags des éléments sélectionnés */
+                        div[data-baseweb="select"] span[data-baseweb="tag"] {
+                            background-color: #0369A1 !important;  /* GRIS MOYEN */
+                            color: white !important;
+                            border-radius: 12px !important;
+                            font-weight: bold;
+                        }
+
+                        /* Style pour la dropdown */
+                        div[role="listbox"] {
+                            background-color: white !important;
+                            border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
+                        }
+
+                        /* Options sélectionnées dans la liste */
+                        div[role="option"][aria-selected="true"] {
+                            background-color: #F1F5F9 !important;  /* GRIS TRÈS CLAIR */
+                            color: #475569 !important;  /* GRIS FONCÉ */
+                        }
+
+                        /* Options au survol */
+                        div[role="option"]:hover {
+                            background-color: #E2E8F0 !important;  /* GRIS CLAIR */
+                        }
+                        </style>
+                        """, unsafe_allow_html=True)
+                        # --- NOUVEAU : Sélection avec clients ---
+                        st.subheader("📋 Sélectionner les BLs à transférer")
+                    
+                        # Créer les options avec format "BL - Client"
+                        options_transfert = []
+                        mapping_bl_original = {}  # Pour garder la correspondance BL original
+                    
+                        for bl, option_affichage in zip(bls_simples, bls_avec_clients):
+                            options_transfert.append(option_affichage)
+                            mapping_bl_original[option_affichage] = bl
+                    
+                        # Multiselect avec clients
+                        bls_selectionnes_affichage = st.multiselect(
+                            "Sélectionnez les BLs à transférer (avec clients) :", 
+                            options_transfert,
+                            format_func=lambda x: x,  # Affiche tel quel le format "BL - Client"
+                            key="bls_transfert_select"
+                        )
+
+                        # Suggestions de véhicules cibles
+                        if suggestions_cibles is not None and not suggestions_cibles.empty:
+                            st.markdown("**🧭 Véhicules cibles suggérés** (détour estimé et capacité restante pour les BLs sélectionnés)")
+                            show_df(suggestions_cibles.head(NB_SUGGESTIONS_CIBLES), use_container_width=True, hide_index=True)
+                    
+                        # Convertir la sélection en BLs simples pour le traitement
+                        bls_selectionnes = [mapping_bl_original[bl_affichage] for bl_affichage in bls_selectionnes_affichage]
+
+                        if bls_selectionnes and st.button("🔁 Exécuter le transfert"):
+                            df_bls_selection = df_livraisons[df_livraisons["No livraison"].isin(bls_selectionnes)]
+                            poids_bls = df_bls_selection["Poids total"].sum()
+                            volume_bls = df_bls_selection["Volume total"].sum()
+
+                            df_cible = df_zone[df_zone["Véhicule N°"] == cible]
+                            poids_cible = df_cible["Poids total chargé"].sum()
+                            volume_cible = df_cible["Volume total chargé"].sum()
+
+                            if (poids_cible + poids_bls) > MAX_POIDS or (volume_cible + volume_bls) > MAX_VOLUME:
+                                st.warning("⚠️ Le transfert dépasse les limites de poids ou volume du véhicule cible.")
+                            else:
+                                def transfer_bl(row):
+                                    bls = row["BL inclus"].split(";") if pd.notna(row["BL inclus"]) else []
+                                    bls_to_move = [b for b in bls if b in bls_selectionnes]
+
+                                    if row["Véhicule N°"] == source:
+                                        new_bls = [b for b in bls if b not in bls_to_move]
+                                        row["BL inclus"] = ";".join(new_bls)
+                                        row["Poids total chargé"] = max(0, row["Poids total chargé"] - poids_bls)
+                                        row["Volume total chargé"] = max(0, row["Volume total chargé"] - volume_bls)
+                                    elif row["Véhicule N°"] == cible:
+                                        new_bls = bls + bls_to_move
+                                        row["BL inclus"] = ";".join(new_bls)
+                                        row["Poids total chargé"] += poids_bls
+                                        row["Volume total chargé"] += volume_bls
+                                    return row
+
+                                df_voyages = df_voyages.apply(transfer_bl, axis=1)
+                                lignes_modifiees = df_voyages[df_voyages["Véhicule N°"].isin([source, cible])]
+                                df_voyages = enregistrer_plan(
+                                    df_voyages, f"Transfert {source} → {cible}",
+                                    vehicules_modifies=zip(lignes_modifiees["Zone"], lignes_modifiees["Véhicule N°"])
+                                )
+                                afficher_resultat_transfert(
+                                    bls_selectionnes, source, cible, df_bls_selection, poids_bls, volume_bls,
+                                    df_voyages, colonnes_requises
+                                )
+
+
+def afficher_resultat_transfert(bls_selectionnes, source, cible, df_bls_selection, poids_bls, volume_bls,
+                                df_voyages, colonnes_requises):
+    """Résumé du transfert, voyages mis à jour (toutes zones) et export Excel."""
+    # Afficher un résumé du transfert avec clients
+    clients_transferes = df_bls_selection["Client de l'estafette"].unique()
+    st.success(f"""
+    ✅ Transfert réussi !
+    - **{len(bls_selectionnes)} BL(s)** déplacé(s) de **{source}** vers **{cible}**
+    - **Clients concernés :** {', '.join(clients_transferes)}
+    - **Poids transféré :** {poids_bls:.1f} kg
+    - **Volume transféré :** {volume_bls:.3f} m³
+    """)
+
+    # --- Affichage Streamlit avec retours à la ligne ---
+    st.subheader("📊 Voyages après transfert (toutes les zones)")
+    df_display = df_voyages.sort_values(by=["Zone", "Véhicule N°"]).copy()
+
+    # Transformer les colonnes avec retours à la ligne HTML
+    if "BL inclus" in df_display.columns:
+        df_display["BL inclus"] = df_display["BL inclus"].astype(str).apply(
+            lambda x: "<br>".join(bl.strip() for bl in x.split(";")) if x != "nan" else ""
+        )
+
+    df_display["Poids total chargé"] = df_display["Poids total chargé"].map(lambda x: f"{x:.3f} kg")
+    df_display["Volume total chargé"] = df_display["Volume total chargé"].map(lambda x: f"{x:.3f} m³")
+
+    # Affichage avec HTML amélioré pour les retours à la ligne et centrage
+    html_content_after = f"""
+    <div class="centered-table">
+    {df_display[colonnes_requises].to_html(escape=False, index=False)}
+    </div>
+    """
+    st.markdown(html_content_after, unsafe_allow_html=True)
+
+    st.download_button(
+        label="💾 Télécharger le tableau mis à jour (XLSX)",
+        data=st.session_state.artefacts.preparer("voyages_apres_transfert", excel_apres_transfert, df_voyages),
+        file_name="voyages_apres_transfert.xlsx",
+        mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        on_click="ignore"
+    )
 
-if "df_voyages" not in st.session_state:
-    st.warning("⚠️ Vous devez d'abord exécuter la section 4 (Voyages par Estafette Optimisé).")
-elif "df_livraisons" not in st.session_state:
-    st.warning("⚠️ Le DataFrame des livraisons détaillées n'est pas disponible.")
-else:
-    df_voyages = st.session_state.df_voyages.copy()
-    df_livraisons = st.session_state.df_livraisons.copy()
 
-    colonnes_requises = ["Zone", "Véhicule N°", "Poids total chargé", "Volume total chargé", "BL inclus"]
+def excel_apres_transfert(df_voyages):
+    """Export Excel des voyages après transfert, BLs avec retours à la ligne \\n."""
+    from io import BytesIO
+    import openpyxl
+    from openpyxl.styles import Alignment
 
-    if not all(col in df_voyages.columns for col in colonnes_requises):
-        st.error(f"❌ Le DataFrame ne contient pas toutes les colonnes nécessaires : {', '.join(colonnes_requises)}")
-    else:
-        zones_disponibles = sorted(df_voyages["Zone"].dropna().unique().tolist())
-        zone_selectionnee = st.selectbox("🌍 Sélectionner une zone", zones_disponibles)
+    df_export = df_voyages.copy()
 
-        if zone_selectionnee:
-            df_zone = df_voyages[df_voyages["Zone"] == zone_selectionnee]
-            vehicules = sorted(df_zone["Véhicule N°"].dropna().unique().tolist())
+    # Transformer les BL avec retours à la ligne \n pour Excel
+    if "BL inclus" in df_export.columns:
+        df_export["BL inclus"] = df_export["BL inclus"].astype(str).apply(
+            lambda x: "\n".join(bl.strip() for bl in x.split(";")) if x != "nan" else ""
+        )
 
-            col1, col2 = st.columns(2)
-            with col1:
-                source = st.selectbox("🚐 Estafette / Camion source", vehicules)
-            with col2:
-                cible = st.selectbox("🎯 Estafette / Camion cible", [v for v in vehicules if v != source])
+    df_export["Poids total chargé"] = df_export["Poids total chargé"].round(3)
+    df_export["Volume total chargé"] = df_export["Volume total chargé"].round(3)
 
-            if source and cible:
-                df_source = df_zone[df_zone["Véhicule N°"] == source]
-                if df_source.empty or df_source["BL inclus"].isna().all():
-                    st.warning("⚠️ Aucun BL trouvé pour ce véhicule source.")
-                else:
-                    st.subheader(f"📦 BLs actuellement assignés à {source}")
+    excel_buffer = BytesIO()
+    with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
+        df_export.to_excel(writer, index=False, sheet_name='Transfert BLs')
 
-                    # --- NOUVEAU : Créer un mapping BL → Client ---
-                    bls_avec_clients = []
-                    bls_simples = df_source["BL inclus"].iloc[0].split(";")
-                    
-                    for bl in bls_simples:
-                        # Trouver le client correspondant à ce BL
-                        client_info = df_livraisons[df_livraisons["No livraison"] == bl]
-                        if not client_info.empty:
-                            client_nom = client_info["Client de l'estafette"].iloc[0]
-                            bl_affichage = f"{bl} - {client_nom}"
-                        else:
-                            bl_affichage = f"{bl} - Client non trouvé"
-                        bls_avec_clients.append(bl_affichage)
-                    
-                    # Affichage formaté avec clients
-                    df_source_display = df_source[["Véhicule N°", "Poids total chargé", "Volume total chargé"]].copy()
-                    df_source_display["BL inclus (avec clients)"] = "<br>".join(bls_avec_clients)
-                    
-                    df_source_display["Poids total chargé"] = df_source_display["Poids total chargé"].map(lambda x: f"{x:.3f} kg")
-                    df_source_display["Volume total chargé"] = df_source_display["Volume total chargé"].map(lambda x: f"{x:.3f} m³")
-                    
-                    # CSS AMÉLIORÉ pour un tableau plus visible et bien centré
-                    st.markdown("""
-                    <style>
-                    .centered-table {
-                        margin-left: auto;
-                        margin-right: auto;
-                        display: table;
-                        width: 100%;
-                    }
-                    .centered-table table {
-                        margin: 0 auto;
-                        border-collapse: collapse;
-                        width: 100%;
-                        font-family: Arial, sans-serif;
-                        box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-                    }
-                    .centered-table th {
-                        background-color: #0369A1;
-                        color: white;
-                        padding: 12px 8px;
-                        text-align: center;
-                        border: 2px solid #555;
-                        font-weight: bold;
-                        font-size: 14px;
-                        vertical-align: middle;  /* ← CENTRAGE VERTICAL AJOUTÉ */
-                    }
-                    .centered-table td {
-                        padding: 10px 8px;
-                        text-align: center;
-                        border: 2px solid #555;
-                        background-color: #f9f9f9;
-                        color: #333;
-                        vertical-align: middle;  /* ← CENTRAGE VERTICAL AJOUTÉ */
-                    }
-                    .centered-table tr:nth-child(even) td {
-                        background-color: #f0f0f0;
-                    }
-                    .centered-table tr:hover td {
-                        background-color: #e6f3ff;
-                    }
-                    </style>
-                    """, unsafe_allow_html=True)
-                    # CSS SPÉCIFIQUE POUR LE MULTISELECT - VERSION GRIS
-                    st.markdown("""
-                    <style>
-                    /* ===== STYLES POUR LE MULTISELECT DES BLs ===== */
-
-                    /* APPROCHE 1 : Style général pour tous les multiselect */
-                    .stMultiSelect > div > div {
-                        background-color: #F8FAFC !important;  /* GRIS TRÈS CLAIR */
-                        border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
-                        border-radius: 8px !important;
-                    }
-
-                    /* APPROCHE 2 : Style pour le conteneur du multiselect */
-                    div[data-baseweb="select"] > div {
-                        background-color: #F8FAFC !important;  /* GRIS TRÈS CLAIR */
-                        border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
-                        border-radius: 8px !important;
-                    }
-
-                    /* APPROCHE 3 : Style spécifique pour l'input */
-                    div[data-baseweb="select"] > div:first-child {
-                        background-color: #F8FAFC !important;  /* GRIS TRÈS CLAIR */
-                        border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
-                        border-radius: 8px !important;
-                    }
-
-                    /* Style pour les tags des éléments sélectionnés */
-                    div[data-baseweb="select"] span[data-baseweb="tag"] {
-                        background-color: #0369A1 !important;  /* GRIS MOYEN */
-                        color: white !important;
-                        border-radius: 12px !important;
-                        font-weight: bold;
-                    }
-
-                    /* Style pour la dropdown */
-                    div[role="listbox"] {
-                        background-color: white !important;
-                        border: 2px solid #CBD5E1 !important;  /* GRIS CLAIR */
-                    }
-
-                    /* Options sélectionnées dans la liste */
-                    div[role="option"][aria-selected="true"] {
-                        background-color: #F1F5F9 !important;  /* GRIS TRÈS CLAIR */
-                        color: #475569 !important;  /* GRIS FONCÉ */
-                    }
-
-                    /* Options au survol */
-                    div[role="option"]:hover {
-                        background-color: #E2E8F0 !important;  /* GRIS CLAIR */
-                    }
-                    </style>
-                    """, unsafe_allow_html=True)
-                    # --- NOUVEAU : Sélection avec clients ---
-                    st.subheader("📋 Sélectionner les BLs à transférer")
-                    
-                    # Créer les options avec format "BL - Client"
-                    options_transfert = []
-                    mapping_bl_original = {}  # Pour garder la correspondance BL original
-                    
-                    for bl in bls_simples:
-                        client_info = df_livraisons[df_livraisons["No livraison"] == bl]
-                        if not client_info.empty:
-                            client_nom = client_info["Client de l'estafette"].iloc[0]
-                            option_affichage = f"{bl} - {client_nom}"
-                        else:
-                            option_affichage = f"{bl} - Client non trouvé"
-                        
-                        options_transfert.append(option_affichage)
-                        mapping_bl_original[option_affichage] = bl
-                    
-                    # Multiselect avec clients
-                    bls_selectionnes_affichage = st.multiselect(
-                        "Sélectionnez les BLs à transférer (avec clients) :", 
-                        options_transfert,
-                        format_func=lambda x: x  # Affiche tel quel le format "BL - Client"
-                    )
-                    
-                    # Convertir la sélection en BLs simples pour le traitement
-                    bls_selectionnes = [mapping_bl_original[bl_affichage] for bl_affichage in bls_selectionnes_affichage]
-
-                    if bls_selectionnes and st.button("🔁 Exécuter le transfert"):
-                        df_bls_selection = df_livraisons[df_livraisons["No livraison"].isin(bls_selectionnes)]
-                        poids_bls = df_bls_selection["Poids total"].sum()
-                        volume_bls = df_bls_selection["Volume total"].sum()
-
-                        df_cible = df_zone[df_zone["Véhicule N°"] == cible]
-                        poids_cible = df_cible["Poids total chargé"].sum()
-                        volume_cible = df_cible["Volume total chargé"].sum()
-
-                        if (poids_cible + poids_bls) > MAX_POIDS or (volume_cible + volume_bls) > MAX_VOLUME:
-                            st.warning("⚠️ Le transfert dépasse les limites de poids ou volume du véhicule cible.")
-                        else:
-                            def transfer_bl(row):
-                                bls = row["BL inclus"].split(";") if pd.notna(row["BL inclus"]) else []
-                                bls_to_move = [b for b in bls if b in bls_selectionnes]
-
-                                if row["Véhicule N°"] == source:
-                                    new_bls = [b for b in bls if b not in bls_to_move]
-                                    row["BL inclus"] = ";".join(new_bls)
-                                    row["Poids total chargé"] = max(0, row["Poids total chargé"] - poids_bls)
-                                    row["Volume total chargé"] = max(0, row["Volume total chargé"] - volume_bls)
-                                elif row["Véhicule N°"] == cible:
-                                    new_bls = bls + bls_to_move
-                                    row["BL inclus"] = ";".join(new_bls)
-                                    row["Poids total chargé"] += poids_bls
-                                    row["Volume total chargé"] += volume_bls
-                                return row
-
-                            df_voyages = df_voyages.apply(transfer_bl, axis=1)
-                            st.session_state.df_voyages = df_voyages
-                            
-                            # Afficher un résumé du transfert avec clients
-                            clients_transferes = df_bls_selection["Client de l'estafette"].unique()
-                            st.success(f"""
-                            ✅ Transfert réussi !
-                            - **{len(bls_selectionnes)} BL(s)** déplacé(s) de **{source}** vers **{cible}**
-                            - **Clients concernés :** {', '.join(clients_transferes)}
-                            - **Poids transféré :** {poids_bls:.1f} kg
-                            - **Volume transféré :** {volume_bls:.3f} m³
-                            """)
-
-                            # --- Affichage Streamlit avec retours à la ligne ---
-                            st.subheader("📊 Voyages après transfert (toutes les zones)")
-                            df_display = df_voyages.sort_values(by=["Zone", "Véhicule N°"]).copy()
-                            
-                            # Transformer les colonnes avec retours à la ligne HTML
-                            if "BL inclus" in df_display.columns:
-                                df_display["BL inclus"] = df_display["BL inclus"].astype(str).apply(
-                                    lambda x: "<br>".join(bl.strip() for bl in x.split(";")) if x != "nan" else ""
-                                )
-                            
-                            df_display["Poids total chargé"] = df_display["Poids total chargé"].map(lambda x: f"{x:.3f} kg")
-                            df_display["Volume total chargé"] = df_display["Volume total chargé"].map(lambda x: f"{x:.3f} m³")
-                            
-                            # Affichage avec HTML amélioré pour les retours à la ligne et centrage
-                            html_content_after = f"""
-                            <div class="centered-table">
-                            {df_display[colonnes_requises].to_html(escape=False, index=False)}
-                            </div>
-                            """
-                            st.markdown(html_content_after, unsafe_allow_html=True)
-
-                            # --- Export Excel avec retours à la ligne \n ---
-                            df_export = df_voyages.copy()
-                            
-                            # Transformer les BL avec retours à la ligne \n pour Excel
-                            if "BL inclus" in df_export.columns:
-                                df_export["BL inclus"] = df_export["BL inclus"].astype(str).apply(
-                                    lambda x: "\n".join(bl.strip() for bl in x.split(";")) if x != "nan" else ""
-                                )
-                            
-                            df_export["Poids total chargé"] = df_export["Poids total chargé"].round(3)
-                            df_export["Volume total chargé"] = df_export["Volume total chargé"].round(3)
+        # Appliquer le format wrap_text pour Excel
+        worksheet = writer.sheets['Transfert BLs']
 
-                            from io import BytesIO
-                            import openpyxl
-                            from openpyxl.styles import Alignment
-                            
-                            excel_buffer = BytesIO()
-                            with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                                df_export.to_excel(writer, index=False, sheet_name='Transfert BLs')
-                                
-                                # Appliquer le format wrap_text pour Excel
-                                workbook = writer.book
-                                worksheet = writer.sheets['Transfert BLs']
-                                
-                                # Appliquer le style wrap_text à la colonne BL inclus
-                                if "BL inclus" in df_export.columns:
-                                    for col_idx, col_name in enumerate(df_export.columns):
-                                        if col_name == "BL inclus":
-                                            col_letter = openpyxl.utils.get_column_letter(col_idx + 1)
-                                            for row in range(2, len(df_export) + 2):
-                                                cell = worksheet[f"{col_letter}{row}"]
-                                                cell.alignment = Alignment(wrap_text=True, vertical='top')
-                            
-                            excel_buffer.seek(0)
+        # Appliquer le style wrap_text à la colonne BL inclus
+        if "BL inclus" in df_export.columns:
+            for col_idx, col_name in enumerate(df_export.columns):
+                if col_name == "BL inclus":
+                    col_letter = openpyxl.utils.get_column_letter(col_idx + 1)
+                    for row in range(2, len(df_export) + 2):
+                        cell = worksheet[f"{col_letter}{row}"]
+                        cell.alignment = Alignment(wrap_text=True, vertical='top')
 
-                            st.download_button(
-                                label="💾 Télécharger le tableau mis à jour (XLSX)",
-                                data=excel_buffer,
-                                file_name="voyages_apres_transfert.xlsx",
-                                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                            )
+    return excel_buffer.getvalue()
+
+section_transfert()
 # =====================================================
 # 6️⃣ AJOUT D'OBJETS MANUELS AUX VÉHICULES
 # =====================================================
@@ -1804,13 +2062,16 @@ st.markdown("## 📦 AJOUT D'OBJETS MANUELS AUX VÉHICULES")
 
 if "df_voyages" in st.session_state:
     # Initialiser le gestionnaire de transfert si pas déjà fait
+    if st.session_state.get("validateur") is None:
+        st.session_state.validateur = VoyageValidator(st.session_state.df_voyages)
     if "transfer_manager" not in st.session_state:
         st.session_state.transfer_manager = TruckTransferManager(
             st.session_state.df_voyages, 
-            st.session_state.df_livraisons
+            st.session_state.df_livraisons,
+            validateur=st.session_state.validateur
         )
     
-    df_voyages = st.session_state.df_voyages.copy()
+    df_voyages = st.session_state.df_voyages  # vue en lecture seule, add_manual_object crée la nouvelle version
     
     #st.info("""
     #**Fonctionnalité :** Ajouter des objets manuels (colis urgents, matériel supplémentaire) 
@@ -1933,27 +2194,31 @@ if "df_voyages" in st.session_state:
                     # MÉCANISME DE MISE À JOUR FORCÉE DE TOUTES LES DONNÉES
                     # =====================================================
                     
-                    # 1. Mettre à jour le DataFrame principal dans session_state
-                    st.session_state.df_voyages = df_updated
+                    # 1. Nouvelle version du plan (delta de la ligne du véhicule)
+                    enregistrer_plan(df_updated, f"Objet {nom_objet} → {vehicule_objet}",
+                                     vehicules_modifies=[(zone_objet, vehicule_objet)])
                     
                     # 2. Synchroniser le gestionnaire de transfert
-                    st.session_state.transfer_manager.df_voyages = df_updated.copy()
+                    st.session_state.transfer_manager.df_voyages = st.session_state.plan_store.vue()
                     
                     # 3. Synchroniser le processeur de location si disponible
                     if st.session_state.rental_processor:
                         try:
                             # Méthode 1 : Mettre à jour directement le df_base
-                            st.session_state.rental_processor.df_base = df_updated.copy()
+                            st.session_state.rental_processor.df_base = st.session_state.plan_store.vue()
                             
                             # Méthode 2 : Recréer le processeur si nécessaire
                             st.session_state.rental_processor = TruckRentalProcessor(
                                 df_updated, 
-                                st.session_state.df_livraisons_original
+                                st.session_state.df_livraisons_original,
+                                st.session_state.get("fenetres_horaires")
                             )
                             
                             st.success("✅ Processeur de location synchronisé")
                         except Exception as e:
                             st.warning(f"⚠️ Synchronisation partielle du processeur : {str(e)}")
+                        # Le plan de base synchronisé n'est pas une nouvelle décision de location
+                        st.session_state.base_location = st.session_state.rental_processor.df_base
                     
                     # 4. Mettre à jour les propositions de location si elles existent
                     if st.session_state.propositions is not None:
@@ -1969,7 +2234,7 @@ if "df_voyages" in st.session_state:
                             mask_valides = df_updated["Véhicule N°"].isin(
                                 st.session_state.df_voyages_valides["Véhicule N°"]
                             )
-                            st.session_state.df_voyages_valides = df_updated[mask_valides].copy()
+                            st.session_state.df_voyages_valides = df_updated[mask_valides]
                         except:
                             pass  # Ignorer si la mise à jour des validations échoute
                     
@@ -2039,20 +2304,19 @@ if "df_voyages" in st.session_state:
         col_clear1, col_clear2 = st.columns([3, 1])
         with col_clear2:
             if st.button("🗑️ Supprimer tous les objets", type="secondary"):
-                # Réinitialiser les données sans objets manuels
-                df_sans_objets = st.session_state.df_voyages.copy()
-                for idx, row in df_sans_objets.iterrows():
-                    bls_originaux = str(row["BL inclus"]).split(";")
-                    bls_filtres = [bl for bl in bls_originaux if not bl.startswith("OBJ-")]
-                    df_sans_objets.at[idx, "BL inclus"] = ";".join(bls_filtres)
+                # Réinitialiser les données sans objets manuels (poids/volume des objets suivis déduits)
+                _, message_suppression, df_sans_objets = st.session_state.transfer_manager.supprimer_objets_manuels(
+                    st.session_state.df_voyages
+                )
                 
                 # Réappliquer la mise à jour forcée
-                st.session_state.df_voyages = df_sans_objets
-                st.session_state.transfer_manager.df_voyages = df_sans_objets.copy()
+                enregistrer_plan(df_sans_objets, "Suppression des objets manuels")
+                st.session_state.transfer_manager.df_voyages = st.session_state.plan_store.vue()
                 if st.session_state.rental_processor:
-                    st.session_state.rental_processor.df_base = df_sans_objets.copy()
+                    st.session_state.rental_processor.df_base = st.session_state.plan_store.vue()
+                    st.session_state.base_location = st.session_state.rental_processor.df_base
                 
-                st.success("✅ Tous les objets manuels ont été supprimés")
+                st.success(message_suppression)
                 st.rerun()
     else:
         st.info(" Aucun objet manuel ajouté pour le moment.")
@@ -2121,145 +2385,170 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# --- Création du DataFrame de validation à partir du df_voyages ---
-if "df_voyages" in st.session_state:
-    voyages_apres_transfert = st.session_state.df_voyages.copy()
-    df_validation = voyages_apres_transfert.copy()
+@section_fragment
+def section_validation():
+    # --- Création du DataFrame de validation à partir du df_voyages ---
+    if "df_voyages" in st.session_state:
+        voyages_apres_transfert = st.session_state.df_voyages.copy()
+        df_validation = voyages_apres_transfert.copy()
 
-    if "validations" not in st.session_state:
-        st.session_state.validations = {}
+        if "validations" not in st.session_state:
+            st.session_state.validations = {}
 
-    # --- Affichage amélioré des voyages ---
-    st.markdown("### 📋 Liste des Voyages à Valider")
-    
-    for idx, row in df_validation.iterrows():
-        # Création d'une carte pour chaque voyage
-        with st.container():
-            st.markdown(f"""
-            <div class="voyage-card">
-                <div class="voyage-header">
-                    <h4>🚚 Voyage {row['Véhicule N°']} | Zone: {row['Zone']}</h4>
-                </div>
-            """, unsafe_allow_html=True)
-            
-            # Métriques principales
-            col1, col2, col3 = st.columns(3)
-            
-            with col1:
-                st.markdown(f"""
-                <div class="metric-card">
-                    <strong>⚖️ Poids Total</strong><br>
-                    {row['Poids total chargé']:.3f} kg
-                </div>
-                """, unsafe_allow_html=True)
-            
-            with col2:
-                st.markdown(f"""
-                <div class="metric-card">
-                    <strong>📏 Volume Total</strong><br>
-                    {row['Volume total chargé']:.3f} m³
-                </div>
-                """, unsafe_allow_html=True)
-            
-            with col3:
-                taux_occupation = row.get('Taux d\'occupation (%)', 'N/A')
-                if taux_occupation != 'N/A':
-                    taux_text = f"{taux_occupation:.1f}%"
-                else:
-                    taux_text = "N/A"
+        # --- Affichage amélioré des voyages ---
+        st.markdown("### 📋 Liste des Voyages à Valider")
+
+        # Seule la page courante (filtrée par zone / véhicule) est rendue en cartes
+        for idx, row in vue_paginee(df_validation, "validation", taille_defaut=10).iterrows():
+            # Création d'une carte pour chaque voyage
+            with st.container():
                 st.markdown(f"""
-                <div class="metric-card">
-                    <strong>📊 Taux d'Occupation</strong><br>
-                    {taux_text}
-                </div>
+                <div class="voyage-card">
+                    <div class="voyage-header">
+                        <h4>🚚 Voyage {row['Véhicule N°']} | Zone: {row['Zone']}</h4>
+                    </div>
                 """, unsafe_allow_html=True)
             
-            # Informations détaillées
-            col4, col5 = st.columns(2)
+                # Métriques principales
+                col1, col2, col3 = st.columns(3)
             
-            with col4:
-                clients = row.get('Client(s) inclus', '')
-                if clients:
-                    st.markdown(f"**👥 Clients:** {clients}")
-                
-                representants = row.get('Représentant(s) inclus', '')
-                if representants:
-                    st.markdown(f"**👨‍💼 Représentants:** {representants}")
+                with col1:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <strong>⚖️ Poids Total</strong><br>
+                        {row['Poids total chargé']:.3f} kg
+                    </div>
+                    """, unsafe_allow_html=True)
             
-            with col5:
-                location = "✅ Oui" if row.get('Location_camion') else "❌ Non"
-                st.markdown(f"**🚛 Location:** {location}")
-                
-                code_vehicule = row.get('Code Véhicule', 'N/A')
-                st.markdown(f"**🔧 Code Véhicule:** {code_vehicule}")
+                with col2:
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <strong>📏 Volume Total</strong><br>
+                        {row['Volume total chargé']:.3f} m³
+                    </div>
+                    """, unsafe_allow_html=True)
             
-            # Liste des BL avec défilement
-            bls = row.get('BL inclus', '')
-            if bls:
-                bls_list = bls.split(';')
-                bls_html = "<br>".join([f"• {bl.strip()}" for bl in bls_list])
-                st.markdown(f"""
-                <div class="bl-list">
-                    <strong>📋 BLs Inclus ({len(bls_list)}):</strong><br>
-                    {bls_html}
-                </div>
-                """, unsafe_allow_html=True)
+                with col3:
+                    taux_occupation = row.get('Taux d\'occupation (%)', 'N/A')
+                    if taux_occupation != 'N/A':
+                        taux_text = f"{taux_occupation:.1f}%"
+                    else:
+                        taux_text = "N/A"
+                    st.markdown(f"""
+                    <div class="metric-card">
+                        <strong>📊 Taux d'Occupation</strong><br>
+                        {taux_text}
+                    </div>
+                    """, unsafe_allow_html=True)
             
-            # Boutons de validation côte à côte
-            st.markdown("**✅ Validation du voyage:**")
-            col_oui, col_non = st.columns(2)
+                # Informations détaillées
+                col4, col5 = st.columns(2)
             
-            with col_oui:
-                if st.button(f"✅ Valider {row['Véhicule N°']}", key=f"btn_oui_{idx}", 
-                           use_container_width=True, type="primary" if st.session_state.validations.get(idx) == "Oui" else "secondary"):
-                    st.session_state.validations[idx] = "Oui"
-                    st.rerun()
+                with col4:
+                    clients = row.get('Client(s) inclus', '')
+                    if clients:
+                        st.markdown(f"**👥 Clients:** {clients}")
+                
+                    representants = row.get('Représentant(s) inclus', '')
+                    if representants:
+                        st.markdown(f"**👨‍💼 Représentants:** {representants}")
             
-            with col_non:
-                if st.button(f"❌ Rejeter {row['Véhicule N°']}", key=f"btn_non_{idx}",
-                           use_container_width=True, type="primary" if st.session_state.validations.get(idx) == "Non" else "secondary"):
-                    st.session_state.validations[idx] = "Non"
-                    st.rerun()
+                with col5:
+                    location = "✅ Oui" if row.get('Location_camion') else "❌ Non"
+                    st.markdown(f"**🚛 Location:** {location}")
+                
+                    code_vehicule = row.get('Code Véhicule', 'N/A')
+                    st.markdown(f"**🔧 Code Véhicule:** {code_vehicule}")
+            
+                # Liste des BL avec défilement
+                bls = row.get('BL inclus', '')
+                if bls:
+                    bls_list = bls.split(';')
+                    bls_html = "<br>".join([f"• {bl.strip()}" for bl in bls_list])
+                    st.markdown(f"""
+                    <div class="bl-list">
+                        <strong>📋 BLs Inclus ({len(bls_list)}):</strong><br>
+                        {bls_html}
+                    </div>
+                    """, unsafe_allow_html=True)
             
-            # Afficher le statut actuel
-            statut = st.session_state.validations.get(idx)
-            if statut == "Oui":
-                st.success(f"✅ Voyage {row['Véhicule N°']} validé")
-            elif statut == "Non":
-                st.error(f"❌ Voyage {row['Véhicule N°']} rejeté")
-            else:
-                st.info("⏳ En attente de validation")
+                # Boutons de validation côte à côte
+                st.markdown("**✅ Validation du voyage:**")
+                col_oui, col_non = st.columns(2)
+            
+                with col_oui:
+                    if st.button(f"✅ Valider {row['Véhicule N°']}", key=f"btn_oui_{idx}", 
+                               use_container_width=True, type="primary" if st.session_state.validations.get(idx) == "Oui" else "secondary"):
+                        st.session_state.validations[idx] = "Oui"
+                        st.rerun()
+            
+                with col_non:
+                    if st.button(f"❌ Rejeter {row['Véhicule N°']}", key=f"btn_non_{idx}",
+                               use_container_width=True, type="primary" if st.session_state.validations.get(idx) == "Non" else "secondary"):
+                        st.session_state.validations[idx] = "Non"
+                        st.rerun()
+            
+                # Afficher le statut actuel
+                statut = st.session_state.validations.get(idx)
+                if statut == "Oui":
+                    st.success(f"✅ Voyage {row['Véhicule N°']} validé")
+                elif statut == "Non":
+                    st.error(f"❌ Voyage {row['Véhicule N°']} rejeté")
+                else:
+                    st.info("⏳ En attente de validation")
             
-            st.markdown("</div>", unsafe_allow_html=True)
-            st.markdown("---")
-
-    # --- Résumé des validations ---
-    st.markdown("### 📊 Résumé des Validations")
-    total_voyages = len(df_validation)
-    valides = sum(1 for v in st.session_state.validations.values() if v == "Oui")
-    rejetes = sum(1 for v in st.session_state.validations.values() if v == "Non")
+                st.markdown("</div>", unsafe_allow_html=True)
+                st.markdown("---")
 
-    col1, col2, col3 = st.columns(3)
-
-    with col1:
-        st.metric("Total Voyages", total_voyages)
-    with col2:
-        st.metric("✅ Validés", valides)
-    with col3:
-        st.metric("❌ Rejetés", rejetes)
+        # --- Résumé des validations ---
+        st.markdown("### 📊 Résumé des Validations")
+        total_voyages = len(df_validation)
+        valides = sum(1 for v in st.session_state.validations.values() if v == "Oui")
+        rejetes = sum(1 for v in st.session_state.validations.values() if v == "Non")
 
-    # Information supplémentaire sur l'état des validations
-    if valides + rejetes < total_voyages:
-        st.info(f"ℹ️ {total_voyages - (valides + rejetes)} voyage(s) n'ont pas encore été validés")
+        col1, col2, col3 = st.columns(3)
 
-    # --- Bouton pour appliquer les validations ---
-    if st.button("🚀 Finaliser la Validation", type="primary", use_container_width=True):
-        valid_indexes = [i for i, v in st.session_state.validations.items() if v == "Oui"]
-        valid_indexes = [i for i in valid_indexes if i in df_validation.index]
+        with col1:
+            st.metric("Total Voyages", total_voyages)
+        with col2:
+            st.metric("✅ Validés", valides)
+        with col3:
+            st.metric("❌ Rejetés", rejetes)
+
+        # Information supplémentaire sur l'état des validations
+        if valides + rejetes < total_voyages:
+            st.info(f"ℹ️ {total_voyages - (valides + rejetes)} voyage(s) n'ont pas encore été validés")
+
+        # --- Contrôles automatiques (seuls les véhicules modifiés sont revalidés) ---
+        with st.expander("🔎 Contrôles automatiques (capacités, doublons, cohérence)"):
+            if st.session_state.get("validateur") is None:
+                st.session_state.validateur = VoyageValidator(voyages_apres_transfert)
+            rapport_validation = st.session_state.validateur.valider_incremental(
+                voyages_apres_transfert, st.session_state.get("vehicules_modifies")
+            )
+            st.session_state.vehicules_modifies = set()
+            nb_erreurs = rapport_validation["Type"].str.contains("ERREUR").sum()
+            if nb_erreurs:
+                st.error(f"❌ {nb_erreurs} erreur(s) détectée(s)")
+            else:
+                st.success("✅ Aucune erreur détectée")
+            show_df(rapport_validation, use_container_width=True, hide_index=True)
+
+        # --- Bouton pour appliquer les validations ---
+        if st.button("🚀 Finaliser la Validation", type="primary", use_container_width=True):
+            valid_indexes = [i for i, v in st.session_state.validations.items() if v == "Oui"]
+            valid_indexes = [i for i in valid_indexes if i in df_validation.index]
+
+            if valid_indexes:
+                st.session_state.df_voyages_valides = df_validation.loc[valid_indexes].reset_index(drop=True)
+                # Attribution, codes voyage et export travaillent sur les voyages validés : relance complète
+                st.session_state.validation_finalisee = True
+                st.rerun(scope="app")
+            else:
+                st.warning("⚠️ Aucun voyage n'a été validé. Veuillez valider au moins un voyage.")
 
-        if valid_indexes:
-            df_voyages_valides = df_validation.loc[valid_indexes].reset_index(drop=True)
-            st.session_state.df_voyages_valides = df_voyages_valides
+        if st.session_state.pop("validation_finalisee", False):
+            df_voyages_valides = st.session_state.df_voyages_valides
 
             st.success(f"✅ {len(df_voyages_valides)} voyage(s) validé(s) avec succès!")
             
@@ -2276,426 +2565,444 @@ if "df_voyages" in st.session_state:
                         st.metric("Volume", f"{row_valide['Volume total chargé']:.3f} m³")
                         st.metric("Représentants", row_valide.get('Représentant(s) inclus', 'N/A'))
 
-            # --- Export Excel ---
-            excel_data = to_excel(df_voyages_valides)
+            # --- Export Excel (généré en arrière-plan) ---
             st.download_button(
                 label="💾 Télécharger les voyages validés (XLSX)",
-                data=excel_data,
+                data=st.session_state.artefacts.preparer("voyages_valides", to_excel, df_voyages_valides),
                 file_name="Voyages_valides.xlsx",
                 mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                use_container_width=True
+                use_container_width=True,
+                on_click="ignore"
             )
-        else:
-            st.warning("⚠️ Aucun voyage n'a été validé. Veuillez valider au moins un voyage.")
 
-else:
-    st.warning("⚠️ Vous devez d'abord exécuter la section 4 (Voyages par Estafette Optimisé).")
+    else:
+        st.warning("⚠️ Vous devez d'abord exécuter la section 4 (Voyages par Estafette Optimisé).")
+
+section_validation()
 
 # =====================================================
 # 8️⃣ ATTRIBUTION DES VÉHICULES ET CHAUFFEURS
 # =====================================================
 st.markdown("## 🚛 Attribution des véhicules et chauffeurs ")
 
-if 'df_voyages_valides' in st.session_state and st.session_state.df_voyages_valides is not None and not st.session_state.df_voyages_valides.empty:
-
-    df_attribution = st.session_state.df_voyages_valides.copy()
-
-    # Fonction pour formatter les colonnes avec retours à la ligne POUR STREAMLIT
-    def formater_colonnes_listes_streamlit(df):
-        df_formate = df.copy()
-        colonnes_a_formater = ['Client(s) inclus', 'Représentant(s) inclus', 'BL inclus']
-        
-        for col in colonnes_a_formater:
-            if col in df_formate.columns:
-                df_formate[col] = df_formate[col].apply(
-                    lambda x: '\n'.join([elem.strip() for elem in str(x).replace(';', ',').split(',') if elem.strip()]) 
-                    if pd.notna(x) else ""
-                )
-        return df_formate
-
-    if "attributions" not in st.session_state:
-        st.session_state.attributions = {}
-
-    for idx, row in df_attribution.iterrows():
-        with st.expander(f"🚚 Voyage {row['Véhicule N°']} | Zone : {row['Zone']}"):
-            st.write("**Informations du voyage :**")
-            
-            # Créer un affichage personnalisé avec retours à ligne
-            col1, col2, col3 = st.columns(3)
-            
-            with col1:
-                st.write(f"**Zone:** {row['Zone']}")
-                st.write(f"**Véhicule N°:** {row['Véhicule N°']}")
-                if "Poids total chargé" in row:
-                    st.write(f"**Poids total chargé:** {row['Poids total chargé']:.2f} kg")
-                if "Volume total chargé" in row:
-                    st.write(f"**Volume total chargé:** {row['Volume total chargé']:.3f} m³")
-                if "Taux d'occupation (%)" in row:
-                    st.write(f"**Taux d'occupation:** {row['Taux d\'occupation (%)']:.1f}%")
-            
-            with col2:
-                # Afficher les clients avec retours à ligne
-                if 'Client(s) inclus' in row and pd.notna(row['Client(s) inclus']):
-                    st.write("**Clients:**")
-                    clients = str(row['Client(s) inclus']).replace(';', ',').split(',')
-                    for client in clients:
-                        client_clean = client.strip()
-                        if client_clean:
-                            st.write(f"- {client_clean}")
-                
-                # Afficher les représentants avec retours à ligne
-                if 'Représentant(s) inclus' in row and pd.notna(row['Représentant(s) inclus']):
-                    st.write("**Représentants:**")
-                    representants = str(row['Représentant(s) inclus']).replace(';', ',').split(',')
-                    for rep in representants:
-                        rep_clean = rep.strip()
-                        if rep_clean:
-                            st.write(f"- {rep_clean}")
-            
-            with col3:
-                # Afficher les BL avec retours à ligne
-                if 'BL inclus' in row and pd.notna(row['BL inclus']):
-                    st.write("**BL associés:**")
-                    bls = str(row['BL inclus']).replace(';', ',').split(',')
-                    for bl in bls:
-                        bl_clean = bl.strip()
-                        if bl_clean:
-                            st.write(f"- {bl_clean}")
-
-            col_veh, col_chauf = st.columns(2)
-            
-            with col_veh:
-                vehicule_selectionne = st.selectbox(
-                    f"Véhicule pour le voyage {row['Véhicule N°']}",
-                    VEHICULES_DISPONIBLES,
-                    index=0 if st.session_state.attributions.get(idx, {}).get("Véhicule") else 0,
-                    key=f"vehicule_{idx}"
-                )
-            
-            with col_chauf:
-                options_chauffeurs = [f"{matricule} - {nom}" for matricule, nom in CHAUFFEURS_DETAILS.items() if matricule != 'Matricule']
-                
-                default_index = 0
-                chauffeur_actuel = st.session_state.attributions.get(idx, {}).get("Chauffeur_complet")
-                if chauffeur_actuel and chauffeur_actuel in options_chauffeurs:
-                    default_index = options_chauffeurs.index(chauffeur_actuel)
-                
-                chauffeur_selectionne_complet = st.selectbox(
-                    f"Chauffeur pour le voyage {row['Véhicule N°']}",
-                    options_chauffeurs,
-                    index=default_index,
-                    key=f"chauffeur_{idx}"
-                )
-                
-                if chauffeur_selectionne_complet:
-                    matricule_chauffeur = chauffeur_selectionne_complet.split(" - ")[0]
-                    nom_chauffeur = chauffeur_selectionne_complet.split(" - ")[1]
-                else:
-                    matricule_chauffeur = ""
-                    nom_chauffeur = ""
-
-            st.session_state.attributions[idx] = {
-                "Véhicule": vehicule_selectionne,
-                "Chauffeur_complet": chauffeur_selectionne_complet,
-                "Matricule_chauffeur": matricule_chauffeur,
-                "Nom_chauffeur": nom_chauffeur
-            }
-
-    if st.button("✅ Appliquer les attributions"):
-
-        df_attribution["Véhicule attribué"] = df_attribution.index.map(lambda i: st.session_state.attributions[i]["Véhicule"])
-        df_attribution["Chauffeur attribué"] = df_attribution.index.map(lambda i: st.session_state.attributions[i]["Nom_chauffeur"])
-        df_attribution["Matricule chauffeur"] = df_attribution.index.map(lambda i: st.session_state.attributions[i]["Matricule_chauffeur"])
-
-        
-        st.markdown("### 📦 Voyages avec Véhicule et Chauffeur")
+def planifier_flotte(df_voyages, durees, duree_shift_h, heure_debut, amelioration_locale):
+    """Planning multi-tours de la flotte réelle pour les paramètres de shift donnés."""
+    return FleetScheduler(
+        df_voyages, VEHICULES_DISPONIBLES, durees,
+        duree_shift_min=duree_shift_h * 60,
+        heure_debut=heure_debut,
+        chauffeurs=CHAUFFEURS_DETAILS
+    ).planifier(amelioration_locale=amelioration_locale)
 
-        # --- Affichage Streamlit amélioré avec retours à ligne ---
-        for idx, row in df_attribution.iterrows():
-            with st.expander(f"📋 Voyage {row['Véhicule N°']} - Zone {row['Zone']} - Véhicule: {row.get('Véhicule attribué', 'N/A')} - Chauffeur: {row.get('Chauffeur attribué', 'N/A')}"):
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    st.write("**Informations de base:**")
-                    st.write(f"**Zone:** {row['Zone']}")
-                    st.write(f"**Véhicule N°:** {row['Véhicule N°']}")
-                    if "Poids total chargé" in row:
-                        st.write(f"**Poids total chargé:** {row['Poids total chargé']:.3f} kg")
-                    if "Volume total chargé" in row:
-                        st.write(f"**Volume total chargé:** {row['Volume total chargé']:.3f} m³")
-                    if "Taux d'occupation (%)" in row:
-                        st.write(f"**Taux d'occupation:** {row['Taux d\'occupation (%)']:.3f}%")
-                    if "Véhicule attribué" in row:
-                        st.write(f"**Véhicule attribué:** {row['Véhicule attribué']}")
-                    if "Chauffeur attribué" in row:
-                        st.write(f"**Chauffeur attribué:** {row['Chauffeur attribué']}")
-                    if "Matricule chauffeur" in row:
-                        st.write(f"**Matricule chauffeur:** {row['Matricule chauffeur']}")
-                
-                with col2:
-                    # Afficher les clients avec retours à ligne
-                    if 'Client(s) inclus' in row and pd.notna(row['Client(s) inclus']):
-                        st.write("**📋 Clients inclus:**")
-                        clients = str(row['Client(s) inclus']).replace(';', ',').split(',')
-                        for client in clients:
-                            client_clean = client.strip()
-                            if client_clean:
-                                st.write(f"• {client_clean}")
-                    
-                    # Afficher les représentants avec retours à ligne
-                    if 'Représentant(s) inclus' in row and pd.notna(row['Représentant(s) inclus']):
-                        st.write("**👤 Représentants inclus:**")
-                        representants = str(row['Représentant(s) inclus']).replace(';', ',').split(',')
-                        for rep in representants:
-                            rep_clean = rep.strip()
-                            if rep_clean:
-                                st.write(f"• {rep_clean}")
-                
-                with col3:
-                    # Afficher les BL avec retours à ligne
-                    if 'BL inclus' in row and pd.notna(row['BL inclus']):
-                        st.write("**📄 BL associés:**")
-                        bls = str(row['BL inclus']).replace(';', ',').split(',')
-                        # Afficher en colonnes si beaucoup de BL
-                        if len(bls) > 5:
-                            cols = st.columns(2)
-                            half = len(bls) // 2
-                            for i, bl in enumerate(bls):
-                                bl_clean = bl.strip()
-                                if bl_clean:
-                                    col_idx = 0 if i < half else 1
-                                    with cols[col_idx]:
-                                        st.write(f"• {bl_clean}")
-                        else:
-                            for bl in bls:
-                                bl_clean = bl.strip()
-                                if bl_clean:
-                                    st.write(f"• {bl_clean}")
+@section_fragment
+def section_attribution():
+    if 'df_voyages_valides' in st.session_state and st.session_state.df_voyages_valides is not None and not st.session_state.df_voyages_valides.empty:
 
-        # --- Export Excel avec retours à ligne et CENTRAGE ---
-        from io import BytesIO
-        import openpyxl
+        df_attribution = st.session_state.df_voyages_valides.copy()
 
-        def to_excel(df):
-            df_export = df.copy()
-            
-            # Formater les colonnes avec retours à ligne pour Excel
+        # Fonction pour formatter les colonnes avec retours à la ligne POUR STREAMLIT
+        def formater_colonnes_listes_streamlit(df):
+            df_formate = df.copy()
             colonnes_a_formater = ['Client(s) inclus', 'Représentant(s) inclus', 'BL inclus']
+        
             for col in colonnes_a_formater:
-                if col in df_export.columns:
-                    df_export[col] = df_export[col].apply(
+                if col in df_formate.columns:
+                    df_formate[col] = df_formate[col].apply(
                         lambda x: '\n'.join([elem.strip() for elem in str(x).replace(';', ',').split(',') if elem.strip()]) 
                         if pd.notna(x) else ""
                     )
-            
-            if "Poids total chargé" in df_export.columns:
-                df_export["Poids total chargé"] = df_export["Poids total chargé"].round(3)
-            if "Volume total chargé" in df_export.columns:
-                df_export["Volume total chargé"] = df_export["Volume total chargé"].round(3)
-            
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                df_export.to_excel(writer, index=False, sheet_name='Voyages_Attribués')
-                
-                # Appliquer le formatage des retours à ligne et CENTRAGE dans Excel
-                workbook = writer.book
-                worksheet = writer.sheets['Voyages_Attribués']
-                
-                # Style de centrage avec retours à ligne
-                center_alignment = openpyxl.styles.Alignment(
-                    horizontal='center', 
-                    vertical='center', 
-                    wrap_text=True
-                )
-                
-                # Appliquer le centrage à TOUTES les cellules
-                for row in worksheet.iter_rows(min_row=1, max_row=len(df_export) + 1, min_col=1, max_col=len(df_export.columns)):
-                    for cell in row:
-                        cell.alignment = center_alignment
-                
-                # Ajuster automatiquement la largeur des colonnes
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if cell.value:
-                                # Calculer la longueur maximale en prenant en compte les retours à ligne
-                                lines = str(cell.value).split('\n')
-                                max_line_length = max(len(line) for line in lines)
-                                max_length = max(max_length, max_line_length)
-                        except:
-                            pass
-                    adjusted_width = min(50, (max_length + 2))  # Limiter à 50 caractères max
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-                
-                # Ajuster la hauteur des lignes pour les retours à ligne
-                for row in range(2, len(df_export) + 2):  # Commencer à la ligne 2 (après l'en-tête)
-                    worksheet.row_dimensions[row].height = 60  # Hauteur fixe pour accommoder les retours à ligne
-            
-            return output.getvalue()
+            return df_formate
+
+        # --- Planification automatique multi-tours sur la flotte réelle ---
+        st.markdown("### 🗓️ Planification et attribution automatiques")
+        col_shift, col_debut, col_opt = st.columns(3)
+        with col_shift:
+            duree_shift_h = st.number_input("Durée du shift (heures)", min_value=1.0, max_value=24.0,
+                                            value=DUREE_SHIFT_MIN / 60, step=0.5, key="duree_shift_h")
+        with col_debut:
+            heure_debut = st.time_input("Début du shift", value=pd.Timestamp("07:00").time(), key="heure_debut_shift")
+        with col_opt:
+            amelioration_locale = st.checkbox("Amélioration locale (déplacements / échanges)", value=True,
+                                              key="amelioration_locale")
+
+        planning = None
+        attribution_auto = None
+        if "attributions" not in st.session_state:
+            st.session_state.attributions = {}
+        try:
+            # Durées et planning ne sont recalculés que si les voyages ou les paramètres du shift changent ;
+            # un choix manuel (véhicule / chauffeur) ne relance que le solveur
+            durees = entree_section(
+                "durees_voyages", estimer_duree_voyages,
+                df_attribution, st.session_state.df_grouped_zone, st.session_state.get("df_clients_gps")
+            )
+            planning = entree_section(
+                "planning_flotte", planifier_flotte,
+                df_attribution, durees, duree_shift_h, heure_debut.strftime("%H:%M"), amelioration_locale
+            )
+            # Le solveur part du planning et respecte les choix manuels (verrouillages) de l'utilisateur
+            attribution_auto = AttributionSolver(
+                VEHICULES_DISPONIBLES, CHAUFFEURS_DETAILS,
+                duree_shift_min=duree_shift_h * 60,
+                heure_debut=heure_debut.strftime("%H:%M")
+            ).resoudre(planning, durees, verrouillages=st.session_state.attributions)
+        except Exception as e:
+            st.warning(f"⚠️ Attribution automatique indisponible : {str(e)}")
+
+        indices_a_corriger = list(df_attribution.index)
+        if attribution_auto is not None:
+            show_df(
+                attribution_auto[["Véhicule N°", "Zone", "Véhicule attribué", "Chauffeur attribué", "Tour N°",
+                                  "Durée estimée (min)", "Heure départ", "Heure retour", "Exception"]]
+                .sort_values(["Véhicule attribué", "Tour N°"]),
+                use_container_width=True, hide_index=True
+            )
+            show_df(FleetScheduler.resume(attribution_auto, duree_shift_h * 60), use_container_width=True, hide_index=True)
 
-        # --- Export PDF avec tableau ÉLARGI et ESPACES MINIMISÉS ---
-        from fpdf import FPDF
+            mask_exceptions = attribution_auto["Exception"] != ""
+            if mask_exceptions.any():
+                st.warning(f"⚠️ {int(mask_exceptions.sum())} voyage(s) à corriger manuellement ci-dessous.")
+            else:
+                st.success("✅ Tous les voyages ont un véhicule et un chauffeur compatibles, dans le shift.")
+
+            col_manuel, col_reset = st.columns([3, 1])
+            with col_manuel:
+                afficher_tout = st.checkbox("✏️ Modifier manuellement tous les voyages", key="attribution_manuelle_complete")
+            with col_reset:
+                if st.session_state.attributions and st.button("🔄 Réinitialiser les choix manuels"):
+                    st.session_state.attributions = {}
+                    st.rerun(scope="fragment")
+            if not afficher_tout:
+                indices_a_corriger = list(attribution_auto.index[mask_exceptions])
+
+        options_chauffeurs = [f"{matricule} - {nom}" for matricule, nom in CHAUFFEURS_DETAILS.items() if matricule != 'Matricule']
+
+        # Choix courant de chaque voyage : proposition du solveur (qui intègre déjà les verrouillages),
+        # sinon choix manuel enregistré, sinon première option
+        df_choix = pd.DataFrame(index=df_attribution.index)
+        if attribution_auto is not None:
+            df_choix["Véhicule attribué"] = attribution_auto["Véhicule attribué"]
+            df_choix["Chauffeur attribué"] = (attribution_auto["Matricule chauffeur"].astype(str) + " - "
+                                              + attribution_auto["Chauffeur attribué"].astype(str))
+            df_choix["Exception"] = attribution_auto["Exception"]
+        else:
+            choix_manuels = [st.session_state.attributions.get(i, {}) for i in df_attribution.index]
+            df_choix["Véhicule attribué"] = [c.get("Véhicule", VEHICULES_DISPONIBLES[0]) for c in choix_manuels]
+            df_choix["Chauffeur attribué"] = [c.get("Chauffeur_complet", options_chauffeurs[0]) for c in choix_manuels]
+
+        def verrouiller_attributions_grille(cle_grille, indices_page):
+            """Enregistre les choix manuels saisis dans la grille : le solveur les respecte aux exécutions suivantes."""
+            for position, changements in st.session_state[cle_grille]["edited_rows"].items():
+                idx = indices_page[int(position)]
+                vehicule = changements.get("Véhicule attribué", df_choix.at[idx, "Véhicule attribué"])
+                chauffeur_complet = changements.get("Chauffeur attribué", df_choix.at[idx, "Chauffeur attribué"]) or ""
+                st.session_state.attributions[idx] = {
+                    "Véhicule": vehicule,
+                    "Chauffeur_complet": chauffeur_complet,
+                    "Matricule_chauffeur": chauffeur_complet.split(" - ")[0] if chauffeur_complet else "",
+                    "Nom_chauffeur": chauffeur_complet.split(" - ")[1] if chauffeur_complet else ""
+                }
+            # Nouvelle grille au prochain rendu : les lignes éditées de cette page ne s'appliquent pas aux autres pages
+            st.session_state.version_grille_attribution = st.session_state.get("version_grille_attribution", 0) + 1
+
+        # --- Grille d'édition unique, filtrée et paginée côté serveur ---
+        if indices_a_corriger:
+            colonnes_grille = [c for c in ["Véhicule N°", "Zone", "Poids total chargé", "Volume total chargé",
+                                           "Client(s) inclus", "BL inclus"] if c in df_attribution.columns]
+            df_grille = df_attribution.loc[indices_a_corriger, colonnes_grille].join(df_choix)
+            df_page = vue_paginee(df_grille, "attribution")
+            cle_grille = f"grille_attribution_{st.session_state.get('version_grille_attribution', 0)}"
+            st.data_editor(
+                df_page.reset_index(drop=True),
+                key=cle_grille,
+                hide_index=True,
+                use_container_width=True,
+                disabled=[c for c in df_page.columns if c not in ("Véhicule attribué", "Chauffeur attribué")],
+                column_config={
+                    "Poids total chargé": st.column_config.NumberColumn("Poids (kg)", format="%.3f"),
+                    "Volume total chargé": st.column_config.NumberColumn("Volume (m³)", format="%.3f"),
+                    # Flotte réelle, plus les identifiants des camions loués (une location par voyage loué)
+                    "Véhicule attribué": st.column_config.SelectboxColumn(
+                        "🚚 Véhicule attribué", required=True,
+                        options=list(dict.fromkeys(VEHICULES_DISPONIBLES + list(df_choix["Véhicule attribué"].dropna())))),
+                    "Chauffeur attribué": st.column_config.SelectboxColumn(
+                        "👨‍✈️ Chauffeur attribué", options=options_chauffeurs),
+                },
+                on_change=verrouiller_attributions_grille,
+                args=(cle_grille, list(df_page.index))
+            )
 
-        def to_pdf_better_centered(df, title="Voyages Attribués"):
-            pdf = FPDF(orientation='L')  # Paysage pour plus d'espace
-            pdf.add_page()
-            
-            # RÉDUCTION des marges pour utiliser TOUTE la largeur
-            pdf.set_left_margin(5)   # Marge gauche réduite
-            pdf.set_right_margin(5)  # Marge droite réduite
-            pdf.set_top_margin(10)   # Marge haut réduite
-            
-            # Titre PLUS PETIT et PLUS HAUT
-            pdf.set_font("Arial", 'B', 14)  # Taille réduite
-            pdf.cell(0, 8, title, ln=True, align="C")  # Hauteur réduite
-            pdf.ln(3)  # Espacement réduit après le titre
-            
-            # Créer une copie formatée pour le PDF
-            df_pdf = df.copy()
-            
-            # Formater les nombres avec 3 chiffres après la virgule SAUF le taux avec 2 chiffres
-            numeric_columns = {
-                'Poids total chargé': ('kg', 3),
-                'Volume total chargé': ('m³', 3), 
-                'Taux d\'occupation (%)': ('%', 2)  # 2 chiffres après la virgule
-            }
-            
-            for col, (unit, decimals) in numeric_columns.items():
-                if col in df_pdf.columns:
-                    df_pdf[col] = df_pdf[col].apply(
-                        lambda x: f"{float(x):.{decimals}f} {unit}" if x and str(x).strip() and str(x).strip() != 'nan' else ""
-                    )
-            
-            # Configuration des colonnes AVEC LARGEURS MAXIMALISÉES
-            col_config = {
-                'Zone': {'width': 15, 'header': 'Zone'},
-                'Véhicule N°': {'width': 18, 'header': 'Véhicule'},
-                'Poids total chargé': {'width': 22, 'header': 'Poids (kg)'},
-                'Volume total chargé': {'width': 22, 'header': 'Volume (m³)'},
-                'Client(s) inclus': {'width': 30, 'header': 'Clients'},
-                'Représentant(s) inclus': {'width': 30, 'header': 'Représentants'},
-                'BL inclus': {'width': 35, 'header': 'BL associés'},
-                'Taux d\'occupation (%)': {'width': 18, 'header': 'Taux %'},
-                'Véhicule attribué': {'width': 25, 'header': 'Véhicule Attribué'},
-                'Chauffeur attribué': {'width': 25, 'header': 'Chauffeur'},
-                'Matricule chauffeur': {'width': 20, 'header': 'Matricule'}
-            }
-            
-            # Sélectionner seulement les colonnes existantes
-            colonnes_existantes = [col for col in df_pdf.columns if col in col_config]
-            widths = [col_config[col]['width'] for col in colonnes_existantes]
-            headers = [col_config[col]['header'] for col in colonnes_existantes]
-            
-            # Calculer la position de départ - DÉBUT PLUS À GAUCHE
-            total_width = sum(widths)
-            page_width = 297  # Largeur d'une page A4 en paysage (mm)
-            start_x = 5  # Commencer presque au bord gauche
-            
-            # Positionner le tableau AU DÉBUT
-            pdf.set_x(start_x)
-            
-            # En-têtes CENTRÉS avec police PLUS PETITE
-            pdf.set_font("Arial", 'B', 8)  # Taille réduite
-            for i, header in enumerate(headers):
-                pdf.cell(widths[i], 6, header, border=1, align='C')  # Hauteur réduite
-            pdf.ln()
+        if st.button("✅ Appliquer les attributions"):
+
+            if attribution_auto is not None:
+                for col in ["Véhicule attribué", "Chauffeur attribué", "Matricule chauffeur",
+                            "Tour N°", "Heure départ", "Heure retour"]:
+                    df_attribution[col] = attribution_auto[col]
+            else:
+                chauffeurs_choisis = [c or " - " for c in df_choix["Chauffeur attribué"]]
+                df_attribution["Véhicule attribué"] = df_choix["Véhicule attribué"]
+                df_attribution["Chauffeur attribué"] = [c.split(" - ")[1] for c in chauffeurs_choisis]
+                df_attribution["Matricule chauffeur"] = [c.split(" - ")[0] for c in chauffeurs_choisis]
+
+            # Mettre à jour le session state ; codes voyage et export final reprennent les attributions
+            st.session_state.df_voyages_valides = df_attribution
+            st.session_state.attributions_appliquees = True
+            st.rerun(scope="app")
+
+        if "Véhicule attribué" in df_attribution.columns:
+            st.markdown("### 📦 Voyages avec Véhicule et Chauffeur")
+
+            # --- Tableau paginé, listes (clients, représentants, BL) avec retours à ligne ---
+            colonnes_resultat = [c for c in ["Zone", "Véhicule N°", "Véhicule attribué", "Chauffeur attribué",
+                                             "Matricule chauffeur", "Tour N°", "Heure départ", "Heure retour",
+                                             "Poids total chargé", "Volume total chargé", "Taux d'occupation (%)",
+                                             "Client(s) inclus", "Représentant(s) inclus", "BL inclus"]
+                                 if c in df_attribution.columns]
+            df_page_resultat = vue_paginee(df_attribution[colonnes_resultat], "resultat_attribution")
+            show_df(formater_colonnes_listes_streamlit(df_page_resultat), use_container_width=True, hide_index=True)
+
+            # --- Export Excel avec retours à ligne et CENTRAGE ---
+            from io import BytesIO
+            import openpyxl
+
+            def to_excel(df):
+                df_export = df.copy()
+            
+                # Formater les colonnes avec retours à ligne pour Excel
+                colonnes_a_formater = ['Client(s) inclus', 'Représentant(s) inclus', 'BL inclus']
+                for col in colonnes_a_formater:
+                    if col in df_export.columns:
+                        df_export[col] = df_export[col].apply(
+                            lambda x: '\n'.join([elem.strip() for elem in str(x).replace(';', ',').split(',') if elem.strip()]) 
+                            if pd.notna(x) else ""
+                        )
             
-            # Données avec centrage VERTICAL et HORIZONTAL
-            pdf.set_font("Arial", '', 7)  # Taille réduite pour les données
+                if "Poids total chargé" in df_export.columns:
+                    df_export["Poids total chargé"] = df_export["Poids total chargé"].round(3)
+                if "Volume total chargé" in df_export.columns:
+                    df_export["Volume total chargé"] = df_export["Volume total chargé"].round(3)
             
-            for voyage_idx, (_, row) in enumerate(df_pdf.iterrows()):
-                # Vérifier si on dépasse la hauteur de page
-                if pdf.get_y() > 180:  # Si on approche du bas de page
-                    pdf.add_page()  # Nouvelle page
-                    pdf.set_x(start_x)
-                    # Ré-afficher les en-têtes sur la nouvelle page
-                    pdf.set_font("Arial", 'B', 8)
-                    for i, header in enumerate(headers):
-                        pdf.cell(widths[i], 6, header, border=1, align='C')
-                    pdf.ln()
-                    pdf.set_font("Arial", '', 7)
+                output = BytesIO()
+                with pd.ExcelWriter(output, engine='openpyxl') as writer:
+                    df_export.to_excel(writer, index=False, sheet_name='Voyages_Attribués')
+                
+                    # Appliquer le formatage des retours à ligne et CENTRAGE dans Excel
+                    workbook = writer.book
+                    worksheet = writer.sheets['Voyages_Attribués']
                 
-                # Déterminer le nombre de lignes nécessaires pour ce voyage
-                list_columns = ['Client(s) inclus', 'Représentant(s) inclus', 'BL inclus']
-                non_list_columns = [col for col in colonnes_existantes if col not in list_columns]
+                    # Style de centrage avec retours à ligne
+                    center_alignment = openpyxl.styles.Alignment(
+                        horizontal='center', 
+                        vertical='center', 
+                        wrap_text=True
+                    )
                 
-                max_lines = 1
-                list_contents = {}
+                    # Appliquer le centrage à TOUTES les cellules
+                    for row in worksheet.iter_rows(min_row=1, max_row=len(df_export) + 1, min_col=1, max_col=len(df_export.columns)):
+                        for cell in row:
+                            cell.alignment = center_alignment
                 
-                for col in list_columns:
-                    if col in colonnes_existantes:
-                        content = str(row[col]) if pd.notna(row[col]) and str(row[col]) != 'nan' else ""
-                        elements = content.replace(';', ',').split(',')
-                        elements = [elem.strip() for elem in elements if elem.strip()]
-                        list_contents[col] = elements
-                        max_lines = max(max_lines, len(elements))
+                    # Ajuster automatiquement la largeur des colonnes
+                    for column in worksheet.columns:
+                        max_length = 0
+                        column_letter = column[0].column_letter
+                        for cell in column:
+                            try:
+                                if cell.value:
+                                    # Calculer la longueur maximale en prenant en compte les retours à ligne
+                                    lines = str(cell.value).split('\n')
+                                    max_line_length = max(len(line) for line in lines)
+                                    max_length = max(max_length, max_line_length)
+                            except:
+                                pass
+                        adjusted_width = min(50, (max_length + 2))  # Limiter à 50 caractères max
+                        worksheet.column_dimensions[column_letter].width = adjusted_width
                 
-                # Pour chaque ligne du voyage
-                for line_idx in range(max_lines):
-                    # Vérifier si on dépasse la hauteur de page pour cette ligne
-                    if pdf.get_y() > 190:  # Si on approche vraiment du bas
-                        pdf.add_page()
+                    # Ajuster la hauteur des lignes pour les retours à ligne
+                    for row in range(2, len(df_export) + 2):  # Commencer à la ligne 2 (après l'en-tête)
+                        worksheet.row_dimensions[row].height = 60  # Hauteur fixe pour accommoder les retours à ligne
+            
+                return output.getvalue()
+
+            # --- Export PDF avec tableau ÉLARGI et ESPACES MINIMISÉS ---
+            from fpdf import FPDF
+
+            def to_pdf_better_centered(df, title="Voyages Attribués"):
+                pdf = FPDF(orientation='L')  # Paysage pour plus d'espace
+                pdf.add_page()
+            
+                # RÉDUCTION des marges pour utiliser TOUTE la largeur
+                pdf.set_left_margin(5)   # Marge gauche réduite
+                pdf.set_right_margin(5)  # Marge droite réduite
+                pdf.set_top_margin(10)   # Marge haut réduite
+            
+                # Titre PLUS PETIT et PLUS HAUT
+                pdf.set_font("Arial", 'B', 14)  # Taille réduite
+                pdf.cell(0, 8, title, ln=True, align="C")  # Hauteur réduite
+                pdf.ln(3)  # Espacement réduit après le titre
+            
+                # Créer une copie formatée pour le PDF
+                df_pdf = df.copy()
+            
+                # Formater les nombres avec 3 chiffres après la virgule SAUF le taux avec 2 chiffres
+                numeric_columns = {
+                    'Poids total chargé': ('kg', 3),
+                    'Volume total chargé': ('m³', 3), 
+                    'Taux d\'occupation (%)': ('%', 2)  # 2 chiffres après la virgule
+                }
+            
+                for col, (unit, decimals) in numeric_columns.items():
+                    if col in df_pdf.columns:
+                        df_pdf[col] = df_pdf[col].apply(
+                            lambda x: f"{float(x):.{decimals}f} {unit}" if x and str(x).strip() and str(x).strip() != 'nan' else ""
+                        )
+            
+                # Configuration des colonnes AVEC LARGEURS MAXIMALISÉES
+                col_config = {
+                    'Zone': {'width': 15, 'header': 'Zone'},
+                    'Véhicule N°': {'width': 18, 'header': 'Véhicule'},
+                    'Poids total chargé': {'width': 22, 'header': 'Poids (kg)'},
+                    'Volume total chargé': {'width': 22, 'header': 'Volume (m³)'},
+                    'Client(s) inclus': {'width': 30, 'header': 'Clients'},
+                    'Représentant(s) inclus': {'width': 30, 'header': 'Représentants'},
+                    'BL inclus': {'width': 35, 'header': 'BL associés'},
+                    'Taux d\'occupation (%)': {'width': 18, 'header': 'Taux %'},
+                    'Véhicule attribué': {'width': 25, 'header': 'Véhicule Attribué'},
+                    'Chauffeur attribué': {'width': 25, 'header': 'Chauffeur'},
+                    'Matricule chauffeur': {'width': 20, 'header': 'Matricule'},
+                    'Tour N°': {'width': 10, 'header': 'Tour'},
+                    'Heure départ': {'width': 16, 'header': 'Départ'}
+                }
+            
+                # Sélectionner seulement les colonnes existantes
+                colonnes_existantes = [col for col in df_pdf.columns if col in col_config]
+                widths = [col_config[col]['width'] for col in colonnes_existantes]
+                headers = [col_config[col]['header'] for col in colonnes_existantes]
+            
+                # Calculer la position de départ - DÉBUT PLUS À GAUCHE
+                total_width = sum(widths)
+                page_width = 297  # Largeur d'une page A4 en paysage (mm)
+                start_x = 5  # Commencer presque au bord gauche
+            
+                # Positionner le tableau AU DÉBUT
+                pdf.set_x(start_x)
+            
+                # En-têtes CENTRÉS avec police PLUS PETITE
+                pdf.set_font("Arial", 'B', 8)  # Taille réduite
+                for i, header in enumerate(headers):
+                    pdf.cell(widths[i], 6, header, border=1, align='C')  # Hauteur réduite
+                pdf.ln()
+            
+                # Données avec centrage VERTICAL et HORIZONTAL
+                pdf.set_font("Arial", '', 7)  # Taille réduite pour les données
+            
+                for voyage_idx, (_, row) in enumerate(df_pdf.iterrows()):
+                    # Vérifier si on dépasse la hauteur de page
+                    if pdf.get_y() > 180:  # Si on approche du bas de page
+                        pdf.add_page()  # Nouvelle page
                         pdf.set_x(start_x)
+                        # Ré-afficher les en-têtes sur la nouvelle page
                         pdf.set_font("Arial", 'B', 8)
                         for i, header in enumerate(headers):
                             pdf.cell(widths[i], 6, header, border=1, align='C')
                         pdf.ln()
                         pdf.set_font("Arial", '', 7)
+                
+                    # Déterminer le nombre de lignes nécessaires pour ce voyage
+                    list_columns = ['Client(s) inclus', 'Représentant(s) inclus', 'BL inclus']
+                    non_list_columns = [col for col in colonnes_existantes if col not in list_columns]
+                
+                    max_lines = 1
+                    list_contents = {}
+                
+                    for col in list_columns:
+                        if col in colonnes_existantes:
+                            content = str(row[col]) if pd.notna(row[col]) and str(row[col]) != 'nan' else ""
+                            elements = content.replace(';', ',').split(',')
+                            elements = [elem.strip() for elem in elements if elem.strip()]
+                            list_contents[col] = elements
+                            max_lines = max(max_lines, len(elements))
+                
+                    # Pour chaque ligne du voyage
+                    for line_idx in range(max_lines):
+                        # Vérifier si on dépasse la hauteur de page pour cette ligne
+                        if pdf.get_y() > 190:  # Si on approche vraiment du bas
+                            pdf.add_page()
+                            pdf.set_x(start_x)
+                            pdf.set_font("Arial", 'B', 8)
+                            for i, header in enumerate(headers):
+                                pdf.cell(widths[i], 6, header, border=1, align='C')
+                            pdf.ln()
+                            pdf.set_font("Arial", '', 7)
                     
-                    # Positionner au DÉBUT pour chaque ligne
-                    pdf.set_x(start_x)
+                        # Positionner au DÉBUT pour chaque ligne
+                        pdf.set_x(start_x)
                     
-                    for i, col in enumerate(colonnes_existantes):
-                        if col in list_columns:
-                            # Colonnes de liste - afficher élément par élément
-                            elements = list_contents.get(col, [])
-                            content = elements[line_idx] if line_idx < len(elements) else ""
-                        else:
-                            # Colonnes non-liste - afficher sur la première ligne seulement
-                            if line_idx == 0:
-                                content = str(row[col]) if pd.notna(row[col]) and str(row[col]) != 'nan' else ""
+                        for i, col in enumerate(colonnes_existantes):
+                            if col in list_columns:
+                                # Colonnes de liste - afficher élément par élément
+                                elements = list_contents.get(col, [])
+                                content = elements[line_idx] if line_idx < len(elements) else ""
                             else:
-                                content = ""
+                                # Colonnes non-liste - afficher sur la première ligne seulement
+                                if line_idx == 0:
+                                    content = str(row[col]) if pd.notna(row[col]) and str(row[col]) != 'nan' else ""
+                                else:
+                                    content = ""
                         
-                        # Bordures avec hauteur RÉDUITE
-                        border = 'LR'
-                        if line_idx == 0: border += 'T'
-                        if line_idx == max_lines - 1: border += 'B'
-                        if i == 0: border += 'L'
-                        if i == len(colonnes_existantes) - 1: border += 'R'
+                            # Bordures avec hauteur RÉDUITE
+                            border = 'LR'
+                            if line_idx == 0: border += 'T'
+                            if line_idx == max_lines - 1: border += 'B'
+                            if i == 0: border += 'L'
+                            if i == len(colonnes_existantes) - 1: border += 'R'
                         
-                        pdf.cell(widths[i], 5, content, border=border, align='C')  # Hauteur réduite à 5
+                            pdf.cell(widths[i], 5, content, border=border, align='C')  # Hauteur réduite à 5
                     
-                    pdf.ln()
+                        pdf.ln()
             
-            return pdf.output(dest='S').encode('latin-1')
-        # Afficher les boutons de téléchargement côte à côte
-        col1, col2 = st.columns(2)
+                return pdf.output(dest='S').encode('latin-1')
+            # Afficher les boutons de téléchargement côte à côte (fichiers générés en arrière-plan)
+            col1, col2, col3 = st.columns(3)
 
-        with col1:
-            st.download_button(
-                label="💾 Télécharger le tableau final (XLSX)",
-                data=to_excel(df_attribution),
-                file_name="Voyages_attribues.xlsx",
-                mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            )
+            with col1:
+                st.download_button(
+                    label="💾 Télécharger le tableau final (XLSX)",
+                    data=st.session_state.artefacts.preparer("voyages_attribues_xlsx", to_excel, df_attribution),
+                    file_name="Voyages_attribues.xlsx",
+                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    on_click="ignore"
+                )
 
-        with col2:
-            st.download_button(
-                label="📄 Télécharger le tableau final (PDF)",
-                data=to_pdf_better_centered(df_attribution),
-                file_name="Voyages_attribues.pdf",
-                mime='application/pdf'
-            )
+            with col2:
+                st.download_button(
+                    label="📄 Télécharger le tableau final (PDF)",
+                    data=st.session_state.artefacts.preparer("voyages_attribues_pdf", to_pdf_better_centered, df_attribution),
+                    file_name="Voyages_attribues.pdf",
+                    mime='application/pdf',
+                    on_click="ignore"
+                )
+
+            with col3:
+                # Une feuille de route PDF par chauffeur (arrêts dans l'ordre de passage), regroupées en ZIP
+                st.download_button(
+                    label="🧾 Feuilles de route par chauffeur (ZIP)",
+                    data=st.session_state.artefacts.preparer(
+                        "feuilles_route", generer_feuilles_route_zip, df_attribution,
+                        st.session_state.df_livraisons_original, st.session_state.get("df_tournees")
+                    ),
+                    file_name="Feuilles_de_route.zip",
+                    mime='application/zip',
+                    on_click="ignore"
+                )
                 
-        # Mettre à jour le session state
-        st.session_state.df_voyages_valides = df_attribution
-        st.success("✅ Attributions appliquées avec succès !")
+            if st.session_state.pop("attributions_appliquees", False):
+                st.success("✅ Attributions appliquées avec succès !")
         
-else:
-    st.warning("⚠️ Vous devez d'abord valider les voyages dans la section 7.")
+    else:
+        st.warning("⚠️ Vous devez d'abord valider les voyages dans la section 7.")
+
+section_attribution()
 
 # =====================================================
 # 9️⃣ RAPPORTS AVANCÉS ET ANALYTICS
@@ -2724,6 +3031,26 @@ if "df_voyages" in st.session_state and "df_livraisons_original" in st.session_s
             with st.spinner("Génération du rapport en cours..."):
                 rapport = report_generator.generer_rapport_analytique()
                 st.text_area("Rapport détaillé", rapport, height=400)
+
+                # Graphiques et tableau rendus depuis les mêmes indicateurs que le rapport texte
+                indicateurs = report_generator.indicateurs_analytiques()
+                col_graph1, col_graph2 = st.columns(2)
+                with col_graph1:
+                    fig_zone_type = px.bar(
+                        indicateurs["par_zone_type"].reset_index(), x="Zone", y="Poids (kg)",
+                        color="Type véhicule", title="Poids transporté par zone et type de véhicule"
+                    )
+                    st.plotly_chart(fig_zone_type, use_container_width=True)
+                with col_graph2:
+                    repartition_taux = indicateurs["par_tranche"].reset_index().melt(
+                        id_vars="Tranche de taux", var_name="Type véhicule", value_name="Véhicules"
+                    )
+                    fig_taux = px.bar(
+                        repartition_taux, x="Tranche de taux", y="Véhicules", color="Type véhicule",
+                        barmode="group", title="Répartition des taux d'occupation"
+                    )
+                    st.plotly_chart(fig_taux, use_container_width=True)
+                show_df(indicateurs["par_zone_type"].reset_index().round(2), use_container_width=True, hide_index=True)
     
     with tab2:
         st.subheader("Rapport Spécifique Client")
@@ -2740,9 +3067,11 @@ if "df_voyages" in st.session_state and "df_livraisons_original" in st.session_s
         col_cost1, col_cost2 = st.columns(2)
         
         with col_cost1:
-            cout_estafette = st.number_input("Coût unitaire estafette (TND)", value=150, min_value=50, max_value=500)
+            cout_estafette = st.number_input("Coût unitaire estafette (TND)", value=150, min_value=50, max_value=500,
+                                             key="cout_estafette")
         with col_cost2:
-            cout_camion = st.number_input("Coût unitaire camion (TND)", value=800, min_value=300, max_value=2000)
+            cout_camion = st.number_input("Coût unitaire camion (TND)", value=800, min_value=300, max_value=2000,
+                                          key="cout_camion")
         
         if st.button("💰 Calculer les coûts"):
             from backend import calculer_couts_estimation
@@ -2774,16 +3103,43 @@ if "df_voyages" in st.session_state and "df_livraisons_original" in st.session_s
     with tab4:
         st.subheader("Validation d'Intégrité des Données")
         if st.button("🔍 Vérifier l'intégrité des données"):
-            from backend import verifier_integrite_donnees
+            from backend import verifier_integrite_donnees, reconcilier_donnees
+            transfer_manager = st.session_state.get("transfer_manager")
+            objets_suivis = transfer_manager.objets_manuels if transfer_manager is not None else None
             resultat_validation = verifier_integrite_donnees(
                 st.session_state.df_voyages,
-                st.session_state.df_livraisons_original
+                st.session_state.df_livraisons_original,
+                objets_suivis
             )
             
             if "✅" in resultat_validation:
                 st.success(resultat_validation)
             else:
                 st.warning(resultat_validation)
+            
+            # Réconciliation détaillée (par zone, client, véhicule et objets manuels)
+            reconciliation = reconcilier_donnees(
+                st.session_state.df_voyages,
+                st.session_state.df_livraisons_original,
+                objets_suivis
+            )
+            if "erreur" in reconciliation:
+                st.error(reconciliation["erreur"])
+            else:
+                with st.expander("🧮 Réconciliation détaillée"):
+                    if reconciliation["bls_manquants"]:
+                        st.write("**BLs manquants :** " + ", ".join(reconciliation["bls_manquants"]))
+                    if reconciliation["bls_dupliques"]:
+                        st.write("**BLs présents dans plusieurs véhicules :** " + ", ".join(reconciliation["bls_dupliques"]))
+                    st.markdown("**Par zone**")
+                    show_df(reconciliation["par_zone"].round(3), use_container_width=True, hide_index=True)
+                    st.markdown("**Par client**")
+                    show_df(reconciliation["par_client"].round(3), use_container_width=True, hide_index=True)
+                    st.markdown("**Par véhicule** (chargé = BLs + objets manuels + écart)")
+                    show_df(reconciliation["par_vehicule"].round(3), use_container_width=True, hide_index=True)
+                    if not reconciliation["objets"].empty:
+                        st.markdown("**Objets manuels**")
+                        show_df(reconciliation["objets"].round(3), use_container_width=True, hide_index=True)
 
 else:
     st.warning("⚠️ Vous devez d'abord traiter les données .")
@@ -3154,6 +3510,17 @@ if generer_export:
         
         if success:
             st.success(message)
+
+            # Planning finalisé conservé dans l'historique (tendances, coûts, taux d'occupation)
+            ok_historique, message_historique, _ = HISTORIQUE_PLANNING.enregistrer_plan(
+                df_export_final,
+                HISTORIQUE_PLANNING.date_du_plan(df_export_final, st.session_state.get("dates_bl")),
+                st.session_state.df_livraisons_original,
+                st.session_state.get("cout_estafette", 150),
+                st.session_state.get("cout_camion", 800),
+                libelle=nom_fichier
+            )
+            (st.success if ok_historique else st.warning)(message_historique)
             
             # =====================================================
             # APERÇU DU FORMAT D'EXPORT (MAINTENANT EN DEHORS !)
@@ -3300,6 +3667,28 @@ if generer_export:
                     file_name=f"{nom_fichier}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
+
+            # =====================================================
+            # FORMATS MACHINE (WMS / TMS) : SCHÉMA STABLE
+            # =====================================================
+            st.markdown("#### 📦 Export pour WMS / TMS")
+            st.caption("Voyages, affectations BL et rapport de validation, une table par fichier (archive ZIP avec le schéma).")
+            transfer_manager = st.session_state.get("transfer_manager")
+            exporteur = PlanExporter(
+                df_export_final,
+                st.session_state.df_livraisons_original,
+                df_objets_manuels=transfer_manager.objets_manuels if transfer_manager is not None else None
+            )
+            colonnes_formats = st.columns(4)
+            for colonne_format, format_export in zip(colonnes_formats, ["parquet", "csv", "json", "arrow"]):
+                with colonne_format:
+                    st.download_button(
+                        label=f"💾 {format_export.upper()}",
+                        data=exporteur.vers_octets(format_export, prefixe=nom_fichier),
+                        file_name=f"{nom_fichier}_{format_export}.zip",
+                        mime="application/zip",
+                        key=f"export_machine_{format_export}"
+                    )
         else:
             st.error(message)
             
@@ -3480,4 +3869,6 @@ st.markdown("""
         margin: 1rem 0;
     }
 </style>
-""", unsafe_allow_html=True)
\ No newline at end of file
+""", unsafe_allow_html=True)
+# Point de reprise de la session (tables modifiées et nouvelles versions du plan uniquement)
+sauvegarder_session()
@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from io import BytesIO
-from backend import DeliveryProcessor, TruckRentalProcessor, TruckTransferManager, SEUIL_POIDS, SEUIL_VOLUME
+from backend import DeliveryProcessor, TruckRentalProcessor, TruckTransferManager, HISTORIQUE_PLANNING, agreger_indicateurs, frequence_historique, MAX_POINTS_GRAPHIQUE, SEUIL_POIDS, SEUIL_VOLUME
 import openpyxl
 from openpyxl.styles import Alignment
 # =====================================================
@@ -278,7 +278,8 @@ def page_import():
                 processor = DeliveryProcessor()
                 try:
                     with st.spinner("🔍 Traitement des données en cours..."):
-                        df_grouped, df_city, df_grouped_zone, df_zone, df_optimized_estafettes, df_livraisons_original = processor.process_delivery_data(
+                        # Résultats repris du cache si les mêmes fichiers ont déjà été traités
+                        df_grouped, df_city, df_grouped_zone, df_zone, df_optimized_estafettes, df_livraisons_original = processor.traiter_avec_cache(
                             liv_file, ydlogist_file, wcliegps_file
                         )
                     
@@ -302,6 +303,8 @@ def page_import():
                     <p style="color: green; font-size: 16px; font-weight: bold;">✅ Données importées et traitées avec succès !</p>
                 </div>
                 """, unsafe_allow_html=True)
+                    if processor.depuis_cache:
+                        st.caption("♻️ Fichiers déjà traités : résultats repris du cache.")
                 
                     
                 except Exception as e:
@@ -3316,6 +3319,17 @@ def page_finalisation():
                 
                 if success:
                     st.success(message)
+
+                    # Planning finalisé conservé dans l'historique (tendances, coûts, taux d'occupation)
+                    ok_historique, message_historique, _ = HISTORIQUE_PLANNING.enregistrer_plan(
+                        df_export_final,
+                        HISTORIQUE_PLANNING.date_du_plan(df_export_final, st.session_state.get("dates_bl")),
+                        st.session_state.df_livraisons_original,
+                        st.session_state.get("cout_estafette", 150),
+                        st.session_state.get("cout_camion", 800),
+                        libelle=nom_fichier
+                    )
+                    (st.success if ok_historique else st.warning)(message_historique)
                     
                     # =====================================================
                     # APERÇU DU FORMAT D'EXPORT
@@ -3602,6 +3616,148 @@ def page_finalisation():
         if st.button("🚚 Retourner à l'optimisation pour valider les voyages", type="primary"):
             st.session_state.page = "optimisation"
             st.rerun()
+
+# =====================================================
+# PAGE 5: HISTORIQUE ET TENDANCES
+# =====================================================
+# Requêtes sur les synthèses journalières de l'historique, mises en cache jusqu'au prochain
+# enregistrement d'un planning (la signature de l'historique fait partie de la clé)
+@st.cache_data(show_spinner=False, max_entries=64)
+def indicateurs_historique(signature, debut, fin, zones):
+    return HISTORIQUE_PLANNING.indicateurs_journaliers(debut, fin, list(zones) or None)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def zones_historique(signature, debut, fin):
+    return HISTORIQUE_PLANNING.indicateurs_par_zone(debut, fin)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def locations_historique(signature, debut, fin, limite):
+    return HISTORIQUE_PLANNING.locations_par_client(debut, fin, limite)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def vehicules_historique(signature, debut, fin, seuil_taux):
+    return HISTORIQUE_PLANNING.utilisation_vehicules(debut, fin, seuil_taux)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def series_historique(signature, debut, fin, zones, frequence):
+    """Indicateurs de la période regroupés au pas d'affichage (au plus MAX_POINTS_GRAPHIQUE points)."""
+    return agreger_indicateurs(indicateurs_historique(signature, debut, fin, zones), frequence)
+
+def page_historique():
+    st.markdown("<h1 class='main-header'>5. 📈 Historique et Tendances</h1>", unsafe_allow_html=True)
+
+    signature = HISTORIQUE_PLANNING.signature()
+    premiere_date, derniere_date = HISTORIQUE_PLANNING.periode()
+    if premiere_date is None:
+        st.info("ℹ️ L'historique est vide : chaque planning exporté depuis la page « Planning et KPIs » y est enregistré.")
+        return
+
+    # =====================================================
+    # PÉRIODE, ZONES ET PAS D'AFFICHAGE
+    # =====================================================
+    col_periode, col_zones, col_pas = st.columns([2, 2, 1])
+    with col_periode:
+        periode = st.date_input(
+            "📅 Période",
+            value=(max(premiere_date, derniere_date - pd.Timedelta(days=364)).date(), derniere_date.date()),
+            min_value=premiere_date.date(), max_value=derniere_date.date(), key="historique_periode"
+        )
+    # Une seule date sélectionnée (saisie en cours) : période d'un jour
+    debut, fin = (periode[0], periode[-1]) if isinstance(periode, (tuple, list)) and periode else (periode, periode)
+    with col_zones:
+        zones_disponibles = zones_historique(signature, debut, fin)["Zone"].tolist()
+        zones = st.multiselect("🌍 Zones", zones_disponibles, key="historique_zones")
+    with col_pas:
+        pas_auto = frequence_historique(debut, fin)
+        pas = st.selectbox("Pas", ["Auto", "Jour", "Semaine", "Mois"], key="historique_pas",
+                           help=f"Auto : au plus {MAX_POINTS_GRAPHIQUE} points par graphique ({pas_auto.lower()} sur cette période)")
+    frequence = pas_auto if pas == "Auto" else pas
+
+    df_jours = indicateurs_historique(signature, debut, fin, tuple(zones))
+    if df_jours.empty:
+        st.warning("⚠️ Aucun planning enregistré sur cette période.")
+        return
+    df_series = series_historique(signature, debut, fin, tuple(zones), frequence)
+
+    # =====================================================
+    # INDICATEURS DE LA PÉRIODE
+    # =====================================================
+    poids_total = df_jours["Poids (kg)"].sum()
+    col1, col2, col3, col4, col5 = st.columns(5)
+    col1.metric("📅 Jours planifiés", len(df_jours))
+    col2.metric("🚚 Voyages", int(df_jours["Voyages"].sum()), f"{int(df_jours['Camions loués'].sum())} camion(s) loué(s)",
+                delta_color="off")
+    col3.metric("📊 Taux moyen", f"{(df_jours['Taux moyen (%)'] * df_jours['Voyages']).sum() / df_jours['Voyages'].sum():.1f} %")
+    col4.metric("💰 Coût total", f"{df_jours['Coût (TND)'].sum():,.0f} TND")
+    col5.metric("⚖️ Coût par kg", f"{df_jours['Coût (TND)'].sum() / poids_total:.3f} TND" if poids_total else "—")
+    st.caption(f"Graphiques au pas « {frequence.lower()} » : {len(df_series)} point(s) pour {len(df_jours)} jour(s) planifié(s).")
+
+    # =====================================================
+    # UTILISATION DE LA FLOTTE ET COÛT PAR KG
+    # =====================================================
+    # Onglets rendus à la demande : seules les figures de l'onglet ouvert sont construites
+    onglet_flotte, onglet_couts, onglet_clients, onglet_vehicules = st.tabs(
+        ["🚚 Utilisation de la flotte", "💰 Coût par kg", "🏢 Locations par client", "🔻 Véhicules sous-utilisés"],
+        key="onglets_historique", on_change="rerun"
+    )
+    if onglet_flotte.open:
+        with onglet_flotte:
+            fig_voyages = px.bar(
+                df_series, x="Date", y=["Estafettes", "Camions loués"],
+                title="Voyages par type de véhicule", labels={"value": "Voyages", "variable": "Type"}
+            )
+            st.plotly_chart(fig_voyages, use_container_width=True)
+            fig_taux = px.line(df_series, x="Date", y="Taux moyen (%)", markers=len(df_series) <= 60,
+                               title="Taux d'occupation moyen des voyages")
+            fig_taux.add_hline(y=70, line_dash="dot", annotation_text="Objectif 70 %")
+            st.plotly_chart(fig_taux, use_container_width=True)
+
+    if onglet_couts.open:
+        with onglet_couts:
+            fig_cout_kg = px.line(df_series, x="Date", y="Coût par kg (TND)", markers=len(df_series) <= 60,
+                                  title="Coût de transport par kg livré")
+            st.plotly_chart(fig_cout_kg, use_container_width=True)
+            df_zones = zones_historique(signature, debut, fin)
+            if not df_zones.empty:
+                fig_zones = px.bar(df_zones, x="Zone", y="Coût par kg (TND)", color="Taux moyen (%)",
+                                   title="Coût par kg et taux moyen par zone")
+                st.plotly_chart(fig_zones, use_container_width=True)
+
+    if onglet_clients.open:
+        with onglet_clients:
+            nb_clients = st.slider("Nombre de clients", min_value=5, max_value=50, value=15, step=5,
+                                   key="historique_nb_clients")
+            df_locations = locations_historique(signature, debut, fin, nb_clients)
+            if df_locations.empty:
+                st.info("ℹ️ Aucune location de camion sur cette période.")
+            else:
+                fig_locations = px.bar(df_locations.iloc[::-1], x="Camions loués", y="Client", orientation="h",
+                                       hover_data=["Jours avec location", "BLs", "Poids (kg)"],
+                                       title="Clients ayant nécessité le plus de camions loués")
+                st.plotly_chart(fig_locations, use_container_width=True)
+
+    if onglet_vehicules.open:
+        with onglet_vehicules:
+            seuil_taux = st.slider("Taux moyen inférieur à (%)", min_value=10, max_value=100, value=50, step=5,
+                                   key="historique_seuil_taux")
+            df_sous_utilises = vehicules_historique(signature, debut, fin, seuil_taux)
+            if df_sous_utilises.empty:
+                st.success(f"✅ Aucun véhicule sous {seuil_taux} % de taux moyen sur cette période.")
+            else:
+                st.warning(f"⚠️ {len(df_sous_utilises)} véhicule(s) sous {seuil_taux} % de taux d'occupation moyen.")
+                show_df(df_sous_utilises, use_container_width=True, hide_index=True)
+
+    with st.expander("🗂️ Plannings enregistrés"):
+        df_plans = HISTORIQUE_PLANNING.plans_enregistres()
+        df_plans = df_plans[(df_plans["Date"] >= pd.Timestamp(debut)) & (df_plans["Date"] <= pd.Timestamp(fin))]
+        show_df(df_plans, use_container_width=True, hide_index=True)
+        st.download_button(
+            label="📥 Télécharger les indicateurs journaliers",
+            data=lambda: to_excel(df_jours, "Indicateurs journaliers"),  # généré seulement au clic
+            file_name=f"Historique_{pd.Timestamp(debut):%Y%m%d}_{pd.Timestamp(fin):%Y%m%d}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
+
 # =====================================================
 # NAVIGATION PRINCIPALE
 # =====================================================
@@ -3623,7 +3779,8 @@ def main():
             "import": {"icon": "📥", "label": "Importation Données"},
             "analyse": {"icon": "🔍", "label": "Analyse Détaillée"},
             "optimisation": {"icon": "🚚", "label": "Optimisation"},
-            "finalisation": {"icon": "📊", "label": "Planning et KPIs"}
+            "finalisation": {"icon": "📊", "label": "Planning et KPIs"},
+            "historique": {"icon": "📈", "label": "Historique et Tendances"}
         }
         
         for page_key, page_info in page_options.items():
@@ -3668,6 +3825,8 @@ def main():
         page_optimisation()
     elif st.session_state.page == "finalisation":
         page_finalisation()
+    elif st.session_state.page == "historique":
+        page_historique()
 
 # =====================================================
 # LANCEMENT DE L'APPLICATION
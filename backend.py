@@ -1,7 +1,17 @@
 
 import pandas as pd
 import math
+import heapq
+import string
+import bisect
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Copy-on-Write : actif par défaut à partir de pandas 3, activé explicitement pour pandas 2.x.
+# Les vues (copy(deep=False)) du plan ne sont copiées qu'à leur première modification.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # --- Constantes pour la location de camion ---
 SEUIL_POIDS = 3000.0    # kg
@@ -37,25 +47,234 @@ def get_capacite_volume_camion(truck_type="5 tonnes"):
 CAMION_POIDS_MAX = get_capacite_poids_camion  # C'est maintenant une fonction !
 CAMION_VOLUME_MAX = get_capacite_volume_camion  # C'est maintenant une fonction !
 
+def get_capacites_vehicules(df):
+    """Retourne les capacités max (poids, volume) de chaque voyage du DataFrame, en vectorisé."""
+    code = df["Code Véhicule"] if "Code Véhicule" in df.columns else pd.Series("ESTAFETTE", index=df.index)
+    type_camion = df["Type_Camion"] if "Type_Camion" in df.columns else pd.Series("5 tonnes", index=df.index)
+
+    est_camion = (code == CAMION_CODE).to_numpy()
+    est_10t = (type_camion == "10 tonnes").to_numpy()
+
+    poids_max = np.where(est_camion, np.where(est_10t, CAPACITE_POIDS_CAMION_10T, CAPACITE_POIDS_CAMION_5T),
+                         CAPACITE_POIDS_ESTAFETTE)
+    volume_max = np.where(est_camion, np.where(est_10t, CAPACITE_VOLUME_CAMION_10T, CAPACITE_VOLUME_CAMION_5T),
+                          CAPACITE_VOLUME_ESTAFETTE)
+    return pd.Series(poids_max, index=df.index, dtype=float), pd.Series(volume_max, index=df.index, dtype=float)
+
+# =====================================================
+# CACHE DU TRAITEMENT COMPLET (CONTENU DES FICHIERS)
+# =====================================================
+TAILLE_MAX_CACHE_TRAITEMENT_MO = 512   # taille mémoire estimée maximale des résultats gardés
+
+
+def _octets_fichier(fichier):
+    """Contenu binaire d'un fichier importé (UploadedFile, BytesIO, bytes ou chemin), sans déplacer sa position."""
+    import os
+    if fichier is None:
+        return None
+    if isinstance(fichier, (bytes, bytearray)):
+        return bytes(fichier)
+    if isinstance(fichier, (str, os.PathLike)):
+        with open(fichier, "rb") as f:
+            return f.read()
+    if hasattr(fichier, "getvalue"):
+        return fichier.getvalue()
+    position = fichier.tell()
+    fichier.seek(0)
+    contenu = fichier.read()
+    fichier.seek(position)
+    return contenu
+
+
+def _taille_objet(objet):
+    """Taille mémoire estimée (octets) d'un résultat : DataFrames/Series en profondeur, conteneurs parcourus."""
+    import sys
+    if isinstance(objet, pd.DataFrame):
+        return int(objet.memory_usage(index=True, deep=True).sum())
+    if isinstance(objet, pd.Series):
+        return int(objet.memory_usage(index=True, deep=True))
+    if isinstance(objet, (tuple, list)):
+        return sum(_taille_objet(element) for element in objet)
+    if isinstance(objet, dict):
+        return sum(_taille_objet(element) for element in objet.values())
+    return sys.getsizeof(objet)
+
+
+class PipelineCache:
+    """
+    Cache LRU des résultats du traitement complet, partagé par toutes les sessions du processus.
+    Clé : sha256 du contenu des fichiers importés et de la configuration ; les entrées les moins
+    récemment utilisées sont évincées au-delà de `taille_max_octets` (taille mémoire estimée).
+    Les résultats sont copiés à l'entrée et à la sortie : une session ne modifie jamais le cache.
+    """
+
+    def __init__(self, taille_max_octets=TAILLE_MAX_CACHE_TRAITEMENT_MO * 1024 ** 2):
+        import threading
+        from collections import OrderedDict
+        self.taille_max_octets = taille_max_octets
+        self._entrees = OrderedDict()   # clé -> (résultat, taille)
+        self._taille = 0
+        self._verrou = threading.Lock()
+        self.succes = 0
+        self.echecs = 0
+
+    @staticmethod
+    def cle(fichiers, configuration=None):
+        """Empreinte sha256 du contenu des fichiers (dans l'ordre, None compris) et de la configuration."""
+        import hashlib
+        empreinte = hashlib.sha256()
+        for fichier in fichiers:
+            contenu = _octets_fichier(fichier)
+            # Longueur en préfixe : deux découpages différents des mêmes octets ne collisionnent pas
+            empreinte.update(b"-" if contenu is None else len(contenu).to_bytes(8, "big") + contenu)
+        empreinte.update(repr(configuration).encode())
+        return empreinte.hexdigest()
+
+    def obtenir(self, cle):
+        """Copie du résultat mis en cache (et marqué récemment utilisé), None si absent."""
+        import copy
+        with self._verrou:
+            entree = self._entrees.get(cle)
+            if entree is None:
+                self.echecs += 1
+                return None
+            self._entrees.move_to_end(cle)
+            self.succes += 1
+        return copy.deepcopy(entree[0])
+
+    def enregistrer(self, cle, resultat):
+        """Met en cache une copie du résultat puis évince les plus anciens au-delà de la taille maximale."""
+        import copy
+        taille = _taille_objet(resultat)
+        if taille > self.taille_max_octets:
+            return False
+        copie = copy.deepcopy(resultat)
+        with self._verrou:
+            if cle in self._entrees:
+                self._taille -= self._entrees.pop(cle)[1]
+            self._entrees[cle] = (copie, taille)
+            self._taille += taille
+            while self._taille > self.taille_max_octets:
+                _, (_, taille_evincee) = self._entrees.popitem(last=False)
+                self._taille -= taille_evincee
+        return True
+
+    def vider(self):
+        with self._verrou:
+            self._entrees.clear()
+            self._taille = 0
+
+    def statistiques(self):
+        """Entrées, taille estimée (Mo), succès et échecs du cache."""
+        with self._verrou:
+            return {"entrees": len(self._entrees), "taille_mo": round(self._taille / 1024 ** 2, 2),
+                    "succes": self.succes, "echecs": self.echecs}
+
+
+# Cache unique du processus (modules importés une fois par le serveur Streamlit)
+CACHE_TRAITEMENT = PipelineCache()
+
+
 # =====================================================
 # CLASSE PRINCIPALE DE TRAITEMENT DES LIVRAISONS
 # =====================================================
 class DeliveryProcessor:
+    # Villes desservies par zone
+    ZONES = {
+        "Zone 1": ["TUNIS", "ARIANA", "MANOUBA", "BEN AROUS", "BIZERTE", "MATEUR",
+                  "MENZEL BOURGUIBA", "UTIQUE"],
+        "Zone 2": ["NABEUL", "HAMMAMET", "KORBA", "MENZEL TEMIME", "KELIBIA", "SOLIMAN"],
+        "Zone 3": ["SOUSSE", "MONASTIR", "MAHDIA", "KAIROUAN"],
+        "Zone 4": ["GABÈS", "MEDENINE", "ZARZIS", "DJERBA"],
+        "Zone 5": ["GAFSA", "KASSERINE", "TOZEUR", "NEFTA", "DOUZ"],
+        "Zone 6": ["JENDOUBA", "BÉJA", "LE KEF", "TABARKA", "SILIANA"],
+        "Zone 7": ["SFAX"]
+    }
+
+    # Clients du groupe exclus des livraisons
+    CLIENTS_EXCLUS = [
+        "AMECAP", "SANA", "SOPAL", "SOPALGAZ", "SOPALSERV", "SOPALTEC",
+        "SOPALALG", "AQUA", "WINOX", "QUIVEM", "SANISTONE",
+        "SOPAMAR", "SOPALAFR", "SOPALINTER"
+    ]
+
     def __init__(self):
         self.df_livraisons_original = None
-    
-    def process_delivery_data(self, liv_file, ydlogist_file, wcliegps_file):
-        """Traite les fichiers d'entrée et retourne les DataFrames résultants."""
+        self.df_clients_gps = pd.DataFrame(columns=["Client", "Latitude", "Longitude"])
+        self.fenetres_horaires = None
+        self.df_tournees = pd.DataFrame()
+        self.dates_bl = pd.Series(dtype="datetime64[ns]")
+        self.vues_analyse = None
+        self.depuis_cache = False
+
+    def configuration(self):
+        """Paramètres dont dépend le résultat du traitement (avec le contenu des fichiers : clé du cache)."""
+        return {
+            "zones": self.ZONES,
+            "clients_exclus": self.CLIENTS_EXCLUS,
+            "seuils": (SEUIL_POIDS, SEUIL_VOLUME),
+            "capacites": (CAPACITE_POIDS_ESTAFETTE, CAPACITE_VOLUME_ESTAFETTE,
+                          CAPACITE_POIDS_CAMION_5T, CAPACITE_VOLUME_CAMION_5T,
+                          CAPACITE_POIDS_CAMION_10T, CAPACITE_VOLUME_CAMION_10T),
+            "tournees": (DEPOT_LATITUDE, DEPOT_LONGITUDE, VITESSE_MOYENNE_KMH, FACTEUR_DETOUR_ROUTE,
+                         TEMPS_SERVICE_CLIENT_MIN, TEMPS_CHARGEMENT_MIN),
+        }
+
+    def traiter_avec_cache(self, liv_file, ydlogist_file, wcliegps_file, fenetres_file=None, cache=None,
+                           progression=None):
+        """
+        process_delivery_data mémoïsé par contenu des fichiers + configuration (CACHE_TRAITEMENT par défaut,
+        partagé par toutes les sessions). self.depuis_cache indique si le résultat vient du cache.
+        Les vues de l'analyse de livraison (self.vues_analyse) sont calculées avec le traitement
+        et mises en cache avec ses résultats. `progression(etape, avancement)` : voir process_delivery_data.
+        """
+        cache = cache if cache is not None else CACHE_TRAITEMENT
+        cle = cache.cle((liv_file, ydlogist_file, wcliegps_file, fenetres_file), self.configuration())
+        entree = cache.obtenir(cle)
+        if entree is not None:
+            resultats, (self.df_clients_gps, self.fenetres_horaires, self.df_tournees, self.dates_bl,
+                        self.vues_analyse) = entree
+            self.df_livraisons_original = resultats[5]
+            self.depuis_cache = True
+            signaler_etape(progression, "Résultats repris du cache", 1.0)
+            return resultats
+
+        resultats = self.process_delivery_data(liv_file, ydlogist_file, wcliegps_file, fenetres_file, progression)
+        signaler_etape(progression, "Préparation des vues d'analyse", 0.95)
+        self.vues_analyse = preparer_vues_analyse(*resultats[:4])
+        cache.enregistrer(cle, (resultats, (self.df_clients_gps, self.fenetres_horaires, self.df_tournees,
+                                            self.dates_bl, self.vues_analyse)))
+        self.depuis_cache = False
+        signaler_etape(progression, "Traitement terminé", 1.0)
+        return resultats
+
+    def process_delivery_data(self, liv_file, ydlogist_file, wcliegps_file, fenetres_file=None, progression=None):
+        """
+        Traite les fichiers d'entrée et retourne les DataFrames résultants.
+        `progression(etape, avancement)` (optionnel) est appelé au début de chaque étape ; il peut
+        lever TraitementAnnule pour interrompre le traitement (Job.signaler).
+        """
         try:
             # Lecture des fichiers
+            signaler_etape(progression, "Lecture des livraisons", 0.0)
             df_liv = self._load_livraisons(liv_file)
+            signaler_etape(progression, "Lecture des volumes articles", 0.05)
             df_yd = self._load_ydlogist(ydlogist_file)
+            signaler_etape(progression, "Lecture des clients", 0.65)
             df_clients = self._load_wcliegps(wcliegps_file)
 
+            # Référentiel optionnel des fenêtres horaires / temps de service
+            self.fenetres_horaires = None
+            if fenetres_file is not None:
+                self.fenetres_horaires = FenetresHoraires(self._load_fenetres(fenetres_file), self.df_clients_gps)
+
             # Filtrage des données
+            signaler_etape(progression, "Filtrage des livraisons", 0.75)
             df_liv = self._filter_initial_data(df_liv)
+            self.dates_bl = self._extract_dates_livraison(df_liv)
 
             # Calcul Poids & Volume
+            signaler_etape(progression, "Calcul des poids et volumes", 0.8)
             df_poids = self._calculate_weights(df_liv)
             df_vol = self._calculate_volumes(df_liv, df_yd)
 
@@ -70,6 +289,7 @@ class DeliveryProcessor:
             df_final["Volume total"] = df_final["Volume de l'US"] * df_final["Quantité livrée US"]
 
             # Regroupement par ville et client (pour l'affichage "Livraisons Client/Ville")
+            signaler_etape(progression, "Regroupement par client, ville et zone", 0.85)
             df_grouped, df_city = self._group_data(df_final)
 
             # Calcul du besoin en estafette par ville
@@ -88,6 +308,7 @@ class DeliveryProcessor:
             df_zone = self._calculate_estafette_need(df_zone)
 
             # Calcul des voyages optimisés 
+            signaler_etape(progression, "Optimisation des voyages", 0.88)
             df_optimized_estafettes = self._calculate_optimized_estafette(df_grouped_zone)
 
             # 🆕 CORRECTION : Stocker les données originales du tableau "Livraisons par Client & Ville + Zone"
@@ -96,6 +317,8 @@ class DeliveryProcessor:
             # 🆕 CORRECTION : Retourner 6 valeurs
             return df_grouped, df_city, df_grouped_zone, df_zone, df_optimized_estafettes, self.df_livraisons_original
 
+        except TraitementAnnule:
+            raise
         except Exception as e:
             raise Exception(f"❌ Erreur lors du traitement des données : {str(e)}")
 
@@ -126,15 +349,50 @@ class DeliveryProcessor:
         for col in required_cols:
             if col not in df_clients.columns:
                 raise ValueError(f"La colonne '{col}' est manquante dans le fichier clients.")
+        # La 4e colonne du fichier clients contient les coordonnées GPS « lat, lon »
+        if len(df_clients.columns) > 3:
+            self.df_clients_gps = self._extract_gps_clients(df_clients, df_clients.columns[3])
         return df_clients[["Client", "Ville", "Représentant"]].copy()
 
+    def _extract_dates_livraison(self, df_liv):
+        """Date de livraison de chaque BL (utilisée par la planification multi-jours)."""
+        if "Date livraison" not in df_liv.columns:
+            return pd.Series(dtype="datetime64[ns]")
+        dates = pd.to_datetime(df_liv["Date livraison"], dayfirst=True, errors="coerce")
+        return dates.groupby(df_liv["No livraison"].astype(str)).min()
+
+    def _load_fenetres(self, fenetres_file):
+        df = pd.read_excel(fenetres_file)
+        if "Client" not in df.columns:
+            raise ValueError("La colonne 'Client' est manquante dans le référentiel des fenêtres horaires.")
+        colonnes = ["Heure début", "Heure fin", "Temps de service (min)"]
+        if not any(col in df.columns for col in colonnes):
+            raise ValueError(f"Le référentiel des fenêtres horaires doit contenir au moins une des colonnes {colonnes}.")
+        return df
+
+    def _extract_gps_clients(self, df_clients, gps_col):
+        """Extrait les coordonnées GPS des clients, complétées par le centroïde de leur ville."""
+        coords = df_clients[gps_col].astype(str).str.extract(r"(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)")
+        df_gps = pd.DataFrame({
+            "Client": df_clients["Client"].astype(str),
+            "Ville": df_clients["Ville"].astype(str).str.upper().str.strip(),
+            "Latitude": pd.to_numeric(coords[0], errors="coerce"),
+            "Longitude": pd.to_numeric(coords[1], errors="coerce"),
+        })
+
+        # Écarter les coordonnées aberrantes
+        valides = df_gps["Latitude"].between(-90, 90) & df_gps["Longitude"].between(-180, 180)
+        df_gps.loc[~valides, ["Latitude", "Longitude"]] = np.nan
+
+        # Clients sans GPS : centroïde des clients géolocalisés de la même ville
+        centroides = df_gps.groupby("Ville")[["Latitude", "Longitude"]].transform("mean")
+        df_gps[["Latitude", "Longitude"]] = df_gps[["Latitude", "Longitude"]].fillna(centroides)
+
+        df_gps = df_gps.dropna(subset=["Latitude", "Longitude"]).drop_duplicates(subset="Client")
+        return df_gps[["Client", "Latitude", "Longitude"]].reset_index(drop=True)
+
     def _filter_initial_data(self, df):
-        clients_exclus = [
-            "AMECAP", "SANA", "SOPAL", "SOPALGAZ", "SOPALSERV", "SOPALTEC",
-            "SOPALALG", "AQUA", "WINOX", "QUIVEM", "SANISTONE",
-            "SOPAMAR", "SOPALAFR", "SOPALINTER"
-        ]
-        return df[(df["Type livraison"] != "SDC") & (~df["Client commande"].isin(clients_exclus))]
+        return df[(df["Type livraison"] != "SDC") & (~df["Client commande"].isin(self.CLIENTS_EXCLUS))]
 
     def _calculate_weights(self, df):
         df["Poids de l'US"] = pd.to_numeric(df["Poids de l'US"].astype(str).str.replace(",", ".")
@@ -179,20 +437,9 @@ class DeliveryProcessor:
         return df
 
     def _add_zone(self, df):
-        zones = {
-            "Zone 1": ["TUNIS", "ARIANA", "MANOUBA", "BEN AROUS", "BIZERTE", "MATEUR",
-                      "MENZEL BOURGUIBA", "UTIQUE"],
-            "Zone 2": ["NABEUL", "HAMMAMET", "KORBA", "MENZEL TEMIME", "KELIBIA", "SOLIMAN"],
-            "Zone 3": ["SOUSSE", "MONASTIR", "MAHDIA", "KAIROUAN"],
-            "Zone 4": ["GABÈS", "MEDENINE", "ZARZIS", "DJERBA"],
-            "Zone 5": ["GAFSA", "KASSERINE", "TOZEUR", "NEFTA", "DOUZ"],
-            "Zone 6": ["JENDOUBA", "BÉJA", "LE KEF", "TABARKA", "SILIANA"],
-            "Zone 7": ["SFAX"]
-        }
-
         def get_zone(ville):
             ville = str(ville).upper().strip()
-            for z, villes in zones.items():
+            for z, villes in self.ZONES.items():
                 if ville in villes:
                     return z
             return "Zone inconnue"
@@ -210,6 +457,7 @@ class DeliveryProcessor:
 
     def _calculate_optimized_estafette(self, df_grouped_zone):
         resultats = []
+        tournees = []
         estafette_num = 1
 
         for zone, group in df_grouped_zone.groupby("Zone"):
@@ -226,28 +474,46 @@ class DeliveryProcessor:
                 
                 for e in estafettes:
                     if e["poids"] + poids <= CAPACITE_POIDS_ESTAFETTE and e["volume"] + volume <= CAPACITE_VOLUME_ESTAFETTE:
+                        # Fenêtres horaires : insertion dans la tournée seulement si elle reste réalisable
+                        if e["tournee"] is not None and not e["tournee"].placer_bl(client):
+                            continue
                         e["poids"] += poids
                         e["volume"] += volume
                         e["bls"].append(bl)
+                        e["bl_clients"].append(client.strip())
                         for c in client.split(','): e["clients"].add(c.strip())
                         for r in representant.split(','): e["representants"].add(r.strip())
                         placed = True
                         break
                 
                 if not placed:
+                    tournee = None
+                    if self.fenetres_horaires is not None:
+                        tournee = self.fenetres_horaires.nouvelle_tournee()
+                        tournee.placer_bl(client, forcer=True)
                     estafettes.append({
                         "poids": poids,
                         "volume": volume,
                         "bls": [bl],
+                        "bl_clients": [client.strip()],
                         "clients": {c.strip() for c in client.split(',')},
                         "representants": {r.strip() for r in representant.split(',')},
-                        "num_global": estafette_num
+                        "num_global": estafette_num,
+                        "tournee": tournee
                     })
                     estafette_num += 1
 
             for e in estafettes:
                 clients_list = ", ".join(sorted(list(e["clients"])))
                 representants_list = ", ".join(sorted(list(e["representants"])))
+                bls = e["bls"]
+                if e["tournee"] is not None:
+                    # BLs dans l'ordre de passage de la tournée
+                    ordre = {c: i for i, c in enumerate(e["tournee"].clients)}
+                    premier_arret = lambda clients: min((ordre[c] for c in Tournee.clients_du_bl(clients)), default=0)
+                    bls = [bl for _, bl in sorted(zip(e["bl_clients"], e["bls"]), key=lambda x: premier_arret(x[0]))]
+                    for arret in e["tournee"].planning():
+                        tournees.append({"Zone": zone, "Véhicule N°": f"E{e['num_global']}", **arret})
                 resultats.append([
                     zone,
                     e["num_global"],
@@ -255,8 +521,9 @@ class DeliveryProcessor:
                     e["volume"],
                     clients_list,   
                     representants_list,
-                    ";".join(e["bls"])
+                    ";".join(bls)
                 ])
+        self.df_tournees = pd.DataFrame(tournees)
                 
         df_estafettes = pd.DataFrame(resultats, columns=[
             "Zone", "Estafette N°", "Poids total chargé", "Volume total chargé", 
@@ -278,14 +545,516 @@ class DeliveryProcessor:
         
         return df_estafettes
 
+# =====================================================
+# MAGASIN DU PLAN (VERSIONS COPY-ON-WRITE ET DELTAS)
+# =====================================================
+def _empreintes_lignes(df):
+    """Empreinte de chaque ligne (indexée par étiquette), cellules non hachables rendues en texte."""
+    try:
+        return pd.util.hash_pandas_object(df, index=False)
+    except TypeError:
+        return pd.util.hash_pandas_object(df.astype(str), index=False)
+
+def _tampons_colonne(serie):
+    """Adresses des tampons mémoire d'une colonne (numpy ou Arrow) : identifie les colonnes partagées."""
+    tableau = serie.array
+    if hasattr(tableau, "__arrow_array__"):
+        import pyarrow as pa
+        morceaux = pa.chunked_array(tableau.__arrow_array__()).chunks
+        return tuple(t.address for morceau in morceaux for t in morceau.buffers() if t is not None)
+    valeurs = np.asarray(tableau)
+    return (valeurs.__array_interface__["data"][0], valeurs.nbytes)
+
+def memoire_dataframes(objets):
+    """
+    Mémoire des DataFrames de la session ({nom: DataFrame}) : colonnes propres à chaque objet,
+    colonnes partagées avec un objet déjà compté (vues copy-on-write) et coût d'une copie complète.
+    """
+    vus = set()
+    lignes = []
+    for nom, df in objets.items():
+        if not isinstance(df, pd.DataFrame):
+            continue
+        propre = partage = 0
+        for position in range(df.shape[1]):
+            serie = df.iloc[:, position]
+            taille = int(serie.memory_usage(index=False, deep=True))
+            tampons = _tampons_colonne(serie)
+            if tampons in vus:
+                partage += taille
+            else:
+                vus.add(tampons)
+                propre += taille
+        lignes.append({
+            "Objet": nom,
+            "Lignes": len(df),
+            "Mémoire propre (Mo)": round(propre / 1024 ** 2, 3),
+            "Partagée (Mo)": round(partage / 1024 ** 2, 3),
+            "Copie complète (Mo)": round((propre + partage) / 1024 ** 2, 3),
+        })
+    return pd.DataFrame(lignes, columns=["Objet", "Lignes", "Mémoire propre (Mo)", "Partagée (Mo)", "Copie complète (Mo)"])
+
+# Un instantané (vue partagée du plan complet) toutes les N versions : une restauration rejoue au plus N/2 deltas
+INTERVALLE_INSTANTANES_PLAN = 10
+
+def _rejouer_delta(df, delta, en_avant=True):
+    """Plan obtenu en appliquant un delta du journal (en avant) ou en l'annulant (en arrière)."""
+    if "complet" in delta:
+        plan = delta["complet"] if en_avant else delta["precedent"]
+        return None if plan is None else plan.copy(deep=False)
+    retirees, ajoutees = (delta["avant"], delta["apres"]) if en_avant else (delta["apres"], delta["avant"])
+    ordre = delta["index"] if en_avant else delta["index_avant"]
+    if ordre is None:
+        # Mêmes lignes dans le même ordre : seules les colonnes modifiées sont copiées (copy-on-write)
+        plan = df.copy(deep=False)
+        actuelles = df.loc[ajoutees.index]
+        for colonne in ajoutees.columns:
+            if not actuelles[colonne].equals(ajoutees[colonne]):
+                plan.loc[ajoutees.index, colonne] = ajoutees[colonne]
+        return plan
+    morceaux = [df.drop(index=retirees.index)]
+    if not ajoutees.empty:
+        morceaux.append(ajoutees)
+    return pd.concat(morceaux).loc[ordre]
+
+class PlanStore:
+    """
+    Plan de voyages versionné. Le magasin garde une seule version courante du plan et distribue
+    des vues en lecture seule (copy-on-write : une vue modifiée est copiée, jamais le plan du magasin).
+    Chaque modification est enregistrée dans un journal en ajout seul, comme un delta limité aux lignes
+    modifiées, ajoutées ou supprimées (étiquettes d'index) ; un changement de colonnes est enregistré
+    comme plan complet. Des instantanés périodiques permettent d'annuler, de rétablir ou d'aller à
+    une version quelconque en rejouant quelques deltas.
+    """
+
+    def __init__(self, df_plan=None, operation="Plan initial", contexte=None,
+                 intervalle_instantanes=INTERVALLE_INSTANTANES_PLAN):
+        self._plan = None
+        self._empreintes = None
+        self.version = 0    # version courante (inférieure à la dernière version après une annulation)
+        self.journal = []   # journal[i] : delta de la version i à la version i + 1
+        self.intervalle_instantanes = intervalle_instantanes
+        self._instantanes = {}   # version -> plan complet (vue partagée)
+        self._contextes = {}     # version -> état associé (ex. décisions de location)
+        if df_plan is not None:
+            self.enregistrer(df_plan, operation, contexte)
+
+    @property
+    def derniere_version(self):
+        return len(self.journal)
+
+    @property
+    def contextes(self):
+        """Contextes enregistrés par version (lecture seule)."""
+        return dict(self._contextes)
+
+    @classmethod
+    def depuis_journal(cls, journal, version=None, contextes=None, intervalle_instantanes=INTERVALLE_INSTANTANES_PLAN):
+        """
+        Reconstruit un magasin à partir d'un journal relu (SessionPersistence) : les deltas sont rejoués
+        une fois pour retrouver les instantanés et les plans précédant les plans complets.
+        """
+        magasin = cls(intervalle_instantanes=intervalle_instantanes)
+        plan = None
+        for delta in journal:
+            if "complet" in delta:
+                delta["precedent"] = None if plan is None else plan.copy(deep=False)
+            plan = _rejouer_delta(plan, delta, en_avant=True)
+            magasin.journal.append(delta)
+            if "complet" in delta or delta["version"] % intervalle_instantanes == 0:
+                magasin._instantanes[delta["version"]] = plan.copy(deep=False)
+        magasin._plan = plan
+        magasin.version = len(magasin.journal)
+        magasin._contextes = dict(contextes or {})
+        if version is not None and version != magasin.version:
+            magasin.aller_a(version)
+        return magasin
+
+    def vue(self):
+        """Vue du plan courant (aucune copie ; une modification de la vue ne touche pas le magasin)."""
+        return None if self._plan is None else self._plan.copy(deep=False)
+
+    def _delta(self, df_plan, empreintes):
+        """Lignes avant/après modification ; None si le plan est inchangé."""
+        ancien = self._plan
+        if (ancien is None or not ancien.columns.equals(df_plan.columns)
+                or not ancien.index.is_unique or not df_plan.index.is_unique):
+            return {"complet": df_plan.copy(deep=False), "precedent": self.vue()}
+
+        if self._empreintes is None:
+            self._empreintes = _empreintes_lignes(ancien)
+        communs = ancien.index.intersection(df_plan.index)
+        modifies = communs[self._empreintes.reindex(communs).to_numpy() != empreintes.reindex(communs).to_numpy()]
+        ajoutes = df_plan.index.difference(ancien.index)
+        supprimes = ancien.index.difference(df_plan.index)
+        meme_ordre = ancien.index.equals(df_plan.index)
+        if modifies.empty and ajoutes.empty and supprimes.empty and meme_ordre:
+            return None
+        return {
+            "avant": ancien.loc[modifies.append(supprimes)],
+            "apres": df_plan.loc[modifies.append(ajoutes)],
+            "index": None if meme_ordre else df_plan.index,
+            "index_avant": None if meme_ordre else ancien.index,
+        }
+
+    def enregistrer(self, df_plan, operation, contexte=None):
+        """
+        Nouvelle version du plan si df_plan diffère de la version courante. Après une annulation,
+        les versions suivantes (rétablissables) sont abandonnées. `contexte` : état associé à la
+        version, retrouvé par contexte() tant qu'une version ultérieure ne le remplace pas.
+        Retourne True si une version a été créée.
+        """
+        import time
+        empreintes = _empreintes_lignes(df_plan)
+        delta = self._delta(df_plan, empreintes)
+        if delta is None:
+            return False
+        if self.version < self.derniere_version:
+            del self.journal[self.version:]
+            self._instantanes = {v: p for v, p in self._instantanes.items() if v <= self.version}
+            self._contextes = {v: c for v, c in self._contextes.items() if v <= self.version}
+        self.version += 1
+        delta.update({"version": self.version, "operation": operation, "horodatage": time.time()})
+        self.journal.append(delta)
+        self._plan = df_plan.copy(deep=False)
+        self._empreintes = empreintes
+        if "complet" in delta or self.version % self.intervalle_instantanes == 0:
+            self._instantanes[self.version] = self.vue()
+        if contexte is not None:
+            self._contextes[self.version] = contexte
+        return True
+
+    def aller_a(self, version):
+        """
+        Restaure la version demandée en partant du point le plus proche (version courante ou
+        instantané) et en rejouant les deltas intermédiaires. Retourne False si la version n'existe pas.
+        """
+        if not 1 <= version <= self.derniere_version:
+            return False
+        depart, plan = self.version, self._plan
+        for version_instantane, instantane in self._instantanes.items():
+            if abs(version_instantane - version) < abs(depart - version):
+                depart, plan = version_instantane, instantane
+        while depart < version:
+            plan = _rejouer_delta(plan, self.journal[depart], en_avant=True)
+            depart += 1
+        while depart > version:
+            depart -= 1
+            plan = _rejouer_delta(plan, self.journal[depart], en_avant=False)
+        self._plan = plan
+        self._empreintes = None  # recalculées à la prochaine modification
+        self.version = version
+        return True
+
+    def annuler(self):
+        """Revient à la version précédente (la version initiale ne s'annule pas)."""
+        return self.version > 1 and self.aller_a(self.version - 1)
+
+    def retablir(self):
+        """Rétablit la version annulée suivante."""
+        return self.version < self.derniere_version and self.aller_a(self.version + 1)
+
+    def contexte(self, version=None, cle=None):
+        """
+        Dernier contexte enregistré jusqu'à la version donnée (version courante par défaut),
+        limité aux contextes contenant la clé `cle` si elle est précisée.
+        """
+        version = self.version if version is None else version
+        versions = [v for v, c in self._contextes.items() if v <= version and (cle is None or cle in c)]
+        return self._contextes[max(versions)] if versions else None
+
+    def historique(self):
+        """Versions enregistrées : opération, statut, lignes modifiées et taille du delta."""
+        return pd.DataFrame([{
+            "Version": delta["version"],
+            "Opération": delta["operation"],
+            "Statut": ("✅ Courante" if delta["version"] == self.version
+                       else "↪️ Annulée" if delta["version"] > self.version else ""),
+            "Type": "Plan complet" if "complet" in delta else "Delta",
+            "Lignes modifiées": len(delta["complet"]) if "complet" in delta else max(len(delta["avant"]), len(delta["apres"])),
+            "Delta (Ko)": round(self._taille_delta(delta) / 1024, 1),
+        } for delta in self.journal], columns=["Version", "Opération", "Statut", "Type", "Lignes modifiées", "Delta (Ko)"])
+
+    @staticmethod
+    def _taille_delta(delta):
+        # Un plan complet est une vue partagée avec la version qu'il décrit : compté à part
+        return sum(_taille_objet(delta[cle]) for cle in ("avant", "apres") if cle in delta)
+
+    def memoire(self):
+        """Version, nombre de deltas et d'instantanés, mémoire (Mo) du plan courant et du journal."""
+        return {
+            "version": self.version,
+            "deltas": len(self.journal),
+            "instantanes": len(self._instantanes),
+            "plan_mo": round(_taille_objet(self._plan) / 1024 ** 2, 3) if self._plan is not None else 0.0,
+            "journal_mo": round(sum(self._taille_delta(delta) for delta in self.journal) / 1024 ** 2, 3),
+        }
+
+# =====================================================
+# PERSISTANCE DES SESSIONS DE PLANIFICATION (PARQUET + JSON)
+# =====================================================
+MAX_SESSIONS_PERSISTEES = 20   # sessions gardées sur disque, les plus anciennes sont supprimées
+
+def _ecrire_atomique(chemin, ecrire):
+    """Écrit via un fichier temporaire renommé : un point de reprise n'est jamais lu à moitié écrit."""
+    import os
+    temporaire = f"{chemin}.tmp"
+    ecrire(temporaire)
+    os.replace(temporaire, chemin)
+
+def _ecrire_table_parquet(df, chemin):
+    """DataFrame (index compris) en Parquet ; colonnes objet hétérogènes rendues en texte si nécessaire."""
+    try:
+        _ecrire_atomique(chemin, lambda destination: df.to_parquet(destination))
+    except (TypeError, ValueError, ImportError) as e:
+        if isinstance(e, ImportError):
+            raise
+        colonnes_objet = df.select_dtypes(include="object").columns
+        _ecrire_atomique(chemin, lambda destination: df.astype({c: str for c in colonnes_objet}).to_parquet(destination))
+
+class SessionPersistence:
+    """
+    Points de reprise des sessions de planification sur disque local, un dossier par session :
+    tables en Parquet (Arrow), journal du PlanStore en fichiers Parquet par delta, métadonnées
+    et état léger (validations, attributions, client sélectionné...) dans session.json.
+    Une sauvegarde n'écrit que les tables modifiées et les deltas nouveaux ; session.json est
+    écrit en dernier, de sorte que le dernier point de reprise complet est toujours lisible.
+    """
+
+    FICHIER_META = "session.json"
+
+    def __init__(self, dossier=None, max_sessions=MAX_SESSIONS_PERSISTEES):
+        import os
+        import threading
+        self.dossier = dossier or os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions")
+        self.max_sessions = max_sessions
+        self._tables_ecrites = {}   # id session -> {table: (objet, empreinte)} : ni réécriture ni re-hachage
+        self._verrou = threading.Lock()
+
+    @staticmethod
+    def nouvel_identifiant():
+        import uuid
+        from datetime import datetime
+        return f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}"
+
+    def _chemin(self, id_session, *parties):
+        import os
+        return os.path.join(self.dossier, id_session, *parties)
+
+    def _lire_meta(self, id_session):
+        import json
+        import os
+        chemin = self._chemin(id_session, self.FICHIER_META)
+        if not os.path.exists(chemin):
+            return None
+        with open(chemin, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _ecrire_meta(self, id_session, meta):
+        import json
+
+        def ecrire(destination):
+            with open(destination, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=1, default=str)
+        _ecrire_atomique(self._chemin(id_session, self.FICHIER_META), ecrire)
+
+    # -------------------------------------------------
+    # Sauvegarde
+    # -------------------------------------------------
+    def _sauvegarder_tables(self, id_session, tables, meta):
+        """Écrit les tables nouvelles ou modifiées ; retourne le nombre de fichiers écrits."""
+        import os
+        ecrites = self._tables_ecrites.setdefault(id_session, {})
+        ecrits = 0
+        for nom, objet in tables.items():
+            if objet is None or (nom in ecrites and ecrites[nom][0] is objet):
+                continue
+            empreinte = version_donnees(objet)
+            if meta["tables"].get(nom, {}).get("empreinte") == empreinte:
+                ecrites[nom] = (objet, empreinte)
+                continue
+            df = objet.to_frame(name="valeur") if isinstance(objet, pd.Series) else objet
+            _ecrire_table_parquet(df, self._chemin(id_session, "tables", f"{nom}.parquet"))
+            meta["tables"][nom] = {"empreinte": empreinte, "serie": isinstance(objet, pd.Series),
+                                   "nom_serie": objet.name if isinstance(objet, pd.Series) else None}
+            ecrites[nom] = (objet, empreinte)
+            ecrits += 1
+        for nom in [n for n, objet in tables.items() if objet is None and n in meta["tables"]]:
+            del meta["tables"][nom]
+            ecrites.pop(nom, None)
+            chemin = self._chemin(id_session, "tables", f"{nom}.parquet")
+            if os.path.exists(chemin):
+                os.remove(chemin)
+        return ecrits
+
+    def _sauvegarder_journal(self, id_session, magasin, meta):
+        """Écrit les deltas (et contextes) absents du point de reprise, supprime les versions abandonnées."""
+        import os
+        journal_meta = meta["journal"]
+        ecrits = 0
+        for delta in magasin.journal:
+            cle = str(delta["version"])
+            if journal_meta.get(cle, {}).get("horodatage") == delta["horodatage"]:
+                continue
+            parties = []
+            for partie in ("complet", "avant", "apres", "index", "index_avant"):
+                valeur = delta.get(partie)
+                if valeur is None:
+                    continue
+                df = valeur.to_frame(index=False, name="index") if isinstance(valeur, pd.Index) else valeur
+                _ecrire_table_parquet(df, self._chemin(id_session, "journal", f"v{delta['version']:05d}_{partie}.parquet"))
+                parties.append(partie)
+                ecrits += 1
+            contexte = magasin.contextes.get(delta["version"])
+            contexte_meta = None
+            if contexte is not None:
+                contexte_meta = {}
+                for cle_contexte, valeur in contexte.items():
+                    if isinstance(valeur, pd.DataFrame):
+                        _ecrire_table_parquet(valeur, self._chemin(
+                            id_session, "journal", f"v{delta['version']:05d}_contexte_{cle_contexte}.parquet"))
+                        contexte_meta[cle_contexte] = {"table": True}
+                        ecrits += 1
+                    else:
+                        contexte_meta[cle_contexte] = {"valeur": valeur}
+            journal_meta[cle] = {"operation": delta["operation"], "horodatage": delta["horodatage"],
+                                 "parties": parties, "contexte": contexte_meta}
+
+        # Versions abandonnées (nouvelle modification après une annulation)
+        for cle in [c for c in journal_meta if int(c) > magasin.derniere_version]:
+            del journal_meta[cle]
+            prefixe = f"v{int(cle):05d}_"
+            dossier_journal = self._chemin(id_session, "journal")
+            for fichier in os.listdir(dossier_journal):
+                if fichier.startswith(prefixe):
+                    os.remove(os.path.join(dossier_journal, fichier))
+        return ecrits
+
+    def sauvegarder(self, id_session, tables=None, magasin=None, etat=None, libelle=None):
+        """
+        Point de reprise de la session : tables modifiées, deltas nouveaux du PlanStore et état JSON.
+        session.json n'est réécrit que si quelque chose a changé.
+        Retourne (succès, message, nombre de fichiers écrits).
+        """
+        import os
+        from datetime import datetime
+        try:
+            with self._verrou:
+                for sous_dossier in ("tables", "journal"):
+                    os.makedirs(self._chemin(id_session, sous_dossier), exist_ok=True)
+                meta = self._lire_meta(id_session)
+                nouvelle = meta is None
+                meta = meta or {
+                    "id": id_session, "libelle": libelle or id_session, "cree": datetime.now().isoformat(timespec="seconds"),
+                    "tables": {}, "journal": {}, "version": 0, "etat": {},
+                }
+                ecrits = self._sauvegarder_tables(id_session, tables or {}, meta)
+                if magasin is not None:
+                    ecrits += self._sauvegarder_journal(id_session, magasin, meta)
+                etat = etat if etat is not None else meta["etat"]
+                version = magasin.version if magasin is not None else meta["version"]
+                if (ecrits == 0 and etat == meta["etat"] and version == meta["version"]
+                        and os.path.exists(self._chemin(id_session, self.FICHIER_META))):
+                    return True, "✅ Session déjà à jour", 0
+                meta.update({"etat": etat, "version": version,
+                             "modifie": datetime.now().isoformat(timespec="seconds")})
+                if libelle:
+                    meta["libelle"] = libelle
+                self._ecrire_meta(id_session, meta)
+            if nouvelle:
+                self._purger()
+            return True, f"✅ Session sauvegardée ({ecrits} fichier(s) écrit(s))", ecrits
+        except Exception as e:
+            print(f"❌ Erreur lors de la sauvegarde de la session {id_session}: {e}")
+            return False, f"❌ Erreur lors de la sauvegarde de la session : {str(e)}", 0
+
+    # -------------------------------------------------
+    # Reprise
+    # -------------------------------------------------
+    def charger(self, id_session):
+        """
+        Reprise d'une session : {"tables", "magasin" (PlanStore reconstruit à sa version courante),
+        "etat", "libelle"}. Retourne (succès, message, données).
+        """
+        try:
+            meta = self._lire_meta(id_session)
+            if meta is None:
+                return False, f"❌ Session {id_session} introuvable.", None
+            tables = {}
+            for nom, info in meta["tables"].items():
+                df = pd.read_parquet(self._chemin(id_session, "tables", f"{nom}.parquet"))
+                tables[nom] = df["valeur"].rename(info.get("nom_serie")) if info.get("serie") else df
+
+            journal, contextes = [], {}
+            for cle in sorted(meta["journal"], key=int):
+                info = meta["journal"][cle]
+                version = int(cle)
+                delta = {"version": version, "operation": info["operation"], "horodatage": info["horodatage"],
+                         "index": None, "index_avant": None}
+                for partie in info["parties"]:
+                    df = pd.read_parquet(self._chemin(id_session, "journal", f"v{version:05d}_{partie}.parquet"))
+                    delta[partie] = pd.Index(df["index"]).rename(None) if partie.startswith("index") else df
+                journal.append(delta)
+                if info.get("contexte") is not None:
+                    contextes[version] = {
+                        cle_contexte: (pd.read_parquet(self._chemin(
+                            id_session, "journal", f"v{version:05d}_contexte_{cle_contexte}.parquet"))
+                            if valeur.get("table") else valeur.get("valeur"))
+                        for cle_contexte, valeur in info["contexte"].items()
+                    }
+            magasin = PlanStore.depuis_journal(journal, meta["version"], contextes) if journal else None
+            # Les prochaines sauvegardes de cette session repartent de ce point de reprise
+            self._tables_ecrites[id_session] = {nom: (tables[nom], info["empreinte"]) for nom, info in meta["tables"].items()}
+            donnees = {"tables": tables, "magasin": magasin, "etat": meta["etat"], "libelle": meta["libelle"]}
+            return True, f"✅ Session « {meta['libelle']} » reprise (version {meta['version']} du plan)", donnees
+        except Exception as e:
+            print(f"❌ Erreur lors de la reprise de la session {id_session}: {e}")
+            return False, f"❌ Erreur lors de la reprise de la session : {str(e)}", None
+
+    def sessions_recentes(self, nombre=10):
+        """Sessions enregistrées, de la plus récemment modifiée à la plus ancienne."""
+        import os
+        colonnes = ["Session", "Libellé", "Dernière sauvegarde", "Version du plan", "Taille (Mo)"]
+        if not os.path.isdir(self.dossier):
+            return pd.DataFrame(columns=colonnes)
+        lignes = []
+        for id_session in os.listdir(self.dossier):
+            meta = self._lire_meta(id_session) if os.path.isdir(os.path.join(self.dossier, id_session)) else None
+            if meta is None:
+                continue
+            taille = sum(entree.stat().st_size for sous_dossier in ("tables", "journal")
+                         for entree in os.scandir(self._chemin(id_session, sous_dossier)) if entree.is_file())
+            lignes.append({"Session": id_session, "Libellé": meta["libelle"],
+                           "Dernière sauvegarde": meta.get("modifie", meta["cree"]),
+                           "Version du plan": meta["version"], "Taille (Mo)": round(taille / 1024 ** 2, 2)})
+        df = pd.DataFrame(lignes, columns=colonnes).sort_values("Dernière sauvegarde", ascending=False)
+        return (df if nombre is None else df.head(nombre)).reset_index(drop=True)
+
+    def supprimer(self, id_session):
+        import shutil
+        shutil.rmtree(self._chemin(id_session), ignore_errors=True)
+        self._tables_ecrites.pop(id_session, None)
+
+    def _purger(self):
+        """Supprime les sessions les plus anciennes au-delà de max_sessions."""
+        sessions = self.sessions_recentes(nombre=None)
+        for id_session in sessions["Session"].iloc[self.max_sessions:]:
+            self.supprimer(id_session)
+
+
+# Persistance unique du processus (dossier « sessions » à côté de l'application)
+PERSISTANCE_SESSIONS = SessionPersistence()
+
 # =====================================================
 # CLASSE DE GESTION DE LA LOCATION DE CAMIONS
 # =====================================================
 class TruckRentalProcessor:
-    def __init__(self, df_optimized, df_livraisons_original):
-        """Initialise avec le DataFrame optimisé ET les données originales."""
-        self.df_base = self._initialize_rental_columns(df_optimized.copy())
-        self.df_livraisons_original = df_livraisons_original.copy()
+    def __init__(self, df_optimized, df_livraisons_original, fenetres_horaires=None, validateur=None):
+        """Initialise avec le DataFrame optimisé ET les données originales (vues copy-on-write, sans copie)."""
+        self.df_base = self._initialize_rental_columns(df_optimized.copy(deep=False))
+        self.df_livraisons_original = df_livraisons_original.copy(deep=False)
+        self.fenetres_horaires = fenetres_horaires  # Fenêtres respectées lors des réoptimisations
+        self.validateur = validateur  # VoyageValidator notifié des véhicules modifiés
         self._next_camion_num = self.df_base[self.df_base["Code Véhicule"] == CAMION_CODE].shape[0] + 1
         self.truck_type = "5 tonnes"  # Valeur par défaut
     
@@ -459,7 +1228,7 @@ class TruckRentalProcessor:
             # Récupérer tous les BLs du client
             bls_client = client_data_original["No livraison"].unique()
             
-            df = self.df_base.copy()
+            df = self.df_base.copy(deep=False)
             
             if accepter:
                 # Récupérer les données consolidées pour le camion
@@ -526,6 +1295,10 @@ class TruckRentalProcessor:
                 df_final = pd.concat([df_camions_existants, df_estafettes_optimisees, new_row], ignore_index=True)
                 
                 self.df_base = df_final
+                if self.validateur is not None:
+                    df_resultat = self.get_df_result()
+                    modifies = df_resultat["Zone"].isin(zones_affectees) | (df_resultat["Véhicule N°"] == camion_num_final)
+                    self.validateur.mettre_a_jour(df_resultat, zip(df_resultat.loc[modifies, "Zone"], df_resultat.loc[modifies, "Véhicule N°"]))
                 return True, f"✅ Location ACCEPTÉE pour {client} avec camion {truck_type}. Commandes transférées vers {camion_num_final}. Réoptimisation des estafettes effectuée.", self.detecter_propositions()
             else:
                 # Refuser la proposition - pas de changement dans l'optimisation
@@ -536,6 +1309,8 @@ class TruckRentalProcessor:
                 df.loc[mask_original, "Camion N°"] = df.loc[mask_original, "Estafette N°"].apply(lambda x: f"E{int(x)}")
                 
                 self.df_base = df
+                if self.validateur is not None:
+                    self.validateur.mettre_a_jour(self.get_df_result(), zip(df.loc[mask_original, "Zone"], df.loc[mask_original, "Camion N°"]))
                 return True, f"❌ Proposition REFUSÉE pour {client}. Les commandes restent en Estafettes.", self.detecter_propositions()
                 
         except Exception as e:
@@ -582,6 +1357,8 @@ class TruckRentalProcessor:
                     for e in estafettes_zone:
                         if (e["poids"] + poids <= CAPACITE_POIDS_ESTAFETTE and 
                             e["volume"] + volume <= CAPACITE_VOLUME_ESTAFETTE):
+                            if e["tournee"] is not None and not e["tournee"].placer_bl(client):
+                                continue
                             e["poids"] += poids
                             e["volume"] += volume
                             e["bls"].append(bl)
@@ -592,13 +1369,18 @@ class TruckRentalProcessor:
                     
                     # Si pas placé, créer une nouvelle estafette
                     if not placed:
+                        tournee = None
+                        if self.fenetres_horaires is not None:
+                            tournee = self.fenetres_horaires.nouvelle_tournee()
+                            tournee.placer_bl(client, forcer=True)
                         estafettes_zone.append({
                             "poids": poids,
                             "volume": volume,
                             "bls": [bl],
                             "clients": {client},
                             "representants": {representant},
-                            "num_global": estafette_num
+                            "num_global": estafette_num,
+                            "tournee": tournee
                         })
                         estafette_num += 1
 
@@ -639,7 +1421,7 @@ class TruckRentalProcessor:
 
     def get_df_result(self):
         """Retourne le DataFrame optimisé final."""
-        df_result = self.df_base.copy()
+        df_result = self.df_base.copy(deep=False)
         
         # Renommer les colonnes si nécessaire
         rename_mapping = {
@@ -689,15 +1471,26 @@ class TruckRentalProcessor:
         # Filtrer seulement les colonnes qui existent
         available_columns = [col for col in final_columns if col in df_result.columns]
         return df_result[available_columns]
+
+    def etat(self):
+        """État des décisions de location (vue du plan de base, numéro du prochain camion), pour PlanStore."""
+        return {"df_base": self.df_base.copy(deep=False), "camion_suivant": self._next_camion_num}
+
+    def restaurer_etat(self, etat):
+        """Restaure un état retourné par etat() (annulation / rétablissement des décisions)."""
+        self.df_base = etat["df_base"].copy(deep=False)
+        self._next_camion_num = etat["camion_suivant"]
 # =====================================================
 # CLASSE DE GESTION DES TRANSFERTS DE BL
 # =====================================================
 class TruckTransferManager:
-    def __init__(self, df_voyages, df_livraisons):
-        self.df_voyages = df_voyages.copy()
-        self.df_livraisons = df_livraisons.copy()
+    def __init__(self, df_voyages, df_livraisons, validateur=None):
+        self.df_voyages = df_voyages.copy(deep=False)
+        self.df_livraisons = df_livraisons.copy(deep=False)
+        self.validateur = validateur  # VoyageValidator notifié des véhicules modifiés
         self.MAX_POIDS_ESTAFETTE = CAPACITE_POIDS_ESTAFETTE
         self.MAX_VOLUME_ESTAFETTE = CAPACITE_VOLUME_ESTAFETTE
+        self.objets_manuels = pd.DataFrame(columns=COLONNES_OBJETS_MANUELS)  # Registre des objets ajoutés
     
     def _get_capacites_vehicule(self, vehicule, df_voyages):
         """Retourne les capacités max selon le type de véhicule."""
@@ -751,6 +1544,10 @@ class TruckTransferManager:
             ]
             poids_transfert = df_bls_transfert["Poids total"].sum()
             volume_transfert = df_bls_transfert["Volume total"].sum()
+            # Les objets manuels suivis voyagent avec leur poids/volume
+            objets_transferes = self.objets_manuels["Code"].astype(str).isin(bls_existants)
+            poids_transfert += self.objets_manuels.loc[objets_transferes, "Poids"].astype(float).sum()
+            volume_transfert += self.objets_manuels.loc[objets_transferes, "Volume"].astype(float).sum()
             
             # Vérifier la capacité du véhicule cible avec les capacités dynamiques
             df_cible = self.df_voyages[
@@ -801,6 +1598,13 @@ class TruckTransferManager:
                     taux_cible = max((new_poids_cible / max_poids_cible) * 100, (new_volume_cible / max_volume_cible) * 100)
                     self.df_voyages.at[idx, "Taux d'occupation (%)"] = taux_cible
             
+            if objets_transferes.any():
+                self.objets_manuels = self.objets_manuels.copy()
+                self.objets_manuels.loc[objets_transferes, "Véhicule N°"] = cible
+
+            if self.validateur is not None:
+                self.validateur.mettre_a_jour(self.df_voyages, [(zone, source), (zone, cible)])
+
             message = f"✅ Transfert réussi : {len(bls_existants)} BL(s) déplacé(s) de {source} vers {cible}"
             return True, message, self.df_voyages
             
@@ -810,6 +1614,47 @@ class TruckTransferManager:
     def get_voyages_actuels(self):
         return self.df_voyages
 
+    def supprimer_objets_manuels(self, df_voyages):
+        """
+        Retire tous les objets manuels (OBJ-) du plan et déduit le poids/volume des objets suivis.
+        """
+        try:
+            df = df_voyages.copy(deep=False)
+            if "Véhicule N°" not in df.columns:
+                return False, "Structure du DataFrame inattendue.", df_voyages
+
+            cles = list(zip(df["Zone"].astype(object).map(str), df["Véhicule N°"].astype(object).map(str)))
+            # Le registre est indexé par code OBJ- : chaque objet est déduit du véhicule qui porte
+            # actuellement son jeton dans "BL inclus" (il a pu être transféré depuis son ajout)
+            jetons = df["BL inclus"].astype(object).map(str).reset_index(drop=True).str.split(";").explode().str.strip()
+            jetons = jetons[jetons.str.startswith("OBJ-")]
+            suivis = self.objets_manuels.astype({"Code": str}).groupby("Code")[["Poids", "Volume"]].sum()
+            objets = pd.DataFrame({"_pos": jetons.index.to_numpy(dtype=int), "Code": jetons.to_numpy()}).drop_duplicates()
+            objets = objets.join(suivis, on="Code").fillna({"Poids": 0, "Volume": 0})
+            poids_objets = np.bincount(objets["_pos"], weights=objets["Poids"].to_numpy(dtype=float), minlength=len(df))
+            volume_objets = np.bincount(objets["_pos"], weights=objets["Volume"].to_numpy(dtype=float), minlength=len(df))
+
+            df["BL inclus"] = df["BL inclus"].map(
+                lambda bls: ";".join(bl for bl in str(bls).split(";") if not bl.startswith("OBJ-")) if pd.notna(bls) else bls
+            )
+            df["Poids total chargé"] = np.maximum(df["Poids total chargé"].astype(float) - poids_objets, 0)
+            df["Volume total chargé"] = np.maximum(df["Volume total chargé"].astype(float) - volume_objets, 0)
+            poids_max, volume_max = get_capacites_vehicules(df)
+            modifies = (poids_objets > 0) | (volume_objets > 0)
+            df.loc[modifies, "Taux d'occupation (%)"] = np.maximum(
+                df["Poids total chargé"] / poids_max * 100, df["Volume total chargé"] / volume_max * 100
+            )[modifies]
+
+            if self.validateur is not None:
+                self.validateur.mettre_a_jour(df, [cle for cle, modifie in zip(cles, modifies) if modifie])
+            nb_objets = int(objets["Code"].isin(suivis.index).sum())
+            self.objets_manuels = pd.DataFrame(columns=COLONNES_OBJETS_MANUELS)
+            self.df_voyages = df.copy(deep=False)
+            return True, f"✅ Tous les objets manuels ont été supprimés ({nb_objets} objet(s) suivi(s) déduit(s))", df
+
+        except Exception as e:
+            return False, f"❌ Erreur lors de la suppression des objets : {str(e)}", df_voyages
+
     def add_manual_object(self, df_voyages, vehicle, zone, name, weight, volume):
         """
         Ajoute un objet manuel (objet virtuel) dans le véhicule sélectionné.
@@ -821,7 +1666,7 @@ class TruckTransferManager:
             if weight < 0 or volume < 0:
                 return False, "Poids et volume doivent être >= 0", df_voyages
 
-            df = df_voyages.copy()
+            df = df_voyages.copy(deep=False)
 
             # Rechercher la ligne du véhicule dans df
             if "Véhicule N°" in df.columns:
@@ -857,8 +1702,14 @@ class TruckTransferManager:
                 
                 return False, f"❌ Capacité dépassée pour {vehicle_type}{type_info} {vehicle} : {new_poids:.1f}kg/{max_poids}kg, {new_volume:.3f}m³/{max_volume}m³", df
 
-            # Générer code unique pour l'objet
+            # Générer code unique pour l'objet (le registre est indexé par code)
             obj_code = f"OBJ-{name}"
+            codes_existants = set(self.objets_manuels["Code"].astype(str))
+            codes_existants.update(df["BL inclus"].astype(object).map(str).str.split(";").explode().str.strip())
+            suffixe = 2
+            while obj_code in codes_existants:
+                obj_code = f"OBJ-{name}-{suffixe}"
+                suffixe += 1
 
             # Mettre à jour BL inclus
             bls_current = str(row.get("BL inclus", "")).strip()
@@ -883,300 +1734,1706 @@ class TruckTransferManager:
             taux = max((new_poids / max_poids) * 100, (new_volume / max_volume) * 100)
             df.at[idx, "Taux d'occupation (%)"] = taux
 
+            if self.validateur is not None:
+                self.validateur.mettre_a_jour(df, [(zone, vehicle)])
+
+            # Suivre l'objet avec son propre poids/volume (réconciliation exacte)
+            objet = pd.DataFrame([{"Code": obj_code, "Objet": name, "Zone": zone, "Véhicule N°": vehicle,
+                                   "Poids": weight, "Volume": volume}])
+            self.objets_manuels = objet if self.objets_manuels.empty else pd.concat([self.objets_manuels, objet], ignore_index=True)
+
             return True, f"✅ Objet '{name}' ajouté à {vehicle} en zone {zone}", df
 
         except Exception as e:
             return False, f"❌ Erreur lors de l'ajout de l'objet : {str(e)}", df_voyages
 
 # =====================================================
-# CLASSE DE VALIDATION DES VOYAGES
+# INDEX SPATIAL DES VOYAGES (SUGGESTIONS DE TRANSFERT)
 # =====================================================
-class VoyageValidator:
-    def __init__(self, df_voyages):
-        self.df_voyages = df_voyages.copy()
-    
-    def validate_voyages(self):
-        """Valide les voyages en tenant compte des types de camions."""
-        try:
-            df = self.df_voyages.copy()
-            rapports = []
-            
-            # Validation des capacités
-            for idx, row in df.iterrows():
-                vehicule = row.get("Véhicule N°", "Inconnu")
-                zone = row.get("Zone", "Inconnue")
-                poids = float(row.get("Poids total chargé", 0))
-                volume = float(row.get("Volume total chargé", 0))
-                code_vehicule = row.get("Code Véhicule", "ESTAFETTE")
-                
-                # Déterminer les capacités max selon le type de véhicule
-                if code_vehicule == CAMION_CODE:
-                    # Vérifier le type de camion
-                    truck_type = row.get("Type_Camion", "5 tonnes")
-                    # Utiliser les fonctions pour obtenir les capacités
-                    poids_max = get_capacite_poids_camion(truck_type)
-                    volume_max = get_capacite_volume_camion(truck_type)
-                    type_veh = f"Camion {truck_type}"
-                else:
-                    poids_max = CAPACITE_POIDS_ESTAFETTE
-                    volume_max = CAPACITE_VOLUME_ESTAFETTE
-                    type_veh = "Estafette"
-                
-                # Vérifier les dépassements
-                if poids > poids_max:
-                    rapports.append({
-                        'Type': '❌ ERREUR',
-                        'Message': f"{type_veh} {vehicule} (Zone {zone}) dépasse la capacité poids : {poids:.1f}kg > {poids_max}kg"
-                    })
-                
-                if volume > volume_max:
-                    rapports.append({
-                        'Type': '❌ ERREUR', 
-                        'Message': f"{type_veh} {vehicule} (Zone {zone}) dépasse la capacité volume : {volume:.3f}m³ > {volume_max}m³"
-                    })
-                
-                # Vérifier le taux d'occupation
-                taux_occupation = float(row.get("Taux d'occupation (%)", 0))
-                if taux_occupation > 100:
-                    rapports.append({
-                        'Type': '⚠️ ALERTE',
-                        'Message': f"{type_veh} {vehicule} (Zone {zone}) a un taux d'occupation > 100% : {taux_occupation:.1f}%"
-                    })
-                elif taux_occupation < 50:
-                    rapports.append({
-                        'Type': '💡 SUGGESTION',
-                        'Message': f"{type_veh} {vehicule} (Zone {zone}) sous-utilisé : {taux_occupation:.1f}% - possibilité d'optimisation"
-                    })
-            
-            # Validation des BLs dupliqués
-            tous_bls = []
-            for idx, row in df.iterrows():
-                bls = str(row.get("BL inclus", "")).split(';')
-                for bl in bls:
-                    if bl.strip() and bl != 'nan' and not bl.startswith('OBJ-'):
-                        tous_bls.append((bl.strip(), row["Véhicule N°"], row["Zone"]))
-            
-            bls_counts = {}
-            for bl, vehicule, zone in tous_bls:
-                if bl not in bls_counts:
-                    bls_counts[bl] = []
-                bls_counts[bl].append((vehicule, zone))
-            
-            for bl, occurrences in bls_counts.items():
-                if len(occurrences) > 1:
-                    vehicules = ", ".join([f"{veh} (Zone {zone})" for veh, zone in occurrences])
-                    rapports.append({
-                        'Type': '❌ ERREUR',
-                        'Message': f"BL {bl} présent dans plusieurs véhicules : {vehicules}"
-                    })
-            
-            # Validation de la cohérence des données
-            for idx, row in df.iterrows():
-                vehicule = row.get("Véhicule N°", "Inconnu")
-                zone = row.get("Zone", "Inconnue")
-                clients = str(row.get("Client(s) inclus", ""))
-                representants = str(row.get("Représentant(s) inclus", ""))
-                bls = str(row.get("BL inclus", ""))
-                
-                # Filtrer les objets manuels pour vérifier les BLs réels
-                bls_list = [bl for bl in str(bls).split(';') if bl.strip() and not bl.startswith('OBJ-')]
-                
-                if not clients.strip() or clients == 'nan':
-                    rapports.append({
-                        'Type': '⚠️ ALERTE',
-                        'Message': f"Véhicule {vehicule} (Zone {zone}) n'a pas de client associé"
-                    })
-                
-                if not bls_list:  # Pas de BLs réels (seulement objets manuels ou vide)
-                    if not any(bl.startswith('OBJ-') for bl in str(bls).split(';') if bl.strip()):
-                        rapports.append({
-                            'Type': '❌ ERREUR', 
-                            'Message': f"Véhicule {vehicule} (Zone {zone}) n'a pas de BL associé"
-                        })
-            
-            # Résumé global
-            nb_estafettes = len(df[df["Code Véhicule"] == "ESTAFETTE"])
-            nb_camions = len(df[df["Code Véhicule"] == CAMION_CODE])
-            
-            # Compter les types de camions
-            camions_5t = 0
-            camions_10t = 0
-            if nb_camions > 0 and "Type_Camion" in df.columns:
-                camions_5t = len(df[(df["Code Véhicule"] == CAMION_CODE) & (df["Type_Camion"] == "5 tonnes")])
-                camions_10t = len(df[(df["Code Véhicule"] == CAMION_CODE) & (df["Type_Camion"] == "10 tonnes")])
-            
-            poids_total = df["Poids total chargé"].sum()
-            volume_total = df["Volume total chargé"].sum()
-            taux_moyen = df["Taux d'occupation (%)"].mean()
-            
-            # Résumé détaillé
-            message_resume = f"Total : {nb_estafettes} estafettes"
-            if nb_camions > 0:
-                message_resume += f", {nb_camions} camions ({camions_5t}×5t, {camions_10t}×10t)"
-            message_resume += f" | Poids total : {poids_total:.1f}kg | Volume total : {volume_total:.3f}m³ | Taux moyen : {taux_moyen:.1f}%"
-            
-            rapports.append({
-                'Type': '📊 RÉSUMÉ',
-                'Message': message_resume
-            })
-            
-            return pd.DataFrame(rapports)
-            
-        except Exception as e:
-            return pd.DataFrame([{
-                'Type': '❌ ERREUR SYSTÈME',
-                'Message': f"Erreur lors de la validation : {str(e)}"
-            }])
+RAYON_TERRE_KM = 6371.0
 
-    def generer_rapport_excel(self, file_path):
-        """Génère un rapport Excel détaillé des voyages validés."""
-        try:
-            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-                # Feuille principale des voyages
-                self.df_voyages.to_excel(writer, sheet_name='Voyages Optimisés', index=False)
-                
-                # Feuille de validation
-                rapport_validation = self.validate_voyages()
-                rapport_validation.to_excel(writer, sheet_name='Rapport Validation', index=False)
-                
-                # Feuille de statistiques par zone
-                stats_zone = self.df_voyages.groupby('Zone').agg({
-                    'Véhicule N°': 'count',
-                    'Poids total chargé': 'sum',
-                    'Volume total chargé': 'sum',
-                    'Taux d\'occupation (%)': 'mean'
-                }).rename(columns={
-                    'Véhicule N°': 'Nombre Véhicules',
-                    'Poids total chargé': 'Poids Total (kg)',
-                    'Volume total chargé': 'Volume Total (m³)',
-                    'Taux d\'occupation (%)': 'Taux Occupation Moyen (%)'
-                }).round(2)
-                
-                stats_zone.to_excel(writer, sheet_name='Stats par Zone')
-                
-                # Feuille de détails par véhicule
-                details_vehicules = self.df_voyages[[
-                    'Zone', 'Véhicule N°', 'Code Véhicule', 'Type_Camion', 
-                    'Poids total chargé', 'Volume total chargé', 'Taux d\'occupation (%)', 
-                    'Client(s) inclus', 'Représentant(s) inclus', 'BL inclus'
-                ]].copy()
-                
-                # Déterminer les capacités max selon le type de véhicule
-                def get_capacites(row):
-                    if row['Code Véhicule'] == CAMION_CODE:
-                        truck_type = row.get('Type_Camion', '5 tonnes')
-                        poids_max = get_capacite_poids_camion(truck_type)
-                        volume_max = get_capacite_volume_camion(truck_type)
-                        return pd.Series([poids_max, volume_max, f"Camion {truck_type}"])
-                    else:
-                        return pd.Series([CAPACITE_POIDS_ESTAFETTE, CAPACITE_VOLUME_ESTAFETTE, "Estafette"])
-                
-                # Appliquer la fonction pour obtenir les capacités
-                capacites = details_vehicules.apply(get_capacites, axis=1)
-                details_vehicules['Capacité Max Poids'] = capacites[0]
-                details_vehicules['Capacité Max Volume'] = capacites[1]
-                details_vehicules['Type Véhicule'] = capacites[2]
-                
-                details_vehicules['Marge Poids'] = details_vehicules['Capacité Max Poids'] - details_vehicules['Poids total chargé']
-                details_vehicules['Marge Volume'] = details_vehicules['Capacité Max Volume'] - details_vehicules['Volume total chargé']
-                details_vehicules['Taux Utilisation Poids (%)'] = (details_vehicules['Poids total chargé'] / details_vehicules['Capacité Max Poids']) * 100
-                details_vehicules['Taux Utilisation Volume (%)'] = (details_vehicules['Volume total chargé'] / details_vehicules['Capacité Max Volume']) * 100
-                
-                # Arrondir les valeurs
-                details_vehicules['Taux Utilisation Poids (%)'] = details_vehicules['Taux Utilisation Poids (%)'].round(1)
-                details_vehicules['Taux Utilisation Volume (%)'] = details_vehicules['Taux Utilisation Volume (%)'].round(1)
-                details_vehicules['Marge Poids'] = details_vehicules['Marge Poids'].round(1)
-                details_vehicules['Marge Volume'] = details_vehicules['Marge Volume'].round(3)
-                
-                # Réorganiser les colonnes
-                colonnes_ordre = [
-                    'Zone', 'Véhicule N°', 'Type Véhicule', 'Type_Camion', 
-                    'Poids total chargé', 'Capacité Max Poids', 'Marge Poids', 'Taux Utilisation Poids (%)',
-                    'Volume total chargé', 'Capacité Max Volume', 'Marge Volume', 'Taux Utilisation Volume (%)',
-                    'Taux d\'occupation (%)', 'Client(s) inclus', 'Représentant(s) inclus', 'BL inclus'
-                ]
-                
-                # Filtrer les colonnes qui existent
-                colonnes_existantes = [col for col in colonnes_ordre if col in details_vehicules.columns]
-                details_vehicules = details_vehicules[colonnes_existantes]
-                
-                details_vehicules.to_excel(writer, sheet_name='Détails Véhicules', index=False)
-            
-            return True, f"✅ Rapport Excel généré avec succès : {file_path}"
-            
-        except Exception as e:
-            return False, f"❌ Erreur lors de la génération du rapport Excel : {str(e)}"
+class VoyageSpatialIndex:
+    """Grille uniforme (NumPy) sur les centroïdes des voyages pour classer les véhicules cibles d'un transfert."""
+
+    def __init__(self, df_voyages, df_livraisons, df_clients_gps, taille_cellule_km=25.0):
+        self.taille_cellule_km = float(taille_cellule_km)
+        self.df_voyages = df_voyages.reset_index(drop=True)
+        self.veh_col = "Véhicule N°" if "Véhicule N°" in self.df_voyages.columns else "Camion N°"
+        self.poids_col = "Poids total chargé" if "Poids total chargé" in self.df_voyages.columns else "Poids total"
+        self.volume_col = "Volume total chargé" if "Volume total chargé" in self.df_voyages.columns else "Volume total"
+        self._preparer_bls(df_livraisons, df_clients_gps)
+        self._construire_grille()
+
+    def _projeter(self, lat, lon):
+        """Projection équirectangulaire locale (km) autour de la latitude de référence."""
+        x = np.radians(lon) * RAYON_TERRE_KM * math.cos(self._lat_ref)
+        y = np.radians(lat) * RAYON_TERRE_KM
+        return x, y
+
+    def _preparer_bls(self, df_livraisons, df_clients_gps):
+        """Associe à chaque BL son poids, son volume et la position (projetée) de son client."""
+        df_bls = df_livraisons[["No livraison", "Client de l'estafette", "Poids total", "Volume total"]].copy()
+        df_bls["No livraison"] = df_bls["No livraison"].astype(str)
+        df_bls["Client de l'estafette"] = df_bls["Client de l'estafette"].astype(str)
+
+        if df_clients_gps is not None and not df_clients_gps.empty:
+            df_gps = df_clients_gps.assign(Client=df_clients_gps["Client"].astype(str))
+            df_bls = df_bls.merge(df_gps, left_on="Client de l'estafette", right_on="Client", how="left")
+        else:
+            df_bls["Latitude"] = np.nan
+            df_bls["Longitude"] = np.nan
+
+        lat_ref = df_bls["Latitude"].mean()
+        self._lat_ref = math.radians(lat_ref) if pd.notna(lat_ref) else 0.0
+        df_bls["x"], df_bls["y"] = self._projeter(df_bls["Latitude"].to_numpy(), df_bls["Longitude"].to_numpy())
+        self.df_bls = df_bls.drop_duplicates(subset="No livraison").set_index("No livraison")
+
+    def _construire_grille(self):
+        """Calcule les centroïdes des voyages et les range dans les cellules de la grille."""
+        bls = self.df_voyages[self.veh_col].to_frame().assign(
+            bl=self.df_voyages["BL inclus"].astype(str).str.split(";")
+        ).explode("bl")
+        bls = bls.join(self.df_bls[["x", "y"]], on="bl")
+        centroides = bls.groupby(level=0)[["x", "y"]].mean().reindex(self.df_voyages.index)
+        self.centroides = centroides.to_numpy()
+
+        poids_max, volume_max = get_capacites_vehicules(self.df_voyages)
+        self.poids_restant = (poids_max - self.df_voyages[self.poids_col].astype(float)).to_numpy()
+        self.volume_restant = (volume_max - self.df_voyages[self.volume_col].astype(float)).to_numpy()
+        self.poids_max = poids_max.to_numpy()
+
+        # Rangement des voyages géolocalisés par cellule (i, j)
+        self.grille = {}
+        positions = np.flatnonzero(~np.isnan(self.centroides).any(axis=1))
+        if len(positions) == 0:
+            self._bornes = None
+            return
+        cellules = np.floor(self.centroides[positions] / self.taille_cellule_km).astype(int)
+        ordre = np.lexsort((cellules[:, 1], cellules[:, 0]))
+        cellules, positions = cellules[ordre], positions[ordre]
+        ruptures = np.flatnonzero(np.any(np.diff(cellules, axis=0) != 0, axis=1)) + 1
+        for bloc_cellules, bloc_positions in zip(np.split(cellules, ruptures), np.split(positions, ruptures)):
+            self.grille[tuple(bloc_cellules[0])] = bloc_positions
+        self._bornes = (cellules.min(axis=0), cellules.max(axis=0))
+
+    def _cellules_anneau(self, centre, rayon):
+        """Cellules situées exactement à `rayon` cellules (distance de Tchebychev) du centre."""
+        ci, cj = centre
+        if rayon == 0:
+            return [(ci, cj)]
+        cellules = [(ci + d, cj - rayon) for d in range(-rayon, rayon + 1)]
+        cellules += [(ci + d, cj + rayon) for d in range(-rayon, rayon + 1)]
+        cellules += [(ci - rayon, cj + d) for d in range(-rayon + 1, rayon)]
+        cellules += [(ci + rayon, cj + d) for d in range(-rayon + 1, rayon)]
+        return cellules
+
+    def _plus_proches(self, point, k, eligible):
+        """Recherche par anneaux croissants des k voyages éligibles les plus proches du point."""
+        if self._bornes is None:
+            return np.array([], dtype=int), np.array([])
+        centre = tuple(np.floor(point / self.taille_cellule_km).astype(int))
+        rayon_max = int(max(np.abs(self._bornes[0] - centre).max(), np.abs(self._bornes[1] - centre).max()))
+
+        candidats, distances = [], []
+        for rayon in range(rayon_max + 1):
+            for cellule in self._cellules_anneau(centre, rayon):
+                positions = self.grille.get(cellule)
+                if positions is None:
+                    continue
+                positions = positions[eligible[positions]]
+                if len(positions):
+                    candidats.append(positions)
+                    distances.append(np.hypot(*(self.centroides[positions] - point).T))
+            if candidats:
+                toutes = np.concatenate(distances)
+                # Au-delà de cet anneau, aucun voyage ne peut être plus proche que le k-ième trouvé
+                if len(toutes) >= k and np.sort(toutes)[k - 1] <= rayon * self.taille_cellule_km:
+                    break
+        if not candidats:
+            return np.array([], dtype=int), np.array([])
+        positions, toutes = np.concatenate(candidats), np.concatenate(distances)
+        ordre = np.argsort(toutes, kind="stable")[:k]
+        return positions[ordre], toutes[ordre]
+
+    def suggerer_cibles(self, source, bls, zone=None, k=5):
+        """Classe les véhicules cibles pour les BLs sélectionnés par détour ajouté et capacité restante."""
+        colonnes = ["Véhicule N°", "Zone", "Détour estimé (km)", "Poids restant après transfert (kg)",
+                    "Volume restant après transfert (m³)", "Capacité suffisante"]
+        bls = [str(bl) for bl in bls]
+        df_sel = self.df_bls.reindex(bls)
+        poids_transfert = df_sel["Poids total"].fillna(0).sum()
+        volume_transfert = df_sel["Volume total"].fillna(0).sum()
+
+        eligible = (self.df_voyages[self.veh_col] != source).to_numpy()
+        if zone is not None:
+            eligible = eligible & (self.df_voyages["Zone"] == zone).to_numpy()
+        capacite_ok = (self.poids_restant >= poids_transfert) & (self.volume_restant >= volume_transfert)
+
+        # Détour aller-retour entre le centroïde du voyage cible et celui des BLs transférés
+        point = df_sel[["x", "y"]].mean().to_numpy()
+        detour = np.full(len(self.df_voyages), np.nan)
+        if not np.isnan(point).any():
+            positions, distances = self._plus_proches(point, k, eligible & capacite_ok)
+            detour[positions] = 2 * distances
+            # Compléter avec les voyages sans capacité suffisante s'il manque des suggestions
+            if len(positions) < k:
+                positions, distances = self._plus_proches(point, k - len(positions), eligible & ~capacite_ok)
+                detour[positions] = 2 * distances
+
+        df = pd.DataFrame({
+            "Véhicule N°": self.df_voyages[self.veh_col],
+            "Zone": self.df_voyages["Zone"],
+            "Détour estimé (km)": detour,
+            "Poids restant après transfert (kg)": self.poids_restant - poids_transfert,
+            "Volume restant après transfert (m³)": self.volume_restant - volume_transfert,
+            "Capacité suffisante": capacite_ok,
+            "_ratio_libre": (self.poids_restant - poids_transfert) / self.poids_max,
+        })[eligible]
+
+        # Priorité : capacité suffisante, puis détour le plus faible, puis la plus grande marge restante
+        df = df.sort_values(
+            ["Capacité suffisante", "Détour estimé (km)", "_ratio_libre"],
+            ascending=[False, True, False], na_position="last", kind="stable"
+        )
+        return df[colonnes].reset_index(drop=True)
+
+# =====================================================
+# PLANIFICATION MULTI-TOURS SUR LA FLOTTE RÉELLE
+# =====================================================
+# Dépôt (Sfax) et hypothèses de temps de tournée
+DEPOT_LATITUDE = 34.7406
+DEPOT_LONGITUDE = 10.7603
+VITESSE_MOYENNE_KMH = 70.0
+FACTEUR_DETOUR_ROUTE = 1.2       # distance routière / distance à vol d'oiseau
+TEMPS_SERVICE_CLIENT_MIN = 10    # min par client livré
+TEMPS_CHARGEMENT_MIN = 30        # min de chargement au dépôt avant chaque tour
+DUREE_SHIFT_MIN = 600            # 10 h de service par véhicule
+DUREE_DEFAUT_ZONE_MIN = {        # durée d'un tour quand aucun client n'est géolocalisé
+    "Zone 1": 540, "Zone 2": 480, "Zone 3": 300, "Zone 4": 360,
+    "Zone 5": 480, "Zone 6": 600, "Zone 7": 150,
+}
+DUREE_DEFAUT_MIN = 300
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Distance orthodromique (haversine) en km, vectorisée."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAYON_TERRE_KM * np.arcsin(np.sqrt(a))
+
+def estimer_duree_voyages(df_voyages, df_livraisons, df_clients_gps=None):
+    """Estime la durée (min) de chaque voyage : tournée plus proche voisin depuis le dépôt + temps de service."""
+    df_bls = df_livraisons.drop_duplicates(subset="No livraison")
+    clients_par_bl = pd.Series(df_bls["Client de l'estafette"].astype(str).to_numpy(),
+                               index=df_bls["No livraison"].astype(str))
+
+    positions = {}
+    if df_clients_gps is not None and not df_clients_gps.empty:
+        positions = dict(zip(df_clients_gps["Client"].astype(str),
+                             zip(df_clients_gps["Latitude"], df_clients_gps["Longitude"])))
+
+    durees = []
+    for _, row in df_voyages.iterrows():
+        bls = [bl.strip() for bl in str(row.get("BL inclus", "")).split(";") if bl.strip()]
+        clients = list(dict.fromkeys(clients_par_bl.get(bl) for bl in bls if bl in clients_par_bl.index))
+        points = np.array([positions[c] for c in clients if c in positions], dtype=float).reshape(-1, 2)
+        service = TEMPS_CHARGEMENT_MIN + TEMPS_SERVICE_CLIENT_MIN * max(len(clients), 1)
+
+        if len(points) == 0:
+            durees.append(DUREE_DEFAUT_ZONE_MIN.get(row.get("Zone"), DUREE_DEFAUT_MIN))
+            continue
+
+        # Tournée plus proche voisin : dépôt -> clients -> dépôt
+        courant = np.array([DEPOT_LATITUDE, DEPOT_LONGITUDE])
+        restants = points
+        distance = 0.0
+        while len(restants):
+            d = distance_km(courant[0], courant[1], restants[:, 0], restants[:, 1])
+            i = int(np.argmin(d))
+            distance += d[i]
+            courant, restants = restants[i], np.delete(restants, i, axis=0)
+        distance += distance_km(courant[0], courant[1], DEPOT_LATITUDE, DEPOT_LONGITUDE)
+
+        trajet = distance * FACTEUR_DETOUR_ROUTE / VITESSE_MOYENNE_KMH * 60
+        durees.append(round(trajet + service))
+
+    return pd.Series(durees, index=df_voyages.index, name="Durée estimée (min)", dtype=float)
+
+CHAUFFEUR_LOCATION_DEFAUT = ("", "Chauffeur de location")  # (matricule, nom) sans chauffeur « camion » configuré
+
+def formater_heure(minutes):
+    """Formate un nombre de minutes depuis minuit en « HH:MM » (préfixé « J+n » au-delà de minuit)."""
+    jours, minutes = divmod(int(round(minutes)), 24 * 60)
+    heure = f"{minutes // 60:02d}:{minutes % 60:02d}"
+    return f"J+{jours} {heure}" if jours else heure
+
+def identifiants_location(df_voyages):
+    """
+    Identifiant de chaque camion loué, aligné sur les lignes de df_voyages (None pour les autres voyages).
+    Chaque voyage loué est une location distincte, numérotée dans l'ordre du plan : CAMION-LOUE-1, -2, ...
+    """
+    identifiants = np.full(len(df_voyages), None, dtype=object)
+    if "Code Véhicule" in df_voyages.columns:
+        est_location = (df_voyages["Code Véhicule"] == CAMION_CODE).to_numpy()
+        identifiants[est_location] = [f"{CAMION_CODE}-{i}" for i in range(1, int(est_location.sum()) + 1)]
+    return identifiants
+
+def chauffeur_location(chauffeurs):
+    """
+    Chauffeur des camions loués : le chauffeur « camion » configuré (chauffeur fourni avec la location,
+    partagé par toutes les locations), sinon CHAUFFEUR_LOCATION_DEFAUT. `chauffeurs` : paires (matricule, nom).
+    """
+    return next(((m, n) for m, n in chauffeurs if "camion" in str(n).lower()), CHAUFFEUR_LOCATION_DEFAUT)
+
+class FleetScheduler:
+    """Affecte les voyages aux véhicules physiques en tours successifs dans la limite du shift (LPT + recherche locale)."""
+
+    def __init__(self, df_voyages, vehicules, durees, duree_shift_min=DUREE_SHIFT_MIN,
+                 heure_debut="07:00", chauffeurs=None):
+        self.df_voyages = df_voyages
+        self.durees = pd.Series(durees, index=df_voyages.index).astype(float)
+        self.duree_shift_min = float(duree_shift_min)
+        heures, minutes = str(heure_debut).split(":")
+        self.debut_min = int(heures) * 60 + int(minutes)
+
+        # Les estafettes tournent sur les véhicules physiques hors « camion » ; les camions loués
+        # reçoivent chacun un identifiant de location (identifiants_location)
+        self.vehicules_estafette = [v for v in vehicules if "camion" not in str(v).lower()]
+        self.chauffeurs = self._affecter_chauffeurs(chauffeurs or {})
+        self.chauffeur_location = chauffeur_location((m, n) for m, n in (chauffeurs or {}).items() if m != "Matricule")
+
+    def _affecter_chauffeurs(self, chauffeurs):
+        """Associe un chauffeur fixe à chaque estafette (les chauffeurs « camion » sont ceux des locations)."""
+        items = [(m, n) for m, n in chauffeurs.items() if m != "Matricule"]
+        chauffeurs_estafette = [(m, n) for m, n in items if "camion" not in str(n).lower()]
+        return dict(zip(self.vehicules_estafette, chauffeurs_estafette))
+
+    def _lpt(self, positions):
+        """Ordonnancement LPT : le voyage le plus long va au véhicule le moins chargé (tas binaire)."""
+        tas = [(0.0, rang, v) for rang, v in enumerate(self.vehicules_estafette)]
+        heapq.heapify(tas)
+        tours = {v: [] for v in self.vehicules_estafette}
+        for pos in sorted(positions, key=lambda p: -self.durees.iloc[p]):
+            charge, rang, v = heapq.heappop(tas)
+            tours[v].append(pos)
+            heapq.heappush(tas, (charge + self.durees.iloc[pos], rang, v))
+        return tours
+
+    def _ameliorer(self, tours, iterations_max=200):
+        """Recherche locale (déplacement / échange) pour réduire la charge du véhicule le plus chargé."""
+        d = self.durees.to_numpy()
+        # Tours de chaque véhicule triés par durée : la meilleure durée à déplacer/échanger se trouve par bisection
+        tries = {v: sorted((d[p], p) for p in positions) for v, positions in tours.items()}
+        charges = {v: sum(x for x, _ in t) for v, t in tries.items()}
+
+        def plus_proche(liste, cible):
+            i = bisect.bisect_left(liste, (cible, -1))
+            return [liste[k] for k in (i - 1, i) if 0 <= k < len(liste)]
+
+        for _ in range(iterations_max):
+            v_max = max(charges, key=charges.get)
+            meilleur, gain_max = None, 1e-9
+            for w in tries:
+                ecart = charges[v_max] - charges[w]
+                if w == v_max or ecart <= 0:
+                    continue
+                # Déplacement : la durée idéale vaut la moitié de l'écart de charge
+                for dp, p in plus_proche(tries[v_max], ecart / 2):
+                    gain = charges[v_max] - max(charges[v_max] - dp, charges[w] + dp)
+                    if gain > gain_max:
+                        meilleur, gain_max = (w, (dp, p), None), gain
+                # Échange p <-> q : la durée idéale de q vaut d[p] - écart / 2
+                for dp, p in tries[v_max]:
+                    for dq, q in plus_proche(tries[w], dp - ecart / 2):
+                        if dq >= dp:
+                            continue
+                        gain = charges[v_max] - max(charges[v_max] - dp + dq, charges[w] - dq + dp)
+                        if gain > gain_max:
+                            meilleur, gain_max = (w, (dp, p), (dq, q)), gain
+            if meilleur is None:
+                break
+            w, sortant, entrant = meilleur
+            tries[v_max].remove(sortant)
+            bisect.insort(tries[w], sortant)
+            charges[v_max] -= sortant[0]
+            charges[w] += sortant[0]
+            if entrant is not None:
+                tries[w].remove(entrant)
+                bisect.insort(tries[v_max], entrant)
+                charges[w] -= entrant[0]
+                charges[v_max] += entrant[0]
+        return {v: [p for _, p in t] for v, t in tries.items()}
+
+    def planifier(self, amelioration_locale=True):
+        """Retourne les voyages avec véhicule, chauffeur, n° de tour, horaires et dépassement de shift."""
+        df = self.df_voyages.copy()
+        locations = identifiants_location(df)
+        est_camion = pd.notna(locations)
+        positions_estafettes = list(np.flatnonzero(~est_camion))
+
+        tours = self._lpt(positions_estafettes) if self.vehicules_estafette else {}
+        if amelioration_locale and len(tours) > 1:
+            tours = self._ameliorer(tours)
+
+        vehicule = [None] * len(df)
+        tour = [0] * len(df)
+        depart = [np.nan] * len(df)
+        retour = [np.nan] * len(df)
+
+        for v, positions in tours.items():
+            # Tours du plus long au plus court, enchaînés depuis le début du shift
+            horloge = 0.0
+            for n, pos in enumerate(sorted(positions, key=lambda p: -self.durees.iloc[p]), start=1):
+                vehicule[pos], tour[pos] = v, n
+                depart[pos], retour[pos] = horloge, horloge + self.durees.iloc[pos]
+                horloge = retour[pos]
+
+        # Chaque camion loué correspond à une location distincte : son propre identifiant, un seul tour,
+        # conduite par le chauffeur fourni avec la location
+        chauffeurs = [("", "")] * len(df)
+        for pos in np.flatnonzero(est_camion):
+            vehicule[pos], tour[pos] = locations[pos], 1
+            depart[pos], retour[pos] = 0.0, self.durees.iloc[pos]
+            chauffeurs[pos] = self.chauffeur_location
+        for pos in positions_estafettes:
+            chauffeurs[pos] = self.chauffeurs.get(vehicule[pos], ("", ""))
+
+        depart, retour = np.array(depart, dtype=float), np.array(retour, dtype=float)
+        df["Véhicule attribué"] = vehicule
+        df["Chauffeur attribué"] = [nom for _, nom in chauffeurs]
+        df["Matricule chauffeur"] = [matricule for matricule, _ in chauffeurs]
+        df["Tour N°"] = tour
+        df["Durée estimée (min)"] = self.durees.round().astype(int).to_numpy()
+        df["Heure départ"] = [formater_heure(self.debut_min + m) if not np.isnan(m) else "" for m in depart]
+        df["Heure retour"] = [formater_heure(self.debut_min + m) if not np.isnan(m) else "" for m in retour]
+        df["Dépassement shift"] = retour > self.duree_shift_min
+        return df
+
+    @staticmethod
+    def resume(df_planning, duree_shift_min=DUREE_SHIFT_MIN):
+        """Synthèse par véhicule physique : nombre de tours, temps planifié et utilisation du shift."""
+        vehicule = df_planning["Véhicule attribué"].to_numpy(dtype=object).copy()
+        # Un camion loué est une location distincte : jamais cumulé avec une autre location
+        locations = identifiants_location(df_planning)
+        vehicule[pd.notna(locations)] = locations[pd.notna(locations)]
+        df = df_planning.groupby(pd.Series(vehicule, index=df_planning.index, name="Véhicule attribué")).agg(**{
+            "Chauffeur": ("Chauffeur attribué", "first"),
+            "Nombre de tours": ("Tour N°", "count"),
+            "Temps planifié (min)": ("Durée estimée (min)", "sum"),
+            "Dépassement shift": ("Dépassement shift", "any"),
+        }).reset_index()
+        df["Utilisation shift (%)"] = (df["Temps planifié (min)"] / duree_shift_min * 100).round(1)
+        return df
+
+# =====================================================
+# ATTRIBUTION AUTOMATIQUE VÉHICULES / CHAUFFEURS
+# =====================================================
+COUT_INCOMPATIBLE = 1e9          # big-M : couple voyage/véhicule ou véhicule/chauffeur interdit
+PENALITE_DEPASSEMENT_MIN = 1e5   # pénalité d'un tour qui finit après le shift
+BONUS_PREFERENCE_MIN = 60        # bonus d'un couple proposé par le planning ou verrouillé par l'utilisateur
+
+def affectation_cout_minimal(couts):
+    """Affectation de coût minimal (méthode hongroise) ; utilise SciPy si disponible."""
+    couts = np.asarray(couts, dtype=float)
+    if couts.size == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    try:
+        from scipy.optimize import linear_sum_assignment
+        return linear_sum_assignment(couts)
+    except ImportError:
+        pass
+
+    transpose = couts.shape[0] > couts.shape[1]
+    if transpose:
+        couts = couts.T
+    n, m = couts.shape
+
+    # Algorithme hongrois à potentiels (O(n² m)), boucle interne vectorisée sur les colonnes
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)      # p[j] : ligne (1..n) affectée à la colonne j
+    chemin = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        utilise = np.zeros(m + 1, dtype=bool)
+        while True:
+            utilise[j0] = True
+            i0 = p[j0]
+            libres = ~utilise[1:]
+            reduits = couts[i0 - 1] - u[i0] - v[1:]
+            maj = libres & (reduits < minv[1:])
+            minv[1:][maj] = reduits[maj]
+            chemin[1:][maj] = j0
+            candidats = np.where(libres, minv[1:], np.inf)
+            j1 = int(np.argmin(candidats)) + 1
+            delta = candidats[j1 - 1]
+            u[p[utilise]] += delta
+            v[utilise] -= delta
+            minv[1:][libres] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = chemin[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    colonnes = np.flatnonzero(p[1:])
+    lignes = p[1:][colonnes] - 1
+    ordre = np.argsort(lignes)
+    lignes, colonnes = lignes[ordre], colonnes[ordre]
+    return (colonnes, lignes) if transpose else (lignes, colonnes)
+
+class AttributionSolver:
+    """Attribue véhicules et chauffeurs aux voyages par tours d'affectation de coût minimal, sans double réservation."""
+
+    def __init__(self, vehicules, chauffeurs, duree_shift_min=DUREE_SHIFT_MIN, heure_debut="07:00"):
+        self.vehicules = list(vehicules)
+        self.chauffeurs = [(m, n) for m, n in chauffeurs.items() if m != "Matricule"]
+        self.chauffeur_location = chauffeur_location(self.chauffeurs)
+        self.duree_shift_min = float(duree_shift_min)
+        heures, minutes = str(heure_debut).split(":")
+        self.debut_min = int(heures) * 60 + int(minutes)
+
+    @staticmethod
+    def _est_camion(nom):
+        return "camion" in str(nom).lower()
+
+    def _rounds(self, df, durees):
+        """Tours successifs : ceux du planning s'il existe, sinon des lots LPT de la taille de la flotte."""
+        if "Tour N°" in df.columns and (df["Tour N°"] > 0).all():
+            return [list(np.flatnonzero((df["Tour N°"] == t).to_numpy())) for t in sorted(df["Tour N°"].unique())]
+        taille = max(sum(not self._est_camion(v) for v in self.vehicules), 1)
+        ordre = list(np.argsort(-durees, kind="stable"))
+        return [ordre[k:k + taille] for k in range(0, len(ordre), taille)]
+
+    def _affecter_vehicules(self, df, durees, preferences, verrous):
+        """
+        Affectation voyage -> véhicule, tour par tour : une estafette ne porte qu'un voyage par tour.
+        Chaque camion loué est une location distincte (identifiants_location, comme FleetScheduler) :
+        un seul tour au début du shift, hors affectation.
+        """
+        locations = identifiants_location(df)
+        est_camion = pd.notna(locations)
+        vehicules_estafette = [v for v in self.vehicules if not self._est_camion(v)]
+
+        fin = dict.fromkeys(vehicules_estafette, 0.0)
+        nb_tours = dict.fromkeys(vehicules_estafette, 0)
+        vehicule, tour = [None] * len(df), [0] * len(df)
+        depart, retour = np.full(len(df), np.nan), np.full(len(df), np.nan)
+        exceptions = [[] for _ in range(len(df))]
+
+        for pos in np.flatnonzero(est_camion):
+            if verrous.get(pos) is not None and not self._est_camion(verrous[pos]):
+                exceptions[pos].append(f"Véhicule verrouillé {verrous[pos]} incompatible avec ce voyage")
+                continue
+            vehicule[pos], tour[pos], depart[pos], retour[pos] = locations[pos], 1, 0.0, durees[pos]
+
+        lots = [lot for lot in ([p for p in lot if not est_camion[p]] for lot in self._rounds(df, durees)) if lot]
+        k = 0
+        while k < len(lots):
+            lot = lots[k]
+            k += 1
+            colonnes = vehicules_estafette
+            couts = np.full((len(lot), len(colonnes)), COUT_INCOMPATIBLE)
+            for r, pos in enumerate(lot):
+                for c, v in enumerate(colonnes):
+                    cout = fin[v] + durees[pos]
+                    if cout > self.duree_shift_min:
+                        cout += PENALITE_DEPASSEMENT_MIN
+                    if verrous.get(pos) is not None:
+                        cout = 0.0 if v == verrous[pos] else COUT_INCOMPATIBLE
+                    elif v == preferences[pos]:
+                        cout -= BONUS_PREFERENCE_MIN
+                    couts[r, c] = cout
+
+            lignes, cols = affectation_cout_minimal(couts)
+            affectes = set()
+            for r, c in zip(lignes, cols):
+                pos, v = lot[r], colonnes[c]
+                if couts[r, c] >= COUT_INCOMPATIBLE:
+                    continue
+                affectes.add(pos)
+                vehicule[pos] = v
+                nb_tours[v] += 1
+                tour[pos], depart[pos] = nb_tours[v], fin[v]
+                fin[v] += durees[pos]
+                retour[pos] = fin[v]
+
+            # Un voyage verrouillé sur une estafette déjà prise à ce tour passe au tour suivant
+            reportes = []
+            for pos in sorted(set(lot) - affectes):
+                if verrous.get(pos) in vehicules_estafette:
+                    reportes.append(pos)
+                elif verrous.get(pos) is not None:
+                    exceptions[pos].append(f"Véhicule verrouillé {verrous[pos]} incompatible avec ce voyage")
+                else:
+                    exceptions[pos].append("Aucun véhicule compatible disponible")
+            if reportes:
+                if k < len(lots):
+                    lots[k] = lots[k] + reportes
+                else:
+                    lots.append(reportes)
+
+        return vehicule, tour, depart, retour, exceptions
+
+    def _affecter_chauffeurs(self, vehicules_utilises, preferences):
+        """Affectation estafette -> chauffeur (un chauffeur par estafette, hors chauffeurs « camion »)."""
+        vehicules_utilises = list(dict.fromkeys(vehicules_utilises))
+        couts = np.full((len(vehicules_utilises), len(self.chauffeurs)), COUT_INCOMPATIBLE)
+        for r, v in enumerate(vehicules_utilises):
+            for c, (matricule, nom) in enumerate(self.chauffeurs):
+                if self._est_camion(v) != self._est_camion(nom):
+                    continue
+                if preferences.get(v) is not None:
+                    couts[r, c] = 0.0 if matricule == preferences[v] else COUT_INCOMPATIBLE
+                else:
+                    couts[r, c] = float(c)  # ordre de la liste des chauffeurs à coût égal
+        lignes, cols = affectation_cout_minimal(couts)
+        return {vehicules_utilises[r]: self.chauffeurs[c] for r, c in zip(lignes, cols)
+                if couts[r, c] < COUT_INCOMPATIBLE}
+
+    def resoudre(self, df_voyages, durees=None, verrouillages=None):
+        """Retourne les voyages attribués ; la colonne « Exception » liste ce qui reste à corriger à la main."""
+        df = df_voyages.copy()
+        verrouillages = verrouillages or {}
+        durees = (pd.Series(durees, index=df.index) if durees is not None
+                  else pd.Series(DUREE_DEFAUT_MIN, index=df.index)).astype(float).to_numpy()
+        positions = {idx: pos for pos, idx in enumerate(df.index)}
+
+        preferences = (df["Véhicule attribué"].tolist() if "Véhicule attribué" in df.columns else [None] * len(df))
+        verrous_vehicule = {positions[idx]: v.get("Véhicule") for idx, v in verrouillages.items() if idx in positions}
+        vehicule, tour, depart, retour, exceptions = self._affecter_vehicules(df, durees, preferences, verrous_vehicule)
+
+        # Chauffeur verrouillé : il suit le véhicule du voyage verrouillé
+        verrous_chauffeur = {}
+        for idx, v in verrouillages.items():
+            if idx in positions and v.get("Matricule_chauffeur") and vehicule[positions[idx]]:
+                verrous_chauffeur.setdefault(vehicule[positions[idx]], v["Matricule_chauffeur"])
+        locations = set(identifiants_location(df)) - {None}
+        chauffeurs = self._affecter_chauffeurs([v for v in vehicule if v and v not in locations], verrous_chauffeur)
+        # Camions loués : le chauffeur fourni avec chaque location, externe à la flotte
+        chauffeurs.update(dict.fromkeys(locations, self.chauffeur_location))
+
+        for pos, v in enumerate(vehicule):
+            if v and v not in chauffeurs:
+                exceptions[pos].append("Aucun chauffeur compatible disponible")
+            if v and retour[pos] > self.duree_shift_min:
+                exceptions[pos].append("Dépassement du shift")
+
+        df["Véhicule attribué"] = vehicule
+        df["Chauffeur attribué"] = [chauffeurs.get(v, ("", ""))[1] for v in vehicule]
+        df["Matricule chauffeur"] = [chauffeurs.get(v, ("", ""))[0] for v in vehicule]
+        df["Tour N°"] = tour
+        df["Durée estimée (min)"] = np.round(durees).astype(int)
+        df["Heure départ"] = [formater_heure(self.debut_min + m) if not np.isnan(m) else "" for m in depart]
+        df["Heure retour"] = [formater_heure(self.debut_min + m) if not np.isnan(m) else "" for m in retour]
+        df["Dépassement shift"] = np.nan_to_num(retour, nan=0.0) > self.duree_shift_min
+        df["Exception"] = ["; ".join(e) for e in exceptions]
+        return df
+
+# =====================================================
+# FENÊTRES HORAIRES ET TEMPS DE SERVICE
+# =====================================================
+def heure_en_minutes(valeur):
+    """
+    Convertit une heure (« HH:MM », « HH:MM:SS », « 8h30 », datetime.time, fraction de jour Excel) en
+    minutes depuis minuit. None si la valeur est vide ou illisible (texte libre, plage « 8h-12h »).
+    """
+    import re
+    if valeur is None or (not hasattr(valeur, "hour") and pd.isna(valeur)):
+        return None
+    if hasattr(valeur, "hour"):
+        return valeur.hour * 60 + valeur.minute
+    if isinstance(valeur, (int, float)):
+        return float(valeur) * 24 * 60 if float(valeur) < 1 else float(valeur) * 60
+    correspondance = re.fullmatch(r"(\d{1,2})\s*(?:[:hH]\s*(\d{2})?(?::\d{2})?)?", str(valeur).strip())
+    if correspondance is None:
+        return None
+    heures, minutes = int(correspondance.group(1)), int(correspondance.group(2) or 0)
+    return heures * 60 + minutes if heures <= 24 and minutes < 60 else None
+
+class FenetresHoraires:
+    """Référentiel clients : fenêtres horaires, temps de service et temps de trajet entre clients."""
+
+    def __init__(self, df_fenetres, df_clients_gps=None, heure_depart="07:00"):
+        self.fenetres = {}
+        self.services = {}
+        self.lignes_ignorees = []   # fenêtres à l'heure illisible : « ligne n (client) : valeur »
+        for i, row in df_fenetres.reset_index(drop=True).iterrows():
+            client = str(row["Client"]).strip()
+            valeurs = [row.get("Heure début"), row.get("Heure fin")]
+            debut, fin = (heure_en_minutes(v) for v in valeurs)
+            illisibles = [str(v) for v, m in zip(valeurs, (debut, fin))
+                          if m is None and v is not None and not pd.isna(v) and str(v).strip()]
+            if illisibles:
+                # Heure illisible : le client n'a pas de fenêtre plutôt qu'une fenêtre à moitié connue
+                self.lignes_ignorees.append(f"ligne {i + 2} ({client}) : {', '.join(illisibles)}")
+                debut = fin = None
+            self.fenetres[client] = (debut if debut is not None else 0.0, fin if fin is not None else math.inf)
+            service = pd.to_numeric(row.get("Temps de service (min)"), errors="coerce")
+            if pd.notna(service):
+                self.services[client] = float(service)
+
+        self.positions = {}
+        if df_clients_gps is not None and not df_clients_gps.empty:
+            self.positions = dict(zip(df_clients_gps["Client"].astype(str),
+                                      zip(df_clients_gps["Latitude"], df_clients_gps["Longitude"])))
+        self.depart_min = heure_en_minutes(heure_depart) + TEMPS_CHARGEMENT_MIN
+        if self.lignes_ignorees:
+            print(f"⚠️ {len(self.lignes_ignorees)} fenêtre(s) horaire(s) ignorée(s), heure illisible : "
+                  + "; ".join(self.lignes_ignorees))
+        self._trajets = {}
+
+    def fenetre(self, client):
+        return self.fenetres.get(client, (0.0, math.inf))
+
+    def service(self, client):
+        return self.services.get(client, TEMPS_SERVICE_CLIENT_MIN)
+
+    def _position(self, client):
+        return (DEPOT_LATITUDE, DEPOT_LONGITUDE) if client is None else self.positions.get(client)
+
+    def trajet_min(self, origine, destination):
+        """Temps de trajet (min) ; None désigne le dépôt, un client non géolocalisé compte 0."""
+        cle = (origine, destination)
+        if cle not in self._trajets:
+            a, b = self._position(origine), self._position(destination)
+            if a is None or b is None:
+                self._trajets[cle] = 0.0
+            else:
+                distance = distance_km(a[0], a[1], b[0], b[1])
+                self._trajets[cle] = float(distance) * FACTEUR_DETOUR_ROUTE / VITESSE_MOYENNE_KMH * 60
+        return self._trajets[cle]
+
+    def nouvelle_tournee(self):
+        return Tournee(self)
+
+    def vers_table(self):
+        """Fenêtres et temps de service au format du fichier importé (reconstruction après reprise de session)."""
+        clients = sorted(set(self.fenetres) | set(self.services))
+        return pd.DataFrame({
+            "Client": clients,
+            "Heure début": [formater_heure(self.fenetres[c][0]) if c in self.fenetres else None for c in clients],
+            "Heure fin": [formater_heure(self.fenetres[c][1]) if c in self.fenetres and math.isfinite(self.fenetres[c][1])
+                          else None for c in clients],
+            "Temps de service (min)": [self.services.get(c) for c in clients],
+        })
+
+class Tournee:
+    """Tournée d'un véhicule sous fenêtres horaires : test d'insertion O(1) par position (forward time slack)."""
+
+    def __init__(self, fenetres_horaires):
+        self.fh = fenetres_horaires
+        self.clients = []
+        self.arrivee = []
+        self.debut = []     # début de service à chaque arrêt
+        self.slack = []     # marge de retard absorbable à partir de chaque arrêt
+        self.retour = self.fh.depart_min
+
+    def __contains__(self, client):
+        return client in self.clients
+
+    def _depart(self, i):
+        """Heure de départ de l'arrêt i (i = -1 : dépôt)."""
+        return self.fh.depart_min if i < 0 else self.debut[i] + self.fh.service(self.clients[i])
+
+    def _recalculer(self):
+        """Propage les heures vers l'avant puis les marges (forward time slack) vers l'arrière."""
+        n = len(self.clients)
+        self.arrivee, self.debut = [0.0] * n, [0.0] * n
+        precedent = None
+        for i, client in enumerate(self.clients):
+            self.arrivee[i] = self._depart(i - 1) + self.fh.trajet_min(precedent, client)
+            self.debut[i] = max(self.arrivee[i], self.fh.fenetre(client)[0])
+            precedent = client
+        self.retour = self._depart(n - 1) + self.fh.trajet_min(precedent, None)
+
+        # F_i = min(l_i - s_i, attente_{i+1} + F_{i+1}) ; retour au dépôt sans limite
+        self.slack = [0.0] * n
+        suivant = math.inf
+        for i in range(n - 1, -1, -1):
+            self.slack[i] = min(self.fh.fenetre(self.clients[i])[1] - self.debut[i], suivant)
+            suivant = (self.debut[i] - self.arrivee[i]) + self.slack[i]
+
+    def meilleure_insertion(self, client):
+        """Position d'insertion réalisable de plus faible détour, ou None si aucune ne respecte les fenêtres."""
+        debut_fenetre, fin_fenetre = self.fh.fenetre(client)
+        service = self.fh.service(client)
+        meilleure = None
+        for p in range(len(self.clients) + 1):
+            precedent = self.clients[p - 1] if p > 0 else None
+            suivant = self.clients[p] if p < len(self.clients) else None
+            debut = max(self._depart(p - 1) + self.fh.trajet_min(precedent, client), debut_fenetre)
+            if debut > fin_fenetre:
+                continue
+            if suivant is not None:
+                # Décalage de l'arrêt suivant : réalisable s'il reste dans sa marge
+                arrivee_suivant = debut + service + self.fh.trajet_min(client, suivant)
+                decalage = max(arrivee_suivant, self.fh.fenetre(suivant)[0]) - self.debut[p]
+                if decalage > self.slack[p]:
+                    continue
+            detour = (self.fh.trajet_min(precedent, client) + self.fh.trajet_min(client, suivant)
+                      - self.fh.trajet_min(precedent, suivant))
+            if meilleure is None or detour < meilleure[1]:
+                meilleure = (p, detour)
+        return meilleure
+
+    def inserer(self, client, position=None):
+        self.clients.insert(len(self.clients) if position is None else position, client)
+        self._recalculer()
+
+    def placer(self, client):
+        """Ajoute le client s'il est déjà desservi ou si une insertion respecte les fenêtres."""
+        if client in self.clients:
+            return True
+        insertion = self.meilleure_insertion(client)
+        if insertion is None:
+            return False
+        self.inserer(client, insertion[0])
+        return True
+
+    @staticmethod
+    def clients_du_bl(clients):
+        """Clients d'un BL (« C1, C2 » -> ["C1", "C2"])."""
+        return [c.strip() for c in str(clients).split(",") if c.strip()]
+
+    def placer_bl(self, clients, forcer=False):
+        """
+        Place tous les clients d'un BL ou aucun : la tournée est restaurée si l'un d'eux
+        n'a pas d'insertion réalisable. Avec `forcer` (véhicule ouvert pour ce BL),
+        un client sans insertion réalisable est ajouté en fin de tournée.
+        """
+        sauvegarde = (list(self.clients), self.arrivee, self.debut, self.slack, self.retour)
+        for client in self.clients_du_bl(clients):
+            if self.placer(client):
+                continue
+            if forcer:
+                self.inserer(client)
+                continue
+            self.clients, self.arrivee, self.debut, self.slack, self.retour = sauvegarde
+            return False
+        return True
+
+    def planning(self):
+        """Détail horaire des arrêts de la tournée."""
+        lignes = []
+        for i, client in enumerate(self.clients):
+            debut_fenetre, fin_fenetre = self.fh.fenetre(client)
+            lignes.append({
+                "Ordre": i + 1,
+                "Client": client,
+                "Arrivée": formater_heure(self.arrivee[i]),
+                "Début service": formater_heure(self.debut[i]),
+                "Fin service": formater_heure(self.debut[i] + self.fh.service(client)),
+                "Fenêtre": f"{formater_heure(debut_fenetre)} - "
+                           f"{formater_heure(fin_fenetre) if fin_fenetre != math.inf else '--:--'}",
+                "Retard (min)": round(max(self.debut[i] - fin_fenetre, 0.0), 1),
+            })
+        return lignes
+
+# =====================================================
+# PLANIFICATION MULTI-JOURS (HORIZON GLISSANT)
+# =====================================================
+class HorizonPlanner:
+    """Planification glissante par date de livraison : jours planifiés un à un, mis en cache et lissés."""
+
+    COLONNES_BL = ["No livraison", "Client de l'estafette", "Représentant", "Poids total", "Volume total", "Zone"]
+    COLONNE_FLEXIBLE = "BL flexible"   # BL livrable en avance (lissage) ; absent = non flexible
+
+    def __init__(self, fenetres_horaires=None, nb_jours=5, flexibilite_jours=1, seuil_remplissage=70.0,
+                 voyages_max_jour=None):
+        self.fenetres_horaires = fenetres_horaires
+        self.nb_jours = int(nb_jours)
+        self.flexibilite_jours = int(flexibilite_jours)
+        self.seuil_remplissage = float(seuil_remplissage)
+        self.voyages_max_jour = voyages_max_jour
+        self._cache = {}                  # (jour, signature du lot de BLs) -> voyages planifiés
+        self.reliquat = pd.DataFrame()    # BLs non planifiés, reportés au run suivant
+        self.jours_recalcules = []
+
+    def _planifier_jour(self, df_jour):
+        """Empaquetage d'un jour (même algorithme que le traitement principal)."""
+        processor = DeliveryProcessor()
+        processor.fenetres_horaires = self.fenetres_horaires
+        return processor._calculate_optimized_estafette(df_jour)
+
+    def _signature(self, df_jour):
+        return int(pd.util.hash_pandas_object(df_jour[self.COLONNES_BL], index=False).sum()) if len(df_jour) else 0
+
+    def _planifier_jours(self, lots, progression=None):
+        """
+        Planifie, l'un après l'autre, les jours dont le lot de BLs n'a pas encore été calculé.
+        L'empaquetage d'un jour est du Python pur (quelques dizaines de ms) : un pool de threads est
+        sérialisé par le GIL et un pool de processus coûte plus cher à démarrer que le calcul.
+        Sur annulation (TraitementAnnule levé par progression), les jours restants sont abandonnés ;
+        les jours déjà planifiés restent en cache.
+        """
+        cles = {jour: (jour, self._signature(df)) for jour, df in lots.items() if len(df)}
+        a_calculer = [jour for jour, cle in cles.items() if cle not in self._cache]
+        for n, jour in enumerate(a_calculer, start=1):
+            self._cache[cles[jour]] = self._planifier_jour(lots[jour])
+            self.jours_recalcules.append(jour)
+            signaler_etape(progression, f"Jour du {jour:%d/%m/%Y} planifié ({n}/{len(a_calculer)})",
+                           0.1 + 0.7 * n / len(a_calculer))
+        return {jour: self._cache[cles[jour]] if jour in cles else pd.DataFrame() for jour in lots}
+
+    def _voyages_vers_bls(self, plans, df_bls):
+        """Passe des voyages par jour à une table BL -> (jour, voyage)."""
+        lignes = []
+        for jour, df in plans.items():
+            if df.empty:
+                continue
+            for voyage, bls in zip(df["Camion N°"], df["BL inclus"]):
+                lignes += [(jour, voyage, bl) for bl in str(bls).split(";")]
+        df_affect = pd.DataFrame(lignes, columns=["Jour", "Voyage", "No livraison"])
+        return df_affect.merge(df_bls, on="No livraison", how="left")
+
+    def _lisser(self, df_affect):
+        """
+        Avance des BLs flexibles du jour J+k vers les voyages sous-remplis du jour J (même zone).
+        Charges des voyages et candidats en tableaux NumPy : aucun filtrage de DataFrame dans les boucles.
+        """
+        n = len(df_affect)
+        jour = df_affect["Jour"].to_numpy().copy()
+        voyage = df_affect["Voyage"].to_numpy(dtype=object).copy()
+        zone = df_affect["Zone"].astype(object).map(str).to_numpy()
+        client = df_affect["Client de l'estafette"].astype(object).map(str).to_numpy()
+        poids_bl = df_affect["Poids total"].fillna(0).to_numpy(dtype=float)
+        volume_bl = df_affect["Volume total"].fillna(0).to_numpy(dtype=float)
+        flexible = (df_affect[self.COLONNE_FLEXIBLE].fillna(False).to_numpy(dtype=bool)
+                    if self.COLONNE_FLEXIBLE in df_affect.columns else np.zeros(n, dtype=bool))
+
+        # Charge de chaque voyage (jour, voyage), indexée par code entier
+        codes, voyages = pd.factorize(pd.MultiIndex.from_arrays([jour, voyage]))
+        poids = np.bincount(codes, weights=poids_bl, minlength=len(voyages))
+        volume = np.bincount(codes, weights=volume_bl, minlength=len(voyages))
+        nom_voyage = voyages.get_level_values(1).to_numpy(dtype=object)
+        avance_max = np.timedelta64(self.flexibilite_jours, "D")
+        deplaces = 0
+
+        if not flexible.any():
+            return df_affect, deplaces
+
+        for j, z in sorted(set(zip(jour, zone))):
+            dans_jour = (zone == z) & (jour == j)
+            candidats = np.flatnonzero(flexible & (zone == z) & (jour > j) & (jour <= j + avance_max))
+            if not len(candidats) or not dans_jour.any():
+                continue
+            receveurs = np.unique(codes[dans_jour])
+            receveurs = receveurs[np.maximum(poids[receveurs] / CAPACITE_POIDS_ESTAFETTE,
+                                             volume[receveurs] / CAPACITE_VOLUME_ESTAFETTE) * 100 < self.seuil_remplissage]
+            if not len(receveurs):
+                continue
+            if self.fenetres_horaires is not None:
+                # Avec fenêtres horaires, on ne rajoute pas d'arrêt à une tournée déjà construite
+                clients_receveurs = [set(client[dans_jour & (codes == r)]) for r in receveurs]
+            # Les voyages donneurs les moins remplis se vident en premier, leurs BLs du plus lourd au plus léger
+            candidats = candidats[np.lexsort((-poids_bl[candidats], codes[candidats], poids[codes[candidats]]))]
+            for i in candidats:
+                possibles = ((poids[receveurs] + poids_bl[i] <= CAPACITE_POIDS_ESTAFETTE)
+                             & (volume[receveurs] + volume_bl[i] <= CAPACITE_VOLUME_ESTAFETTE))
+                if self.fenetres_horaires is not None:
+                    possibles &= np.array([client[i] in clients for clients in clients_receveurs])
+                if not possibles.any():
+                    continue
+                r = receveurs[np.argmax(possibles)]
+                poids[codes[i]] -= poids_bl[i]
+                volume[codes[i]] -= volume_bl[i]
+                poids[r] += poids_bl[i]
+                volume[r] += volume_bl[i]
+                codes[i], jour[i], voyage[i] = r, j, nom_voyage[r]
+                deplaces += 1
+
+        df_affect = df_affect.assign(Jour=jour, Voyage=voyage)
+        return df_affect, deplaces
+
+    def _bls_vers_voyages(self, df_affect):
+        """Reconstruit les voyages (format du traitement principal) à partir de la table BL -> voyage."""
+        joindre = lambda x: ", ".join(sorted(set(str(e).strip() for e in x)))
+        df = df_affect.groupby(["Jour", "Voyage"], sort=False).agg(**{
+            "Zone": ("Zone", "first"),
+            "Poids total chargé": ("Poids total", "sum"),
+            "Volume total chargé": ("Volume total", "sum"),
+            "Client(s) inclus": ("Client de l'estafette", joindre),
+            "Représentant(s) inclus": ("Représentant", joindre),
+            "BL inclus": ("No livraison", ";".join),
+        }).reset_index()
+        df["Taux d'occupation (%)"] = np.maximum(
+            df["Poids total chargé"] / CAPACITE_POIDS_ESTAFETTE, df["Volume total chargé"] / CAPACITE_VOLUME_ESTAFETTE
+        ).mul(100).round(2)
+        df["Location_camion"] = False
+        df["Location_proposee"] = False
+        df["Code Véhicule"] = "ESTAFETTE"
+        df["Estafette N°"] = df["Voyage"].str[1:].astype(int)
+        df = df.rename(columns={"Jour": "Date livraison", "Voyage": "Camion N°"})
+        return df.sort_values(["Date livraison", "Zone", "Estafette N°"]).reset_index(drop=True)
+
+    def planifier(self, df_livraisons, dates_bl, date_debut=None, progression=None):
+        """
+        Planifie l'horizon ; retourne (voyages par jour, BLs reportés au prochain run, résumé par jour).
+        `progression(etape, avancement)` (optionnel) suit les jours planifiés et peut annuler le run.
+        """
+        signaler_etape(progression, "Répartition des BLs par jour", 0.0)
+        df = df_livraisons.copy()
+        df["No livraison"] = df["No livraison"].astype(str)
+        df["Date livraison"] = df["No livraison"].map(dates_bl)
+        df[self.COLONNE_FLEXIBLE] = (df[self.COLONNE_FLEXIBLE].fillna(False).astype(bool)
+                                     if self.COLONNE_FLEXIBLE in df.columns else False)
+
+        # BLs non planifiés lors du run précédent : repris s'ils ne figurent pas dans les nouvelles données
+        if not self.reliquat.empty:
+            df = pd.concat([df, self.reliquat[~self.reliquat["No livraison"].isin(df["No livraison"])]],
+                           ignore_index=True)
+
+        dates = pd.to_datetime(df["Date livraison"]).dt.normalize()
+        if date_debut is None:
+            date_debut = dates.max() - pd.Timedelta(days=self.nb_jours - 1)
+        date_debut = pd.Timestamp(date_debut).normalize()
+        jours = list(pd.date_range(date_debut, periods=self.nb_jours, freq="D"))
+
+        # En retard ou sans date : rattrapés le premier jour ; au-delà de l'horizon : reliquat des runs suivants
+        df["Jour"] = dates.where(dates >= date_debut, date_debut).fillna(date_debut)
+        apres_horizon = df[df["Jour"] > jours[-1]]
+        df = df[df["Jour"] <= jours[-1]]
+        df_bls = df.drop_duplicates(subset="No livraison")[self.COLONNES_BL + ["Date livraison", self.COLONNE_FLEXIBLE]]
+
+        self.jours_recalcules = []
+        lots = {jour: df[df["Jour"] == jour] for jour in jours}
+        plans = self._planifier_jours(lots, progression)
+
+        # Plafond de voyages par jour : les voyages les moins remplis passent au jour suivant
+        reportes = df.iloc[0:0]
+        if self.voyages_max_jour:
+            for i, jour in enumerate(jours):
+                if not reportes.empty:
+                    lots[jour] = pd.concat([lots[jour], reportes], ignore_index=True)
+                    plans[jour] = self._planifier_jours({jour: lots[jour]})[jour]
+                    reportes = df.iloc[0:0]
+                if len(plans[jour]) > self.voyages_max_jour:
+                    surplus = plans[jour].nsmallest(len(plans[jour]) - self.voyages_max_jour, "Taux d'occupation (%)")
+                    bls_surplus = set(";".join(surplus["BL inclus"]).split(";"))
+                    reportes = lots[jour][lots[jour]["No livraison"].isin(bls_surplus)]
+                    plans[jour] = plans[jour].drop(surplus.index)
+
+        signaler_etape(progression, "Lissage entre les jours", 0.85)
+        df_affect = self._voyages_vers_bls(plans, df_bls)
+        deplaces = 0
+        if not df_affect.empty and self.flexibilite_jours > 0:
+            df_affect, deplaces = self._lisser(df_affect)
+        df_plan = self._bls_vers_voyages(df_affect) if not df_affect.empty else pd.DataFrame()
+
+        self.reliquat = pd.concat([reportes, apres_horizon]).drop(columns=["Jour"], errors="ignore").reset_index(drop=True)
+        # Le cache ne garde que les jours de l'horizon courant
+        self._cache = {cle: v for cle, v in self._cache.items() if cle[0] >= date_debut}
+
+        resume = pd.DataFrame({"Date livraison": jours})
+        if not df_plan.empty:
+            par_jour = df_plan.groupby("Date livraison").agg(**{
+                "Voyages": ("Camion N°", "count"),
+                "BLs": ("BL inclus", lambda x: sum(len(b.split(";")) for b in x)),
+                "Poids total (kg)": ("Poids total chargé", "sum"),
+                "Taux moyen (%)": ("Taux d'occupation (%)", "mean"),
+            }).reset_index()
+            resume = resume.merge(par_jour, on="Date livraison", how="left").fillna(0)
+            resume[["Voyages", "BLs"]] = resume[["Voyages", "BLs"]].astype(int)
+        resume["Recalculé"] = resume["Date livraison"].isin(self.jours_recalcules)
+        self.bls_avances = deplaces
+        signaler_etape(progression, "Horizon planifié", 1.0)
+        return df_plan, self.reliquat, resume
+
+# =====================================================
+# MOTEUR DE RÈGLES DE VALIDATION
+# =====================================================
+# Règles déclarées une seule fois. Chaque règle compare une colonne du contexte
+# (véhicules, BLs ou plan) à un seuil ou à une autre colonne ("reference") ;
+# le message est un gabarit format() sur les colonnes du contexte ({seuil} inclus).
+#   portee : "vehicule" (une ligne par voyage), "bl" (une ligne par BL), "plan" (une seule ligne)
+#   bloc   : section du rapport qui utilise la règle, ordre : rang du message dans la ligne
+REGLES_VALIDATION = [
+    {"nom": "capacite_poids", "portee": "vehicule", "bloc": "capacite", "ordre": 0, "type": "❌ ERREUR",
+     "colonne": "poids", "operateur": ">", "reference": "poids_max",
+     "message": "{libelle} dépasse la capacité poids : {poids:.1f}kg > {poids_max_txt}kg"},
+    {"nom": "capacite_volume", "portee": "vehicule", "bloc": "capacite", "ordre": 1, "type": "❌ ERREUR",
+     "colonne": "volume", "operateur": ">", "reference": "volume_max",
+     "message": "{libelle} dépasse la capacité volume : {volume:.3f}m³ > {volume_max_txt}m³"},
+    {"nom": "surcharge", "portee": "vehicule", "bloc": "capacite", "ordre": 2, "type": "⚠️ ALERTE",
+     "colonne": "taux", "operateur": ">", "seuil": 100,
+     "message": "{libelle} a un taux d'occupation > {seuil}% : {taux:.1f}%"},
+    {"nom": "sous_utilisation", "portee": "vehicule", "bloc": "capacite", "ordre": 2, "type": "💡 SUGGESTION",
+     "colonne": "taux", "operateur": "<", "seuil": 50,
+     "message": "{libelle} sous-utilisé : {taux:.1f}% - possibilité d'optimisation"},
+    {"nom": "bl_duplique", "portee": "bl", "bloc": "doublons", "ordre": 0, "type": "❌ ERREUR",
+     "colonne": "nb_occurrences", "operateur": ">", "seuil": 1,
+     "message": "BL {bl} présent dans plusieurs véhicules : {occurrences}"},
+    {"nom": "client_manquant", "portee": "vehicule", "bloc": "coherence", "ordre": 0, "type": "⚠️ ALERTE",
+     "colonne": "client_vide", "operateur": "==", "seuil": True,
+     "message": "Véhicule {vehicule} (Zone {zone}) n'a pas de client associé"},
+    {"nom": "bl_manquant", "portee": "vehicule", "bloc": "coherence", "ordre": 1, "type": "❌ ERREUR",
+     "colonne": "sans_bl", "operateur": "==", "seuil": True,
+     "message": "Véhicule {vehicule} (Zone {zone}) n'a pas de BL associé"},
+    {"nom": "analyse_sous_utilisation", "portee": "vehicule", "bloc": "analyse", "ordre": 0, "type": "📊 ANALYSE",
+     "colonne": "taux", "operateur": "<", "seuil": 60,
+     "titre": "• Véhicules sous-utilisés (< {seuil}%)", "message": "  - {vehicule} (Zone {zone}) : {taux:.1f}%"},
+    {"nom": "analyse_tres_charge", "portee": "vehicule", "bloc": "analyse", "ordre": 1, "type": "📊 ANALYSE",
+     "colonne": "taux", "operateur": ">", "seuil": 95,
+     "titre": "• Véhicules très chargés (> {seuil}%)", "message": "  - {vehicule} (Zone {zone}) : {taux:.1f}%"},
+    {"nom": "camions_sous_utilises", "portee": "plan", "bloc": "analyse", "ordre": 0, "type": "🎯 RECOMMANDATION",
+     "colonne": "taux_moyen_camions", "operateur": "<", "seuil": 70,
+     "message": "• Attention : les camions sont sous-utilisés, envisager plus d'estafettes"},
+    {"nom": "ecart_poids", "portee": "plan", "bloc": "integrite", "ordre": 0, "type": "⚠️ ALERTE",
+     "colonne": "ecart_poids", "operateur": ">", "seuil": 0.01,
+     "message": "⚠️ Écart de poids : Original {poids_original:.1f}kg vs Voyages {poids_voyages:.1f}kg (diff: {diff_poids:.1f}kg)"},
+    {"nom": "ecart_volume", "portee": "plan", "bloc": "integrite", "ordre": 1, "type": "⚠️ ALERTE",
+     "colonne": "ecart_volume", "operateur": ">", "seuil": 0.01,
+     "message": "⚠️ Écart de volume : Original {volume_original:.3f}m³ vs Voyages {volume_voyages:.3f}m³ (diff: {diff_volume:.3f}m³)"},
+]
+
+OPERATEURS_REGLES = {
+    "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+    "==": np.equal, "!=": np.not_equal,
+}
+
+
+def contexte_vehicules(df, jetons=None):
+    """
+    Colonnes dérivées d'un plan (index 0..n-1) sur lesquelles portent les règles "vehicule" :
+    valeurs numériques, capacités max, libellés et indicateurs de cohérence.
+    `jetons` : "BL inclus" éclaté par ';' (recalculé si non fourni).
+    """
+    colonne = lambda nom, defaut: df[nom] if nom in df.columns else pd.Series(defaut, index=df.index)
+    texte = lambda serie: serie.astype(object).map(str)  # même rendu que str() / f-string ligne à ligne
+
+    vehicule = texte(colonne("Véhicule N°", "Inconnu"))
+    zone = texte(colonne("Zone", "Inconnue"))
+    code = colonne("Code Véhicule", "ESTAFETTE")
+    type_camion = colonne("Type_Camion", "5 tonnes")
+
+    est_camion = (code == CAMION_CODE).to_numpy()
+    est_10t = (type_camion == "10 tonnes").to_numpy()
+    poids_max, volume_max = get_capacites_vehicules(df.assign(**{"Code Véhicule": code, "Type_Camion": type_camion}))
+    type_veh = pd.Series(np.where(est_camion, "Camion " + texte(type_camion), "Estafette"), index=df.index)
+
+    # Jetons de "BL inclus" : BLs réels et objets manuels (OBJ-)
+    if jetons is None:
+        jetons = texte(colonne("BL inclus", "")).str.split(';').explode()
+    jetons_non_vides = jetons[jetons.str.strip().ne('')]
+    a_bl_reel = (~jetons_non_vides.str.startswith('OBJ-')).groupby(level=0).any().reindex(df.index, fill_value=False)
+    a_objet = jetons_non_vides.str.startswith('OBJ-').groupby(level=0).any().reindex(df.index, fill_value=False)
+    clients = texte(colonne("Client(s) inclus", ""))
+
+    return pd.DataFrame({
+        "vehicule": vehicule,
+        "zone": zone,
+        "libelle": type_veh + " " + vehicule + " (Zone " + zone + ")",
+        "poids": colonne("Poids total chargé", 0).astype(float),
+        "volume": colonne("Volume total chargé", 0).astype(float),
+        "taux": colonne("Taux d'occupation (%)", 0).astype(float),
+        "poids_max": poids_max,
+        "volume_max": volume_max,
+        "poids_max_txt": np.where(est_camion, np.where(est_10t, str(CAPACITE_POIDS_CAMION_10T), str(CAPACITE_POIDS_CAMION_5T)),
+                                  str(CAPACITE_POIDS_ESTAFETTE)),
+        "volume_max_txt": np.where(est_camion, np.where(est_10t, str(CAPACITE_VOLUME_CAMION_10T), str(CAPACITE_VOLUME_CAMION_5T)),
+                                   str(CAPACITE_VOLUME_ESTAFETTE)),
+        "client_vide": ((clients.str.strip() == '') | (clients == 'nan')).to_numpy(dtype=bool),
+        "sans_bl": (~a_bl_reel & ~a_objet).to_numpy(dtype=bool),
+    }, index=df.index)
+
+
+class MoteurRegles:
+    """
+    Compile les règles déclarées (REGLES_VALIDATION) en masques vectorisés.
+    Toutes les règles d'une portée sont évaluées en un seul lot : une matrice
+    booléenne (lignes × règles), puis les messages des seules lignes retenues.
+    """
+
+    def __init__(self, regles=None):
+        self.regles = [dict(regle) for regle in (regles if regles is not None else REGLES_VALIDATION)]
+        self._compilees = [self._compiler(regle) for regle in self.regles]
+
+    def regle(self, nom):
+        """Règle déclarée par son nom (KeyError si absente)."""
+        for regle in self.regles:
+            if regle["nom"] == nom:
+                return regle
+        raise KeyError(nom)
+
+    def titre(self, nom):
+        """Titre de la règle avec son seuil."""
+        regle = self.regle(nom)
+        return regle.get("titre", regle["nom"]).format(seuil=regle.get("seuil"))
+
+    @staticmethod
+    def _compiler(regle):
+        """Fonction de masque et gabarit de message (parties littérales / champs) d'une règle."""
+        operateur = OPERATEURS_REGLES[regle["operateur"]]
+        colonne, reference, seuil = regle["colonne"], regle.get("reference"), regle.get("seuil")
+        if reference is not None:
+            masque = lambda ctx: operateur(ctx[colonne].to_numpy(), ctx[reference].to_numpy())
+        else:
+            masque = lambda ctx: operateur(ctx[colonne].to_numpy(), seuil)
+
+        parties = []
+        for litteral, champ, spec, _ in string.Formatter().parse(regle["message"]):
+            if litteral:
+                parties.append((litteral, None))
+            if champ == "seuil":
+                parties.append((format(seuil, spec), None))
+            elif champ is not None:
+                parties.append((champ, spec))
+        return regle, masque, parties
+
+    def _selection(self, portee, blocs, noms):
+        return [
+            compilee for compilee in self._compilees
+            if compilee[0]["portee"] == portee
+            and (blocs is None or compilee[0]["bloc"] in blocs)
+            and (noms is None or compilee[0]["nom"] in noms)
+        ]
+
+    def masques(self, contexte, portee="vehicule", blocs=None, noms=None):
+        """Matrice booléenne (lignes du contexte × règles sélectionnées), en DataFrame."""
+        selection = self._selection(portee, blocs, noms)
+        if not selection or contexte.empty:
+            return pd.DataFrame(index=contexte.index, columns=[r["nom"] for r, _, _ in selection], dtype=bool)
+        matrice = np.column_stack([
+            np.asarray(pd.Series(masque(contexte)).fillna(False), dtype=bool) for _, masque, _ in selection
+        ])
+        return pd.DataFrame(matrice, index=contexte.index, columns=[r["nom"] for r, _, _ in selection])
+
+    def evaluer(self, contexte, portee="vehicule", blocs=None, noms=None):
+        """
+        Messages des règles violées, un par (ligne, règle) :
+        colonnes _pos (ligne du contexte), _ordre, Regle, Bloc, Type, Message.
+        """
+        masques = self.masques(contexte, portee, blocs, noms)
+        lots = []
+        for (regle, _, parties), nom in zip(self._selection(portee, blocs, noms), masques.columns):
+            m = masques[nom].to_numpy()
+            if not m.any():
+                continue
+            message = pd.Series("", index=contexte.index[m], dtype=object)
+            for partie, spec in parties:
+                if spec is None:
+                    message = message + partie
+                elif spec:
+                    message = message + pd.Series([format(x, spec) for x in contexte[partie].to_numpy()[m]],
+                                                  index=message.index, dtype=object)
+                else:
+                    message = message + contexte[partie][m].astype(object).map(str)
+            lots.append(pd.DataFrame({
+                "_pos": np.flatnonzero(m), "_ordre": regle["ordre"], "Regle": regle["nom"],
+                "Bloc": regle["bloc"], "Type": regle["type"], "Message": message.to_numpy(),
+            }))
+        if not lots:
+            return pd.DataFrame(columns=["_pos", "_ordre", "Regle", "Bloc", "Type", "Message"])
+        return pd.concat(lots, ignore_index=True)
+
+
+MOTEUR_REGLES = MoteurRegles()
+
+# =====================================================
+# CLASSE DE VALIDATION DES VOYAGES
+# =====================================================
+class VoyageValidator:
+    def __init__(self, df_voyages, moteur=None):
+        self.df_voyages = df_voyages.copy(deep=False)
+        self.moteur = moteur if moteur is not None else MOTEUR_REGLES
+        # Validation incrémentale : résultats par véhicule (clé (Zone, Véhicule N°)),
+        # BLs réels par véhicule, index global des BLs et ensemble des véhicules modifiés
+        self._resultats_vehicules = None
+        self._bls_vehicules = {}
+        self._index_bls = {}
+        self._bls_doublons = set()
+        self._messages_doublons = {}
+        self._ordre_cles = []
+        self._positions = {}
+        self._empreintes = {}
+        self._vehicules_modifies = set()
+        # Rapport assemblé (messages capacité / cohérence) et nombre de messages par position
+        self._rapport_capacite, self._rapport_coherence = [], []
+        self._nb_capacite = self._nb_coherence = None
+
+    def validate_voyages(self):
+        """Valide les voyages en tenant compte des types de camions (vectorisé, même rapport que la version ligne à ligne)."""
+        try:
+            df = self.df_voyages.reset_index(drop=True)
+            bloc_capacite, bloc_coherence, occurrences = self._analyser_lignes(df)
+
+            # Validation des BLs dupliqués (hors objets manuels), dans l'ordre de première apparition
+            contexte_bl = pd.DataFrame({"bl": occurrences["BL"].drop_duplicates().to_numpy()})
+            contexte_bl["nb_occurrences"] = contexte_bl["bl"].map(occurrences["BL"].value_counts()).to_numpy()
+            contexte_bl = contexte_bl[self.moteur.masques(contexte_bl, "bl").any(axis=1)].reset_index(drop=True)
+            groupes = {bl: [] for bl in contexte_bl["bl"].tolist()}
+            for bl, occurrence in zip(occurrences["BL"].tolist(), occurrences["Occurrence"].tolist()):
+                if bl in groupes:
+                    groupes[bl].append(occurrence)
+            contexte_bl["occurrences"] = [", ".join(occ) for occ in groupes.values()]
+            bloc_doublons = self.moteur.evaluer(contexte_bl, "bl")
+
+            rapports = [
+                bloc.sort_values(["_pos", "_ordre"], kind="stable")[["Type", "Message"]]
+                for bloc in (bloc_capacite, bloc_doublons, bloc_coherence)
+            ]
+            rapports.append(pd.DataFrame([{'Type': '📊 RÉSUMÉ', 'Message': self._resume_validation(df)}]))
+            return pd.concat(rapports, ignore_index=True).astype(str)
+
+        except Exception as e:
+            return pd.DataFrame([{
+                'Type': '❌ ERREUR SYSTÈME',
+                'Message': f"Erreur lors de la validation : {str(e)}"
+            }])
+
+    def _analyser_lignes(self, df):
+        """
+        Contrôles ligne par ligne (vectorisés) d'un DataFrame à index 0..n-1.
+        Retourne (bloc_capacite, bloc_coherence, occurrences) : les deux blocs de messages
+        avec leur clé de tri (_pos, _ordre) et les occurrences des BLs réels (_pos, BL, Occurrence).
+        """
+        texte = lambda serie: serie.astype(object).map(str)  # même rendu que str() / f-string ligne à ligne
+        bls_bruts = texte(df["BL inclus"]) if "BL inclus" in df.columns else pd.Series("", index=df.index)
+        jetons = bls_bruts.str.split(';').explode()
+        contexte = contexte_vehicules(df, jetons)
+
+        # Règles "vehicule" : capacités, taux d'occupation et cohérence, évaluées en un seul lot
+        messages = self.moteur.evaluer(contexte, "vehicule", blocs=["capacite", "coherence"])
+        bloc_capacite = messages[messages["Bloc"] == "capacite"]
+        bloc_coherence = messages[messages["Bloc"] == "coherence"]
+
+        # Occurrences des BLs réels (hors objets manuels)
+        reels = jetons.str.strip().ne('') & jetons.ne('nan') & ~jetons.str.startswith('OBJ-')
+        occurrences = pd.DataFrame({
+            "_pos": jetons[reels].index.to_numpy(dtype=int),
+            "BL": jetons[reels].str.strip(),
+            "Occurrence": (contexte["vehicule"] + " (Zone " + contexte["zone"] + ")").reindex(jetons[reels].index),
+        })
+        return bloc_capacite, bloc_coherence, occurrences
+
+    # -------------------------------------------------
+    # Validation incrémentale
+    # -------------------------------------------------
+    @staticmethod
+    def _cles(df):
+        """Clé (Zone, Véhicule N°) de chaque ligne, au format texte du rapport."""
+        colonne = lambda nom, defaut: df[nom] if nom in df.columns else pd.Series(defaut, index=df.index)
+        zone = colonne("Zone", "Inconnue").astype(object).map(str)
+        vehicule = colonne("Véhicule N°", "Inconnu").astype(object).map(str)
+        return list(zip(zone.tolist(), vehicule.tolist()))
+
+    def marquer_modifies(self, vehicules):
+        """Ajoute des véhicules (Zone, Véhicule N°) à l'ensemble à revalider."""
+        self._vehicules_modifies.update((str(zone), str(vehicule)) for zone, vehicule in vehicules)
+
+    def mettre_a_jour(self, df_voyages, vehicules_modifies=None):
+        """
+        Remplace le plan validé après une modification.
+        Si `vehicules_modifies` n'est pas fourni, les véhicules modifiés sont détectés
+        par empreinte de ligne (véhicules ajoutés / supprimés détectés dans tous les cas).
+        """
+        if vehicules_modifies is not None:
+            # Seuls ces véhicules ont changé : le plan est gardé tel quel, sans copie ni empreintes
+            self.df_voyages = df_voyages
+            self.marquer_modifies(vehicules_modifies)
+            return
+        self.df_voyages = df_voyages.copy(deep=False)
+        if self._resultats_vehicules is not None:
+            df = self.df_voyages.reset_index(drop=True)
+            empreintes = pd.util.hash_pandas_object(df, index=False).tolist()
+            self._vehicules_modifies.update(
+                cle for cle, empreinte in zip(self._cles(df), empreintes)
+                if self._empreintes.get(cle) != empreinte
+            )
+
+    def valider_incremental(self, df_voyages=None, vehicules_modifies=None):
+        """
+        Même rapport que validate_voyages, en ne revalidant que les véhicules modifiés
+        depuis le dernier appel (plus l'index global des BLs pour les doublons).
+        Avec `vehicules_modifies`, les clés des autres véhicules et le rapport déjà assemblé
+        sont réutilisés : seules les lignes de ces véhicules sont relues.
+        """
+        if df_voyages is not None:
+            self.mettre_a_jour(df_voyages, vehicules_modifies)
+        try:
+            df = self.df_voyages.reset_index(drop=True)
+            cles = self._cles_inchangees(df) if vehicules_modifies is not None else None
+            rapport_a_assembler = cles is None
+            if cles is None:
+                cles = self._cles(df)
+                if len(set(cles)) != len(cles):
+                    # Clé (Zone, Véhicule N°) ambiguë : validation complète
+                    self._reinitialiser()
+                    return self.validate_voyages()
+
+                if self._resultats_vehicules is None:
+                    self._resultats_vehicules, self._bls_vehicules, self._index_bls, self._empreintes = {}, {}, {}, {}
+                    self._bls_doublons, self._messages_doublons = set(), {}
+                if cles != self._ordre_cles:
+                    # Ordre des véhicules changé : l'ordre des occurrences des doublons aussi
+                    self._messages_doublons = {}
+                    self._ordre_cles = cles
+                self._positions = {cle: pos for pos, cle in enumerate(cles)}
+
+                # Véhicules supprimés du plan
+                for cle in [c for c in self._resultats_vehicules if c not in self._positions]:
+                    self._oublier_vehicule(cle)
+            positions = self._positions
+
+            # Véhicules à revalider : modifiés ou jamais validés
+            nouveaux = set(positions) - set(self._resultats_vehicules) if rapport_a_assembler else set()
+            a_valider = sorted(positions[cle] for cle in nouveaux | self._vehicules_modifies if cle in positions)
+            self._vehicules_modifies.clear()
+            if a_valider:
+                self._revalider(df.iloc[a_valider].reset_index(drop=True), [cles[pos] for pos in a_valider])
+
+            # Rapport : assemblé une fois, puis seuls les messages des véhicules revalidés sont remplacés
+            if rapport_a_assembler:
+                self._assembler_rapport(cles)
+            else:
+                for pos in a_valider:
+                    self._remplacer_messages(pos, cles[pos])
+
+            a_construire = [bl for bl in self._bls_doublons if bl not in self._messages_doublons]
+            if a_construire:
+                lignes_bl = []
+                for bl in a_construire:
+                    vehicules = self._index_bls[bl]
+                    occurrences = sorted(vehicules, key=positions.get)
+                    lignes_bl.append({
+                        "bl": bl,
+                        "nb_occurrences": sum(vehicules.values()),
+                        "occurrences": ", ".join(f"{cle[1]} (Zone {cle[0]})" for cle in occurrences for _ in range(vehicules[cle])),
+                        "premiere": (positions[occurrences[0]], self._bls_vehicules[occurrences[0]].index(bl)),
+                    })
+                messages_bl = self.moteur.evaluer(pd.DataFrame(lignes_bl), "bl")
+                self._messages_doublons.update(dict.fromkeys(a_construire))
+                for pos, type_msg, message in zip(messages_bl["_pos"].tolist(), messages_bl["Type"].tolist(), messages_bl["Message"].tolist()):
+                    self._messages_doublons[a_construire[pos]] = (lignes_bl[pos]["premiere"], (type_msg, message))
+            doublons = [self._messages_doublons[bl] for bl in self._bls_doublons if self._messages_doublons[bl] is not None]
+            doublons = [message for _, message in sorted(doublons, key=lambda d: d[0])]
+
+            lignes = self._rapport_capacite + doublons + self._rapport_coherence + [('📊 RÉSUMÉ', self._resume_validation(df))]
+            return pd.DataFrame(lignes, columns=["Type", "Message"]).astype(str)
+
+        except Exception as e:
+            self._reinitialiser()
+            return pd.DataFrame([{
+                'Type': '❌ ERREUR SYSTÈME',
+                'Message': f"Erreur lors de la validation : {str(e)}"
+            }])
+
+    def _reinitialiser(self):
+        """Oublie les résultats par véhicule : la prochaine validation incrémentale repart de zéro."""
+        self._resultats_vehicules = None
+        self._nb_capacite = self._nb_coherence = None
+        self._vehicules_modifies.clear()
+
+    def _cles_inchangees(self, df):
+        """
+        Clés du dernier rapport si le plan a la même taille et que chaque véhicule modifié
+        est toujours à sa position ; None sinon (clés recalculées sur tout le plan).
+        """
+        if self._resultats_vehicules is None or self._nb_capacite is None or len(df) != len(self._ordre_cles):
+            return None
+        modifies = [cle for cle in self._vehicules_modifies if cle in self._positions]
+        if len(modifies) != len(self._vehicules_modifies):
+            return None
+        lignes = [self._positions[cle] for cle in modifies]
+        if self._cles(df.iloc[lignes]) != modifies:
+            return None
+        return self._ordre_cles
+
+    def _assembler_rapport(self, cles):
+        """Messages capacité / cohérence de tous les véhicules, dans l'ordre du plan."""
+        self._rapport_capacite, self._rapport_coherence = [], []
+        self._nb_capacite = np.zeros(len(cles), dtype=int)
+        self._nb_coherence = np.zeros(len(cles), dtype=int)
+        for pos, cle in enumerate(cles):
+            messages_capacite, messages_coherence = self._resultats_vehicules[cle]
+            self._rapport_capacite.extend(messages_capacite)
+            self._rapport_coherence.extend(messages_coherence)
+            self._nb_capacite[pos] = len(messages_capacite)
+            self._nb_coherence[pos] = len(messages_coherence)
+
+    def _remplacer_messages(self, pos, cle):
+        """Remplace dans le rapport assemblé les messages du véhicule à la position donnée."""
+        for rapport, nombres, messages in zip((self._rapport_capacite, self._rapport_coherence),
+                                              (self._nb_capacite, self._nb_coherence),
+                                              self._resultats_vehicules[cle]):
+            debut = int(nombres[:pos].sum())
+            rapport[debut:debut + nombres[pos]] = messages
+            nombres[pos] = len(messages)
+
+    def _oublier_vehicule(self, cle):
+        """Retire un véhicule des résultats et de l'index global des BLs."""
+        self._resultats_vehicules.pop(cle, None)
+        self._empreintes.pop(cle, None)
+        for bl in set(self._bls_vehicules.pop(cle, [])):
+            self._messages_doublons.pop(bl, None)
+            vehicules = self._index_bls.get(bl, {})
+            vehicules.pop(cle, None)
+            if not vehicules:
+                self._index_bls.pop(bl, None)
+            if sum(vehicules.values()) < 2:
+                self._bls_doublons.discard(bl)
+
+    def _revalider(self, df_modifies, cles):
+        """Recalcule les messages et les BLs des seuls véhicules modifiés."""
+        bloc_capacite, bloc_coherence, occurrences = self._analyser_lignes(df_modifies)
+        bloc_capacite = bloc_capacite.sort_values(["_pos", "_ordre"], kind="stable")
+        bloc_coherence = bloc_coherence.sort_values(["_pos", "_ordre"], kind="stable")
+        empreintes = pd.util.hash_pandas_object(df_modifies, index=False).tolist()
+
+        def par_ligne(bloc):
+            messages = {}
+            for pos, type_msg, message in zip(bloc["_pos"].tolist(), bloc["Type"].tolist(), bloc["Message"].tolist()):
+                messages.setdefault(pos, []).append((type_msg, message))
+            return messages
+
+        capacite, coherence = par_ligne(bloc_capacite), par_ligne(bloc_coherence)
+        bls = {}
+        for pos, bl in zip(occurrences["_pos"].tolist(), occurrences["BL"].tolist()):
+            bls.setdefault(pos, []).append(bl)
+
+        for pos, cle in enumerate(cles):
+            self._oublier_vehicule(cle)
+            self._resultats_vehicules[cle] = (capacite.get(pos, []), coherence.get(pos, []))
+            self._bls_vehicules[cle] = bls.get(pos, [])
+            self._empreintes[cle] = empreintes[pos]
+            for bl in self._bls_vehicules[cle]:
+                vehicules = self._index_bls.setdefault(bl, {})
+                vehicules[cle] = vehicules.get(cle, 0) + 1
+                self._messages_doublons.pop(bl, None)
+                if sum(vehicules.values()) >= 2:
+                    self._bls_doublons.add(bl)
+
+    def _resume_validation(self, df):
+        """Ligne de résumé global du rapport de validation."""
+        nb_estafettes = len(df[df["Code Véhicule"] == "ESTAFETTE"])
+        nb_camions = len(df[df["Code Véhicule"] == CAMION_CODE])
+        
+        # Compter les types de camions
+        camions_5t = 0
+        camions_10t = 0
+        if nb_camions > 0 and "Type_Camion" in df.columns:
+            camions_5t = len(df[(df["Code Véhicule"] == CAMION_CODE) & (df["Type_Camion"] == "5 tonnes")])
+            camions_10t = len(df[(df["Code Véhicule"] == CAMION_CODE) & (df["Type_Camion"] == "10 tonnes")])
+        
+        poids_total = df["Poids total chargé"].sum()
+        volume_total = df["Volume total chargé"].sum()
+        taux_moyen = df["Taux d'occupation (%)"].mean()
+        
+        # Résumé détaillé
+        message_resume = f"Total : {nb_estafettes} estafettes"
+        if nb_camions > 0:
+            message_resume += f", {nb_camions} camions ({camions_5t}×5t, {camions_10t}×10t)"
+        message_resume += f" | Poids total : {poids_total:.1f}kg | Volume total : {volume_total:.3f}m³ | Taux moyen : {taux_moyen:.1f}%"
+        return message_resume
+
+    def generer_rapport_excel(self, file_path):
+        """Génère un rapport Excel détaillé des voyages validés."""
+        try:
+            with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
+                # Feuille principale des voyages
+                self.df_voyages.to_excel(writer, sheet_name='Voyages Optimisés', index=False)
+                
+                # Feuille de validation
+                rapport_validation = self.validate_voyages()
+                rapport_validation.to_excel(writer, sheet_name='Rapport Validation', index=False)
+                
+                # Feuille de statistiques par zone
+                stats_zone = self.df_voyages.groupby('Zone').agg({
+                    'Véhicule N°': 'count',
+                    'Poids total chargé': 'sum',
+                    'Volume total chargé': 'sum',
+                    'Taux d\'occupation (%)': 'mean'
+                }).rename(columns={
+                    'Véhicule N°': 'Nombre Véhicules',
+                    'Poids total chargé': 'Poids Total (kg)',
+                    'Volume total chargé': 'Volume Total (m³)',
+                    'Taux d\'occupation (%)': 'Taux Occupation Moyen (%)'
+                }).round(2)
+                
+                stats_zone.to_excel(writer, sheet_name='Stats par Zone')
+                
+                # Feuille de détails par véhicule
+                details_vehicules = self.df_voyages[[
+                    'Zone', 'Véhicule N°', 'Code Véhicule', 'Type_Camion', 
+                    'Poids total chargé', 'Volume total chargé', 'Taux d\'occupation (%)', 
+                    'Client(s) inclus', 'Représentant(s) inclus', 'BL inclus'
+                ]].copy()
+                
+                # Déterminer les capacités max selon le type de véhicule
+                def get_capacites(row):
+                    if row['Code Véhicule'] == CAMION_CODE:
+                        truck_type = row.get('Type_Camion', '5 tonnes')
+                        poids_max = get_capacite_poids_camion(truck_type)
+                        volume_max = get_capacite_volume_camion(truck_type)
+                        return pd.Series([poids_max, volume_max, f"Camion {truck_type}"])
+                    else:
+                        return pd.Series([CAPACITE_POIDS_ESTAFETTE, CAPACITE_VOLUME_ESTAFETTE, "Estafette"])
+                
+                # Appliquer la fonction pour obtenir les capacités
+                capacites = details_vehicules.apply(get_capacites, axis=1)
+                details_vehicules['Capacité Max Poids'] = capacites[0]
+                details_vehicules['Capacité Max Volume'] = capacites[1]
+                details_vehicules['Type Véhicule'] = capacites[2]
+                
+                details_vehicules['Marge Poids'] = details_vehicules['Capacité Max Poids'] - details_vehicules['Poids total chargé']
+                details_vehicules['Marge Volume'] = details_vehicules['Capacité Max Volume'] - details_vehicules['Volume total chargé']
+                details_vehicules['Taux Utilisation Poids (%)'] = (details_vehicules['Poids total chargé'] / details_vehicules['Capacité Max Poids']) * 100
+                details_vehicules['Taux Utilisation Volume (%)'] = (details_vehicules['Volume total chargé'] / details_vehicules['Capacité Max Volume']) * 100
+                
+                # Arrondir les valeurs
+                details_vehicules['Taux Utilisation Poids (%)'] = details_vehicules['Taux Utilisation Poids (%)'].round(1)
+                details_vehicules['Taux Utilisation Volume (%)'] = details_vehicules['Taux Utilisation Volume (%)'].round(1)
+                details_vehicules['Marge Poids'] = details_vehicules['Marge Poids'].round(1)
+                details_vehicules['Marge Volume'] = details_vehicules['Marge Volume'].round(3)
+                
+                # Réorganiser les colonnes
+                colonnes_ordre = [
+                    'Zone', 'Véhicule N°', 'Type Véhicule', 'Type_Camion', 
+                    'Poids total chargé', 'Capacité Max Poids', 'Marge Poids', 'Taux Utilisation Poids (%)',
+                    'Volume total chargé', 'Capacité Max Volume', 'Marge Volume', 'Taux Utilisation Volume (%)',
+                    'Taux d\'occupation (%)', 'Client(s) inclus', 'Représentant(s) inclus', 'BL inclus'
+                ]
+                
+                # Filtrer les colonnes qui existent
+                colonnes_existantes = [col for col in colonnes_ordre if col in details_vehicules.columns]
+                details_vehicules = details_vehicules[colonnes_existantes]
+                
+                details_vehicules.to_excel(writer, sheet_name='Détails Véhicules', index=False)
+            
+            return True, f"✅ Rapport Excel généré avec succès : {file_path}"
+            
+        except Exception as e:
+            return False, f"❌ Erreur lors de la génération du rapport Excel : {str(e)}"
+
+    def get_voyages_valides(self):
+        """Retourne les voyages après validation."""
+        return self.df_voyages
+# =====================================================
+# CLASSE DE GESTION DES RAPPORTS AVANCÉS
+# =====================================================
+class AdvancedReportGenerator:
+    def __init__(self, df_voyages, df_livraisons_original):
+        self.df_voyages = df_voyages.copy(deep=False)
+        self.df_livraisons_original = df_livraisons_original.copy(deep=False)
+        self._indicateurs = None
+    
+    # Tranches de taux d'occupation (%) des tableaux de répartition
+    TRANCHES_TAUX = [-np.inf, 50, 60, 80, 95, 100, np.inf]
+    LIBELLES_TRANCHES = ["≤ 50 %", "50-60 %", "60-80 %", "80-95 %", "95-100 %", "> 100 %"]
+
+    def indicateurs_analytiques(self):
+        """
+        Indicateurs du rapport analytique calculés en un seul groupby (Zone, Type véhicule), tranches
+        de taux incluses ; les vues par type et par zone sont consolidées depuis cette table.
+        Retourne un dict de DataFrames : par_zone_type, par_type, par_zone, par_tranche, vehicules_signales.
+        Le rapport texte et les graphiques se rendent depuis ces tables (calculées une fois).
+        """
+        if self._indicateurs is not None:
+            return self._indicateurs
+
+        df = self.df_voyages.reset_index(drop=True)
+        code = df["Code Véhicule"]
+        type_vehicule = np.select([code.eq("ESTAFETTE").to_numpy(), code.eq(CAMION_CODE).to_numpy()],
+                                  ["Estafette", "Camion"], "Autre")
+        taux = pd.to_numeric(df["Taux d'occupation (%)"], errors="coerce")
+
+        # Seuils sous-utilisation / très chargé : règles "analyse" du moteur de règles
+        contexte = contexte_vehicules(df)
+        masques = MOTEUR_REGLES.masques(contexte, "vehicule", blocs=["analyse"])
+        tranches = pd.get_dummies(pd.cut(taux, self.TRANCHES_TAUX, labels=self.LIBELLES_TRANCHES)).astype(int)
+
+        base = pd.DataFrame({
+            "Zone": df["Zone"].to_numpy(),
+            "Type véhicule": type_vehicule,
+            "Poids (kg)": df["Poids total chargé"].to_numpy(),
+            "Volume (m³)": df["Volume total chargé"].to_numpy(),
+            "_somme_taux": taux.to_numpy(),
+            "_nb_taux": taux.notna().to_numpy(dtype=int),
+            "Sous-utilisés": masques["analyse_sous_utilisation"].to_numpy(dtype=int),
+            "Très chargés": masques["analyse_tres_charge"].to_numpy(dtype=int),
+        })
+        base = pd.concat([base, tranches.reset_index(drop=True)], axis=1)
+        base.insert(2, "Véhicules", 1)
+
+        par_zone_type = base.groupby(["Zone", "Type véhicule"], sort=False, dropna=False).sum(min_count=0)
+
+        def consolider(table):
+            table = table.copy()
+            table["Taux moyen (%)"] = table["_somme_taux"] / table["_nb_taux"].where(table["_nb_taux"] > 0)
+            return table.drop(columns=["_somme_taux", "_nb_taux"] + self.LIBELLES_TRANCHES)
+
+        self._indicateurs = {
+            "par_zone_type": consolider(par_zone_type),
+            "par_type": consolider(par_zone_type.groupby(level="Type véhicule", sort=False).sum()),
+            "par_zone": consolider(par_zone_type.groupby(level="Zone", sort=False, dropna=False).sum()),
+            "par_tranche": par_zone_type[self.LIBELLES_TRANCHES].groupby(level="Type véhicule", sort=False).sum().T
+                                                                .rename_axis("Tranche de taux"),
+            "vehicules_signales": MOTEUR_REGLES.evaluer(contexte, "vehicule", blocs=["analyse"])[["Regle", "Message"]],
+        }
+        return self._indicateurs
 
-    def get_voyages_valides(self):
-        """Retourne les voyages après validation."""
-        return self.df_voyages
-# =====================================================
-# CLASSE DE GESTION DES RAPPORTS AVANCÉS
-# =====================================================
-class AdvancedReportGenerator:
-    def __init__(self, df_voyages, df_livraisons_original):
-        self.df_voyages = df_voyages.copy()
-        self.df_livraisons_original = df_livraisons_original.copy()
-    
     def generer_rapport_analytique(self):
-        """Génère un rapport analytique complet."""
+        """Génère un rapport analytique complet (rendu texte de indicateurs_analytiques)."""
         try:
+            indicateurs = self.indicateurs_analytiques()
+            par_type = indicateurs["par_type"]
+            valeur = lambda type_vehicule, colonne, defaut=0: (
+                par_type.at[type_vehicule, colonne] if type_vehicule in par_type.index else defaut)
+            nb_estafettes = int(valeur("Estafette", "Véhicules"))
+            nb_camions = int(valeur("Camion", "Véhicules"))
             analyses = []
             
             # 1. Analyse par type de véhicule
-            estafettes = self.df_voyages[self.df_voyages["Code Véhicule"] == "ESTAFETTE"]
-            camions = self.df_voyages[self.df_voyages["Code Véhicule"] == CAMION_CODE]
-            
             analyses.append("📊 ANALYSE PAR TYPE DE VÉHICULE")
-            analyses.append(f"• Nombre total d'estafettes : {len(estafettes)}")
-            analyses.append(f"• Nombre total de camions : {len(camions)}")
-            analyses.append(f"• Poids total transporté par estafettes : {estafettes['Poids total chargé'].sum():.1f} kg")
-            analyses.append(f"• Volume total transporté par estafettes : {estafettes['Volume total chargé'].sum():.3f} m³")
-            analyses.append(f"• Poids total transporté par camions : {camions['Poids total chargé'].sum():.1f} kg")
-            analyses.append(f"• Volume total transporté par camions : {camions['Volume total chargé'].sum():.3f} m³")
+            analyses.append(f"• Nombre total d'estafettes : {nb_estafettes}")
+            analyses.append(f"• Nombre total de camions : {nb_camions}")
+            analyses.append(f"• Poids total transporté par estafettes : {valeur('Estafette', 'Poids (kg)'):.1f} kg")
+            analyses.append(f"• Volume total transporté par estafettes : {valeur('Estafette', 'Volume (m³)'):.3f} m³")
+            analyses.append(f"• Poids total transporté par camions : {valeur('Camion', 'Poids (kg)'):.1f} kg")
+            analyses.append(f"• Volume total transporté par camions : {valeur('Camion', 'Volume (m³)'):.3f} m³")
             
             # 2. Analyse par zone
             analyses.append("\n🌍 ANALYSE PAR ZONE GÉOGRAPHIQUE")
-            for zone in self.df_voyages["Zone"].unique():
-                df_zone = self.df_voyages[self.df_voyages["Zone"] == zone]
-                analyses.append(f"• {zone} : {len(df_zone)} véhicules, {df_zone['Poids total chargé'].sum():.1f} kg, {df_zone['Volume total chargé'].sum():.3f} m³")
+            par_zone = indicateurs["par_zone"]
+            for zone, nombre, poids, volume in zip(par_zone.index, par_zone["Véhicules"], par_zone["Poids (kg)"],
+                                                   par_zone["Volume (m³)"]):
+                analyses.append(f"• {zone} : {nombre} véhicules, {poids:.1f} kg, {volume:.3f} m³")
             
             # 3. Analyse d'efficacité
             analyses.append("\n⚡ ANALYSE D'EFFICACITÉ")
-            taux_moyen_estafettes = estafettes["Taux d'occupation (%)"].mean()
-            taux_moyen_camions = camions["Taux d'occupation (%)"].mean() if len(camions) > 0 else 0
+            taux_moyen_estafettes = valeur("Estafette", "Taux moyen (%)", np.nan)
+            taux_moyen_camions = valeur("Camion", "Taux moyen (%)", np.nan)
             
             analyses.append(f"• Taux d'occupation moyen des estafettes : {taux_moyen_estafettes:.1f}%")
-            analyses.append(f"• Taux d'occupation moyen des camions : {taux_moyen_camions:.1f}%")
-            
-            # Véhicules sous-utilisés (< 60%)
-            vehicules_sous_utilises = self.df_voyages[self.df_voyages["Taux d'occupation (%)"] < 60]
-            if len(vehicules_sous_utilises) > 0:
-                analyses.append(f"• Véhicules sous-utilisés (< 60%) : {len(vehicules_sous_utilises)}")
-                for idx, row in vehicules_sous_utilises.iterrows():
-                    analyses.append(f"  - {row['Véhicule N°']} (Zone {row['Zone']}) : {row['Taux d\'occupation (%)']:.1f}%")
-            
-            # Véhicules sur-utilisés (> 95%)
-            vehicules_sur_utilises = self.df_voyages[self.df_voyages["Taux d'occupation (%)"] > 95]
-            if len(vehicules_sur_utilises) > 0:
-                analyses.append(f"• Véhicules très chargés (> 95%) : {len(vehicules_sur_utilises)}")
-                for idx, row in vehicules_sur_utilises.iterrows():
-                    analyses.append(f"  - {row['Véhicule N°']} (Zone {row['Zone']}) : {row['Taux d\'occupation (%)']:.1f}%")
+            analyses.append(f"• Taux d'occupation moyen des camions : {taux_moyen_camions if nb_camions > 0 else 0:.1f}%")
+            
+            # Véhicules sous-utilisés / très chargés (seuils des règles "analyse")
+            signales = indicateurs["vehicules_signales"]
+            nb_sous_utilises = int(par_type["Sous-utilisés"].sum())
+            nb_sur_utilises = int(par_type["Très chargés"].sum())
+            for nom, nombre in (("analyse_sous_utilisation", nb_sous_utilises), ("analyse_tres_charge", nb_sur_utilises)):
+                if nombre > 0:
+                    analyses.append(f"{MOTEUR_REGLES.titre(nom)} : {nombre}")
+                    analyses.extend(signales.loc[signales["Regle"] == nom, "Message"].tolist())
             
             # 4. Analyse économique
             analyses.append("\n💰 ANALYSE ÉCONOMIQUE")
-            analyses.append(f"• Coût estimé des estafettes : {len(estafettes)} x [coût unitaire]")
-            analyses.append(f"• Coût estimé des camions : {len(camions)} x [coût unitaire camion]")
+            analyses.append(f"• Coût estimé des estafettes : {nb_estafettes} x [coût unitaire]")
+            analyses.append(f"• Coût estimé des camions : {nb_camions} x [coût unitaire camion]")
             
             # 5. Recommandations
             analyses.append("\n🎯 RECOMMANDATIONS")
-            if len(vehicules_sous_utilises) > len(vehicules_sur_utilises):
+            if nb_sous_utilises > nb_sur_utilises:
                 analyses.append("• Optimisation possible : regrouper certains voyages sous-utilisés")
             
-            if camions["Taux d'occupation (%)"].mean() < 70 and len(camions) > 0:
-                analyses.append("• Attention : les camions sont sous-utilisés, envisager plus d'estafettes")
+            contexte_plan = pd.DataFrame([{"taux_moyen_camions": taux_moyen_camions}])
+            analyses.extend(MOTEUR_REGLES.evaluer(contexte_plan, "plan", blocs=["analyse"])["Message"].tolist())
             
-            if len(vehicules_sur_utilises) > 0:
+            if nb_sur_utilises > 0:
                 analyses.append("• Vigilance : certains véhicules sont à pleine capacité")
             
             return "\n".join(analyses)
@@ -1237,34 +3494,687 @@ class AdvancedReportGenerator:
             return f"❌ Erreur lors de la génération du rapport client : {str(e)}"
 
 # =====================================================
-# FONCTIONS UTILITAIRES GLOBALES
+# FONCTIONS UTILITAIRES GLOBALES
+# =====================================================
+def calculer_couts_estimation(df_voyages, cout_estafette=150, cout_camion=800):
+    """Estime les coûts de transport basés sur les véhicules utilisés."""
+    try:
+        nb_estafettes = len(df_voyages[df_voyages["Code Véhicule"] == "ESTAFETTE"])
+        nb_camions = len(df_voyages[df_voyages["Code Véhicule"] == CAMION_CODE])
+        
+        cout_total = (nb_estafettes * cout_estafette) + (nb_camions * cout_camion)
+        
+        return {
+            'estafettes': nb_estafettes,
+            'camions': nb_camions,
+            'cout_estafette_unitaire': cout_estafette,
+            'cout_camion_unitaire': cout_camion,
+            'cout_total': cout_total,
+            'cout_estimation': f"💰 Estimation des coûts : {nb_estafettes} estafettes × {cout_estafette} TND + {nb_camions} camions × {cout_camion} TND = {cout_total} TND"
+        }
+    except Exception as e:
+        return {'erreur': f"❌ Erreur dans le calcul des coûts : {str(e)}"}
+
+def filtrer_voyages(df_voyages, zones=None, recherche="", colonnes_recherche=("Véhicule N°", "Véhicule attribué")):
+    """
+    Filtre les voyages par zone(s) et par texte recherché (sous-chaîne, insensible à la casse)
+    dans les colonnes véhicule présentes. L'index d'origine est conservé pour rattacher
+    les modifications faites sur une page aux voyages du plan.
+    """
+    masque = pd.Series(True, index=df_voyages.index)
+    if zones:
+        masque &= df_voyages["Zone"].isin(zones)
+    recherche = str(recherche or "").strip()
+    if recherche:
+        trouve = pd.Series(False, index=df_voyages.index)
+        for col in colonnes_recherche:
+            if col in df_voyages.columns:
+                trouve |= df_voyages[col].astype(str).str.contains(recherche, case=False, regex=False)
+        masque &= trouve
+    return df_voyages[masque]
+
+# =====================================================
+# HISTORIQUE DES PLANNINGS FINALISÉS (SQLITE)
+# =====================================================
+SCHEMA_HISTORIQUE = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    date_plan TEXT NOT NULL UNIQUE,
+    enregistre TEXT NOT NULL,
+    libelle TEXT,
+    nb_voyages INTEGER, nb_estafettes INTEGER, nb_camions INTEGER,
+    poids REAL, volume REAL, taux_moyen REAL, cout_total REAL
+);
+CREATE TABLE IF NOT EXISTS voyages (
+    plan_id INTEGER NOT NULL REFERENCES plans(id) ON DELETE CASCADE,
+    date_plan TEXT NOT NULL,
+    voyage TEXT NOT NULL,
+    zone TEXT,
+    code_vehicule TEXT,
+    vehicule TEXT,
+    chauffeur TEXT,
+    code_voyage TEXT,
+    nb_bls INTEGER,
+    poids REAL, volume REAL, taux_occupation REAL, cout REAL
+);
+CREATE TABLE IF NOT EXISTS affectations_bl (
+    plan_id INTEGER NOT NULL REFERENCES plans(id) ON DELETE CASCADE,
+    date_plan TEXT NOT NULL,
+    bl TEXT NOT NULL,
+    voyage TEXT NOT NULL,
+    zone TEXT,
+    client TEXT,
+    poids REAL, volume REAL
+);
+CREATE INDEX IF NOT EXISTS idx_voyages_date ON voyages(date_plan);
+CREATE INDEX IF NOT EXISTS idx_voyages_zone ON voyages(zone, date_plan);
+CREATE INDEX IF NOT EXISTS idx_voyages_vehicule ON voyages(vehicule, date_plan);
+CREATE INDEX IF NOT EXISTS idx_voyages_plan ON voyages(plan_id, voyage);
+CREATE INDEX IF NOT EXISTS idx_bl_date ON affectations_bl(date_plan);
+CREATE INDEX IF NOT EXISTS idx_bl_client ON affectations_bl(client, date_plan);
+CREATE INDEX IF NOT EXISTS idx_bl_zone ON affectations_bl(zone, date_plan);
+CREATE INDEX IF NOT EXISTS idx_bl_numero ON affectations_bl(bl);
+CREATE INDEX IF NOT EXISTS idx_bl_plan ON affectations_bl(plan_id);
+
+-- Synthèses journalières (une ligne par jour et zone / client / véhicule), recalculées à chaque enregistrement
+CREATE TABLE IF NOT EXISTS synthese_jour (
+    date_plan TEXT NOT NULL, zone TEXT NOT NULL, code_vehicule TEXT NOT NULL,
+    nb_voyages INTEGER, nb_bls INTEGER, poids REAL, volume REAL, taux_somme REAL, cout REAL,
+    PRIMARY KEY (date_plan, zone, code_vehicule)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS synthese_client_jour (
+    date_plan TEXT NOT NULL, client TEXT NOT NULL,
+    nb_bls INTEGER, nb_voyages INTEGER, nb_camions_loues INTEGER, poids REAL, volume REAL,
+    PRIMARY KEY (date_plan, client)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_synthese_client ON synthese_client_jour(client, date_plan);
+CREATE TABLE IF NOT EXISTS synthese_vehicule_jour (
+    date_plan TEXT NOT NULL, vehicule TEXT NOT NULL, code_vehicule TEXT,
+    nb_voyages INTEGER, poids REAL, volume REAL, taux_somme REAL, cout REAL,
+    PRIMARY KEY (date_plan, vehicule)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_synthese_vehicule ON synthese_vehicule_jour(vehicule, date_plan);
+"""
+
+ROLLUPS_HISTORIQUE = [
+    """INSERT INTO synthese_jour
+       SELECT date_plan, COALESCE(zone, ''), COALESCE(code_vehicule, ''), COUNT(*), SUM(nb_bls),
+              SUM(poids), SUM(volume), SUM(taux_occupation), SUM(cout)
+       FROM voyages WHERE date_plan = :date GROUP BY 1, 2, 3""",
+    """INSERT INTO synthese_client_jour
+       SELECT a.date_plan, a.client, COUNT(DISTINCT a.bl), COUNT(DISTINCT a.voyage),
+              COUNT(DISTINCT CASE WHEN v.code_vehicule = :camion THEN a.voyage END), SUM(a.poids), SUM(a.volume)
+       FROM affectations_bl a JOIN voyages v ON v.plan_id = a.plan_id AND v.voyage = a.voyage
+       WHERE a.date_plan = :date AND a.client IS NOT NULL GROUP BY 1, 2""",
+    """INSERT INTO synthese_vehicule_jour
+       SELECT date_plan, vehicule, MAX(code_vehicule), COUNT(*), SUM(poids), SUM(volume),
+              SUM(taux_occupation), SUM(cout)
+       FROM voyages WHERE date_plan = :date GROUP BY 1, 2""",
+]
+
+
+class PlanningHistoryStore:
+    """
+    Historique local des plannings finalisés (SQLite, bibliothèque standard) : un plan par date
+    (un nouvel enregistrement du même jour le remplace), voyages, affectation des BLs, coûts
+    (calculer_couts_estimation) et taux d'occupation. Les synthèses journalières par zone, client
+    et véhicule sont recalculées à l'enregistrement : les requêtes de tendance n'agrègent qu'elles.
+    """
+
+    def __init__(self, chemin=None):
+        import os
+        self.chemin = chemin or os.path.join(os.path.dirname(os.path.abspath(__file__)), "historique_planning.db")
+        self._schema_cree = False
+
+    def _connexion(self):
+        """Nouvelle connexion (une par opération : les sessions Streamlit tournent dans des threads différents)."""
+        import sqlite3
+        connexion = sqlite3.connect(self.chemin, timeout=10)
+        connexion.execute("PRAGMA foreign_keys = ON")
+        if not self._schema_cree:
+            connexion.executescript(SCHEMA_HISTORIQUE)
+            self._schema_cree = True
+        return connexion
+
+    def _requete(self, sql, parametres=()):
+        from contextlib import closing
+        with closing(self._connexion()) as connexion:
+            return pd.read_sql_query(sql, connexion, params=parametres)
+
+    @staticmethod
+    def _periode(debut=None, fin=None, colonne="date_plan"):
+        """Clause WHERE et paramètres d'une période (bornes incluses, dates ISO)."""
+        conditions, parametres = [], []
+        if debut is not None:
+            conditions.append(f"{colonne} >= ?")
+            parametres.append(pd.Timestamp(debut).strftime("%Y-%m-%d"))
+        if fin is not None:
+            conditions.append(f"{colonne} <= ?")
+            parametres.append(pd.Timestamp(fin).strftime("%Y-%m-%d"))
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", parametres
+
+    # -------------------------------------------------
+    # Enregistrement
+    # -------------------------------------------------
+    @staticmethod
+    def date_du_plan(df_voyages, dates_bl=None):
+        """Date de livraison la plus fréquente des BLs du plan (date du jour si inconnue)."""
+        if dates_bl is not None and len(dates_bl) and "BL inclus" in df_voyages.columns:
+            bls = df_voyages["BL inclus"].dropna().astype(str).str.split(r"[;\n]", regex=True).explode().str.strip()
+            dates = bls.map(dates_bl).dropna()
+            if len(dates):
+                return pd.Timestamp(dates.dt.normalize().mode().iloc[0])
+        return pd.Timestamp.now().normalize()
+
+    def _lignes_voyages(self, df, cout_estafette, cout_camion):
+        """Voyages du plan au format de la table voyages (coût unitaire selon le type de véhicule)."""
+        def colonne(nom, defaut=None):
+            return df[nom] if nom in df.columns else pd.Series(defaut, index=df.index)
+
+        code = colonne("Code Véhicule", "ESTAFETTE").fillna("ESTAFETTE").astype(str)
+        voyage = colonne("Véhicule N°", "").astype(str)
+        vehicule = colonne("Véhicule attribué").astype(object)
+        vehicule = vehicule.where(vehicule.notna() & vehicule.astype(str).str.strip().ne(""), voyage).astype(str)
+        bls = colonne("BL inclus", "").fillna("").astype(str)
+        return pd.DataFrame({
+            "voyage": voyage,
+            "zone": colonne("Zone").astype(object),
+            "code_vehicule": code,
+            "vehicule": vehicule,
+            "chauffeur": colonne("Chauffeur attribué").astype(object),
+            "code_voyage": colonne("Code voyage").astype(object),
+            "nb_bls": bls.str.split(r"[;\n]", regex=True).map(lambda l: sum(1 for b in l if b.strip())),
+            "poids": pd.to_numeric(colonne("Poids total chargé", 0.0), errors="coerce"),
+            "volume": pd.to_numeric(colonne("Volume total chargé", 0.0), errors="coerce"),
+            "taux_occupation": pd.to_numeric(colonne("Taux d'occupation (%)"), errors="coerce"),
+            "cout": np.where(code.eq(CAMION_CODE), float(cout_camion), float(cout_estafette)),
+        })
+
+    @staticmethod
+    def _lignes_bls(voyages, df_voyages, df_livraisons):
+        """Un BL par ligne avec son voyage, sa zone et (d'après les livraisons) son client, poids et volume."""
+        bls = df_voyages["BL inclus"].fillna("").astype(str) if "BL inclus" in df_voyages.columns \
+            else pd.Series("", index=df_voyages.index)
+        jetons = bls.reset_index(drop=True).str.split(r"[;\n]", regex=True).explode().str.strip()
+        jetons = jetons[jetons.notna() & jetons.ne("")]
+        lignes = pd.DataFrame({
+            "bl": jetons.to_numpy(),
+            "voyage": voyages["voyage"].to_numpy()[jetons.index],
+            "zone": voyages["zone"].to_numpy()[jetons.index],
+        }).drop_duplicates(["bl", "voyage"])
+        if df_livraisons is not None and "No livraison" in df_livraisons.columns:
+            par_bl = df_livraisons.assign(bl=df_livraisons["No livraison"].astype(str)).groupby("bl").agg(
+                client=("Client de l'estafette", "first") if "Client de l'estafette" in df_livraisons.columns
+                else ("bl", lambda x: None),
+                poids=("Poids total", "sum") if "Poids total" in df_livraisons.columns else ("bl", lambda x: np.nan),
+                volume=("Volume total", "sum") if "Volume total" in df_livraisons.columns else ("bl", lambda x: np.nan),
+            )
+            lignes = lignes.join(par_bl, on="bl")
+        else:
+            lignes = lignes.assign(client=None, poids=np.nan, volume=np.nan)
+        return lignes
+
+    def enregistrer_plan(self, df_voyages, date_plan=None, df_livraisons=None, cout_estafette=150, cout_camion=800,
+                         libelle=None):
+        """
+        Enregistre un planning finalisé pour date_plan (remplace celui déjà enregistré ce jour-là)
+        et recalcule les synthèses de ce jour. Retourne (succès, message, identifiant du plan).
+        """
+        from contextlib import closing
+        from datetime import datetime
+        try:
+            if df_voyages is None or df_voyages.empty:
+                return False, "⚠️ Aucun voyage à enregistrer dans l'historique.", None
+            couts = calculer_couts_estimation(df_voyages, cout_estafette, cout_camion)
+            if "erreur" in couts:
+                return False, couts["erreur"], None
+            date = pd.Timestamp(date_plan if date_plan is not None else pd.Timestamp.now()).strftime("%Y-%m-%d")
+            voyages = self._lignes_voyages(df_voyages, cout_estafette, cout_camion)
+            bls = self._lignes_bls(voyages, df_voyages, df_livraisons)
+
+            with closing(self._connexion()) as connexion, connexion:
+                connexion.execute("DELETE FROM plans WHERE date_plan = ?", (date,))
+                for table in ("synthese_jour", "synthese_client_jour", "synthese_vehicule_jour"):
+                    connexion.execute(f"DELETE FROM {table} WHERE date_plan = ?", (date,))
+                curseur = connexion.execute(
+                    "INSERT INTO plans (date_plan, enregistre, libelle, nb_voyages, nb_estafettes, nb_camions,"
+                    " poids, volume, taux_moyen, cout_total) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (date, datetime.now().isoformat(timespec="seconds"), libelle, len(voyages),
+                     int(couts["estafettes"]), int(couts["camions"]), float(voyages["poids"].sum()),
+                     float(voyages["volume"].sum()), float(voyages["taux_occupation"].mean())
+                     if voyages["taux_occupation"].notna().any() else None, float(couts["cout_total"])))
+                plan_id = curseur.lastrowid
+                connexion.executemany(
+                    "INSERT INTO voyages (plan_id, date_plan, voyage, zone, code_vehicule, vehicule, chauffeur,"
+                    " code_voyage, nb_bls, poids, volume, taux_occupation, cout)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    _lignes_sql(voyages.assign(plan_id=plan_id, date_plan=date)[
+                        ["plan_id", "date_plan", "voyage", "zone", "code_vehicule", "vehicule", "chauffeur",
+                         "code_voyage", "nb_bls", "poids", "volume", "taux_occupation", "cout"]]))
+                connexion.executemany(
+                    "INSERT INTO affectations_bl (plan_id, date_plan, bl, voyage, zone, client, poids, volume)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    _lignes_sql(bls.assign(plan_id=plan_id, date_plan=date)[
+                        ["plan_id", "date_plan", "bl", "voyage", "zone", "client", "poids", "volume"]]))
+                for rollup in ROLLUPS_HISTORIQUE:
+                    connexion.execute(rollup, {"date": date, "camion": CAMION_CODE})
+            return (True, f"✅ Planning du {pd.Timestamp(date):%d/%m/%Y} enregistré dans l'historique "
+                          f"({len(voyages)} voyages, {len(bls)} BLs, {couts['cout_total']} TND)", plan_id)
+        except Exception as e:
+            print(f"❌ Erreur lors de l'enregistrement dans l'historique: {e}")
+            return False, f"❌ Erreur lors de l'enregistrement dans l'historique : {str(e)}", None
+
+    def supprimer_plan(self, date_plan):
+        """Retire un jour de l'historique (plan, détail et synthèses)."""
+        from contextlib import closing
+        date = pd.Timestamp(date_plan).strftime("%Y-%m-%d")
+        with closing(self._connexion()) as connexion, connexion:
+            for table in ("plans", "synthese_jour", "synthese_client_jour", "synthese_vehicule_jour"):
+                connexion.execute(f"DELETE FROM {table} WHERE date_plan = ?", (date,))
+
+    # -------------------------------------------------
+    # Requêtes (synthèses journalières)
+    # -------------------------------------------------
+    def plans_enregistres(self):
+        """Plans de l'historique, du plus récent au plus ancien."""
+        df = self._requete(
+            "SELECT date_plan AS \"Date\", libelle AS \"Libellé\", enregistre AS \"Enregistré le\","
+            " nb_voyages AS \"Voyages\", nb_camions AS \"Camions loués\", poids AS \"Poids (kg)\","
+            " taux_moyen AS \"Taux moyen (%)\", cout_total AS \"Coût (TND)\" FROM plans ORDER BY date_plan DESC")
+        df["Date"] = pd.to_datetime(df["Date"])
+        return df
+
+    def indicateurs_journaliers(self, debut=None, fin=None, zones=None):
+        """Par jour : voyages, estafettes, camions loués, BLs, poids, volume, taux moyen, coût et coût par kg."""
+        clause, parametres = self._periode(debut, fin)
+        if zones:
+            clause += (" AND " if clause else " WHERE ") + f"zone IN ({', '.join('?' * len(zones))})"
+            parametres += list(zones)
+        df = self._requete(
+            "SELECT date_plan AS \"Date\", SUM(nb_voyages) AS \"Voyages\","
+            f" SUM(CASE WHEN code_vehicule = '{CAMION_CODE}' THEN 0 ELSE nb_voyages END) AS \"Estafettes\","
+            f" SUM(CASE WHEN code_vehicule = '{CAMION_CODE}' THEN nb_voyages ELSE 0 END) AS \"Camions loués\","
+            " SUM(nb_bls) AS \"BLs\", SUM(poids) AS \"Poids (kg)\", SUM(volume) AS \"Volume (m³)\","
+            " SUM(taux_somme) / SUM(nb_voyages) AS \"Taux moyen (%)\", SUM(cout) AS \"Coût (TND)\","
+            " SUM(cout) / NULLIF(SUM(poids), 0) AS \"Coût par kg (TND)\""
+            f" FROM synthese_jour{clause} GROUP BY date_plan ORDER BY date_plan", parametres)
+        df["Date"] = pd.to_datetime(df["Date"])
+        return df
+
+    def indicateurs_par_zone(self, debut=None, fin=None):
+        """Par zone sur la période : voyages, poids, taux moyen, coût et coût par kg."""
+        clause, parametres = self._periode(debut, fin)
+        return self._requete(
+            "SELECT zone AS \"Zone\", SUM(nb_voyages) AS \"Voyages\", SUM(poids) AS \"Poids (kg)\","
+            " SUM(taux_somme) / SUM(nb_voyages) AS \"Taux moyen (%)\", SUM(cout) AS \"Coût (TND)\","
+            " SUM(cout) / NULLIF(SUM(poids), 0) AS \"Coût par kg (TND)\""
+            f" FROM synthese_jour{clause} GROUP BY zone ORDER BY zone", parametres)
+
+    def locations_par_client(self, debut=None, fin=None, limite=20):
+        """Clients ayant nécessité le plus de camions loués sur la période."""
+        clause, parametres = self._periode(debut, fin)
+        return self._requete(
+            "SELECT client AS \"Client\", SUM(nb_camions_loues) AS \"Camions loués\","
+            " COUNT(CASE WHEN nb_camions_loues > 0 THEN 1 END) AS \"Jours avec location\","
+            " SUM(nb_bls) AS \"BLs\", SUM(poids) AS \"Poids (kg)\""
+            f" FROM synthese_client_jour{clause} GROUP BY client HAVING SUM(nb_camions_loues) > 0"
+            " ORDER BY 2 DESC, 5 DESC LIMIT ?", parametres + [int(limite)])
+
+    def utilisation_vehicules(self, debut=None, fin=None, seuil_taux=None):
+        """
+        Par véhicule sur la période : jours actifs, voyages, poids, taux moyen et coût ; avec seuil_taux,
+        seulement les véhicules dont le taux moyen est inférieur au seuil (sous-utilisés).
+        """
+        clause, parametres = self._periode(debut, fin)
+        having = ""
+        if seuil_taux is not None:
+            having = " HAVING SUM(taux_somme) / SUM(nb_voyages) < ?"
+            parametres = parametres + [float(seuil_taux)]
+        return self._requete(
+            "SELECT vehicule AS \"Véhicule\", MAX(code_vehicule) AS \"Type\", COUNT(*) AS \"Jours actifs\","
+            " SUM(nb_voyages) AS \"Voyages\", SUM(poids) AS \"Poids (kg)\","
+            " SUM(taux_somme) / SUM(nb_voyages) AS \"Taux moyen (%)\", SUM(cout) AS \"Coût (TND)\""
+            f" FROM synthese_vehicule_jour{clause} GROUP BY vehicule{having} ORDER BY 6", parametres)
+
+    def historique_bl(self, bl):
+        """Jours, voyages et véhicules auxquels un BL a été affecté."""
+        return self._requete(
+            "SELECT a.date_plan AS \"Date\", a.voyage AS \"Voyage\", a.zone AS \"Zone\", v.vehicule AS \"Véhicule\","
+            " a.client AS \"Client\" FROM affectations_bl a JOIN voyages v ON v.plan_id = a.plan_id"
+            " AND v.voyage = a.voyage WHERE a.bl = ? ORDER BY a.date_plan", (str(bl),))
+
+    def periode(self):
+        """(première date, dernière date) de l'historique, (None, None) s'il est vide."""
+        df = self._requete("SELECT MIN(date_plan) AS debut, MAX(date_plan) AS fin FROM plans")
+        if df.empty or df.at[0, "debut"] is None:
+            return None, None
+        return pd.Timestamp(df.at[0, "debut"]), pd.Timestamp(df.at[0, "fin"])
+
+    def signature(self):
+        """Change à chaque enregistrement ou suppression : clé d'invalidation des requêtes mises en cache."""
+        from contextlib import closing
+        with closing(self._connexion()) as connexion:
+            return connexion.execute("SELECT COUNT(*), MAX(enregistre), MAX(id) FROM plans").fetchone()
+
+
+# Pas d'agrégation des graphiques de tendance : au plus MAX_POINTS_GRAPHIQUE points par courbe
+MAX_POINTS_GRAPHIQUE = 120
+FREQUENCES_HISTORIQUE = {"Jour": "D", "Semaine": "W-MON", "Mois": "MS"}
+
+def frequence_historique(debut, fin, max_points=MAX_POINTS_GRAPHIQUE):
+    """Pas d'agrégation le plus fin (jour, semaine, mois) donnant au plus max_points points sur la période."""
+    jours = (pd.Timestamp(fin) - pd.Timestamp(debut)).days + 1
+    if jours <= max_points:
+        return "Jour"
+    return "Semaine" if jours / 7 <= max_points else "Mois"
+
+def agreger_indicateurs(df_journalier, frequence="Jour"):
+    """
+    Indicateurs journaliers (PlanningHistoryStore.indicateurs_journaliers) regroupés par semaine
+    (commençant le lundi) ou par mois : sommes, taux moyen pondéré par les voyages, coût par kg
+    recalculé et nombre de jours planifiés.
+    """
+    if df_journalier.empty:
+        return df_journalier.assign(**{"Jours planifiés": pd.Series(dtype=int)})
+    if frequence == "Jour":
+        return df_journalier.assign(**{"Jours planifiés": 1})
+    df = df_journalier.set_index("Date")
+    regle = FREQUENCES_HISTORIQUE[frequence]
+    options = {"label": "left", "closed": "left"} if frequence == "Semaine" else {}
+    sommes = ["Voyages", "Estafettes", "Camions loués", "BLs", "Poids (kg)", "Volume (m³)", "Coût (TND)"]
+    agrege = df[sommes].resample(regle, **options).sum()
+    voyages = agrege["Voyages"].where(agrege["Voyages"] > 0)
+    agrege["Taux moyen (%)"] = (df["Taux moyen (%)"] * df["Voyages"]).resample(regle, **options).sum() / voyages
+    agrege["Coût par kg (TND)"] = agrege["Coût (TND)"] / agrege["Poids (kg)"].where(agrege["Poids (kg)"] > 0)
+    agrege["Jours planifiés"] = df["Voyages"].resample(regle, **options).count()
+    return agrege[agrege["Jours planifiés"] > 0].reset_index()[list(df_journalier.columns) + ["Jours planifiés"]]
+
+
+def _lignes_sql(df):
+    """Lignes d'un DataFrame en types Python natifs (NaN -> NULL) pour executemany."""
+    return [tuple(None if (valeur is None or (isinstance(valeur, float) and math.isnan(valeur)))
+                  else (valeur.item() if hasattr(valeur, "item") else valeur) for valeur in ligne)
+            for ligne in df.astype(object).itertuples(index=False, name=None)]
+
+
+# Historique unique du processus (fichier historique_planning.db à côté de l'application)
+HISTORIQUE_PLANNING = PlanningHistoryStore()
+
+# =====================================================
+# VUES DE L'ANALYSE DE LIVRAISON (TABLEAUX, INDICATEURS, GRAPHIQUES)
 # =====================================================
-def calculer_couts_estimation(df_voyages, cout_estafette=150, cout_camion=800):
-    """Estime les coûts de transport basés sur les véhicules utilisés."""
-    try:
-        nb_estafettes = len(df_voyages[df_voyages["Code Véhicule"] == "ESTAFETTE"])
-        nb_camions = len(df_voyages[df_voyages["Code Véhicule"] == CAMION_CODE])
-        
-        cout_total = (nb_estafettes * cout_estafette) + (nb_camions * cout_camion)
-        
-        return {
-            'estafettes': nb_estafettes,
-            'camions': nb_camions,
-            'cout_estafette_unitaire': cout_estafette,
-            'cout_camion_unitaire': cout_camion,
-            'cout_total': cout_total,
-            'cout_estimation': f"💰 Estimation des coûts : {nb_estafettes} estafettes × {cout_estafette} TND + {nb_camions} camions × {cout_camion} TND = {cout_total} TND"
-        }
-    except Exception as e:
-        return {'erreur': f"❌ Erreur dans le calcul des coûts : {str(e)}"}
+# Ville hors périmètre des tableaux et graphiques par ville
+VILLES_EXCLUES_ANALYSE = ["TRIPOLI"]
+
+def _formater_mesures(df, decimales_besoin=1):
+    """Poids (kg), volume (m³) et besoin en estafettes formatés pour l'affichage HTML."""
+    if "Poids total" in df.columns:
+        df["Poids total"] = df["Poids total"].map(lambda x: f"{x:.3f} kg" if pd.notna(x) else "")
+    if "Volume total" in df.columns:
+        df["Volume total"] = df["Volume total"].map(lambda x: f"{x:.3f} m³" if pd.notna(x) else "")
+    if "Besoin estafette réel" in df.columns:
+        df["Besoin estafette réel"] = df["Besoin estafette réel"].map(
+            lambda x: f"{x:.{decimales_besoin}f}" if pd.notna(x) else ""
+        )
+    return df
+
+def _articles_html(df):
+    """Articles d'une livraison sur plusieurs lignes (<br>) dans la même cellule."""
+    if "Article" in df.columns:
+        df["Article"] = df["Article"].astype(str).apply(
+            lambda x: "<br>".join(a.strip() for a in x.split(",") if a.strip())
+        )
+    return df
+
+def preparer_vues_analyse(df_grouped, df_city, df_grouped_zone, df_zone):
+    """
+    Tableaux formatés, indicateurs et données des graphiques de l'analyse de livraison,
+    calculés une fois par traitement. Chaque vue : {"tableau": DataFrame, "indicateurs": dict}.
+    """
+    liv_ville = df_grouped[~df_grouped["Ville"].isin(VILLES_EXCLUES_ANALYSE)]
+    city = df_city[~df_city["Ville"].isin(VILLES_EXCLUES_ANALYSE)]
+
+    vues = {
+        "livraisons_ville": {
+            "tableau": _formater_mesures(_articles_html(liv_ville.drop(columns=["Zone"], errors="ignore"))),
+            "indicateurs": {
+                "livraisons": len(liv_ville),
+                "clients": liv_ville["Client"].nunique(),
+                "poids": liv_ville["Poids total"].sum(),
+                "volume": liv_ville["Volume total"].sum(),
+            },
+        },
+        "besoin_ville": {
+            "tableau": _formater_mesures(city.copy()),
+            "indicateurs": {
+                "villes": len(city),
+                "bls": city["Nombre de BLs"].sum() if "Nombre de BLs" in city.columns else 0,
+                "estafettes": city["Besoin estafette réel"].sum() if "Besoin estafette réel" in city.columns else 0,
+            },
+        },
+        "livraisons_zone": {
+            "tableau": _formater_mesures(_articles_html(df_grouped_zone.copy())),
+            "indicateurs": {
+                "livraisons": len(df_grouped_zone),
+                "zones": df_grouped_zone["Zone"].nunique(),
+                "villes": df_grouped_zone["Ville"].nunique(),
+            },
+        },
+    }
+
+    besoin_zone = _formater_mesures(df_zone.rename(columns={"Nombre livraisons": "Nombre de BLs"}))
+    if "Nombre de BLs" in besoin_zone.columns:
+        besoin_zone["Nombre de BLs"] = besoin_zone["Nombre de BLs"].map(lambda x: f"{int(x)}" if pd.notna(x) else "")
+    vues["besoin_zone"] = {
+        "tableau": besoin_zone,
+        "indicateurs": {
+            "zones": len(besoin_zone),
+            "bls": df_zone["Nombre livraisons"].sum() if "Nombre livraisons" in df_zone.columns else 0,
+            "estafettes": df_zone["Besoin estafette réel"].sum() if "Besoin estafette réel" in df_zone.columns else 0,
+        },
+    }
+
+    # Données des graphiques par ville (valeurs numériques, non formatées)
+    vues["graphiques"] = city.rename(columns={"Nombre livraisons": "Nombre de BLs"})
+    return vues
+
+# =====================================================
+# EXPORT EXCEL EN FLUX (MÉMOIRE CONSTANTE)
+# =====================================================
+HAUTEUR_LIGNE_RETOURS = 40     # hauteur des lignes à retours à la ligne (feuille principale)
+LARGEUR_COLONNE_MAX = 50       # largeur max d'une colonne ajustée automatiquement
+TAILLE_BLOC_EXPORT = 5000      # lignes converties à la fois avant écriture
+
+
+def largeurs_colonnes(df, maximum=LARGEUR_COLONNE_MAX):
+    """Largeur Excel de chaque colonne (plus longue ligne de texte, en-tête compris, + 2), en vectorisé."""
+    largeurs = []
+    for colonne in df.columns:
+        valeurs = df[colonne]
+        valeurs = valeurs[valeurs.notna()].astype(object)
+        valeurs = valeurs[valeurs.astype(bool)]
+        longueurs = valeurs.map(str).str.split('\n').explode().str.len()
+        longueur = max(len(str(colonne)), int(longueurs.max()) if len(longueurs) else 0)
+        largeurs.append(min(maximum, longueur + 2))
+    return largeurs
+
+
+class ExcelStreamWriter:
+    """
+    Classeur Excel écrit en flux (mémoire constante), styles résolus une fois par colonne.
+    Utilise xlsxwriter en mode constant_memory s'il est installé, sinon openpyxl en écriture seule.
+    S'utilise comme pd.ExcelWriter : `with ExcelStreamWriter(chemin) as writer`.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        try:
+            import xlsxwriter
+            self.moteur = "xlsxwriter"
+            self.workbook = xlsxwriter.Workbook(file_path, {
+                "constant_memory": True, "strings_to_formulas": False,
+                "strings_to_urls": False, "strings_to_numbers": False,
+            })
+            self._format_entete = self.workbook.add_format(
+                {"bold": True, "border": 1, "align": "center", "valign": "top"})
+            self._format_retours_ligne = self.workbook.add_format(
+                {"align": "center", "valign": "vcenter", "text_wrap": True})
+        except ImportError:
+            from openpyxl import Workbook
+            self.moteur = "openpyxl"
+            self.workbook = Workbook(write_only=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            if self.moteur == "xlsxwriter":
+                self.workbook.close()
+            else:
+                self.workbook.save(self.file_path)
+        return False
+
+    @staticmethod
+    def _lignes(df):
+        """Lignes du DataFrame en valeurs Python natives (None pour les manquants), bloc par bloc."""
+        for debut in range(0, len(df), TAILLE_BLOC_EXPORT):
+            bloc = df.iloc[debut:debut + TAILLE_BLOC_EXPORT]
+            yield from bloc.astype(object).where(bloc.notna(), None).itertuples(index=False, name=None)
+
+    def ecrire_feuille(self, nom_feuille, df, index=False, colonnes_retours_ligne=(), hauteur_lignes=None,
+                       largeur_auto=False):
+        """Écrit un DataFrame dans une nouvelle feuille (en-tête au style pandas)."""
+        if index:
+            df = df.reset_index()
+        largeurs = largeurs_colonnes(df) if largeur_auto else None
+        retours_ligne = [col_idx for col_idx, colonne in enumerate(df.columns) if colonne in colonnes_retours_ligne]
+        if self.moteur == "xlsxwriter":
+            self._ecrire_xlsxwriter(nom_feuille[:31], df, retours_ligne, hauteur_lignes, largeurs)
+        else:
+            self._ecrire_openpyxl(nom_feuille[:31], df, retours_ligne, hauteur_lignes, largeurs)
+
+    def _ecrire_xlsxwriter(self, nom_feuille, df, retours_ligne, hauteur_lignes, largeurs):
+        worksheet = self.workbook.add_worksheet(nom_feuille)
+        # Format et largeur posés une fois par colonne (appliqués aux cellules sans format propre)
+        for col_idx in range(len(df.columns)):
+            largeur = largeurs[col_idx] if largeurs else None
+            format_colonne = self._format_retours_ligne if col_idx in retours_ligne else None
+            if largeur is not None or format_colonne is not None:
+                worksheet.set_column(col_idx, col_idx, largeur, format_colonne)
+        if hauteur_lignes:
+            worksheet.set_default_row(hauteur_lignes)
+            worksheet.set_row(0, 15)
+        worksheet.write_row(0, 0, [str(colonne) for colonne in df.columns], self._format_entete)
+        for ligne_idx, ligne in enumerate(self._lignes(df), 1):
+            worksheet.write_row(ligne_idx, 0, ligne)
+
+    def _ecrire_openpyxl(self, nom_feuille, df, retours_ligne, hauteur_lignes, largeurs):
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Alignment, Border, Font, Side
+        from openpyxl.utils import get_column_letter
+
+        worksheet = self.workbook.create_sheet(title=nom_feuille)
+        if largeurs:
+            for col_idx, largeur in enumerate(largeurs, 1):
+                worksheet.column_dimensions[get_column_letter(col_idx)].width = largeur
+        if hauteur_lignes:
+            worksheet.sheet_format.defaultRowHeight = hauteur_lignes
+            worksheet.sheet_format.customHeight = True
+            worksheet.row_dimensions[1].height = 15
+
+        # En-tête : gras, centré, bordure fine
+        trait = Side(style="thin")
+        entetes = []
+        for colonne in df.columns:
+            cell = WriteOnlyCell(worksheet, value=str(colonne))
+            cell.font = Font(bold=True)
+            cell.border = Border(left=trait, right=trait, top=trait, bottom=trait)
+            cell.alignment = Alignment(horizontal="center", vertical="top")
+            entetes.append(cell)
+        worksheet.append(entetes)
+
+        # Une cellule stylée par colonne à retours à la ligne, réutilisée à chaque ligne
+        wrap_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+        cellules_style = {}
+        for col_idx in retours_ligne:
+            cellules_style[col_idx] = WriteOnlyCell(worksheet)
+            cellules_style[col_idx].alignment = wrap_alignment
+
+        for ligne in self._lignes(df):
+            if cellules_style:
+                ligne = list(ligne)
+                for col_idx, cell in cellules_style.items():
+                    cell.value = ligne[col_idx]
+                    ligne[col_idx] = cell
+            worksheet.append(ligne)
+
+
+# Cache des villes par plan : signature (BLs du plan, BL -> Ville) -> villes par voyage.
+# Volontairement hors de df.attrs, que pandas recopie en profondeur à chaque opération.
+# Partagé entre les threads de fond d'ArtifactManager : lectures et évictions sous verrou.
+_CACHE_VILLES_VOYAGES = {}
+_VERROU_VILLES_VOYAGES = threading.Lock()
+TAILLE_CACHE_VILLES = 8
+
+
+def _villes_par_bl(df_livraisons_original):
+    """Ville de chaque BL original (la dernière ligne d'un BL l'emporte, BLs/villes vides ignorés)."""
+    livraisons = pd.DataFrame({
+        "BL": df_livraisons_original["No livraison"].astype(object).map(str),
+        "Ville": (df_livraisons_original["Ville"].astype(object).map(str) if "Ville" in df_livraisons_original.columns
+                  else ""),
+    })
+    valides = livraisons["BL"].ne("") & livraisons["BL"].ne("nan") & livraisons["Ville"].ne("") & livraisons["Ville"].ne("nan")
+    return livraisons[valides].drop_duplicates("BL", keep="last").set_index("BL")["Ville"]
+
+
+def villes_des_voyages(df_voyages, df_livraisons_original):
+    """
+    Ville(s) desservie(s) par chaque voyage, alignée sur df_voyages : BLs éclatés, une seule
+    jointure BL -> Ville, puis réagrégation ("Ville inconnue" si aucun BL n'est trouvé).
+    Le résultat est mis en cache par contenu du plan, invalidé si les BLs ou les villes changent.
+    """
+    import hashlib
+    bls = df_voyages["BL inclus"].astype(object).where(df_voyages["BL inclus"].notna(), "").map(str)
+    mapping_ville = _villes_par_bl(df_livraisons_original)
+    # Empreinte sensible à l'ordre des lignes : le résultat est positionnel
+    empreinte = hashlib.sha256()
+    empreinte.update(pd.util.hash_pandas_object(bls, index=False).to_numpy().tobytes())
+    empreinte.update(pd.util.hash_pandas_object(mapping_ville, index=True).to_numpy().tobytes())
+    signature = (empreinte.hexdigest(), len(bls), len(mapping_ville))
+    with _VERROU_VILLES_VOYAGES:
+        resultat = _CACHE_VILLES_VOYAGES.get(signature)
+    if resultat is not None:
+        return pd.Series(resultat, index=df_voyages.index, dtype=object)
+
+    # Un jeton par BL (séparateurs ';' ou retours à la ligne des exports formatés)
+    jetons = bls.reset_index(drop=True).str.split(r"[;\n]", regex=True).explode().str.strip()
+    villes = pd.DataFrame({"_pos": jetons.index, "Ville": jetons.map(mapping_ville).to_numpy()}).dropna()
+    villes = villes.drop_duplicates().sort_values(["_pos", "Ville"])
+
+    # Réagrégation en un seul passage sur les tableaux triés (évite un groupby Python par voyage)
+    positions = villes["_pos"].to_numpy()
+    noms = villes["Ville"].to_numpy(dtype=object)
+    frontieres = np.flatnonzero(np.diff(positions)) + 1
+    resultat = np.full(len(bls), "Ville inconnue", dtype=object)
+    if len(positions):
+        debuts = np.concatenate(([0], frontieres))
+        for position, groupe in zip(positions[debuts], np.split(noms, frontieres)):
+            resultat[position] = ", ".join(groupe)
+    resultat[(bls == "").to_numpy()] = ""
+    with _VERROU_VILLES_VOYAGES:
+        if signature not in _CACHE_VILLES_VOYAGES and len(_CACHE_VILLES_VOYAGES) >= TAILLE_CACHE_VILLES:
+            _CACHE_VILLES_VOYAGES.pop(next(iter(_CACHE_VILLES_VOYAGES)))
+        _CACHE_VILLES_VOYAGES[signature] = resultat
+    return pd.Series(resultat, index=df_voyages.index, dtype=object)
+
 
 def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None, df_livraisons_original=None):
     """Exporte le planning complet vers Excel avec prise en compte des types de camions."""
     try:
-        import openpyxl
-        from openpyxl.styles import Alignment
-        
-        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
+        with ExcelStreamWriter(file_path) as writer:
             # =====================================================
             # ORDRE EXACT DES COLONNES DEMANDÉ AVEC VILLE
             # =====================================================
@@ -1300,16 +4210,17 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
             
             # 2. AJOUT DE LA COLONNE "TYPE VÉHICULE" - NOUVELLE FONCTIONNALITÉ
             if 'Code Véhicule' in df_voyages_working.columns:
-                def get_info_capacite(row):
-                    if row['Code Véhicule'] == CAMION_CODE:
-                        truck_type = row.get('Type_Camion', '5 tonnes')
-                        poids_max = get_capacite_poids_camion(truck_type)
-                        volume_max = get_capacite_volume_camion(truck_type)
-                        return f"Camion {truck_type} ({poids_max} kg, {volume_max} m³)"
-                    else:
-                        return f"Estafette ({CAPACITE_POIDS_ESTAFETTE} kg, {CAPACITE_VOLUME_ESTAFETTE} m³)"
-                
-                df_voyages_working['Type_Véhicule'] = df_voyages_working.apply(get_info_capacite, axis=1)
+                types_camion = (df_voyages_working['Type_Camion'] if 'Type_Camion' in df_voyages_working.columns
+                                else pd.Series('5 tonnes', index=df_voyages_working.index))
+                libelles_camion = {
+                    str(truck_type): f"Camion {truck_type} ({get_capacite_poids_camion(truck_type)} kg, {get_capacite_volume_camion(truck_type)} m³)"
+                    for truck_type in types_camion.unique()
+                }
+                df_voyages_working['Type_Véhicule'] = np.where(
+                    df_voyages_working['Code Véhicule'] == CAMION_CODE,
+                    types_camion.astype(object).map(str).map(libelles_camion),
+                    f"Estafette ({CAPACITE_POIDS_ESTAFETTE} kg, {CAPACITE_VOLUME_ESTAFETTE} m³)"
+                )
                 # Ajouter cette colonne à la liste des colonnes demandées
                 colonnes_demandees.insert(4, "Type_Véhicule")  # Après "Véhicule N°"
             
@@ -1317,40 +4228,8 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
             if "Ville" not in df_voyages_working.columns and df_livraisons_original is not None:
                 print("🔄 Ajout de la colonne Ville depuis les données originales...")
                 
-                # Créer un mapping BL -> Ville depuis les données originales
-                mapping_ville = {}
-                
-                # Parcourir les données originales pour créer le mapping
-                for idx, row in df_livraisons_original.iterrows():
-                    bl = str(row.get("No livraison", ""))
-                    ville = str(row.get("Ville", ""))
-                    if bl and bl != "nan" and ville and ville != "nan":
-                        mapping_ville[bl] = ville
-                
-                # Fonction pour extraire les villes à partir des BLs d'un véhicule
-                def get_villes_from_bls(bls_inclus):
-                    if pd.isna(bls_inclus) or bls_inclus == "":
-                        return ""
-                    
-                    bls_list = str(bls_inclus).split(';')
-                    villes_trouvees = set()
-                    
-                    for bl in bls_list:
-                        bl_clean = bl.strip()
-                        if bl_clean in mapping_ville:
-                            villes_trouvees.add(mapping_ville[bl_clean])
-                        # Ignorer les objets manuels (OBJ-)
-                        elif not bl_clean.startswith('OBJ-'):
-                            # Chercher le BL dans les données originales
-                            for original_bl, original_ville in mapping_ville.items():
-                                if bl_clean == original_bl:
-                                    villes_trouvees.add(original_ville)
-                                    break
-                    
-                    return ", ".join(sorted(villes_trouvees)) if villes_trouvees else "Ville inconnue"
-                
-                # Appliquer la fonction pour créer la colonne Ville
-                df_voyages_working["Ville"] = df_voyages_working["BL inclus"].apply(get_villes_from_bls)
+                # BLs éclatés, une jointure BL -> Ville, réagrégation (mise en cache sur le plan)
+                df_voyages_working["Ville"] = villes_des_voyages(df_voyages, df_livraisons_original).to_numpy()
                 print("✅ Colonne 'Ville' ajoutée avec succès")
             
             # 4. FORMATER LES COLONNES AVEC RETOURS À LIGNE
@@ -1394,50 +4273,12 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
             # =====================================================
             # FEUILLE PRINCIPALE - PLANNING LIVRAISONS
             # =====================================================
-            if not df_voyages_ordered.empty:
-                df_voyages_ordered.to_excel(writer, sheet_name='Planning Livraisons', index=False)
-            else:
-                pd.DataFrame(columns=colonnes_finales).to_excel(writer, sheet_name='Planning Livraisons', index=False)
-            
-            # =====================================================
-            # APPLIQUER LE FORMATAGE DES RETOURS À LIGNE DANS EXCEL
-            # =====================================================
-            workbook = writer.book
-            worksheet = writer.sheets['Planning Livraisons']
-            
-            # Style avec retours à ligne et centrage
-            wrap_alignment = Alignment(
-                horizontal='center', 
-                vertical='center', 
-                wrap_text=True
-            )
-            
-            # Appliquer le formatage aux colonnes avec retours à ligne
-            for col_idx, col_name in enumerate(df_voyages_ordered.columns, 1):
-                if col_name in colonnes_retours_ligne:
-                    for row_idx in range(2, len(df_voyages_ordered) + 2):  # +2 pour header
-                        cell = worksheet.cell(row=row_idx, column=col_idx)
-                        cell.alignment = wrap_alignment
-            
-            # Ajuster la hauteur des lignes pour les retours à ligne
-            for row in range(2, len(df_voyages_ordered) + 2):
-                worksheet.row_dimensions[row].height = 40
-            
-            # Ajuster automatiquement la largeur des colonnes
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if cell.value:
-                            # Calculer la longueur maximale en prenant en compte les retours à ligne
-                            lines = str(cell.value).split('\n')
-                            max_line_length = max(len(line) for line in lines)
-                            max_length = max(max_length, max_line_length)
-                    except:
-                        pass
-                adjusted_width = min(50, (max_length + 2))
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+            # Retours à ligne centrés, hauteur de ligne et largeurs ajustées, appliqués par colonne
+            if df_voyages_ordered.empty:
+                df_voyages_ordered = pd.DataFrame(columns=colonnes_finales)
+            writer.ecrire_feuille('Planning Livraisons', df_voyages_ordered,
+                                  colonnes_retours_ligne=colonnes_retours_ligne,
+                                  hauteur_lignes=HAUTEUR_LIGNE_RETOURS, largeur_auto=True)
             
             # =====================================================
             # FEUILLE DE SYNTHÈSE DÉTAILLÉE
@@ -1479,10 +4320,10 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
                         f"{taux_moyen:.1f}%" if taux_moyen > 0 else "N/A"
                     ]
                 }
-                pd.DataFrame(synthèse_data).to_excel(writer, sheet_name='Synthèse', index=False)
+                writer.ecrire_feuille('Synthèse', pd.DataFrame(synthèse_data))
             except Exception as e:
                 print(f"⚠️ Erreur lors de la création de la synthèse : {e}")
-                pd.DataFrame({'Métrique': ['Erreur'], 'Valeur': ['Données non disponibles']}).to_excel(writer, sheet_name='Synthèse', index=False)
+                writer.ecrire_feuille('Synthèse', pd.DataFrame({'Métrique': ['Erreur'], 'Valeur': ['Données non disponibles']}))
             
             # =====================================================
             # FEUILLE STATS PAR ZONE DÉTAILLÉE
@@ -1491,9 +4332,7 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
                 if 'Zone' in df_voyages_working.columns and not df_voyages_working.empty:
                     # Ajouter une colonne Type pour les statistiques
                     df_stats = df_voyages_working.copy()
-                    df_stats['Type_Véhicule_Simple'] = df_stats['Code Véhicule'].apply(
-                        lambda x: 'CAMION' if x == CAMION_CODE else 'ESTAFETTE'
-                    )
+                    df_stats['Type_Véhicule_Simple'] = np.where(df_stats['Code Véhicule'] == CAMION_CODE, 'CAMION', 'ESTAFETTE')
                     
                     # Statistiques par zone
                     stats_zone = df_stats.groupby('Zone').agg({
@@ -1518,45 +4357,36 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
                     # Ajouter le nombre d'estafettes
                     stats_zone['Nombre Estafettes'] = stats_zone['Nombre Véhicules'] - stats_zone['Nombre Camions']
                     
-                    stats_zone.to_excel(writer, sheet_name='Stats par Zone')
+                    writer.ecrire_feuille('Stats par Zone', stats_zone, index=True)
                 else:
-                    pd.DataFrame(columns=['Zone', 'Nombre_Véhicules']).to_excel(writer, sheet_name='Stats par Zone', index=False)
+                    writer.ecrire_feuille('Stats par Zone', pd.DataFrame(columns=['Zone', 'Nombre_Véhicules']))
             except Exception as e:
                 print(f"⚠️ Erreur lors de la création des stats par zone : {e}")
-                pd.DataFrame(columns=['Zone', 'Nombre_Véhicules']).to_excel(writer, sheet_name='Stats par Zone', index=False)
+                writer.ecrire_feuille('Stats par Zone', pd.DataFrame(columns=['Zone', 'Nombre_Véhicules']))
             
             # =====================================================
             # FEUILLE CAPACITÉS VÉHICULES
             # =====================================================
             try:
                 if not df_voyages_working.empty:
-                    capacites_data = []
-                    
-                    for idx, row in df_voyages_working.iterrows():
-                        if row.get('Code Véhicule') == CAMION_CODE:
-                            truck_type = row.get('Type_Camion', '5 tonnes')
-                            poids_max = get_capacite_poids_camion(truck_type)
-                            volume_max = get_capacite_volume_camion(truck_type)
-                            type_veh = f"Camion {truck_type}"
-                        else:
-                            poids_max = CAPACITE_POIDS_ESTAFETTE
-                            volume_max = CAPACITE_VOLUME_ESTAFETTE
-                            type_veh = "Estafette"
-                        
-                        capacites_data.append({
-                            'Véhicule': row.get('Véhicule N°', ''),
-                            'Type': type_veh,
-                            'Zone': row.get('Zone', ''),
-                            'Poids Chargé (kg)': row.get('Poids total chargé', 0),
-                            'Capacité Max Poids (kg)': poids_max,
-                            'Utilisation Poids (%)': round((row.get('Poids total chargé', 0) / poids_max) * 100, 1),
-                            'Volume Chargé (m³)': row.get('Volume total chargé', 0),
-                            'Capacité Max Volume (m³)': volume_max,
-                            'Utilisation Volume (%)': round((row.get('Volume total chargé', 0) / volume_max) * 100, 1)
-                        })
-                    
-                    df_capacites = pd.DataFrame(capacites_data)
-                    df_capacites.to_excel(writer, sheet_name='Capacités Véhicules', index=False)
+                    colonne = lambda nom, defaut: (df_voyages_working[nom] if nom in df_voyages_working.columns
+                                                   else pd.Series(defaut, index=df_voyages_working.index))
+                    poids_max, volume_max = get_capacites_vehicules(df_voyages_working)
+                    est_camion = colonne('Code Véhicule', '') == CAMION_CODE
+                    poids_charge = colonne('Poids total chargé', 0)
+                    volume_charge = colonne('Volume total chargé', 0)
+                    df_capacites = pd.DataFrame({
+                        'Véhicule': colonne('Véhicule N°', ''),
+                        'Type': np.where(est_camion, "Camion " + colonne('Type_Camion', '5 tonnes').astype(object).map(str), "Estafette"),
+                        'Zone': colonne('Zone', ''),
+                        'Poids Chargé (kg)': poids_charge,
+                        'Capacité Max Poids (kg)': poids_max.astype(int),
+                        'Utilisation Poids (%)': (poids_charge / poids_max * 100).round(1),
+                        'Volume Chargé (m³)': volume_charge,
+                        'Capacité Max Volume (m³)': volume_max,
+                        'Utilisation Volume (%)': (volume_charge / volume_max * 100).round(1),
+                    })
+                    writer.ecrire_feuille('Capacités Véhicules', df_capacites)
             except Exception as e:
                 print(f"⚠️ Erreur lors de la création des capacités véhicules : {e}")
             
@@ -1566,10 +4396,9 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
             if donnees_supplementaires:
                 for nom_feuille, data in donnees_supplementaires.items():
                     if isinstance(data, pd.DataFrame) and not data.empty:
-                        nom_feuille = nom_feuille[:31]
-                        data.to_excel(writer, sheet_name=nom_feuille, index=False)
+                        writer.ecrire_feuille(nom_feuille[:31], data)
                     else:
-                        pd.DataFrame({f'Info': [f'Données non disponibles pour {nom_feuille}']}).to_excel(writer, sheet_name=nom_feuille[:31], index=False)
+                        writer.ecrire_feuille(nom_feuille[:31], pd.DataFrame({'Info': [f'Données non disponibles pour {nom_feuille}']}))
             
             # =====================================================
             # FEUILLE COMPLÈTE (toutes les colonnes) - pour référence
@@ -1583,95 +4412,981 @@ def exporter_planning_excel(df_voyages, file_path, donnees_supplementaires=None,
                     if "Volume total chargé" in df_voyages_complet.columns:
                         df_voyages_complet["Volume total chargé"] = df_voyages_complet["Volume total chargé"].round(3)
                     
-                    df_voyages_complet.to_excel(writer, sheet_name='Données Complètes', index=False)
+                    writer.ecrire_feuille('Données Complètes', df_voyages_complet)
                 else:
-                    pd.DataFrame(columns=list(df_voyages_working.columns)).to_excel(writer, sheet_name='Données Complètes', index=False)
+                    writer.ecrire_feuille('Données Complètes', pd.DataFrame(columns=list(df_voyages_working.columns)))
             except Exception as e:
                 print(f"⚠️ Erreur lors de la création de la feuille complète : {e}")
-                pd.DataFrame({'Erreur': ['Impossible de créer la feuille complète']}).to_excel(writer, sheet_name='Données Complètes', index=False)
+                writer.ecrire_feuille('Données Complètes', pd.DataFrame({'Erreur': ['Impossible de créer la feuille complète']}))
         
         return True, f"✅ Planning exporté avec succès : {file_path}"
     
     except Exception as e:
         return False, f"❌ Erreur lors de l'export Excel : {str(e)}"
+# =====================================================
+# RÉCONCILIATION DES DONNÉES (OBJETS MANUELS SUIVIS)
+# =====================================================
+COLONNES_OBJETS_MANUELS = ["Code", "Objet", "Zone", "Véhicule N°", "Poids", "Volume"]
+
+
+def _livraisons_par_bl(df_livraisons_original):
+    """Poids, volume, zone et client de chaque BL original (clé texte)."""
+    df = df_livraisons_original
+    colonne = lambda nom, defaut: df[nom] if nom in df.columns else pd.Series(defaut, index=df.index)
+    return pd.DataFrame({
+        "BL": df["No livraison"].astype(object).map(str).str.strip(),
+        "Poids": colonne("Poids total", 0).astype(float),
+        "Volume": colonne("Volume total", 0).astype(float),
+        "Zone BL": colonne("Zone", "Inconnue").astype(object).map(str),
+        "Client": colonne("Client de l'estafette", "Inconnu").astype(object).map(str),
+    }).groupby("BL", sort=False).agg({"Poids": "sum", "Volume": "sum", "Zone BL": "first", "Client": "first"})
+
+
+def reconcilier_donnees(df_voyages, df_livraisons_original, df_objets_manuels=None):
+    """
+    Réconciliation exacte plan / données originales.
+    Les objets manuels (OBJ-) sont valorisés avec leur propre poids/volume s'ils sont suivis
+    (registre TruckTransferManager.objets_manuels), sinon estimés par différence sur leur véhicule.
+    Retourne un dict : bls_manquants, bls_ajoutes, bls_dupliques (listes), par_vehicule,
+    par_zone, par_client, objets (DataFrames) et totaux (dict).
+    """
+    try:
+        plan = df_voyages.reset_index(drop=True)
+        livraisons = _livraisons_par_bl(df_livraisons_original)
+        zone = plan["Zone"].astype(object).map(str)
+        vehicule = plan["Véhicule N°"].astype(object).map(str)
+        poids_charge = plan["Poids total chargé"].astype(float).fillna(0)
+        volume_charge = plan["Volume total chargé"].astype(float).fillna(0)
+
+        # Jetons du plan : BLs réels et objets manuels, avec leur ligne
+        jetons = plan["BL inclus"].astype(object).map(str).str.split(';').explode().str.strip()
+        jetons = jetons[jetons.ne('') & jetons.ne('nan')]
+        est_objet = jetons.str.startswith('OBJ-')
+        occurrences_bl = pd.DataFrame({"_pos": jetons[~est_objet].index.to_numpy(dtype=int), "BL": jetons[~est_objet].to_numpy()})
+        occurrences_bl = occurrences_bl.join(livraisons, on="BL")
+
+        # Couverture des BLs (ensembles)
+        bls_originaux = set(livraisons.index)
+        bls_plan = set(occurrences_bl["BL"])
+        comptes = occurrences_bl["BL"].value_counts()
+        bls_manquants = sorted(bls_originaux - bls_plan)
+        bls_ajoutes = sorted(bls_plan - bls_originaux)
+        bls_dupliques = sorted(comptes[comptes > 1].index)
+
+        # Objets manuels : registre agrégé par (Zone, Véhicule N°, Code)
+        objets = pd.DataFrame({
+            "_pos": jetons[est_objet].index.to_numpy(dtype=int),
+            "Code": jetons[est_objet].to_numpy(),
+        }).drop_duplicates()
+        objets["Zone"] = zone.to_numpy()[objets["_pos"]]
+        objets["Véhicule N°"] = vehicule.to_numpy()[objets["_pos"]]
+        registre = df_objets_manuels if df_objets_manuels is not None else pd.DataFrame(columns=COLONNES_OBJETS_MANUELS)
+        registre = registre.assign(**{
+            "Zone": registre["Zone"].astype(object).map(str),
+            "Véhicule N°": registre["Véhicule N°"].astype(object).map(str),
+            "Poids": registre["Poids"].astype(float),
+            "Volume": registre["Volume"].astype(float),
+        }).groupby(["Zone", "Véhicule N°", "Code"]).agg({"Poids": "sum", "Volume": "sum"})
+        objets = objets.join(registre, on=["Zone", "Véhicule N°", "Code"])
+        objets["Suivi"] = objets["Poids"].notna()
+
+        # Réconciliation par véhicule : chargé = BLs + objets suivis + objets non suivis (différence)
+        n = len(plan)
+        somme = lambda serie, pos: np.bincount(pos, weights=serie.fillna(0).to_numpy(dtype=float), minlength=n)
+        poids_bls = somme(occurrences_bl["Poids"], occurrences_bl["_pos"])
+        volume_bls = somme(occurrences_bl["Volume"], occurrences_bl["_pos"])
+        poids_suivis = somme(objets["Poids"], objets["_pos"])
+        volume_suivis = somme(objets["Volume"], objets["_pos"])
+        nb_non_suivis = np.bincount(objets.loc[~objets["Suivi"], "_pos"].to_numpy(dtype=int), minlength=n)
+        residu_poids = poids_charge.to_numpy() - poids_bls - poids_suivis
+        residu_volume = volume_charge.to_numpy() - volume_bls - volume_suivis
+        avec_estimation = nb_non_suivis > 0
+        poids_estimes = np.where(avec_estimation, np.maximum(residu_poids, 0), 0.0)
+        volume_estimes = np.where(avec_estimation, np.maximum(residu_volume, 0), 0.0)
+
+        par_vehicule = pd.DataFrame({
+            "Zone": zone, "Véhicule N°": vehicule,
+            "Poids chargé": poids_charge, "Poids BLs": poids_bls, "Poids objets": poids_suivis + poids_estimes,
+            "Écart poids": residu_poids - poids_estimes,
+            "Volume chargé": volume_charge, "Volume BLs": volume_bls, "Volume objets": volume_suivis + volume_estimes,
+            "Écart volume": residu_volume - volume_estimes,
+            "Objets non suivis": nb_non_suivis,
+        })
+
+        # Objets non suivis : part égale de l'estimation de leur véhicule
+        non_suivis = ~objets["Suivi"]
+        part = nb_non_suivis[objets.loc[non_suivis, "_pos"]]
+        objets.loc[non_suivis, "Poids"] = poids_estimes[objets.loc[non_suivis, "_pos"]] / part
+        objets.loc[non_suivis, "Volume"] = volume_estimes[objets.loc[non_suivis, "_pos"]] / part
+        objets = objets.drop(columns="_pos").reset_index(drop=True)
+
+        # Réconciliation par zone et par client du BL : original vs planifié (chaque occurrence comptée)
+        def par_cle(cle):
+            original = livraisons.groupby(cle).agg(**{
+                "Poids original": ("Poids", "sum"), "Volume original": ("Volume", "sum"),
+                "BLs originaux": ("Poids", "size"),
+            })
+            connus = occurrences_bl.dropna(subset=[cle])
+            planifie = connus.groupby(cle).agg(**{
+                "Poids planifié": ("Poids", "sum"), "Volume planifié": ("Volume", "sum"),
+                "BLs planifiés": ("BL", "nunique"),
+            })
+            table = original.join(planifie, how="outer").fillna(0)
+            table["Écart poids"] = table["Poids planifié"] - table["Poids original"]
+            table["Écart volume"] = table["Volume planifié"] - table["Volume original"]
+            table["BLs manquants"] = (table["BLs originaux"] - table["BLs planifiés"]).astype(int)
+            colonnes = ["BLs originaux", "BLs planifiés", "BLs manquants", "Poids original", "Poids planifié",
+                        "Écart poids", "Volume original", "Volume planifié", "Écart volume"]
+            return table[colonnes].astype({"BLs originaux": int, "BLs planifiés": int}).rename_axis(
+                "Zone" if cle == "Zone BL" else cle).reset_index()
+
+        poids_objets = float(objets["Poids"].sum())
+        volume_objets = float(objets["Volume"].sum())
+        totaux = {
+            "poids_original": float(livraisons["Poids"].sum()),
+            "poids_voyages": float(poids_charge.sum()),
+            "poids_objets": poids_objets,
+            "poids_voyages_hors_objets": float(poids_charge.sum()) - poids_objets,
+            "volume_original": float(livraisons["Volume"].sum()),
+            "volume_voyages": float(volume_charge.sum()),
+            "volume_objets": volume_objets,
+            "volume_voyages_hors_objets": float(volume_charge.sum()) - volume_objets,
+            "nb_objets": len(objets),
+            "nb_objets_non_suivis": int((~objets["Suivi"]).sum()),
+        }
+
+        return {
+            "bls_manquants": bls_manquants,
+            "bls_ajoutes": bls_ajoutes,
+            "bls_dupliques": bls_dupliques,
+            "par_vehicule": par_vehicule,
+            "par_zone": par_cle("Zone BL"),
+            "par_client": par_cle("Client"),
+            "objets": objets,
+            "totaux": totaux,
+        }
+    except Exception as e:
+        return {'erreur': f"❌ Erreur lors de la réconciliation : {str(e)}"}
+
+# =====================================================
+# EXPORT MULTI-FORMAT DU PLANNING (PARQUET, CSV, JSON, ARROW, EXCEL)
+# =====================================================
+# Schéma stable lu par le WMS/TMS : toute évolution incompatible incrémente la version.
+VERSION_SCHEMA_EXPORT = 1
+
+# Table -> [(colonne exportée, type pandas)] ; les colonnes absentes du plan sont exportées vides
+SCHEMA_EXPORT = {
+    "voyages": [
+        ("code_voyage", "string"),
+        ("zone", "string"),
+        ("vehicule", "string"),
+        ("code_vehicule", "string"),
+        ("type_camion", "string"),
+        ("chauffeur", "string"),
+        ("poids_kg", "float64"),
+        ("volume_m3", "float64"),
+        ("taux_occupation_pct", "float64"),
+        ("nb_bls", "int64"),
+        ("bls", "string"),
+        ("clients", "string"),
+        ("representants", "string"),
+        ("villes", "string"),
+        ("location_camion", "boolean"),
+        ("location_proposee", "boolean"),
+    ],
+    "affectations_bl": [
+        ("code_voyage", "string"),
+        ("zone", "string"),
+        ("vehicule", "string"),
+        ("bl", "string"),
+        ("objet_manuel", "boolean"),
+        ("client", "string"),
+        ("ville", "string"),
+        ("poids_kg", "float64"),
+        ("volume_m3", "float64"),
+    ],
+    "validation": [
+        ("ordre", "int64"),
+        ("type", "string"),
+        ("message", "string"),
+    ],
+}
+
+# Colonnes du plan reprises telles quelles dans la table "voyages"
+COLONNES_PLAN_EXPORT = {
+    "code_voyage": "Code voyage",
+    "zone": "Zone",
+    "vehicule": "Véhicule N°",
+    "code_vehicule": "Code Véhicule",
+    "type_camion": "Type_Camion",
+    "chauffeur": "Chauffeur",
+    "poids_kg": "Poids total chargé",
+    "volume_m3": "Volume total chargé",
+    "taux_occupation_pct": "Taux d'occupation (%)",
+    "clients": "Client(s) inclus",
+    "representants": "Représentant(s) inclus",
+    "location_camion": "Location_camion",
+    "location_proposee": "Location_proposee",
+}
+
+NOMS_FEUILLES_EXPORT = {"voyages": "Voyages", "affectations_bl": "Affectations BL", "validation": "Validation"}
+
+
+def _conformer_table(df, table):
+    """
+    Colonnes et types du schéma SCHEMA_EXPORT[table], dans l'ordre du schéma. Seules les colonnes
+    d'un autre type (ou les chaînes contenant des retours à la ligne) sont converties : les autres
+    sont reprises telles quelles, sans recopie.
+    """
+    colonnes = {}
+    for nom, type_colonne in SCHEMA_EXPORT[table]:
+        if nom not in df.columns:
+            colonnes[nom] = pd.Series(np.nan if type_colonne == "float64" else pd.NA, index=df.index, dtype=type_colonne)
+        elif type_colonne == "float64" and df[nom].dtype != "float64":
+            colonnes[nom] = pd.to_numeric(df[nom], errors="coerce").astype("float64")
+        elif type_colonne == "string":
+            colonne = df[nom] if df[nom].dtype.name == "string" else df[nom].astype("string")
+            colonnes[nom] = (colonne.str.replace("\n", ", ", regex=False)
+                             if colonne.str.contains("\n", regex=False).any() else colonne)
+        elif df[nom].dtype != type_colonne:
+            colonnes[nom] = df[nom].astype(type_colonne)
+        else:
+            colonnes[nom] = df[nom]
+    return pd.DataFrame(colonnes, index=df.index, copy=False).reset_index(drop=True)
+
+
+def _schema_arrow(table):
+    """Schéma Arrow de la table (chaînes en large_string, comme le stockage pandas : pas de recopie)."""
+    import pyarrow as pa
+    types = {"string": pa.large_string(), "float64": pa.float64(), "int64": pa.int64(), "boolean": pa.bool_()}
+    return pa.schema(
+        [pa.field(nom, types[type_colonne]) for nom, type_colonne in SCHEMA_EXPORT[table]],
+        metadata={"schema_version": str(VERSION_SCHEMA_EXPORT), "table": table},
+    )
+
+
+def _ecrire_parquet(table_arrow, df, destination):
+    import pyarrow.parquet as pq
+    pq.write_table(table_arrow, destination, compression="snappy")
+
+
+def _ecrire_arrow(table_arrow, df, destination):
+    import pyarrow as pa
+    with pa.ipc.new_file(destination, table_arrow.schema) as writer:
+        writer.write_table(table_arrow)
+
+
+def _ecrire_csv(table_arrow, df, destination):
+    import pyarrow.csv as pcsv
+    pcsv.write_csv(table_arrow, destination)
+
+
+def _ecrire_json(table_arrow, df, destination):
+    df.to_json(destination, orient="records", force_ascii=False)
+
+
+# Rendus disponibles : un fichier par table, sauf Excel (un classeur, une feuille par table)
+RENDUS_EXPORT = {
+    "parquet": {"extension": ".parquet", "ecrire": _ecrire_parquet, "mime": "application/vnd.apache.parquet"},
+    "arrow": {"extension": ".arrow", "ecrire": _ecrire_arrow, "mime": "application/vnd.apache.arrow.file"},
+    "csv": {"extension": ".csv", "ecrire": _ecrire_csv, "mime": "text/csv"},
+    "json": {"extension": ".json", "ecrire": _ecrire_json, "mime": "application/json"},
+    "excel": {"extension": ".xlsx", "ecrire": None,
+              "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"},
+}
+
+
+class PlanExporter:
+    """
+    Exporte le plan sous un schéma stable (SCHEMA_EXPORT) : voyages, affectations BL -> voyage
+    et rapport de validation. Les tables sont construites une fois ; Parquet, Arrow et CSV sont
+    écrits depuis la même table Arrow, JSON et Excel depuis le DataFrame conforme.
+    """
+
+    def __init__(self, df_voyages, df_livraisons_original=None, rapport_validation=None, df_objets_manuels=None):
+        self.df_voyages = df_voyages.reset_index(drop=True)
+        self.df_livraisons_original = df_livraisons_original
+        self.rapport_validation = rapport_validation
+        self.df_objets_manuels = df_objets_manuels
+        self._tables = None
+        self._tables_arrow = {}
+
+    # -------------------------------------------------
+    # Construction des tables
+    # -------------------------------------------------
+    def _jetons(self):
+        """BLs et objets manuels de chaque voyage (Series indexée par position dans le plan)."""
+        bls = self.df_voyages["BL inclus"].astype(object).where(self.df_voyages["BL inclus"].notna(), "").map(str)
+        jetons = bls.str.split(r"[;\n]", regex=True).explode().str.strip()
+        return jetons[jetons.ne("") & jetons.ne("nan")]
+
+    def _table_voyages(self, jetons):
+        plan = self.df_voyages
+        df = pd.DataFrame({nom: plan[source] for nom, source in COLONNES_PLAN_EXPORT.items() if source in plan.columns},
+                          index=plan.index)
+        reels = jetons[~jetons.str.startswith("OBJ-")]
+        df["nb_bls"] = reels.groupby(level=0).size().reindex(plan.index, fill_value=0)
+        df["bls"] = plan["BL inclus"].astype("string").str.strip().str.replace(r"\s*[;\n]\s*", ";", regex=True)
+        if self.df_livraisons_original is not None:
+            df["villes"] = villes_des_voyages(plan, self.df_livraisons_original).to_numpy()
+        return _conformer_table(df, "voyages")
+
+    def _table_affectations(self, jetons):
+        plan = self.df_voyages
+        colonne = lambda nom: plan[nom].astype(object).map(str) if nom in plan.columns else pd.Series(pd.NA, index=plan.index)
+        positions = jetons.index.to_numpy(dtype=int)
+        df = pd.DataFrame({
+            "code_voyage": colonne("Code voyage").to_numpy()[positions],
+            "zone": colonne("Zone").to_numpy()[positions],
+            "vehicule": colonne("Véhicule N°").to_numpy()[positions],
+            "bl": jetons.to_numpy(),
+            "objet_manuel": jetons.str.startswith("OBJ-").to_numpy(),
+        })
+        if self.df_livraisons_original is not None:
+            livraisons = _livraisons_par_bl(self.df_livraisons_original)
+            df["client"] = df["bl"].map(livraisons["Client"])
+            df["ville"] = df["bl"].map(_villes_par_bl(self.df_livraisons_original))
+            df["poids_kg"] = df["bl"].map(livraisons["Poids"])
+            df["volume_m3"] = df["bl"].map(livraisons["Volume"])
+        if self.df_objets_manuels is not None and not self.df_objets_manuels.empty:
+            # Poids/volume des objets manuels suivis, cumulés par (Zone, Véhicule N°, Code)
+            registre = self.df_objets_manuels.astype({"Zone": str, "Véhicule N°": str, "Code": str})
+            registre = registre.groupby(["Zone", "Véhicule N°", "Code"], sort=False)[["Poids", "Volume"]].sum()
+            registre.index.names = ["zone", "vehicule", "bl"]
+            objets = df[["zone", "vehicule", "bl"]].join(registre, on=["zone", "vehicule", "bl"])
+            df.loc[df["objet_manuel"], "poids_kg"] = objets.loc[df["objet_manuel"], "Poids"]
+            df.loc[df["objet_manuel"], "volume_m3"] = objets.loc[df["objet_manuel"], "Volume"]
+        return _conformer_table(df, "affectations_bl")
+
+    def _table_validation(self):
+        rapport = self.rapport_validation
+        if rapport is None:
+            rapport = VoyageValidator(self.df_voyages).validate_voyages()
+        df = pd.DataFrame({"ordre": range(1, len(rapport) + 1), "type": rapport["Type"].to_numpy(),
+                           "message": rapport["Message"].to_numpy()})
+        return _conformer_table(df, "validation")
+
+    def tables(self):
+        """Tables exportées {nom: DataFrame conforme au schéma}, construites une seule fois."""
+        if self._tables is None:
+            jetons = self._jetons()
+            self._tables = {
+                "voyages": self._table_voyages(jetons),
+                "affectations_bl": self._table_affectations(jetons),
+                "validation": self._table_validation(),
+            }
+        return self._tables
+
+    def table_arrow(self, table):
+        """Table Arrow conforme au schéma (colonnes numériques et chaînes reprises sans recopie)."""
+        if table not in self._tables_arrow:
+            import pyarrow as pa
+            self._tables_arrow[table] = pa.Table.from_pandas(
+                self.tables()[table], schema=_schema_arrow(table), preserve_index=False)
+        return self._tables_arrow[table]
+
+    def manifeste(self):
+        """Description du schéma exporté (version, colonnes, types, nombre de lignes)."""
+        return {
+            "schema_version": VERSION_SCHEMA_EXPORT,
+            "tables": {
+                table: {"colonnes": [{"nom": nom, "type": type_colonne} for nom, type_colonne in colonnes],
+                        "lignes": len(self.tables()[table])}
+                for table, colonnes in SCHEMA_EXPORT.items()
+            },
+        }
+
+    # -------------------------------------------------
+    # Rendus
+    # -------------------------------------------------
+    def ecrire(self, format_export, destination, table=None):
+        """
+        Écrit un rendu vers un chemin ou un flux binaire : une table pour les formats à plat
+        (table obligatoire), le classeur complet pour "excel".
+        """
+        if format_export not in RENDUS_EXPORT:
+            raise ValueError(f"Format d'export inconnu : {format_export} (disponibles : {', '.join(RENDUS_EXPORT)})")
+        if format_export == "excel":
+            with ExcelStreamWriter(destination) as writer:
+                for nom, df in self.tables().items():
+                    writer.ecrire_feuille(NOMS_FEUILLES_EXPORT[nom], df, largeur_auto=True)
+            return
+        if table not in SCHEMA_EXPORT:
+            raise ValueError(f"Table inconnue : {table} (disponibles : {', '.join(SCHEMA_EXPORT)})")
+        RENDUS_EXPORT[format_export]["ecrire"](self.table_arrow(table), self.tables()[table], destination)
+
+    def exporter(self, dossier, formats=("parquet",), prefixe="planning"):
+        """
+        Écrit les rendus demandés dans `dossier` : {prefixe}_{table}{extension} par table,
+        {prefixe}.xlsx pour Excel, et le manifeste {prefixe}_schema.json.
+        Retourne (succès, message, liste des fichiers écrits).
+        """
+        import os
+        import json
+        try:
+            os.makedirs(dossier, exist_ok=True)
+            fichiers = []
+            for format_export in formats:
+                extension = RENDUS_EXPORT[format_export]["extension"] if format_export in RENDUS_EXPORT else ""
+                if format_export == "excel":
+                    chemin = os.path.join(dossier, f"{prefixe}{extension}")
+                    self.ecrire(format_export, chemin)
+                    fichiers.append(chemin)
+                    continue
+                for table in SCHEMA_EXPORT:
+                    chemin = os.path.join(dossier, f"{prefixe}_{table}{extension}")
+                    self.ecrire(format_export, chemin, table)
+                    fichiers.append(chemin)
+            chemin_manifeste = os.path.join(dossier, f"{prefixe}_schema.json")
+            with open(chemin_manifeste, "w", encoding="utf-8") as f:
+                json.dump(self.manifeste(), f, ensure_ascii=False, indent=2)
+            fichiers.append(chemin_manifeste)
+            return True, f"✅ Plan exporté ({', '.join(formats)}) : {len(fichiers)} fichier(s) dans {dossier}", fichiers
+        except Exception as e:
+            return False, f"❌ Erreur lors de l'export multi-format : {str(e)}", []
+
+    def vers_octets(self, format_export, prefixe="planning"):
+        """Rendu en mémoire pour un téléchargement : classeur .xlsx pour Excel, archive ZIP sinon."""
+        import io
+        import json
+        import zipfile
+        if format_export == "excel":
+            flux = io.BytesIO()
+            self.ecrire(format_export, flux)
+            return flux.getvalue()
+        extension = RENDUS_EXPORT[format_export]["extension"] if format_export in RENDUS_EXPORT else ""
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for table in SCHEMA_EXPORT:
+                flux = io.BytesIO()
+                self.ecrire(format_export, flux, table)
+                zf.writestr(f"{prefixe}_{table}{extension}", flux.getvalue())
+            zf.writestr(f"{prefixe}_schema.json", json.dumps(self.manifeste(), ensure_ascii=False, indent=2))
+        return archive.getvalue()
+
+
+# =====================================================
+# FEUILLES DE ROUTE PDF PAR CHAUFFEUR (POOL DE PROCESSUS)
+# =====================================================
+# Gabarit commun à toutes les feuilles de route (A4 portrait, mm) : une ligne par BL, arrêts dans l'ordre
+GABARIT_FEUILLE_ROUTE = {
+    "marge": 10,
+    "hauteur_ligne": 5,
+    "bas_de_page": 275,
+    "colonnes": [("Arrêt", 11), ("Client", 45), ("Ville", 28), ("Arrivée", 15), ("BL", 45), ("Poids (kg)", 21),
+                 ("Volume (m³)", 25)],
+}
+SEUIL_POOL_FEUILLES_ROUTE = 16   # en dessous, rendu dans le processus courant (démarrage du pool inutile)
+
+_GABARIT_PDF = None              # gabarit préparé une fois par processus
+_POOL_FEUILLES_ROUTE = None      # pool de processus réutilisé d'un export à l'autre
+
+
+def _initialiser_gabarit_pdf():
+    """Prépare une fois par processus FPDF, les métriques des polices (mises en cache par fpdf) et les en-têtes."""
+    global _GABARIT_PDF
+    if _GABARIT_PDF is None:
+        from fpdf import FPDF
+        pdf = FPDF()
+        for style in ("", "B"):
+            pdf.set_font("Arial", style, 8)
+        colonnes = GABARIT_FEUILLE_ROUTE["colonnes"]
+        _GABARIT_PDF = {
+            "FPDF": FPDF,
+            "entetes": [_texte_pdf(entete) for entete, _ in colonnes],
+            "largeurs": [largeur for _, largeur in colonnes],
+        }
+    return _GABARIT_PDF
+
+
+def _texte_pdf(valeur):
+    """Texte imprimable par les polices de base de FPDF (latin-1), vide pour les manquants."""
+    if valeur is None or (isinstance(valeur, float) and math.isnan(valeur)):
+        return ""
+    return str(valeur).encode("latin-1", "replace").decode("latin-1")
+
+
+def _ajuster_texte(pdf, texte, largeur):
+    """Tronque le texte pour qu'il tienne dans la cellule."""
+    if pdf.get_string_width(texte) <= largeur - 2:
+        return texte
+    while texte and pdf.get_string_width(texte + "..") > largeur - 2:
+        texte = texte[:-1]
+    return texte + ".."
+
+
+def _rendre_feuille_route(feuille):
+    """PDF (bytes) d'une feuille de route : en-tête chauffeur, puis un tableau d'arrêts par voyage."""
+    gabarit = _initialiser_gabarit_pdf()
+    largeurs, entetes = gabarit["largeurs"], gabarit["entetes"]
+    marge, hauteur, bas_de_page = (GABARIT_FEUILLE_ROUTE[cle] for cle in ("marge", "hauteur_ligne", "bas_de_page"))
+
+    pdf = gabarit["FPDF"](orientation="P", unit="mm", format="A4")
+    pdf.set_auto_page_break(False)
+    pdf.set_margins(marge, marge, marge)
+    pdf.add_page()
+
+    def entete_tableau():
+        pdf.set_font("Arial", "B", 8)
+        for entete, largeur in zip(entetes, largeurs):
+            pdf.cell(largeur, 6, entete, border=1, align="C")
+        pdf.ln()
+        pdf.set_font("Arial", "", 8)
+
+    pdf.set_font("Arial", "B", 14)
+    pdf.cell(0, 8, _texte_pdf(f"Feuille de route - {feuille['chauffeur']}"), ln=True, align="C")
+    pdf.set_font("Arial", "", 9)
+    pdf.cell(0, 5, _texte_pdf(feuille["sous_titre"]), ln=True, align="C")
+    pdf.ln(3)
+
+    for voyage in feuille["voyages"]:
+        if pdf.get_y() > bas_de_page - 25:
+            pdf.add_page()
+        pdf.set_font("Arial", "B", 10)
+        pdf.cell(0, 6, _texte_pdf(voyage["titre"]), ln=True)
+        pdf.set_font("Arial", "", 8)
+        pdf.cell(0, 5, _texte_pdf(voyage["resume"]), ln=True)
+        entete_tableau()
+        for ligne in voyage["lignes"]:
+            if pdf.get_y() > bas_de_page:
+                pdf.add_page()
+                entete_tableau()
+            for valeur, largeur in zip(ligne, largeurs):
+                pdf.cell(largeur, hauteur, _ajuster_texte(pdf, _texte_pdf(valeur), largeur), border=1, align="C")
+            pdf.ln()
+        pdf.ln(4)
+
+    # Zone d'émargement
+    if pdf.get_y() > bas_de_page - 15:
+        pdf.add_page()
+    pdf.ln(4)
+    pdf.set_font("Arial", "", 9)
+    pdf.cell(95, 6, "Signature chauffeur :", border="T")
+    pdf.cell(95, 6, "Visa expédition :", border="T", ln=True)
+    return pdf.output(dest="S").encode("latin-1")
+
+
+def _rendre_lot_feuilles(lot):
+    """Rend un lot de feuilles de route (tâche du pool) : [(nom du fichier, bytes)]."""
+    return [(nom_fichier, _rendre_feuille_route(feuille)) for nom_fichier, feuille in lot]
+
+
+def _pool_feuilles_route(max_workers):
+    """Pool de processus (spawn, sûr sous Streamlit) créé une fois puis réutilisé, gabarit préchargé."""
+    global _POOL_FEUILLES_ROUTE
+    if _POOL_FEUILLES_ROUTE is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _POOL_FEUILLES_ROUTE = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_initialiser_gabarit_pdf)
+    return _POOL_FEUILLES_ROUTE
+
+
+class RoadsheetGenerator:
+    """
+    Feuilles de route PDF, une par chauffeur (ou par véhicule à défaut) : ses voyages dans l'ordre
+    des tours, les arrêts dans l'ordre de passage (ordre de 'BL inclus'), BLs, clients, villes,
+    poids et volumes. Rendu parallèle dans un pool de processus, regroupé dans une archive ZIP.
+    """
+
+    def __init__(self, df_voyages, df_livraisons_original=None, df_tournees=None, max_workers=None, titre=""):
+        import os
+        self.df_voyages = df_voyages.reset_index(drop=True)
+        self.df_livraisons_original = df_livraisons_original
+        self.df_tournees = df_tournees
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.titre = titre
+
+    def _lignes_bls(self):
+        """Une ligne par BL du plan, avec son voyage (_pos), son numéro d'arrêt et ses informations."""
+        plan = self.df_voyages
+        bls = plan["BL inclus"].astype(object).where(plan["BL inclus"].notna(), "").map(str)
+        jetons = bls.str.split(r"[;\n]", regex=True).explode().str.strip()
+        jetons = jetons[jetons.ne("") & jetons.ne("nan")]
+        lignes = pd.DataFrame({"_pos": jetons.index.to_numpy(dtype=int), "BL": jetons.to_numpy()})
+        if self.df_livraisons_original is not None:
+            livraisons = _livraisons_par_bl(self.df_livraisons_original)
+            lignes["Client"] = lignes["BL"].map(livraisons["Client"])
+            lignes["Ville"] = lignes["BL"].map(_villes_par_bl(self.df_livraisons_original))
+            lignes["Poids"] = lignes["BL"].map(livraisons["Poids"])
+            lignes["Volume"] = lignes["BL"].map(livraisons["Volume"])
+        else:
+            lignes[["Client", "Ville", "Poids", "Volume"]] = None
+        lignes.loc[lignes["BL"].str.startswith("OBJ-"), "Client"] = "Objet manuel"
+        lignes["Client"] = lignes["Client"].fillna("Client inconnu")
+
+        # Arrêt = suite de BLs consécutifs d'un même client dans le voyage
+        nouveau = lignes["_pos"].ne(lignes["_pos"].shift()) | lignes["Client"].ne(lignes["Client"].shift())
+        lignes["Arrêt"] = nouveau.astype(int).groupby(lignes["_pos"]).cumsum()
+        lignes["Premier"] = nouveau
+
+        # Heure d'arrivée prévue quand la tournée horaire est connue
+        lignes["Arrivée"] = None
+        if self.df_tournees is not None and not self.df_tournees.empty and "Arrivée" in self.df_tournees.columns:
+            arrivees = self.df_tournees.drop_duplicates(["Zone", "Véhicule N°", "Client"]).set_index(
+                ["Zone", "Véhicule N°", "Client"])["Arrivée"]
+            cles = pd.MultiIndex.from_arrays([
+                plan["Zone"].astype(object).map(str).to_numpy()[lignes["_pos"]],
+                plan["Véhicule N°"].astype(object).map(str).to_numpy()[lignes["_pos"]],
+                lignes["Client"].to_numpy(),
+            ])
+            lignes["Arrivée"] = arrivees.reindex(cles).to_numpy()
+        return lignes
+
+    def feuilles(self):
+        """Contenu de chaque feuille de route : [(nom du fichier, dict sérialisable)], triées par chauffeur."""
+        plan = self.df_voyages
+        colonne = lambda nom: plan[nom] if nom in plan.columns else pd.Series(None, index=plan.index, dtype=object)
+        chauffeur = colonne("Chauffeur attribué").where(colonne("Chauffeur attribué").notna(), colonne("Chauffeur"))
+        vehicule_attribue = colonne("Véhicule attribué").where(colonne("Véhicule attribué").notna(), plan["Véhicule N°"])
+        matricule = colonne("Matricule chauffeur")
+        # Regroupement par chauffeur, à défaut par véhicule
+        cle = chauffeur.where(chauffeur.notna() & chauffeur.astype(str).str.strip().ne(""), "Véhicule " + vehicule_attribue.astype(str))
+        cle = cle.astype(str)
+        ordre_tour = pd.to_numeric(colonne("Tour N°"), errors="coerce").fillna(1)
+
+        lignes_par_voyage = {}
+        lignes = self._lignes_bls()
+        for pos, arret, premier, client, ville, arrivee, bl, poids, volume in zip(
+                lignes["_pos"].tolist(), lignes["Arrêt"].tolist(), lignes["Premier"].tolist(), lignes["Client"].tolist(),
+                lignes["Ville"].tolist(), lignes["Arrivée"].tolist(), lignes["BL"].tolist(),
+                lignes["Poids"].tolist(), lignes["Volume"].tolist()):
+            lignes_par_voyage.setdefault(pos, []).append((
+                arret if premier else "", client if premier else "", ville if premier else "",
+                arrivee if premier else "", bl,
+                f"{poids:.3f}" if poids is not None and not pd.isna(poids) else "",
+                f"{volume:.3f}" if volume is not None and not pd.isna(volume) else "",
+            ))
+
+        feuilles = {}
+        for pos in sorted(range(len(plan)), key=lambda p: (cle.iat[p], ordre_tour.iat[p], p)):
+            poids_charge = pd.to_numeric(plan["Poids total chargé"].iat[pos], errors="coerce") if "Poids total chargé" in plan.columns else None
+            volume_charge = pd.to_numeric(plan["Volume total chargé"].iat[pos], errors="coerce") if "Volume total chargé" in plan.columns else None
+            titre = " - ".join(_texte_pdf(v) for v in (
+                f"Voyage {colonne('Code voyage').iat[pos]}" if pd.notna(colonne("Code voyage").iat[pos]) else None,
+                f"Zone {plan['Zone'].iat[pos]}",
+                f"Véhicule {vehicule_attribue.iat[pos]}",
+                f"Tour {colonne('Tour N°').iat[pos]}" if pd.notna(colonne("Tour N°").iat[pos]) else None,
+                f"Départ {colonne('Heure départ').iat[pos]}" if pd.notna(colonne("Heure départ").iat[pos]) else None,
+            ) if v)
+            resume = (f"{len(lignes_par_voyage.get(pos, []))} BL(s) - "
+                      f"Poids : {poids_charge:.3f} kg - Volume : {volume_charge:.3f} m³"
+                      if poids_charge is not None and pd.notna(poids_charge) and volume_charge is not None and pd.notna(volume_charge)
+                      else f"{len(lignes_par_voyage.get(pos, []))} BL(s)")
+            nom = cle.iat[pos]
+            if nom not in feuilles:
+                identifiant = matricule.iat[pos] if pd.notna(matricule.iat[pos]) else ""
+                feuilles[nom] = {
+                    "chauffeur": f"{nom} ({identifiant})" if identifiant else nom,
+                    "sous_titre": self.titre,
+                    "voyages": [],
+                }
+            feuilles[nom]["voyages"].append({"titre": titre, "resume": resume, "lignes": lignes_par_voyage.get(pos, [])})
+
+        resultat = []
+        for nom, feuille in feuilles.items():
+            nom_fichier = "".join(c if c.isalnum() or c in "-_" else "_" for c in nom).strip("_") or "sans_nom"
+            resultat.append((f"Feuille_route_{nom_fichier}.pdf", feuille))
+        return resultat
+
+    def generer(self):
+        """PDF de chaque feuille de route : {nom du fichier: bytes}, en parallèle au-delà du seuil."""
+        feuilles = self.feuilles()
+        if len(feuilles) < SEUIL_POOL_FEUILLES_ROUTE or self.max_workers <= 1:
+            return dict(_rendre_lot_feuilles(feuilles))
+        # Lots de quelques feuilles : moins d'échanges entre processus qu'une tâche par feuille
+        taille_lot = max(1, math.ceil(len(feuilles) / (self.max_workers * 4)))
+        lots = [feuilles[i:i + taille_lot] for i in range(0, len(feuilles), taille_lot)]
+        try:
+            pool = _pool_feuilles_route(self.max_workers)
+            return dict(pdf for lot in pool.map(_rendre_lot_feuilles, lots) for pdf in lot)
+        except Exception as e:
+            # Pool indisponible (processus interdits, pool cassé) : rendu dans le processus courant
+            global _POOL_FEUILLES_ROUTE
+            print(f"⚠️ Pool de feuilles de route indisponible ({e}), rendu séquentiel")
+            _POOL_FEUILLES_ROUTE = None
+            return dict(_rendre_lot_feuilles(feuilles))
+
+    def generer_zip(self):
+        """Archive ZIP (bytes) de toutes les feuilles de route."""
+        import io
+        import zipfile
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for nom_fichier, contenu in self.generer().items():
+                zf.writestr(nom_fichier, contenu)
+        return archive.getvalue()
+
+
+def generer_feuilles_route_zip(df_voyages, df_livraisons_original=None, df_tournees=None, titre=""):
+    """Archive ZIP des feuilles de route par chauffeur (point d'entrée des exports en arrière-plan)."""
+    return RoadsheetGenerator(df_voyages, df_livraisons_original, df_tournees, titre=titre).generer_zip()
+
+
+# =====================================================
+# ARTEFACTS DE TÉLÉCHARGEMENT GÉNÉRÉS EN ARRIÈRE-PLAN
+# =====================================================
+def version_donnees(*donnees):
+    """
+    Empreinte sha256 du contenu des données d'un artefact : DataFrames/Series hachés par pandas
+    (valeurs, index, colonnes et types), autres objets par leur repr.
+    """
+    import hashlib
+    empreinte = hashlib.sha256()
+    for objet in donnees:
+        if isinstance(objet, (pd.DataFrame, pd.Series)):
+            entete = objet.dtypes.to_dict() if isinstance(objet, pd.DataFrame) else (objet.name, objet.dtype)
+            empreinte.update(repr(entete).encode())
+            try:
+                valeurs = pd.util.hash_pandas_object(objet, index=True)
+            except TypeError:
+                # Cellules non hachables (listes, dicts) : rendu texte
+                valeurs = pd.util.hash_pandas_object(objet.astype(str), index=True)
+            empreinte.update(valeurs.to_numpy().tobytes())
+        else:
+            empreinte.update(repr(objet).encode())
+    return empreinte.hexdigest()
+
+
+class ArtifactManager:
+    """
+    Artefacts de téléchargement (bytes) générés dans un thread de fond, mis en cache par
+    (nom, version des données). La génération n'est relancée que si les données changent ;
+    une nouvelle version d'un artefact remplace l'ancienne.
+    """
+
+    def __init__(self, max_workers=2):
+        import threading
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="artefacts")
+        self._verrou = threading.Lock()
+        self._artefacts = {}        # nom -> (version, Future)
+        self.generations = 0        # nombre de générations lancées (suivi / tests)
+
+    def preparer(self, nom, fonction, *donnees, version=None):
+        """
+        Lance `fonction(*donnees)` en arrière-plan si la version des données a changé (ou si la
+        génération précédente a échoué). Retourne un appelable sans argument, à passer tel quel
+        à `st.download_button(data=...)`, qui sert les bytes mis en cache.
+        """
+        version = version if version is not None else version_donnees(*donnees)
+        with self._verrou:
+            courant = self._artefacts.get(nom)
+            echec = courant is not None and courant[1].done() and courant[1].exception() is not None
+            if courant is None or courant[0] != version or echec:
+                # Instantané des données : la session peut les modifier pendant la génération
+                instantane = tuple(d.copy() if isinstance(d, (pd.DataFrame, pd.Series)) else d for d in donnees)
+                courant = (version, self._executor.submit(fonction, *instantane))
+                self._artefacts[nom] = courant
+                self.generations += 1
+        future = courant[1]
+        return lambda: future.result()
+
+    def etat(self, nom):
+        """État de la dernière version : 'absent', 'en cours', 'prêt' ou 'erreur'."""
+        with self._verrou:
+            courant = self._artefacts.get(nom)
+        if courant is None:
+            return "absent"
+        if not courant[1].done():
+            return "en cours"
+        return "erreur" if courant[1].exception() is not None else "prêt"
+
+    def obtenir(self, nom, timeout=None):
+        """Bytes de la dernière version de l'artefact (attend la fin de la génération), None si absent."""
+        with self._verrou:
+            courant = self._artefacts.get(nom)
+        return courant[1].result(timeout=timeout) if courant is not None else None
+
+    def fermer(self):
+        """Arrête le thread de fond (les générations non démarrées sont annulées)."""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# =====================================================
+# EXÉCUTION DES TRAITEMENTS LONGS EN ARRIÈRE-PLAN
+# =====================================================
+MAX_JOBS_CONSERVES = 50
+
+class TraitementAnnule(Exception):
+    """Levée à l'étape suivante d'un traitement dont l'annulation a été demandée."""
+
+
+def signaler_etape(progression, etape, avancement=None):
+    """Début d'une étape d'un traitement suivi (progression optionnelle, voir Job.signaler)."""
+    if progression is not None:
+        progression(etape, avancement)
+
+
+class Job:
+    """
+    Traitement long exécuté par un JobRunner : statut, étape courante, avancement (0 à 1),
+    résultat ou erreur. L'annulation est coopérative : elle prend effet à l'étape suivante.
+    """
+
+    STATUTS_FINAUX = ("terminé", "annulé", "erreur")
+
+    def __init__(self, libelle):
+        import threading
+        import uuid
+        self.id = uuid.uuid4().hex[:12]
+        self.libelle = libelle
+        self.statut = "en attente"
+        self.etape = "En attente d'un worker"
+        self.avancement = 0.0
+        self.etapes = []          # (étape, secondes depuis le début)
+        self.resultat = None
+        self.erreur = None
+        self.debut = None
+        self.fin = None
+        self._annulation = threading.Event()
+
+    def signaler(self, etape, avancement=None):
+        """Progression reportée par le traitement ; lève TraitementAnnule si l'annulation est demandée."""
+        if self._annulation.is_set():
+            raise TraitementAnnule(f"{self.libelle} annulé à l'étape « {etape} »")
+        self.etape = etape
+        if avancement is not None:
+            self.avancement = min(max(float(avancement), 0.0), 1.0)
+        self.etapes.append((etape, self.duree))
+
+    def annuler(self):
+        """Demande l'annulation ; un job encore en attente ne démarre pas."""
+        self._annulation.set()
+
+    @property
+    def annulation_demandee(self):
+        return self._annulation.is_set()
+
+    @property
+    def termine(self):
+        return self.statut in self.STATUTS_FINAUX
+
+    @property
+    def duree(self):
+        """Secondes écoulées depuis le démarrage (durée totale une fois terminé)."""
+        import time
+        if self.debut is None:
+            return 0.0
+        return (self.fin if self.fin is not None else time.perf_counter()) - self.debut
+
+
+class JobRunner:
+    """
+    Pool de threads pour les traitements longs (traitement complet, planification de l'horizon) :
+    la session Streamlit soumet le job puis suit son avancement sans bloquer ses reruns.
+    La fonction soumise reçoit `progression=job.signaler` ; son résultat reste dans job.resultat
+    jusqu'à ce que la session le récupère.
+    """
+
+    def __init__(self, max_workers=2, max_jobs=MAX_JOBS_CONSERVES):
+        import threading
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="traitements")
+        self._verrou = threading.Lock()
+        self._jobs = {}           # id -> Job, du plus ancien au plus récent
+        self.max_jobs = max_jobs
+
+    def soumettre(self, libelle, fonction, *args, **kwargs):
+        """Lance `fonction(*args, progression=job.signaler, **kwargs)` dans un worker ; retourne le Job."""
+        job = Job(libelle)
+        with self._verrou:
+            self._jobs[job.id] = job
+            termines = [j for j in self._jobs.values() if j.termine]
+            for ancien in termines[:max(0, len(self._jobs) - self.max_jobs)]:
+                del self._jobs[ancien.id]
+        self._executor.submit(self._executer, job, fonction, args, kwargs)
+        return job
+
+    @staticmethod
+    def _executer(job, fonction, args, kwargs):
+        import time
+        job.debut = time.perf_counter()
+        try:
+            if job.annulation_demandee:
+                raise TraitementAnnule(f"{job.libelle} annulé avant son démarrage")
+            job.statut = "en cours"
+            job.resultat = fonction(*args, progression=job.signaler, **kwargs)
+            job.statut = "terminé"
+            job.avancement = 1.0
+        except TraitementAnnule as e:
+            job.erreur = str(e)
+            job.statut = "annulé"
+        except Exception as e:
+            print(f"❌ Erreur dans le job « {job.libelle} » : {e}")
+            job.erreur = str(e)
+            job.statut = "erreur"
+        finally:
+            job.fin = time.perf_counter()
+
+    def job(self, id_job):
+        with self._verrou:
+            return self._jobs.get(id_job)
+
+    def annuler(self, id_job):
+        job = self.job(id_job)
+        if job is not None:
+            job.annuler()
+        return job is not None
+
+    def actifs(self):
+        """Jobs en attente ou en cours."""
+        with self._verrou:
+            return [job for job in self._jobs.values() if not job.termine]
+
+    def fermer(self):
+        """Annule les jobs en cours (à leur prochaine étape) et arrête le pool."""
+        for job in self.actifs():
+            job.annuler()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Pool unique du processus, partagé par les sessions (comme CACHE_TRAITEMENT)
+EXECUTEUR_TRAITEMENTS = JobRunner()
+
+
 # =====================================================
 # GARDEZ CETTE FONCTION INTACTE - NE PAS MODIFIER
 # =====================================================
-def verifier_integrite_donnees(df_voyages, df_livraisons_original):
+def verifier_integrite_donnees(df_voyages, df_livraisons_original, df_objets_manuels=None):
     """Vérifie l'intégrité des données entre les voyages optimisés et les données originales."""
     try:
         problèmes = []
         
-        # Vérifier que tous les BLs originaux sont présents dans les voyages
-        bls_originaux = set(df_livraisons_original["No livraison"].astype(str).unique())
-        bls_voyages = set()
-        
-        for bls in df_voyages["BL inclus"]:
-            if pd.notna(bls):
-                # EXCLURE les objets manuels des vérifications
-                bls_filtres = [bl for bl in str(bls).split(';') if not bl.startswith('OBJ-')]
-                bls_voyages.update(bls_filtres)
-        
-        bls_manquants = bls_originaux - bls_voyages
-        bls_ajoutes = bls_voyages - bls_originaux
-        
-        if bls_manquants:
-            problèmes.append(f"❌ BLs manquants dans les voyages : {len(bls_manquants)} BLs")
-        
-        if bls_ajoutes:
-            problèmes.append(f"⚠️ BLs supplémentaires dans les voyages : {len(bls_ajoutes)} BLs (objets manuels exclus)")
-        
-        # Vérifier la cohérence des poids et volumes (EXCLURE les objets manuels)
-        poids_total_originel = df_livraisons_original["Poids total"].sum()
-        volume_total_originel = df_livraisons_original["Volume total"].sum()
-        
-        # Calculer les totaux des voyages SANS les objets manuels
-        poids_total_voyages_sans_objets = 0
-        volume_total_voyages_sans_objets = 0
-        
-        for idx, row in df_voyages.iterrows():
-            bls = str(row.get("BL inclus", ""))
-            if pd.notna(bls):
-                # Identifier les objets manuels dans ce véhicule
-                objets_manuels = [bl for bl in bls.split(';') if bl.startswith('OBJ-')]
-                
-                if objets_manuels:
-                    # Estimer le poids/volume des objets manuels (approximatif)
-                    # Ou simplement utiliser les valeurs actuelles comme référence
-                    pass
-            
-            # Pour simplifier, utilisons les données originales comme référence
-            poids_total_voyages_sans_objets += row.get("Poids total chargé", 0)
-            volume_total_voyages_sans_objets += row.get("Volume total chargé", 0)
-        
-        # Ajuster pour les objets manuels (estimation)
-        # Pour l'instant, utilisons une comparaison directe avec un message explicatif
-        
-        poids_total_voyages = df_voyages["Poids total chargé"].sum()
-        volume_total_voyages = df_voyages["Volume total chargé"].sum()
-        
-        # Vérifier les écarts avec tolérance
-        tolerance = 0.01  # 1%
+        # Couverture des BLs et totaux exacts (objets manuels valorisés à part)
+        reconciliation = reconcilier_donnees(df_voyages, df_livraisons_original, df_objets_manuels)
+        if "erreur" in reconciliation:
+            return reconciliation["erreur"]
+        totaux = reconciliation["totaux"]
         
-        ecart_poids = abs(poids_total_originel - poids_total_voyages) / poids_total_originel
-        ecart_volume = abs(volume_total_originel - volume_total_voyages) / volume_total_originel
+        if reconciliation["bls_manquants"]:
+            problèmes.append(f"❌ BLs manquants dans les voyages : {len(reconciliation['bls_manquants'])} BLs")
         
-        if ecart_poids > tolerance:
-            problèmes.append(
-                f"⚠️ Écart de poids : Original {poids_total_originel:.1f}kg vs "
-                f"Voyages {poids_total_voyages:.1f}kg (diff: {poids_total_voyages-poids_total_originel:.1f}kg)"
-            )
+        if reconciliation["bls_ajoutes"]:
+            problèmes.append(f"⚠️ BLs supplémentaires dans les voyages : {len(reconciliation['bls_ajoutes'])} BLs (objets manuels exclus)")
         
-        if ecart_volume > tolerance:
-            problèmes.append(
-                f"⚠️ Écart de volume : Original {volume_total_originel:.3f}m³ vs "
-                f"Voyages {volume_total_voyages:.3f}m³ (diff: {volume_total_voyages-volume_total_originel:.3f}m³)"
-            )
+        # Vérifier les écarts avec tolérance (règles "integrite"), objets manuels déduits
+        poids_total_originel = totaux["poids_original"]
+        volume_total_originel = totaux["volume_original"]
+        poids_total_voyages = totaux["poids_voyages_hors_objets"]
+        volume_total_voyages = totaux["volume_voyages_hors_objets"]
+        contexte_plan = pd.DataFrame([{
+            "poids_original": poids_total_originel,
+            "poids_voyages": poids_total_voyages,
+            "diff_poids": poids_total_voyages - poids_total_originel,
+            "ecart_poids": abs(poids_total_originel - poids_total_voyages) / poids_total_originel,
+            "volume_original": volume_total_originel,
+            "volume_voyages": volume_total_voyages,
+            "diff_volume": volume_total_voyages - volume_total_originel,
+            "ecart_volume": abs(volume_total_originel - volume_total_voyages) / volume_total_originel,
+        }])
+        problèmes.extend(MOTEUR_REGLES.evaluer(contexte_plan, "plan", blocs=["integrite"])["Message"].tolist())
         
         # Ajouter une note sur les objets manuels
-        objets_count = sum(1 for bls in df_voyages["BL inclus"] if 'OBJ-' in str(bls))
-        if objets_count > 0:
-            problèmes.append(f"📦 Note : {objets_count} objet(s) manuel(s) inclus dans la planification")
+        if totaux["nb_objets"] > 0:
+            note = f"📦 Note : {totaux['nb_objets']} objet(s) manuel(s) inclus dans la planification"
+            if totaux["nb_objets_non_suivis"] > 0:
+                note += f" (dont {totaux['nb_objets_non_suivis']} non suivi(s), poids/volume estimés par différence)"
+            problèmes.append(note)
         
         if not problèmes:
             return "✅ Intégrité des données vérifiée - Aucun problème détecté"
@@ -1705,7 +5420,7 @@ if __name__ == "__main__":
     rapport = validateur.validate_voyages()
     print("Rapport de validation :")
     print(rapport)
-    
+
     # Test de l'ajout d'objet manuel
     transfer_manager = TruckTransferManager(df_test, pd.DataFrame())
     success, message, df_updated = transfer_manager.add_manual_object(
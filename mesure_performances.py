@@ -0,0 +1,212 @@
+"""
+Mesure reproductible des traitements du backend sur des plans synthétiques.
+
+  - validation : VoyageValidator.validate_voyages de backend.py comparé à celui d'une
+    révision git de référence (par défaut le premier commit du dépôt), rapports comparés ;
+  - export : exporter_planning_excel (durée, pic mémoire Python, taille du fichier) ;
+  - villes : villes exportées identiques pour un plan et le même plan réordonné (cache des villes).
+
+Utilisation :
+    python mesure_performances.py validation
+    python mesure_performances.py validation --vehicules 10000 --reference HEAD~5
+    python mesure_performances.py export --tailles 1000 10000 50000
+    python mesure_performances.py villes
+"""
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import backend
+
+DOSSIER = os.path.dirname(os.path.abspath(__file__))
+
+
+# =====================================================
+# BACKEND DE RÉFÉRENCE (RÉVISION GIT)
+# =====================================================
+def revision_initiale():
+    """Premier commit du dépôt."""
+    return subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=DOSSIER,
+                          capture_output=True, text=True, check=True).stdout.split()[0]
+
+
+def charger_backend(revision):
+    """Module backend.py tel qu'il était à la révision git donnée."""
+    source = subprocess.run(["git", "show", f"{revision}:backend.py"], cwd=DOSSIER,
+                            capture_output=True, text=True, check=True).stdout
+    chemin = os.path.join(tempfile.mkdtemp(), "backend_reference.py")
+    with open(chemin, "w", encoding="utf-8") as fichier:
+        fichier.write(source)
+    spec = importlib.util.spec_from_file_location("backend_reference", chemin)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# =====================================================
+# VALIDATION DES VOYAGES
+# =====================================================
+def plan_synthetique(nb_vehicules, graine=0):
+    """Plan de `nb_vehicules` véhicules : BLs dupliqués, objets manuels, dépassements et camions loués."""
+    rng = np.random.default_rng(graine)
+    n = nb_vehicules
+    bls = [";".join(f"BL{rng.integers(0, n * 3)}" for _ in range(rng.integers(0, 6))) for _ in range(n)]
+    bls = [b + ";OBJ-Palette" if rng.random() < 0.05 else b for b in bls]
+    return pd.DataFrame({
+        'Zone': [f"Zone {z}" for z in rng.integers(1, 8, n)],
+        'Véhicule N°': [f"E{i}" for i in range(n)],
+        'Poids total chargé': rng.uniform(0, 6000, n),
+        'Volume total chargé': rng.uniform(0, 25, n),
+        'Client(s) inclus': np.where(rng.random(n) < 0.03, '', 'C1, C2').astype(object),
+        'BL inclus': bls,
+        'Code Véhicule': np.where(rng.random(n) < 0.1, backend.CAMION_CODE, "ESTAFETTE"),
+        "Taux d'occupation (%)": rng.uniform(0, 130, n),
+        'Type_Camion': np.where(rng.random(n) < 0.5, '5 tonnes', '10 tonnes'),
+    })
+
+
+def mesurer_validation(reference, nb_vehicules, graine=0):
+    """(temps référence s, temps actuel s, rapports identiques) sur un même plan synthétique."""
+    df_plan = plan_synthetique(nb_vehicules, graine)
+    resultats = []
+    for module in (reference, backend):
+        validateur = module.VoyageValidator(df_plan)
+        debut = time.perf_counter()
+        rapport = validateur.validate_voyages()
+        resultats.append((time.perf_counter() - debut, rapport))
+    (temps_ref, rapport_ref), (temps, rapport) = resultats
+    return temps_ref, temps, rapport_ref.equals(rapport)
+
+
+# =====================================================
+# EXPORT EXCEL DU PLANNING
+# =====================================================
+def mesurer_export_excel(tailles=(1000, 10000, 50000), graine=0):
+    """
+    Mesure exporter_planning_excel sur des plans synthétiques.
+    Retourne un DataFrame : Voyages, Moteur, Durée (s), Pic mémoire Python (Mo), Taille fichier (Mo).
+    """
+    moteur = "xlsxwriter" if importlib.util.find_spec("xlsxwriter") is not None else "openpyxl"
+    rng = np.random.default_rng(graine)
+    resultats = []
+    for n in tailles:
+        df_plan = pd.DataFrame({
+            "Code voyage": [f"V{i:06d}" for i in range(n)],
+            "Zone": [f"Zone {z}" for z in rng.integers(1, 8, n)],
+            "Véhicule N°": [f"E{i}" for i in range(n)],
+            "Chauffeur": "À attribuer",
+            "BL inclus": [";".join(f"BL{b}" for b in rng.integers(0, 10 * n, rng.integers(1, 6))) for _ in range(n)],
+            "Client(s) inclus": [", ".join(f"C{c}" for c in rng.integers(0, n, rng.integers(1, 4))) for _ in range(n)],
+            "Représentant(s) inclus": "R1",
+            "Poids total chargé": rng.uniform(0, 1500, n),
+            "Volume total chargé": rng.uniform(0, 4.5, n),
+            "Taux d'occupation (%)": rng.uniform(0, 100, n),
+            "Code Véhicule": np.where(rng.random(n) < 0.1, backend.CAMION_CODE, "ESTAFETTE"),
+            "Type_Camion": "5 tonnes",
+            "Ville": "Sfax",
+        })
+        with tempfile.TemporaryDirectory() as dossier:
+            chemin = os.path.join(dossier, "benchmark.xlsx")
+            # Durée mesurée sans traçage, pic mémoire sur une seconde exécution tracée
+            debut = time.perf_counter()
+            succes, message = backend.exporter_planning_excel(df_plan, chemin)
+            duree = time.perf_counter() - debut
+            if not succes:
+                raise RuntimeError(message)
+            tracemalloc.start()
+            backend.exporter_planning_excel(df_plan, chemin)
+            pic = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            resultats.append({
+                "Voyages": n,
+                "Moteur": moteur,
+                "Durée (s)": round(duree, 2),
+                "Pic mémoire Python (Mo)": round(pic / 1e6, 1),
+                "Taille fichier (Mo)": round(os.path.getsize(chemin) / 1e6, 2),
+            })
+    return pd.DataFrame(resultats)
+
+
+# =====================================================
+# VILLES EXPORTÉES D'UN PLAN RÉORDONNÉ
+# =====================================================
+def verifier_villes_plan_reordonne(nb_vehicules=200, graine=0):
+    """
+    Exporte un plan puis le même plan en ordre inverse (cache des villes déjà rempli) et relit
+    la colonne Ville de chaque export. Retourne les véhicules dont la ville diffère (vide si cohérent).
+    """
+    rng = np.random.default_rng(graine)
+    villes = np.array(["SFAX", "TUNIS", "ARIANA", "BEN AROUS", "BIZERTE", "JENDOUBA"], dtype=object)
+    nb_bls = nb_vehicules * 3
+    df_livraisons = pd.DataFrame({
+        "No livraison": [f"BL{i}" for i in range(nb_bls)],
+        "Ville": villes[rng.integers(0, len(villes), nb_bls)],
+    })
+    df_plan = pd.DataFrame({
+        "Zone": [f"Zone {z}" for z in rng.integers(1, 8, nb_vehicules)],
+        "Véhicule N°": [f"E{i}" for i in range(nb_vehicules)],
+        "BL inclus": [";".join(f"BL{b}" for b in rng.integers(0, nb_bls, rng.integers(0, 5)))
+                      for _ in range(nb_vehicules)],
+        "Client(s) inclus": "C1",
+        "Poids total chargé": rng.uniform(0, 1500, nb_vehicules),
+        "Volume total chargé": rng.uniform(0, 4.5, nb_vehicules),
+        "Taux d'occupation (%)": rng.uniform(0, 100, nb_vehicules),
+        "Code Véhicule": "ESTAFETTE",
+    })
+    exports = []
+    with tempfile.TemporaryDirectory() as dossier:
+        for i, plan in enumerate((df_plan, df_plan.iloc[::-1])):
+            chemin = os.path.join(dossier, f"villes_{i}.xlsx")
+            succes, message = backend.exporter_planning_excel(plan, chemin, df_livraisons_original=df_livraisons)
+            if not succes:
+                raise RuntimeError(message)
+            feuille = pd.read_excel(chemin, sheet_name="Planning Livraisons", dtype=str, keep_default_na=False)
+            exports.append(feuille.set_index("Véhicule N°")["Ville"])
+    direct, inverse = exports
+    inverse = inverse.reindex(direct.index)
+    return direct.index[direct.ne(inverse)].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Performances du backend de planification")
+    mesures = parser.add_subparsers(dest="mesure", required=True)
+    validation = mesures.add_parser("validation", help="validation des voyages, comparée à une révision git")
+    validation.add_argument("--vehicules", type=int, default=10000)
+    validation.add_argument("--reference", default=None, help="révision git de référence (premier commit par défaut)")
+    validation.add_argument("--graine", type=int, default=0)
+    export = mesures.add_parser("export", help="export Excel du planning")
+    export.add_argument("--tailles", type=int, nargs="+", default=[1000, 10000, 50000], help="nombres de voyages")
+    export.add_argument("--graine", type=int, default=0)
+    villes = mesures.add_parser("villes", help="villes exportées d'un plan réordonné")
+    villes.add_argument("--vehicules", type=int, default=200)
+    villes.add_argument("--graine", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.mesure == "validation":
+        revision = args.reference or revision_initiale()
+        temps_ref, temps, identiques = mesurer_validation(charger_backend(revision), args.vehicules, args.graine)
+        print(f"📏 Validation de {args.vehicules} véhicules")
+        print(f"{'Référence (' + revision[:10] + ')':<26}{temps_ref:>10.3f}s")
+        print(f"{'Actuel':<26}{temps:>10.3f}s{temps_ref / temps:>9.1f}x")
+        print(f"Rapports identiques : {'✅ oui' if identiques else '❌ non'}")
+    elif args.mesure == "export":
+        print("📏 Export Excel du planning")
+        print(mesurer_export_excel(args.tailles, args.graine).to_string(index=False))
+    elif args.mesure == "villes":
+        differences = verifier_villes_plan_reordonne(args.vehicules, args.graine)
+        if differences:
+            print(f"❌ Villes différentes après réordonnancement : {', '.join(differences[:10])}")
+            sys.exit(1)
+        print(f"✅ Villes identiques pour {args.vehicules} véhicules réordonnés")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Mesure reproductible de la latence des reruns de app.py.
+
+Pour chaque interaction (onglet de l'analyse, client de location, zone de transfert,
+validation d'un voyage, filtre de la grille d'attribution), le script mesure :
+  - le rerun complet du script, ce que coûtait chaque interaction avant les fragments ;
+  - la durée du fragment de la section concernée (st.session_state.durees_sections),
+    seule partie ré-exécutée par Streamlit depuis le passage en st.fragment.
+
+Utilisation :
+    python mesure_reruns.py
+    python mesure_reruns.py --repetitions 5 --app ancienne_version_app.py
+"""
+import argparse
+import os
+import statistics
+import time
+
+from streamlit.testing.v1 import AppTest
+
+from backend import DeliveryProcessor, TruckRentalProcessor
+
+DOSSIER = os.path.dirname(os.path.abspath(__file__))
+FICHIERS_EXEMPLE = (
+    os.path.join(DOSSIER, "Inputs", "F1758623552711_LIV.xlsx"),
+    os.path.join(DOSSIER, "Inputs", "F1758008320774_YDLOGIST.xlsx"),
+    os.path.join(DOSSIER, "Inputs", "F1758721675866_WCLIEGPS.xlsx"),
+)
+
+
+# =====================================================
+# PRÉPARATION DE LA SESSION
+# =====================================================
+def preparer_session(chemin_app, fichiers):
+    """AppTest de l'application avec les données traitées et tous les voyages validés."""
+    processor = DeliveryProcessor()
+    df_grouped, df_city, df_grouped_zone, df_zone, df_optimized, df_original = \
+        processor.process_delivery_data(*fichiers)
+
+    at = AppTest.from_file(chemin_app, default_timeout=600)
+    ss = at.session_state
+    ss.data_processed = True
+    ss.df_grouped = df_grouped
+    ss.df_city = df_city
+    ss.df_grouped_zone = df_grouped_zone
+    ss.df_zone = df_zone
+    ss.df_optimized_estafettes = df_optimized
+    ss.df_livraisons_original = df_original
+    ss.rental_processor = TruckRentalProcessor(df_optimized, df_original)
+    ss.propositions = ss.rental_processor.detecter_propositions()
+    ss.selected_client = None
+    ss.message = ""
+    ss.df_voyages = None
+    ss.df_livraisons = df_grouped_zone
+    ss.df_clients_gps = getattr(processor, "df_clients_gps", None)
+    ss.dates_bl = getattr(processor, "dates_bl", None)
+    at.run()
+
+    # Tous les voyages validés : la section d'attribution est affichée
+    ss.df_voyages_valides = ss.df_voyages.copy()
+    at.run()
+    at.checkbox(key="attribution_manuelle_complete").check()
+    at.run()
+    return at
+
+
+# =====================================================
+# INTERACTIONS MESURÉES
+# =====================================================
+def _selectbox(at, libelle):
+    return next(s for s in at.selectbox if s.label.startswith(libelle))
+
+
+def _autre_option(widget):
+    """Première option différente de la valeur actuelle du widget."""
+    return next(option for option in widget.options if option != widget.value)
+
+
+def changer_onglet_analyse(at):
+    onglet = at.session_state["onglets_analyse"] if "onglets_analyse" in at.session_state else None
+    at.session_state["onglets_analyse"] = "Livraisons Client/Ville" if onglet == "Graphiques" else "Graphiques"
+
+
+def choisir_client(at):
+    widget = at.selectbox(key="client_select")
+    widget.select(_autre_option(widget))
+
+
+def choisir_zone(at):
+    widget = _selectbox(at, "🌍 Sélectionner une zone")
+    widget.select(_autre_option(widget))
+
+
+def valider_voyage(at):
+    next(b for b in at.button if b.label.startswith("✅ Valider")).click()
+
+
+def filtrer_zone_attribution(at):
+    widget = at.multiselect(key="attribution_zones")
+    widget.set_value([next(zone for zone in widget.options if zone not in widget.value)])
+
+
+INTERACTIONS = [
+    ("section_analyse", "Onglet de l'analyse", changer_onglet_analyse),
+    ("section_location", "Client à traiter", choisir_client),
+    ("section_transfert", "Zone du transfert", choisir_zone),
+    ("section_validation", "Validation d'un voyage", valider_voyage),
+    ("section_attribution", "Zone de la grille", filtrer_zone_attribution),
+]
+
+
+def mesurer(at, repetitions):
+    """Médianes (rerun complet, rerun du fragment) en secondes pour chaque interaction."""
+    resultats = []
+    for section, libelle, interaction in INTERACTIONS:
+        complets, fragments = [], []
+        for _ in range(repetitions):
+            interaction(at)
+            debut = time.perf_counter()
+            at.run()
+            complets.append(time.perf_counter() - debut)
+            if at.exception:
+                raise RuntimeError(f"{libelle} : {at.exception[0].value}")
+            durees = at.session_state["durees_sections"] if "durees_sections" in at.session_state else {}
+            if section in durees:
+                fragments.append(durees[section])
+        resultats.append((libelle, statistics.median(complets),
+                          statistics.median(fragments) if fragments else None))
+    return resultats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latence des reruns de l'application de planification")
+    parser.add_argument("--app", default=os.path.join(DOSSIER, "app.py"), help="script Streamlit à mesurer")
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--fichiers", nargs=3, default=FICHIERS_EXEMPLE,
+                        metavar=("LIVRAISONS", "YDLOGIST", "WCLIEGPS"))
+    args = parser.parse_args()
+
+    os.chdir(DOSSIER)
+    at = preparer_session(os.path.abspath(args.app), args.fichiers)
+    print(f"📏 {args.app} — médiane sur {args.repetitions} répétition(s)")
+    print(f"{'Interaction':<26}{'Rerun complet':>16}{'Rerun fragment':>17}{'Gain':>8}")
+    for libelle, complet, fragment in mesurer(at, args.repetitions):
+        if fragment is None:
+            print(f"{libelle:<26}{complet:>15.3f}s{'—':>17}{'—':>8}")
+        else:
+            print(f"{libelle:<26}{complet:>15.3f}s{fragment:>16.3f}s{complet / fragment:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()